@@ -0,0 +1,26 @@
+# Generated by Django 5.1.7 on 2026-10-19 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corridas', '0005_alter_mensagemchat_data_envio_and_more'),
+        ('usuarios', '0007_motorista_motorista_disponivel_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='corrida',
+            index=models.Index(fields=['motorista', 'status'], name='corrida_motorista_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='corrida',
+            index=models.Index(fields=['passageiro', 'status'], name='corrida_passageiro_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='corrida',
+            index=models.Index(condition=models.Q(('status', 'PENDENTE')), fields=['data_solicitacao'], name='corrida_pendente_idx'),
+        ),
+    ]
@@ -80,6 +80,13 @@ class Corrida(models.Model):
         verbose_name = 'Corrida'
         verbose_name_plural = 'Corridas'
         ordering = ['-data_solicitacao']
+        indexes = [
+            # Corrida ativa do motorista / do passageiro (filtro por status__in)
+            models.Index(fields=['motorista', 'status'], name='corrida_motorista_status_idx'),
+            models.Index(fields=['passageiro', 'status'], name='corrida_passageiro_status_idx'),
+            # Varredura das corridas pendentes: índice parcial, só com as poucas corridas PENDENTE
+            models.Index(fields=['data_solicitacao'], condition=models.Q(status='PENDENTE'), name='corrida_pendente_idx'),
+        ]
     
     def __str__(self):
         motorista_nome = self.motorista.usuario.get_full_name() if self.motorista else "Não atribuído"
@@ -1,8 +1,14 @@
 import multiprocessing
+import os
 
 # Configurações do Gunicorn
 bind = "0.0.0.0:8000"
-workers = multiprocessing.cpu_count() * 2 + 1
+# Mais de um worker exige um channel layer compartilhado (CHANNEL_REDIS_HOSTS, ver
+# movex/settings.py); sem ele, cada worker só entrega mensagens às suas conexões
+if os.environ.get('CHANNEL_REDIS_HOSTS'):
+    workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+else:
+    workers = 1
 worker_class = "uvicorn.workers.UvicornWorker"  # Usar worker ASGI do Uvicorn
 timeout = 120
 keepalive = 5
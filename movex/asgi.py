@@ -29,13 +29,16 @@ for url_pattern in resolver.url_patterns:
 
 # Importar as rotas de websocket após a configuração do Django
 from movex.routing import websocket_urlpatterns
+from movex.middleware import TokenAuthMiddleware
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,  # Apenas o ASGI padrão para HTTP
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(
-            URLRouter(
-                websocket_urlpatterns
+            TokenAuthMiddleware(
+                URLRouter(
+                    websocket_urlpatterns
+                )
             )
         )
     ),
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def codificar_json(dados):
+    """
+    Serializa uma mensagem para o WebSocket, com orjson quando disponível.
+
+    Returns:
+        str: texto JSON pronto para `send(text_data=...)`
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(dados).decode('utf-8')
+        except TypeError:
+            # Tipos que o orjson não aceita (ex.: chaves não-string): usa o json padrão
+            pass
+    return json.dumps(dados)
+
+
+async def difundir_para_grupos(channel_layer, grupos, tipo_evento, mensagem):
+    """
+    Envia a mesma mensagem a vários grupos serializando-a uma única vez.
+
+    O evento leva o texto já codificado em `texto`; o handler `tipo_evento` do
+    consumer o repassa direto ao socket, sem montar nem serializar de novo.
+
+    Args:
+        channel_layer: camada de canais do consumer
+        grupos: nomes dos grupos destinatários
+        tipo_evento: handler do consumer que recebe o evento
+        mensagem: dict no formato final enviado ao cliente
+
+    Returns:
+        int: quantidade de grupos para os quais o envio funcionou
+    """
+    grupos = list(grupos)
+    if not grupos:
+        return 0
+    evento = {'type': tipo_evento, 'texto': codificar_json(mensagem)}
+    resultados = await asyncio.gather(
+        *(channel_layer.group_send(grupo, evento) for grupo in grupos),
+        return_exceptions=True
+    )
+    enviados = 0
+    for grupo, resultado in zip(grupos, resultados):
+        if isinstance(resultado, Exception):
+            logger.error(f"Erro ao enviar {tipo_evento} para o grupo {grupo}: {str(resultado)}")
+        else:
+            enviados += 1
+    return enviados
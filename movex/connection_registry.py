@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover - redis é dependência do channels_redis
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+# Identifica este processo nas contagens por worker
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class RegistroConexoesMemoria:
+    """
+    Registro de conexões WebSocket em memória, para um único processo
+    (desenvolvimento e testes). Mesma interface do registro em Redis.
+
+    Cada entrada expira se não for renovada em `ttl` segundos, de modo que
+    conexões de um worker que morreu deixam de contar para o limite do usuário.
+    """
+
+    def __init__(self, ttl=120, relogio=time.time):
+        self.ttl = ttl
+        self._relogio = relogio
+        self._conexoes = {}  # connection_id -> {cpf, worker, canal, registrada_em, expira_em}
+        self._lock = threading.Lock()
+
+    def _remover_expiradas(self, agora):
+        expiradas = [cid for cid, conexao in self._conexoes.items() if conexao['expira_em'] <= agora]
+        for connection_id in expiradas:
+            del self._conexoes[connection_id]
+
+    async def registrar(self, cpf, connection_id, canal, limite, worker=WORKER_ID):
+        """
+        Registra a conexão e, de forma atômica, remove as mais antigas do usuário
+        além de `limite`.
+
+        Returns:
+            list: tuplas (connection_id, canal) das conexões removidas
+        """
+        with self._lock:
+            agora = self._relogio()
+            self._remover_expiradas(agora)
+            self._conexoes[connection_id] = {
+                'cpf': cpf, 'worker': worker, 'canal': canal,
+                'registrada_em': agora, 'expira_em': agora + self.ttl,
+            }
+            do_usuario = sorted(
+                (conexao['registrada_em'], cid) for cid, conexao in self._conexoes.items() if conexao['cpf'] == cpf
+            )
+            removidas = []
+            for _, cid in do_usuario[:max(len(do_usuario) - limite, 0)]:
+                removidas.append((cid, self._conexoes.pop(cid)['canal']))
+            return removidas
+
+    async def renovar(self, cpf, connection_id, worker=WORKER_ID):
+        """Returns: False se a conexão não está mais registrada (expirou ou foi removida)"""
+        with self._lock:
+            conexao = self._conexoes.get(connection_id)
+            if conexao is None or conexao['expira_em'] <= self._relogio():
+                self._conexoes.pop(connection_id, None)
+                return False
+            conexao['expira_em'] = self._relogio() + self.ttl
+            return True
+
+    async def remover(self, cpf, connection_id, worker=WORKER_ID):
+        with self._lock:
+            self._conexoes.pop(connection_id, None)
+
+    async def conexoes_usuario(self, cpf):
+        with self._lock:
+            self._remover_expiradas(self._relogio())
+            return sum(1 for conexao in self._conexoes.values() if conexao['cpf'] == cpf)
+
+    async def conexoes_por_worker(self):
+        with self._lock:
+            self._remover_expiradas(self._relogio())
+            contagem = {}
+            for conexao in self._conexoes.values():
+                contagem[conexao['worker']] = contagem.get(conexao['worker'], 0) + 1
+            return contagem
+
+    async def canais_ativos(self):
+        """Nomes de canal de todas as conexões registradas e não expiradas."""
+        with self._lock:
+            self._remover_expiradas(self._relogio())
+            return {conexao['canal'] for conexao in self._conexoes.values()}
+
+    async def adquirir_lock(self, nome, ttl):
+        # Um único processo: não há outro worker com quem disputar
+        return True
+
+
+# KEYS[1] = conexões do usuário (zset id -> registro), KEYS[2] = conexões do worker
+# ARGV: prefixo, connection_id, agora, ttl, limite, worker, canal, cpf
+SCRIPT_REGISTRAR = """
+local prefixo = ARGV[1]
+local usuario = KEYS[1]
+local id = ARGV[2]
+local ttl = tonumber(ARGV[4])
+for _, membro in ipairs(redis.call('ZRANGE', usuario, 0, -1)) do
+    if redis.call('EXISTS', prefixo .. 'conexao:' .. membro) == 0 then
+        redis.call('ZREM', usuario, membro)
+    end
+end
+redis.call('ZADD', usuario, ARGV[3], id)
+redis.call('EXPIRE', usuario, ttl)
+redis.call('HSET', prefixo .. 'conexao:' .. id, 'cpf', ARGV[8], 'worker', ARGV[6], 'canal', ARGV[7])
+redis.call('EXPIRE', prefixo .. 'conexao:' .. id, ttl)
+redis.call('ZADD', KEYS[2], ARGV[3], id)
+redis.call('EXPIRE', KEYS[2], ttl)
+local removidas = {}
+local excesso = redis.call('ZCARD', usuario) - tonumber(ARGV[5])
+if excesso > 0 then
+    for _, membro in ipairs(redis.call('ZRANGE', usuario, 0, excesso - 1)) do
+        local chave = prefixo .. 'conexao:' .. membro
+        local dados = redis.call('HMGET', chave, 'worker', 'canal')
+        redis.call('ZREM', usuario, membro)
+        redis.call('DEL', chave)
+        if dados[1] then
+            redis.call('ZREM', prefixo .. 'worker:' .. dados[1], membro)
+        end
+        table.insert(removidas, membro)
+        table.insert(removidas, dados[2] or '')
+    end
+end
+return removidas
+"""
+
+# KEYS[1] = zset de conexões (usuário ou worker); ARGV[1] = prefixo
+SCRIPT_CONTAR = """
+local vivas = 0
+for _, membro in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    if redis.call('EXISTS', ARGV[1] .. 'conexao:' .. membro) == 1 then
+        vivas = vivas + 1
+    else
+        redis.call('ZREM', KEYS[1], membro)
+    end
+end
+return vivas
+"""
+
+
+class RegistroConexoesRedis:
+    """
+    Registro de conexões WebSocket compartilhado entre workers e servidores.
+
+    Chaves (com `prefixo`):
+        usuario:<cpf>   zset connection_id -> momento do registro
+        worker:<id>     zset das conexões de cada worker
+        conexao:<id>    hash com cpf, worker e canal, com TTL renovado pelo worker
+    """
+
+    def __init__(self, url=None, cliente=None, prefixo='movex:conexoes:', ttl=120):
+        self.url = url
+        self.prefixo = prefixo
+        self.ttl = ttl
+        self._cliente = cliente
+        self._cliente_fixo = cliente is not None
+        self._cliente_loop = None
+
+    async def _obter_cliente(self):
+        """Cliente Redis do loop atual (conexões redis.asyncio não podem mudar de loop)."""
+        if self._cliente_fixo:
+            return self._cliente
+        loop = asyncio.get_running_loop()
+        if self._cliente is not None and self._cliente_loop is not loop:
+            await self._fechar_cliente_de_outro_loop()
+        if self._cliente is None:
+            self._cliente = aioredis.Redis.from_url(self.url)
+            self._cliente_loop = loop
+        return self._cliente
+
+    async def _fechar_cliente_de_outro_loop(self):
+        # Ex.: async_to_sync cria um loop por chamada; o pool antigo não pode ser reaproveitado
+        cliente, loop_anterior = self._cliente, self._cliente_loop
+        self._cliente = None
+        self._cliente_loop = None
+        if loop_anterior.is_running():
+            # As conexões pertencem ao outro loop: fecha lá
+            asyncio.run_coroutine_threadsafe(cliente.aclose(), loop_anterior)
+            return
+        try:
+            await cliente.aclose()
+        except Exception as e:
+            logger.debug(f"Erro ao fechar cliente Redis de um loop encerrado: {str(e)}")
+
+    def _chave_usuario(self, cpf):
+        return f"{self.prefixo}usuario:{cpf}"
+
+    def _chave_worker(self, worker):
+        return f"{self.prefixo}worker:{worker}"
+
+    def _chave_conexao(self, connection_id):
+        return f"{self.prefixo}conexao:{connection_id}"
+
+    async def registrar(self, cpf, connection_id, canal, limite, worker=WORKER_ID):
+        resultado = await (await self._obter_cliente()).eval(
+            SCRIPT_REGISTRAR, 2, self._chave_usuario(cpf), self._chave_worker(worker),
+            self.prefixo, connection_id, time.time(), self.ttl, limite, worker, canal, cpf
+        )
+        valores = [v.decode() if isinstance(v, bytes) else v for v in resultado]
+        return list(zip(valores[0::2], valores[1::2]))
+
+    async def renovar(self, cpf, connection_id, worker=WORKER_ID):
+        async with (await self._obter_cliente()).pipeline(transaction=False) as pipe:
+            pipe.expire(self._chave_conexao(connection_id), self.ttl)
+            pipe.expire(self._chave_usuario(cpf), self.ttl)
+            pipe.expire(self._chave_worker(worker), self.ttl)
+            renovada, *_ = await pipe.execute()
+        return bool(renovada)
+
+    async def remover(self, cpf, connection_id, worker=WORKER_ID):
+        async with (await self._obter_cliente()).pipeline(transaction=True) as pipe:
+            pipe.zrem(self._chave_usuario(cpf), connection_id)
+            pipe.zrem(self._chave_worker(worker), connection_id)
+            pipe.delete(self._chave_conexao(connection_id))
+            await pipe.execute()
+
+    async def conexoes_usuario(self, cpf):
+        return int(await (await self._obter_cliente()).eval(SCRIPT_CONTAR, 1, self._chave_usuario(cpf), self.prefixo))
+
+    async def conexoes_por_worker(self):
+        cliente = await self._obter_cliente()
+        contagem = {}
+        inicio = len(self._chave_worker(''))
+        async for chave in cliente.scan_iter(match=self._chave_worker('*')):
+            chave = chave.decode() if isinstance(chave, bytes) else chave
+            vivas = int(await cliente.eval(SCRIPT_CONTAR, 1, chave, self.prefixo))
+            if vivas:
+                contagem[chave[inicio:]] = vivas
+        return contagem
+
+    async def canais_ativos(self):
+        """Nomes de canal de todas as conexões registradas e não expiradas."""
+        cliente = await self._obter_cliente()
+        canais = set()
+        chaves = [chave async for chave in cliente.scan_iter(match=self._chave_conexao('*'), count=1000)]
+        for inicio in range(0, len(chaves), 1000):
+            async with cliente.pipeline(transaction=False) as pipe:
+                for chave in chaves[inicio:inicio + 1000]:
+                    pipe.hget(chave, 'canal')
+                for canal in await pipe.execute():
+                    if canal:
+                        canais.add(canal.decode() if isinstance(canal, bytes) else canal)
+        return canais
+
+    async def adquirir_lock(self, nome, ttl):
+        """Lock simples entre workers (SET NX com expiração). Returns: True se adquirido"""
+        return bool(await (await self._obter_cliente()).set(f"{self.prefixo}lock:{nome}", WORKER_ID, nx=True, ex=max(int(ttl), 1)))
+
+
+_registro_conexoes = None
+
+
+def obter_registro_conexoes():
+    """
+    Registro de conexões compartilhado. Usa Redis quando o channel layer usa Redis
+    (settings.CHANNEL_REDIS_HOSTS) e memória caso contrário.
+    """
+    global _registro_conexoes
+    if _registro_conexoes is None:
+        ttl = getattr(settings, 'CONEXOES_TTL', 120)
+        hosts = getattr(settings, 'CHANNEL_REDIS_HOSTS', [])
+        if hosts:
+            _registro_conexoes = RegistroConexoesRedis(url=hosts[0], ttl=ttl)
+        else:
+            _registro_conexoes = RegistroConexoesMemoria(ttl=ttl)
+    return _registro_conexoes
@@ -1,11 +1,12 @@
+import asyncio
 import json
 import logging
 import requests
 import time
-from collections import defaultdict
 import traceback
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.utils import timezone
 from asgiref.sync import sync_to_async
 import datetime
@@ -32,18 +33,8 @@ from .utils import (
 
 # Importando funções de database_services
 from .database_services import (
-    verificar_corridas_em_andamento,
-    buscar_motoristas_disponiveis,
-    registrar_corrida,
-    aceitar_corrida,
-    atualizar_status_motorista,
-    buscar_dados_motorista,
-    atualizar_localizacao_motorista,
-    obter_corrida_em_andamento,
     finalizar_corrida,
     cancelar_corrida,
-    registrar_chegada_motorista,
-    cancelar_corrida_sem_motoristas,
     iniciar_corrida,
     verificar_corrida_em_andamento_motorista,
     verificar_corrida_em_andamento_passageiro,
@@ -51,31 +42,41 @@ from .database_services import (
     avaliar_passageiro,
     obter_dados_avaliacao_corrida,
     atualizar_status_corrida,
-    registrar_mensagem_chat,
     obter_mensagens_chat,
-    limpar_corrida_da_memoria
+    limpar_corrida_da_memoria,
+    registrar_notificacao_push,
+    usuario_e_equipe,
+    comando_aceitar_corrida,
+    comando_aviso_chegada,
+    comando_desconectar_motorista,
+    comando_ficar_disponivel,
+    comando_mensagem_chat,
+    comando_solicitar_corrida,
+    atualizar_status_motorista_async,
+    atualizar_localizacao_motorista_async,
+    obter_corrida_em_andamento_async,
+    corrida_pendente_async,
+    obter_mensagens_chat_async,
+    marcar_mensagens_lidas_async
 )
+from .db_executor import executar_no_banco
+from .routing_services import obter_provedor_rotas
+from .pricing import emitir_cotacao, validar_cotacao, cotacao_corresponde
+from .connection_registry import obter_registro_conexoes
+from .group_audit import iniciar_auditoria_grupos
+from .push_services import iniciar_outbox_no_processo
+from .topics import TopicoInvalido, grupo_topico, permissao_topico
+from .broadcast import difundir_para_grupos
+from .dispatcher import RegistroEventos, exige_campos, exige_tipo_usuario
+from .outbound import PRIORIDADE_ALTA, PRIORIDADE_BAIXA, PRIORIDADE_NORMAL, FilaSaida
+from .rate_limit import limitador_eventos
+from .replay import enviar_com_sequencia, obter_buffer_replay
 
 logger = logging.getLogger(__name__)
 
 # Definindo eventos de alta frequência que não precisam ser logados
 FREQUENT_EVENTS = ['ping', 'pong', 'heartbeat', 'atualizar_localizacao', 'app_background']
 
-# Dicionário para rastrear conexões ativas por usuário (CPF)
-# Formato: {cpf: {connection_id: timestamp}}
-active_connections = defaultdict(dict)
-
-# Dicionário para limitar frequência de solicitações
-# Formato: {(cpf, request_type, parameter): last_request_timestamp}
-request_rate_limiter = {}
-
-# Configurações de limitação de taxa
-RATE_LIMIT_SECONDS = {
-    'default': 1,  # 1 segundo entre solicitações padrão
-    'solicitar_historico_chat': 5,  # 5 segundos entre solicitações de histórico de chat
-    'ping': 0.5,  # 0.5 segundos entre pings
-}
-
 # Número máximo de conexões permitidas por usuário
 MAX_CONNECTIONS_PER_USER = 3
 
@@ -84,18 +85,36 @@ MAX_CONNECTIONS_PER_USER = 3
 historico_chat_cache = {}
 CHAT_CACHE_TTL = 10  # Tempo de vida do cache em segundos
 
+# Tabela de handlers dos eventos recebidos pelo MoveXConsumer, com limite de
+# frequência (movex/rate_limit.py) e métricas por evento
+eventos = RegistroEventos(limitador=limitador_eventos)
+
 class MoveXConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        await self.accept()
         self.user_info = None
-        self.room_group_name = 'movex_general'
-        self.connection_id = f"{id(self)}"  # ID único para esta conexão
+        # Usuário autenticado pelo token no handshake (TokenAuthMiddleware), se houver
+        self.contexto_usuario = self.scope.get('contexto_usuario')
+        self.connection_id = uuid.uuid4().hex  # ID único entre todos os workers
+        if self.scope.get('token_invalido') or (
+            getattr(settings, 'WEBSOCKET_EXIGIR_TOKEN', False) and not self.contexto_usuario
+        ):
+            logger.warning(f"Conexão WebSocket {self.connection_id} recusada: token ausente ou inválido")
+            await self.close()
+            return
+        await self.accept()
+        self._iniciar_fila_saida()
+        self.substituida = False
+        # Renova a entrada no registro mesmo sem mensagens do cliente (só ouvindo)
+        self.tarefa_renovacao = asyncio.create_task(self._renovar_periodicamente())
+        self.grupos = set()  # Grupos em que esta conexão entrou, deixados no disconnect
+        self.topicos = {}  # tópico -> grupo, inscrições feitas com inscrever_topico
+        self.ultimo_seq = 0  # Último evento numerado entregue (buffer de reenvio, movex/replay.py)
+        self._seq_atual = None
         
-        # Adicionar ao grupo geral
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        # Nenhum grupo geral: transmissões só alcançam quem se inscreveu no tópico
+        iniciar_auditoria_grupos(self.channel_layer)
+        # Sem worker de notificações push, o próprio processo web esvazia o outbox
+        iniciar_outbox_no_processo()
         
         # Enviar confirmação de conexão
         await self.send(text_data=json.dumps({
@@ -108,11 +127,13 @@ class MoveXConsumer(AsyncWebsocketConsumer):
         logger.info(f"Nova conexão WebSocket: {self.connection_id}")
     
     async def disconnect(self, close_code):
-        # Remover do grupo geral
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        await self._encerrar_fila_saida()
+        tarefa = getattr(self, 'tarefa_renovacao', None)
+        if tarefa is not None and not tarefa.done():
+            tarefa.cancel()
+        
+        # Sair de todos os grupos (motorista_, passageiro_, conexoes_ e tópicos)
+        await self._sair_dos_grupos()
         
         # Log simplificado de desconexão com informações de usuário
         user_info = ""
@@ -121,65 +142,268 @@ class MoveXConsumer(AsyncWebsocketConsumer):
             tipo = self.user_info.get('tipo', 'Unknown')
             user_info = f" - {tipo}: {cpf}"
             
-            # Remover esta conexão dos registros de conexão ativa
-            if cpf in active_connections and self.connection_id in active_connections[cpf]:
-                del active_connections[cpf][self.connection_id]
-                # Se não houver mais conexões para este usuário, limpe a entrada
-                if not active_connections[cpf]:
-                    del active_connections[cpf]
+            # Remover esta conexão do registro compartilhado
+            try:
+                await obter_registro_conexoes().remover(cpf, self.connection_id)
+            except Exception as e:
+                logger.error(f"Erro ao remover conexão {self.connection_id} do registro: {str(e)}")
         
         logger.info(f"Cliente desconectado{user_info}: código {close_code}")
         
-        # Se for um motorista, atualizar status para offline e verificar corridas
-        if self.user_info and self.user_info.get('tipo') == 'MOTORISTA':
-            await database_sync_to_async(atualizar_status_motorista)(
-                self.user_info.get('cpf'), 'OFFLINE', False
-            )
-            
-            # Verificar corridas em andamento deste motorista
-            sucesso, passageiros_cpfs = await database_sync_to_async(verificar_corridas_em_andamento)(
-                self.user_info.get('cpf')
+        # Se for um motorista, atualizar status para offline e verificar corridas.
+        # Conexões substituídas por uma mais nova do mesmo motorista não o deixam offline.
+        if self.user_info and self.user_info.get('tipo') == 'MOTORISTA' and not self.substituida:
+            # Ficar offline e verificar corridas em andamento deste motorista
+            sucesso, passageiros_cpfs = await executar_no_banco(
+                comando_desconectar_motorista, self.user_info.get('cpf'), contexto=self.user_info, escrita=True
             )
             
             # Notificar passageiros sobre a desconexão do motorista se necessário
             if sucesso and passageiros_cpfs:
                 for passageiro_cpf in passageiros_cpfs:
                     passageiro_group = f'passageiro_{passageiro_cpf}'
-                    await self.channel_layer.group_send(
-                        passageiro_group,
+                    await enviar_com_sequencia(
+                        self.channel_layer, passageiro_group, passageiro_cpf,
                         {
                             'type': 'motorista_desconectado',
                             'message': 'O motorista se desconectou temporariamente.'
                         }
                     )
     
-    def _check_rate_limit(self, event_type, parameter=None):
+    # ===== Fila de saída: os frames são escritos no socket por uma tarefa própria =====
+    
+    def _iniciar_fila_saida(self):
+        self.fila_saida = FilaSaida(getattr(settings, 'FILA_SAIDA_LIMITE', 200))
+        self.fila_saida_aberta = True
+        self.tarefa_envio = asyncio.create_task(self._escrever_fila_saida())
+    
+    async def _escrever_fila_saida(self):
+        fila = self.fila_saida
+        while True:
+            texto = await fila.obter()
+            try:
+                await super().send(text_data=texto)
+            except Exception as e:
+                logger.error(f"Erro ao escrever no socket da conexão {self.connection_id}: {str(e)}")
+                fila.limpar()
+                return
+            finally:
+                fila.concluir()
+    
+    async def _encerrar_fila_saida(self):
+        self.fila_saida_aberta = False
+        tarefa = getattr(self, 'tarefa_envio', None)
+        if tarefa is not None and not tarefa.done():
+            tarefa.cancel()
+            try:
+                await tarefa
+            except asyncio.CancelledError:
+                pass
+        if getattr(self, 'fila_saida', None) is not None:
+            self.fila_saida.limpar()
+    
+    async def send(self, text_data=None, bytes_data=None, close=False, prioridade=PRIORIDADE_NORMAL, chave=None):
         """
-        Verifica se uma solicitação está dentro dos limites de taxa
-        Retorna True se permitido, False se deve ser limitado
+        Coloca o frame na fila de saída da conexão em vez de escrever no socket,
+        para que um cliente lento não segure o consumer.
+        
+        Args:
+            prioridade: PRIORIDADE_ALTA para eventos do ciclo de vida da corrida,
+                PRIORIDADE_BAIXA para frames que podem ser substituídos
+            chave: frames pendentes com a mesma chave são substituídos pelo mais recente
         """
-        if not self.user_info or 'cpf' not in self.user_info:
-            return True  # Não limitar se não estiver autenticado
+        if text_data is not None and getattr(self, '_seq_atual', None) is not None:
+            # Frame gerado por um evento numerado: o cliente guarda o seq para o resume_from
+            frame = json.loads(text_data)
+            if not isinstance(frame, dict):
+                raise TypeError(f"Frame de evento numerado deve ser um objeto JSON: {text_data[:100]}")
+            text_data = json.dumps({'seq': self._seq_atual, **frame})
+        if text_data is None or close or getattr(self, 'fila_saida', None) is None:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        if not self.fila_saida_aberta:
+            return
+        if not self.fila_saida.colocar(text_data, prioridade, chave):
+            # O cliente não está lendo: desconectar mantém a memória por conexão limitada
+            logger.warning(f"Fila de saída cheia para a conexão {self.connection_id}. Desconectando cliente lento.")
+            await self._encerrar_fila_saida()
+            await super().close(code=4008)
+    
+    async def close(self, code=None, reason=None):
+        """Fecha a conexão depois de entregar os frames já enfileirados."""
+        if getattr(self, 'fila_saida', None) is not None and self.fila_saida_aberta:
+            self.fila_saida_aberta = False
+            try:
+                await asyncio.wait_for(self.fila_saida.aguardar_vazia(), getattr(settings, 'FILA_SAIDA_TIMEOUT_FECHAMENTO', 5))
+            except asyncio.TimeoutError:
+                logger.warning(f"Frames pendentes descartados ao fechar a conexão {self.connection_id}")
+        await super().close(code=code, reason=reason)
+    
+    async def _ficar_disponivel(self, cpf, origem):
+        """Coloca o motorista como DISPONÍVEL, registrando o status antes e depois."""
+        try:
+            resultado = await executar_no_banco(comando_ficar_disponivel, cpf, escrita=True)
+        except Exception as e:
+            logger.error(f"Erro ao atualizar status do motorista: {str(e)}")
+            logger.error(traceback.format_exc())
+            return False
         
-        cpf = self.user_info['cpf']
-        now = time.time()
+        if resultado['status_antes']:
+            logger.info(f"Status antes da atualização: {resultado['status_antes'][0]}, disponível: {resultado['status_antes'][1]}")
+        if not resultado['sucesso']:
+            logger.error(f"Falha ao definir motorista {cpf} como disponível")
+            return False
+        logger.info(f"Motorista {cpf} definido como DISPONÍVEL após {origem}")
+        if resultado['status_depois']:
+            logger.info(f"Status após atualização: {resultado['status_depois'][0]}, disponível: {resultado['status_depois'][1]}")
+        return True
+    
+    async def _identificar(self, cpf, tipo_usuario):
+        """
+        Define o user_info da conexão. Conexões autenticadas no handshake usam o
+        contexto do token (papel já verificado e PKs de Motorista/Passageiro, que
+        dispensam a consulta a Usuario nos database_services) e só aceitam o
+        próprio usuário.
         
-        # Chave única para esta combinação de usuário, tipo de evento e parâmetro
-        key = (cpf, event_type, str(parameter) if parameter else None)
+        Returns:
+            bool: False se o cpf/tipo informado não corresponde ao token
+        """
+        if self.contexto_usuario:
+            if cpf != self.contexto_usuario['cpf'] or tipo_usuario != self.contexto_usuario['tipo']:
+                await self.send(json.dumps({
+                    'type': 'erro',
+                    'message': 'CPF ou tipo de usuário não correspondem ao token da conexão'
+                }))
+                return False
+            self.user_info = dict(self.contexto_usuario)
+        else:
+            self.user_info = {
+                'cpf': cpf,
+                'tipo': tipo_usuario
+            }
+        return True
+    
+    async def _identificar_comando(self, cpf_informado):
+        """
+        CPF de quem executa um comando da corrida (aceitar, iniciar, finalizar,
+        avaliar). Conexões autenticadas no handshake usam o cpf do token e recusam
+        um cpf diferente no payload; as demais usam o do payload ou o do login.
         
-        # Obter tempo mínimo entre solicitações para este tipo de evento
-        min_interval = RATE_LIMIT_SECONDS.get(event_type, RATE_LIMIT_SECONDS['default'])
+        Returns:
+            (bool, cpf): False se o cpf informado não corresponde ao token
+        """
+        if self.contexto_usuario:
+            cpf = self.contexto_usuario['cpf']
+            if cpf_informado and str(cpf_informado) != cpf:
+                await self.send(json.dumps({
+                    'type': 'erro',
+                    'message': 'CPF não corresponde ao token da conexão'
+                }))
+                return False, None
+            return True, cpf
+        return True, cpf_informado or (self.user_info.get('cpf') if self.user_info else None)
+    
+    async def dispatch(self, message):
+        """
+        Eventos numerados (enviar_com_sequencia) já entregues a esta conexão por um
+        reenvio são ignorados; os demais passam o seq aos frames que geram.
+        """
+        seq = message.get('seq')
+        if seq is None:
+            await super().dispatch(message)
+            return
+        if seq <= getattr(self, 'ultimo_seq', 0):
+            return
+        self.ultimo_seq = seq
+        self._seq_atual = seq
+        try:
+            await super().dispatch(message)
+        finally:
+            self._seq_atual = None
+    
+    async def _retomar_sessao(self, cpf, resume_from):
+        """
+        Reenvia os eventos numerados posteriores a `resume_from` que o usuário
+        perdeu enquanto estava desconectado. Os eventos passam pelos mesmos
+        handlers da entrega normal (as notificações push repetidas são
+        descartadas pelo outbox).
+        
+        Returns:
+            bool: True se todos os eventos perdidos foram reenviados; se False o
+            cliente recebe resume_incompleto e deve consultar o estado da corrida
+        """
+        try:
+            resume_from = int(resume_from)
+            ultimo_seq, perdidos, completo = await obter_buffer_replay().eventos_desde(cpf, resume_from)
+        except (TypeError, ValueError):
+            await self.send(json.dumps({'type': 'erro', 'message': 'resume_from deve ser um número inteiro'}))
+            return False
+        except Exception as e:
+            logger.error(f"Erro ao consultar o buffer de reenvio de {cpf}: {str(e)}")
+            ultimo_seq, perdidos, completo = 0, [], False
         
-        # Verificar se já existe um registro recente para esta solicitação
-        if key in request_rate_limiter:
-            last_request = request_rate_limiter[key]
-            if now - last_request < min_interval:
-                return False  # Muito cedo para outra solicitação
+        if not completo:
+            self.ultimo_seq = max(self.ultimo_seq, ultimo_seq)
+            await self.send(json.dumps({
+                'type': 'resume_incompleto',
+                'ultimo_seq': ultimo_seq,
+                'message': 'Eventos anteriores não estão mais disponíveis. Consulte o estado da corrida.'
+            }), prioridade=PRIORIDADE_ALTA)
+            return False
         
-        # Atualizar o timestamp da última solicitação
-        request_rate_limiter[key] = now
+        for evento in perdidos:
+            await self.dispatch(evento)
+        self.ultimo_seq = max(self.ultimo_seq, ultimo_seq)
+        await self.send(json.dumps({
+            'type': 'resume_ok',
+            'ultimo_seq': ultimo_seq,
+            'reenviados': len(perdidos)
+        }), prioridade=PRIORIDADE_ALTA)
+        logger.info(f"Sessão de {cpf} retomada a partir de {resume_from}: {len(perdidos)} eventos reenviados")
         return True
     
+    async def _entrar_grupo(self, grupo):
+        await self.channel_layer.group_add(grupo, self.channel_name)
+        self.grupos.add(grupo)
+    
+    async def _sair_grupo(self, grupo):
+        await self.channel_layer.group_discard(grupo, self.channel_name)
+        self.grupos.discard(grupo)
+    
+    async def _sair_dos_grupos(self):
+        grupos = getattr(self, 'grupos', set())
+        resultados = await asyncio.gather(
+            *(self.channel_layer.group_discard(grupo, self.channel_name) for grupo in grupos),
+            return_exceptions=True
+        )
+        for grupo, resultado in zip(grupos, resultados):
+            if isinstance(resultado, Exception):
+                logger.error(f"Erro ao sair do grupo {grupo}: {str(resultado)}")
+        grupos.clear()
+    
+    async def _enviar_rota_calculada(self, resultado_rota, start_lat, start_lng, end_lat, end_lng, modo_calculo=None):
+        """Envia a rota ao cliente junto com a cotação assinada usada em solicitar_corrida"""
+        cpf = self.user_info.get('cpf') if self.user_info else None
+        resposta = {
+            'type': 'rota_calculada',
+            'distancia': resultado_rota['distancia'],
+            'tempo_estimado': resultado_rota['tempo_estimado'],
+            'valor': resultado_rota['valor'],
+            'coordinates': resultado_rota['coordinates'],
+            'polyline': resultado_rota.get('polyline'),
+            'horario_pico': is_horario_pico(),
+            'origem': {'latitude': start_lat, 'longitude': start_lng},
+            'destino': {'latitude': end_lat, 'longitude': end_lng},
+            'cotacao_token': emitir_cotacao(
+                (start_lat, start_lng), (end_lat, end_lng),
+                resultado_rota['distancia'], resultado_rota['tempo_estimado'], resultado_rota['valor'],
+                cpf=cpf
+            ),
+        }
+        if modo_calculo:
+            resposta['modo_calculo'] = modo_calculo
+        await self.send(json.dumps(resposta))
+    
     async def receive(self, text_data):
         try:
             data = json.loads(text_data)
@@ -191,971 +415,913 @@ class MoveXConsumer(AsyncWebsocketConsumer):
                 user_id = f" ({self.user_info['cpf']})" if self.user_info and 'cpf' in self.user_info else ""
                 logger.debug(f"Evento{user_id}: {event_type}")
             
-            # EVENTOS FREQUENTES - sem logs
-            if event_type == 'ping' or event_type == 'heartbeat':
-                await self.send(text_data=json.dumps({
-                    'type': 'pong',
-                    'timestamp': str(timezone.now())
-                }))
-                return
-                
-            # ===== EVENTOS DE MOTORISTA ENVIADOS PELO APP =====
-            # Evento quando o motorista avisa que chegou ao local de embarque
-            elif event_type == 'aviso_chegada':
-                corrida_id = data.get('corridaId') or data.get('corrida_id')
-                motorista_cpf = self.user_info.get('cpf') if self.user_info else None
-                
-                if not corrida_id:
-                    logger.error("ID da corrida não fornecido no aviso_chegada")
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'ID da corrida é obrigatório'
-                    }))
-                    return
-                
-                if not motorista_cpf or self.user_info.get('tipo') != 'MOTORISTA':
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Apenas motoristas podem avisar chegada'
-                    }))
-                    return
-                
-                logger.info(f"Motorista {motorista_cpf} chegou ao local de embarque da corrida {corrida_id}")
+            # Handler do evento, pela tabela `eventos` (ver métodos evento_*)
+            await eventos.despachar(self, event_type, data)
                 
-                # Registrar chegada no banco de dados
-                sucesso = await database_sync_to_async(registrar_chegada_motorista)(
-                    corrida_id, motorista_cpf
-                )
-                
-                if not sucesso:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Não foi possível registrar a chegada. Verifique o ID da corrida.'
-                    }))
-                    return
-                
-                # Obter o CPF do passageiro para notificação
-                try:
-                    from corridas.models import Corrida
-                    corrida = await database_sync_to_async(Corrida.objects.get)(id=corrida_id)
-                    
-                    passageiro_cpf = await database_sync_to_async(
-                        lambda: corrida.passageiro.usuario.cpf if corrida.passageiro and corrida.passageiro.usuario else None
-                    )()
-                    
-                    if passageiro_cpf:
-                        # Confirmar ao motorista
-                        await self.send(json.dumps({
-                            'type': 'chegada_confirmada',
-                            'corridaId': corrida_id,
-                            'message': 'Sua chegada foi registrada com sucesso. O passageiro foi notificado.'
-                        }))
-                        
-                        # Notificar o passageiro
-                        passageiro_group = f'passageiro_{passageiro_cpf}'
-                        await self.channel_layer.group_send(
-                            passageiro_group,
-                            {
-                                'type': 'motorista_chegou',
-                                'corridaId': corrida_id
-                            }
-                        )
-                    else:
-                        await self.send(json.dumps({
-                            'type': 'erro',
-                            'message': 'Não foi possível identificar o passageiro da corrida'
-                        }))
-                
-                except Exception as e:
-                    logger.error(f"Erro ao processar aviso de chegada: {str(e)}")
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': f'Erro ao processar aviso de chegada: {str(e)}'
-                    }))
-                
-                return
+        except json.JSONDecodeError:
+            logger.error("Erro ao decodificar JSON da mensagem recebida")
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Formato de mensagem inválido'
+            }))
+        except Exception as e:
+            logger.error(f"Erro ao processar mensagem: {str(e)}")
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': f'Erro ao processar solicitação: {str(e)}'
+            }))
+
+    # ===== Handlers dos eventos recebidos do app (registrados em `eventos`) =====
+
+    # EVENTOS FREQUENTES - sem logs
+    @eventos.evento('ping', 'heartbeat')
+    async def evento_ping(self, data):
+        await self.send(text_data=json.dumps({
+            'type': 'pong',
+            'timestamp': str(timezone.now())
+        }))
+
+    # ===== EVENTOS DE MOTORISTA ENVIADOS PELO APP =====
+    # Evento quando o motorista avisa que chegou ao local de embarque
+    @eventos.evento('aviso_chegada')
+    @exige_tipo_usuario('MOTORISTA', 'Apenas motoristas podem avisar chegada')
+    async def evento_aviso_chegada(self, data):
+        corrida_id = data.get('corridaId') or data.get('corrida_id')
+        motorista_cpf = self.user_info['cpf']
+        
+        if not corrida_id:
+            logger.error("ID da corrida não fornecido no aviso_chegada")
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'ID da corrida é obrigatório'
+            }))
+            return
+        
+        logger.info(f"Motorista {motorista_cpf} chegou ao local de embarque da corrida {corrida_id}")
+        
+        # Registrar chegada no banco de dados e obter o CPF do passageiro para notificação
+        resultado = await executar_no_banco(comando_aviso_chegada, corrida_id, motorista_cpf, escrita=True)
+        
+        if not resultado['sucesso']:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Não foi possível registrar a chegada. Verifique o ID da corrida.'
+            }))
+            return
+        
+        try:
+            passageiro_cpf = resultado['passageiro_cpf']
             
-            # Evento quando o motorista se conecta e fica online
-            elif event_type == 'motorista_conectado':
-                cpf = data.get('cpf')
-                if not cpf:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'CPF do motorista é obrigatório'
-                    }))
-                    return
-                
-                # Registrar as informações do usuário
-                self.user_info = {
-                    'cpf': cpf,
-                    'tipo': 'MOTORISTA'
-                }
-                
-                logger.info(f"Motorista conectado: {cpf}")
-                
-                # Verificar e gerenciar conexões para este usuário
-                if not self._manage_connections():
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'message': 'Muitas conexões ativas para este motorista. Esta conexão será encerrada.',
-                        'code': 'TOO_MANY_CONNECTIONS'
-                    }))
-                    await self.close(code=4001)
-                    return
-                
-                # Atualizar status do motorista para DISPONÍVEL
-                try:
-                    # Verificar status atual para diagnóstico usando operação assíncrona
-                    # Função auxiliar assíncrona para verificar status
-                    @database_sync_to_async
-                    def check_driver_status(driver_cpf):
-                        from django.db import connection
-                        cursor = connection.cursor()
-                        cursor.execute("SELECT status, esta_disponivel FROM usuarios_motorista WHERE cpf = %s", [driver_cpf])
-                        return cursor.fetchone()
-                    
-                    # Função auxiliar para atualização do status
-                    @database_sync_to_async
-                    def update_driver_status(driver_cpf):
-                        from movex.database_services import atualizar_status_motorista
-                        return atualizar_status_motorista(driver_cpf, 'DISPONIVEL', True)
-                    
-                    # Verificar status antes da atualização
-                    status_antes = await check_driver_status(cpf)
-                    if status_antes:
-                        logger.info(f"Status antes da atualização: {status_antes[0]}, disponível: {status_antes[1]}")
-                    
-                    # Atualizar para DISPONÍVEL
-                    success = await update_driver_status(cpf)
-                    
-                    if success:
-                        logger.info(f"Motorista {cpf} definido como DISPONÍVEL após evento motorista_conectado")
-                        
-                        # Verificar novamente o status após a atualização
-                        status_depois = await check_driver_status(cpf)
-                        if status_depois:
-                            logger.info(f"Status após atualização: {status_depois[0]}, disponível: {status_depois[1]}")
-                    else:
-                        logger.error(f"Falha ao definir motorista {cpf} como disponível")
-                        
-                except Exception as e:
-                    logger.error(f"Erro ao atualizar status do motorista: {str(e)}")
-                    import traceback
-                    logger.error(traceback.format_exc())
-                
-                # Adicionar motorista ao grupo específico para receber notificações
-                motorista_group = f'motorista_{cpf}'
-                await self.channel_layer.group_add(
-                    motorista_group,
-                    self.channel_name
-                )
-                
-                # Confirmar ao motorista que ele está conectado e disponível
-                await self.send(text_data=json.dumps({
-                    'type': 'status_atualizado',
-                    'status': 'DISPONIVEL',
-                    'disponivel': True,
-                    'message': 'Você está online e disponível para receber corridas.'
+            if passageiro_cpf:
+                # Confirmar ao motorista
+                await self.send(json.dumps({
+                    'type': 'chegada_confirmada',
+                    'corridaId': corrida_id,
+                    'message': 'Sua chegada foi registrada com sucesso. O passageiro foi notificado.'
                 }))
                 
-                # Verificar se há corridas em andamento para este motorista (se solicitado)
-                if data.get('verificar_corrida_ativa', False):
-                    corrida_em_andamento = await database_sync_to_async(verificar_corrida_em_andamento_motorista)(cpf)
-                    if corrida_em_andamento:
-                        await self.send(text_data=json.dumps({
-                            'type': 'corrida_em_andamento',
-                            'corridaId': str(corrida_em_andamento.get('id')),
-                            'passageiro': corrida_em_andamento.get('passageiro'),
-                            'origem': corrida_em_andamento.get('origem'),
-                            'destino': corrida_em_andamento.get('destino'),
-                            'status': corrida_em_andamento.get('status'),
-                            'valor': corrida_em_andamento.get('valor')
-                        }))
-                
-                return
-            
-            # Evento periódico de status do motorista
-            elif event_type == 'motorista_status':
-                cpf = data.get('cpf')
-                status = data.get('status')
-                disponivel = data.get('disponivel')
-                em_corrida = data.get('em_corrida')
-                
-                if not cpf:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'CPF do motorista é obrigatório'
-                    }))
-                    return
-                
-                # Se não tiver informação de usuário ainda, registrar
-                if not self.user_info:
-                    self.user_info = {
-                        'cpf': cpf,
-                        'tipo': 'MOTORISTA'
+                # Notificar o passageiro
+                passageiro_group = f'passageiro_{passageiro_cpf}'
+                await enviar_com_sequencia(
+                    self.channel_layer, passageiro_group, passageiro_cpf,
+                    {
+                        'type': 'motorista_chegou',
+                        'corridaId': corrida_id
                     }
-                    
-                    # Adicionar motorista ao grupo apropriado
-                    motorista_group = f'motorista_{cpf}'
-                    await self.channel_layer.group_add(
-                        motorista_group,
-                        self.channel_name
-                    )
-                
-                # Determinar o status no banco de dados com base nas informações enviadas
-                db_status = 'DISPONIVEL'
-                if status == 'offline':
-                    db_status = 'OFFLINE'
-                elif em_corrida:
-                    db_status = 'EM_CORRIDA'
-                
-                # Atualizar status no banco de dados (sem logs extensivos para este evento periódico)
-                await database_sync_to_async(atualizar_status_motorista)(
-                    cpf, db_status, disponivel
                 )
-                
-                # Responder com sucesso (sem logs para não sobrecarregar)
+            else:
                 await self.send(json.dumps({
-                    'type': 'status_atualizado',
-                    'status': db_status,
-                    'disponivel': disponivel,
-                    'timestamp': str(timezone.now())
+                    'type': 'erro',
+                    'message': 'Não foi possível identificar o passageiro da corrida'
                 }))
-                
-                return
-            
-            # Evento quando o motorista fica disponível após finalizar uma corrida
-            elif event_type == 'motorista_disponivel':
-                cpf = data.get('cpf')
-                
-                if not cpf:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'CPF do motorista é obrigatório'
-                    }))
-                    return
-                
-                logger.info(f"Motorista {cpf} sinalizou disponibilidade")
-                
-                # Função auxiliar assíncrona para verificar status
-                @database_sync_to_async
-                def check_driver_status(driver_cpf):
-                    from django.db import connection
-                    cursor = connection.cursor()
-                    cursor.execute("SELECT status, esta_disponivel FROM usuarios_motorista WHERE cpf = %s", [driver_cpf])
-                    return cursor.fetchone()
-                
-                # Função auxiliar para atualização do status
-                @database_sync_to_async
-                def update_driver_status(driver_cpf):
-                    from movex.database_services import atualizar_status_motorista
-                    return atualizar_status_motorista(driver_cpf, 'DISPONIVEL', True)
-                
-                # Atualizar status para DISPONÍVEL
-                success = await update_driver_status(cpf)
-                
-                # Verificar status atual
-                status_atual = await check_driver_status(cpf)
-                
-                if status_atual:
-                    logger.info(f"Status atual do motorista {cpf}: {status_atual[0]}, disponível: {status_atual[1]}")
-                
-                # Confirmar que o motorista está disponível
+        
+        except Exception as e:
+            logger.error(f"Erro ao processar aviso de chegada: {str(e)}")
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': f'Erro ao processar aviso de chegada: {str(e)}'
+            }))
+
+    # Evento quando o motorista se conecta e fica online
+    @eventos.evento('motorista_conectado')
+    @exige_campos('cpf', mensagem='CPF do motorista é obrigatório')
+    async def evento_motorista_conectado(self, data):
+        cpf = data.get('cpf')
+        
+        # Registrar as informações do usuário
+        if not await self._identificar(cpf, 'MOTORISTA'):
+            return
+        
+        logger.info(f"Motorista conectado: {cpf}")
+        
+        # Registrar a conexão e encerrar as mais antigas deste motorista
+        await self._registrar_conexao()
+        
+        # Atualizar status do motorista para DISPONÍVEL
+        await self._ficar_disponivel(cpf, 'motorista_conectado')
+        
+        # Adicionar motorista ao grupo específico para receber notificações
+        motorista_group = f'motorista_{cpf}'
+        await self._entrar_grupo(motorista_group)
+        
+        # Confirmar ao motorista que ele está conectado e disponível
+        await self.send(text_data=json.dumps({
+            'type': 'status_atualizado',
+            'status': 'DISPONIVEL',
+            'disponivel': True,
+            'message': 'Você está online e disponível para receber corridas.'
+        }))
+        
+        # Numa reconexão com resume_from os eventos perdidos são reenviados e a
+        # consulta da corrida ativa só é necessária se o buffer não os tiver mais
+        retomada = False
+        if data.get('resume_from') is not None:
+            retomada = await self._retomar_sessao(cpf, data['resume_from'])
+        
+        # Verificar se há corridas em andamento para este motorista (se solicitado)
+        if data.get('verificar_corrida_ativa', False) and not retomada:
+            corrida_em_andamento = await executar_no_banco(verificar_corrida_em_andamento_motorista, cpf)
+            if corrida_em_andamento:
                 await self.send(text_data=json.dumps({
-                    'type': 'status_atualizado',
-                    'status': 'DISPONIVEL',
-                    'disponivel': True,
-                    'message': 'Você agora está disponível para receber novas corridas.'
+                    'type': 'corrida_em_andamento',
+                    'corridaId': str(corrida_em_andamento.get('id')),
+                    'passageiro': corrida_em_andamento.get('passageiro'),
+                    'origem': corrida_em_andamento.get('origem'),
+                    'destino': corrida_em_andamento.get('destino'),
+                    'status': corrida_em_andamento.get('status'),
+                    'valor': corrida_em_andamento.get('valor')
                 }))
-                
+
+    # Evento periódico de status do motorista
+    @eventos.evento('motorista_status')
+    @exige_campos('cpf', mensagem='CPF do motorista é obrigatório')
+    async def evento_motorista_status(self, data):
+        cpf = data.get('cpf')
+        status = data.get('status')
+        disponivel = data.get('disponivel')
+        em_corrida = data.get('em_corrida')
+        
+        # Se não tiver informação de usuário ainda, registrar
+        if not self.user_info:
+            if not await self._identificar(cpf, 'MOTORISTA'):
                 return
             
-            # EVENTOS DE LOGIN E AUTENTICAÇÃO
-            elif event_type == 'login':
-                cpf = data.get('cpf')
-                tipo_usuario = data.get('tipo')
-                
-                if not cpf or not tipo_usuario:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'CPF e tipo de usuário são obrigatórios para o login'
-                    }))
-                    return
-                
-                # Registrar as informações do usuário
-                self.user_info = {
-                    'cpf': cpf,
-                    'tipo': tipo_usuario
-                }
-                
-                # Log simplificado de login
-                logger.info(f"Login WebSocket: {tipo_usuario} {cpf}")
-                
-                # Verificar e gerenciar conexões para este usuário
-                if not self._manage_connections():
-                    # Enviar mensagem de aviso e fechar conexão
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'message': 'Muitas conexões ativas para este usuário. Esta conexão será encerrada.',
-                        'code': 'TOO_MANY_CONNECTIONS'
-                    }))
-                    await self.close(code=4001)  # Código personalizado
-                    return
-                
-                if tipo_usuario == 'MOTORISTA':
-                    # AQUI É O LOCAL CORRETO para atualizar o status do motorista para DISPONÍVEL
-                    # pois a conexão WebSocket já foi estabelecida
-                    try:
-                        # Primeiro, obtenha o status atual para diagnóstico
-                        from django.db import connection
-                        cursor = connection.cursor()
-                        cursor.execute("SELECT status, esta_disponivel FROM usuarios_motorista WHERE cpf = %s", [cpf])
-                        status_antes = cursor.fetchone()
-                        if status_antes:
-                            logger.info(f"Status antes da atualização: {status_antes[0]}, disponível: {status_antes[1]}")
-                        
-                        # Agora atualize para DISPONÍVEL
-                        success = await database_sync_to_async(atualizar_status_motorista)(
-                            cpf, 'DISPONIVEL', True
-                        )
-                        
-                        if success:
-                            logger.info(f"Motorista {cpf} ficou DISPONÍVEL com sucesso após conexão WebSocket")
-                            
-                            # Verificar novamente o status após a atualização
-                            cursor = connection.cursor()
-                            cursor.execute("SELECT status, esta_disponivel FROM usuarios_motorista WHERE cpf = %s", [cpf])
-                            status_depois = cursor.fetchone()
-                            if status_depois:
-                                logger.info(f"Status após atualização: {status_depois[0]}, disponível: {status_depois[1]}")
-                        else:
-                            logger.error(f"FALHA ao definir motorista {cpf} como disponível")
-                            
-                    except Exception as e:
-                        logger.error(f"Erro ao atualizar status do motorista: {str(e)}")
-                        import traceback
-                        logger.error(traceback.format_exc())
-                    
-                    # Adicionar motorista ao grupo específico para receber notificações
-                    motorista_group = f'motorista_{cpf}'
-                    await self.channel_layer.group_add(
-                        motorista_group,
-                        self.channel_name
-                    )
-                    
-                    # Notificar o motorista sobre seu status atual
-                    await self.send(text_data=json.dumps({
-                        'type': 'status_atualizado',
-                        'status': 'DISPONIVEL',
-                        'disponivel': True,
-                        'message': 'Você está online e disponível para receber corridas.'
-                    }))
-                
-                elif tipo_usuario == 'PASSAGEIRO':
-                    # Adicionar passageiro ao grupo específico
-                    passageiro_group = f'passageiro_{cpf}'
-                    await self.channel_layer.group_add(
-                        passageiro_group,
-                        self.channel_name
-                    )
-                
-                # Confirmar login bem-sucedido
-                await self.send(text_data=json.dumps({
-                    'type': 'login_success',
-                    'message': f'Login WebSocket bem-sucedido como {tipo_usuario}',
-                    'connection_id': self.connection_id
-                }))
-                return
+            # Registrar a conexão (e o grupo do motorista) como em motorista_conectado
+            await self._registrar_conexao()
+            motorista_group = f'motorista_{cpf}'
+            await self._entrar_grupo(motorista_group)
+        
+        # Determinar o status no banco de dados com base nas informações enviadas
+        db_status = 'DISPONIVEL'
+        if status == 'offline':
+            db_status = 'OFFLINE'
+        elif em_corrida:
+            db_status = 'EM_CORRIDA'
+        
+        # Atualizar status no banco de dados (sem logs extensivos para este evento periódico)
+        await atualizar_status_motorista_async(cpf, db_status, disponivel)
+        
+        # Responder com sucesso (sem logs para não sobrecarregar)
+        await self.send(json.dumps({
+            'type': 'status_atualizado',
+            'status': db_status,
+            'disponivel': disponivel,
+            'timestamp': str(timezone.now())
+        }))
+
+    # Evento quando o motorista fica disponível após finalizar uma corrida
+    @eventos.evento('motorista_disponivel')
+    @exige_campos('cpf', mensagem='CPF do motorista é obrigatório')
+    async def evento_motorista_disponivel(self, data):
+        cpf = data.get('cpf')
+        
+        logger.info(f"Motorista {cpf} sinalizou disponibilidade")
+        
+        # Atualizar status para DISPONÍVEL
+        await self._ficar_disponivel(cpf, 'motorista_disponivel')
+        
+        # Confirmar que o motorista está disponível
+        await self.send(text_data=json.dumps({
+            'type': 'status_atualizado',
+            'status': 'DISPONIVEL',
+            'disponivel': True,
+            'message': 'Você agora está disponível para receber novas corridas.'
+        }))
+
+    # EVENTOS DE LOGIN E AUTENTICAÇÃO
+    @eventos.evento('login')
+    @exige_campos('cpf', 'tipo', mensagem='CPF e tipo de usuário são obrigatórios para o login')
+    async def evento_login(self, data):
+        cpf = data.get('cpf')
+        tipo_usuario = data.get('tipo')
+        
+        # Registrar as informações do usuário
+        if not await self._identificar(cpf, tipo_usuario):
+            return
+        
+        # Log simplificado de login
+        logger.info(f"Login WebSocket: {tipo_usuario} {cpf}")
+        
+        # Registrar a conexão e encerrar as mais antigas deste usuário
+        await self._registrar_conexao()
+        
+        # Último seq já emitido para o usuário: ponto de partida de um futuro resume_from.
+        # Lido antes de entrar no grupo: um evento numerado entre a entrada e a leitura
+        # seria descartado como repetido
+        if data.get('resume_from') is None:
+            try:
+                self.ultimo_seq = await obter_buffer_replay().ultimo_seq(cpf)
+            except Exception as e:
+                logger.error(f"Erro ao consultar o buffer de reenvio de {cpf}: {str(e)}")
+        
+        if tipo_usuario == 'MOTORISTA':
+            # AQUI É O LOCAL CORRETO para atualizar o status do motorista para DISPONÍVEL
+            # pois a conexão WebSocket já foi estabelecida
+            await self._ficar_disponivel(cpf, 'login')
             
-            # EVENTO PARA CÁLCULO DE ROTA
-            elif event_type == 'calcular_rota':
-                if not self._check_rate_limit('calcular_rota'):
-                    await self.send(json.dumps({
-                        'type': 'rate_limited',
-                        'message': 'Muitas solicitações recentes. Por favor, aguarde alguns segundos.',
-                        'request_type': 'calcular_rota'
-                    }))
-                    return
-                
-                # Log simplificado - coordenadas resumidas
-                try:
-                    start_lat = float(data.get('start_lat'))
-                    start_lng = float(data.get('start_lng'))
-                    end_lat = float(data.get('end_lat'))
-                    end_lng = float(data.get('end_lng'))
-                    
-                    # Apenas um log resumido e uma vez
-                    logger.info(f"Calculando rota: [{start_lat:.6f},{start_lng:.6f}] → [{end_lat:.6f},{end_lng:.6f}]")
-                    
-                    # Usar a função buscar_rota_openroute
-                    resultado_rota = await buscar_rota_openroute(
-                        start_lat, start_lng, end_lat, end_lng
-                    )
-                    
-                    if resultado_rota and resultado_rota['success']:
-                        if len(resultado_rota['coordinates']) < 2:
-                            resultado_rota = calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
-                        
-                        # Enviar resultado ao cliente
-                        await self.send(json.dumps({
-                            'type': 'rota_calculada',
-                            'distancia': resultado_rota['distancia'],
-                            'tempo_estimado': resultado_rota['tempo_estimado'],
-                            'valor': resultado_rota['valor'],
-                            'coordinates': resultado_rota['coordinates'],
-                            'horario_pico': is_horario_pico(),
-                            'origem': {'latitude': start_lat, 'longitude': start_lng},
-                            'destino': {'latitude': end_lat, 'longitude': end_lng}
-                        }))
-                    else:
-                        # Método alternativo
-                        resultado_rota = calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
-                        
-                        await self.send(json.dumps({
-                            'type': 'rota_calculada',
-                            'distancia': resultado_rota['distancia'],
-                            'tempo_estimado': resultado_rota['tempo_estimado'],
-                            'valor': resultado_rota['valor'],
-                            'coordinates': resultado_rota['coordinates'],
-                            'horario_pico': is_horario_pico(),
-                            'modo_calculo': 'simplificado_melhorado',
-                            'origem': {'latitude': start_lat, 'longitude': start_lng},
-                            'destino': {'latitude': end_lat, 'longitude': end_lng}
-                        }))
-                except Exception as e:
-                    logger.error(f"Erro ao calcular rota: {str(e)}")
-                    
-                    # Tentar método alternativo em caso de erro
-                    try:
-                        resultado_rota = calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
-                        
-                        await self.send(json.dumps({
-                            'type': 'rota_calculada',
-                            'distancia': resultado_rota['distancia'],
-                            'tempo_estimado': resultado_rota['tempo_estimado'],
-                            'valor': resultado_rota['valor'],
-                            'coordinates': resultado_rota['coordinates'],
-                            'horario_pico': is_horario_pico(),
-                            'modo_calculo': 'emergencia',
-                            'origem': {'latitude': start_lat, 'longitude': start_lng},
-                            'destino': {'latitude': end_lat, 'longitude': end_lng}
-                        }))
-                    except Exception as e2:
-                        # Informar o cliente sobre o erro
-                        await self.send(json.dumps({
-                            'type': 'erro_rota',
-                            'message': f'Erro ao calcular rota: {str(e)}'
-                        }))
-                
-                return
+            # Adicionar motorista ao grupo específico para receber notificações
+            motorista_group = f'motorista_{cpf}'
+            await self._entrar_grupo(motorista_group)
             
-            # EVENTO PARA SOLICITAR CORRIDA
-            elif event_type == 'solicitar_corrida':
-                # Log simplificado com informações essenciais
-                passageiro_data = data.get('passageiro', {})
-                origem = data.get('origem', {})
-                destino = data.get('destino', {})
-                
-                # Um único log com informações resumidas
-                logger.info(f"Nova corrida: {passageiro_data.get('nome')} {passageiro_data.get('sobrenome')}, " +
-                           f"Distância: {data.get('distancia', 0):.2f}km, Valor: R${data.get('valor', 0)}")
-                
-                # Verificar campos obrigatórios
-                campos_obrigatorios = ['passageiro', 'origem', 'destino', 'valor', 'distancia', 'tempo_estimado']
-                campos_faltantes = [campo for campo in campos_obrigatorios if campo not in data]
-                
-                if campos_faltantes:
-                    logger.error(f"Campos obrigatórios faltando: {', '.join(campos_faltantes)}")
-                    await self.send(json.dumps({
-                        'type': 'erro_corrida',
-                        'message': f'Campos obrigatórios faltando: {", ".join(campos_faltantes)}'
-                    }))
-                    return
-                
-                # Verificar dados do passageiro
-                campos_passageiro_obrigatorios = ['cpf', 'nome', 'sobrenome', 'telefone']
-                campos_passageiro_faltantes = [campo for campo in campos_passageiro_obrigatorios 
-                                              if campo not in passageiro_data or not passageiro_data.get(campo)]
-                
-                if campos_passageiro_faltantes:
-                    logger.error(f"Campos do passageiro faltando: {', '.join(campos_passageiro_faltantes)}")
-                    await self.send(json.dumps({
-                        'type': 'erro_corrida',
-                        'message': f'Dados do passageiro incompletos: {", ".join(campos_passageiro_faltantes)}'
-                    }))
-                    return
-                
-                # Verificar coordenadas
-                origem = data.get('origem', {})
-                destino = data.get('destino', {})
-                
-                if not origem.get('latitude') or not origem.get('longitude') or not destino.get('latitude') or not destino.get('longitude'):
-                    logger.error("Coordenadas inválidas ou ausentes")
-                    await self.send(json.dumps({
-                        'type': 'erro_corrida',
-                        'message': 'Coordenadas de origem ou destino inválidas'
-                    }))
-                    return
-                
-                # Preparar dados para registro
-                origem_descricao = data.get('origem_descricao', 'Local de origem')
-                destino_descricao = data.get('destino_descricao', 'Local de destino')
-                passageiro_cpf = passageiro_data.get('cpf')
-                data['passageiro_cpf'] = passageiro_cpf
-                
-                # Registrar corrida no banco de dados
-                corrida_id = await database_sync_to_async(registrar_corrida)(data)
-                
-                if not corrida_id:
-                    await self.send(json.dumps({
-                        'type': 'erro_corrida',
-                        'message': 'Erro ao registrar a corrida.'
-                    }))
-                    return
-                
-                logger.info(f"Corrida registrada: ID {corrida_id}")
+            # Notificar o motorista sobre seu status atual
+            await self.send(text_data=json.dumps({
+                'type': 'status_atualizado',
+                'status': 'DISPONIVEL',
+                'disponivel': True,
+                'message': 'Você está online e disponível para receber corridas.'
+            }))
+        
+        elif tipo_usuario == 'PASSAGEIRO':
+            # Adicionar passageiro ao grupo específico
+            passageiro_group = f'passageiro_{cpf}'
+            await self._entrar_grupo(passageiro_group)
+        
+        # Confirmar login bem-sucedido
+        await self.send(text_data=json.dumps({
+            'type': 'login_success',
+            'message': f'Login WebSocket bem-sucedido como {tipo_usuario}',
+            'connection_id': self.connection_id,
+            'ultimo_seq': self.ultimo_seq
+        }), prioridade=PRIORIDADE_ALTA)
+        
+        # Reconexão: reenviar apenas os eventos perdidos desde o último seq recebido
+        if data.get('resume_from') is not None:
+            await self._retomar_sessao(cpf, data['resume_from'])
+
+    # EVENTO PARA CÁLCULO DE ROTA
+    @eventos.evento('calcular_rota')
+    async def evento_calcular_rota(self, data):
+        # Log simplificado - coordenadas resumidas
+        try:
+            start_lat = float(data.get('start_lat'))
+            start_lng = float(data.get('start_lng'))
+            end_lat = float(data.get('end_lat'))
+            end_lng = float(data.get('end_lng'))
+            
+            # Apenas um log resumido e uma vez
+            logger.info(f"Calculando rota: [{start_lat:.6f},{start_lng:.6f}] → [{end_lat:.6f},{end_lng:.6f}]")
+            
+            # Usar a função buscar_rota_openroute
+            resultado_rota = await buscar_rota_openroute(
+                start_lat, start_lng, end_lat, end_lng
+            )
+            
+            if resultado_rota and resultado_rota['success']:
+                if len(resultado_rota['coordinates']) < 2:
+                    resultado_rota = calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
                 
-                # Buscar motoristas disponíveis
-                motoristas_disponiveis = await database_sync_to_async(buscar_motoristas_disponiveis)(
-                    lat=data.get('origem', {}).get('latitude'),
-                    lng=data.get('origem', {}).get('longitude')
-                )
+                # Enviar resultado ao cliente
+                await self._enviar_rota_calculada(resultado_rota, start_lat, start_lng, end_lat, end_lng)
+            else:
+                # Método alternativo
+                resultado_rota = calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
                 
-                if not motoristas_disponiveis:
-                    # Cancelar corrida automaticamente se não houver motoristas
-                    await database_sync_to_async(cancelar_corrida_sem_motoristas)(corrida_id)
-                    await self.send(json.dumps({
-                        'type': 'erro_corrida',
-                        'message': 'Não há motoristas disponíveis no momento.'
-                    }))
-                    return
+                await self._enviar_rota_calculada(resultado_rota, start_lat, start_lng, end_lat, end_lng, modo_calculo='simplificado_melhorado')
+        except Exception as e:
+            logger.error(f"Erro ao calcular rota: {str(e)}")
+            
+            # Tentar método alternativo em caso de erro
+            try:
+                resultado_rota = calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
                 
-                # Confirmar registro ao passageiro
+                await self._enviar_rota_calculada(resultado_rota, start_lat, start_lng, end_lat, end_lng, modo_calculo='emergencia')
+            except Exception as e2:
+                # Informar o cliente sobre o erro
                 await self.send(json.dumps({
-                    'type': 'corrida_registrada',
-                    'corridaId': str(corrida_id),
-                    'message': 'Corrida registrada com sucesso, buscando motorista...'
+                    'type': 'erro_rota',
+                    'message': f'Erro ao calcular rota: {str(e)}'
                 }))
-                
-                # Log resumido dos motoristas disponíveis
-                logger.info(f"Notificando {len(motoristas_disponiveis)} motoristas disponíveis sobre nova corrida")
-                
-                # Notificar motoristas disponíveis
-                for motorista in motoristas_disponiveis:
-                    motorista_group = f'motorista_{motorista["cpf"]}'
-                    
-                    await self.channel_layer.group_send(
-                        motorista_group,
-                        {
-                            'type': 'nova_solicitacao_corrida',
-                            'corridaId': str(corrida_id),
-                            'passageiro': data.get('passageiro'),
-                            'origem': data.get('origem'),
-                            'destino': data.get('destino'),
-                            'origem_descricao': origem_descricao,
-                            'destino_descricao': destino_descricao,
-                            'valor': data.get('valor'),
-                            'distancia': data.get('distancia'),
-                            'tempo_estimado': data.get('tempo_estimado')
-                        }
-                    )
-                
-                return
 
-            # EVENTO PARA ACEITAR CORRIDA
-            elif event_type == 'aceitar_corrida':
-                # Aceitar tanto corridaId quanto corrida_id
-                corrida_id = data.get('corridaId') or data.get('corrida_id')
-                motorista_data = data.get('motorista', {})
-                status = data.get('status', 'ACEITA')
-                
-                # Verificar se o ID da corrida foi fornecido
-                if not corrida_id:
-                    logger.error("ID da corrida não fornecido")
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'ID da corrida não fornecido'
-                    }))
-                    return
-                
-                # Obter CPF do motorista do payload ou das informações de usuário
-                motorista_cpf = motorista_data.get('cpf') or motorista_data.get('id')
-                
-                # Se não houver CPF no payload, usar o CPF do usuário autenticado
-                if not motorista_cpf:
-                    motorista_cpf = self.user_info.get('cpf') if self.user_info else None
-                
-                logger.info(f"Motorista {motorista_cpf} aceitando corrida {corrida_id}")
-
-                if not motorista_cpf:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Motorista não identificado'
-                    }))
-                    return
-
-                # Atualizar corrida com o motorista que aceitou
-                sucesso, passageiro_cpf, outros_motoristas = await database_sync_to_async(aceitar_corrida)(
-                    corrida_id, motorista_cpf, status
-                )
+    # EVENTO PARA SOLICITAR CORRIDA
+    @eventos.evento('solicitar_corrida')
+    async def evento_solicitar_corrida(self, data):
+        # Log simplificado com informações essenciais
+        passageiro_data = data.get('passageiro', {})
+        origem = data.get('origem', {})
+        destino = data.get('destino', {})
+        
+        # Valor, distância e tempo vêm da cotação assinada em calcular_rota,
+        # nunca do cliente; o token vale só para o usuário da conexão que o recebeu
+        cotacao_token = data.get('cotacao_token')
+        if not cotacao_token:
+            await self.send(json.dumps({
+                'type': 'erro_corrida',
+                'codigo': 'cotacao_obrigatoria',
+                'message': 'Cotação não informada. Calcule a rota novamente.'
+            }))
+            return
+        cotacao = validar_cotacao(cotacao_token, cpf=self.user_info.get('cpf') if self.user_info else None)
+        if not cotacao or not cotacao_corresponde(cotacao, origem, destino):
+            await self.send(json.dumps({
+                'type': 'erro_corrida',
+                'codigo': 'cotacao_invalida',
+                'message': 'Cotação inválida ou expirada. Calcule a rota novamente.'
+            }))
+            return
+        data['valor'] = cotacao['valor']
+        data['distancia'] = cotacao['distancia']
+        data['tempo_estimado'] = cotacao['tempo_estimado']
+        
+        # Um único log com informações resumidas
+        logger.info(f"Nova corrida: {passageiro_data.get('nome')} {passageiro_data.get('sobrenome')}, " +
+                   f"Distância: {data.get('distancia', 0)}km, Valor: R${data.get('valor', 0)}")
+        
+        # Verificar campos obrigatórios
+        campos_obrigatorios = ['passageiro', 'origem', 'destino', 'valor', 'distancia', 'tempo_estimado']
+        campos_faltantes = [campo for campo in campos_obrigatorios if campo not in data]
+        
+        if campos_faltantes:
+            logger.error(f"Campos obrigatórios faltando: {', '.join(campos_faltantes)}")
+            await self.send(json.dumps({
+                'type': 'erro_corrida',
+                'message': f'Campos obrigatórios faltando: {", ".join(campos_faltantes)}'
+            }))
+            return
+        
+        # Verificar dados do passageiro
+        campos_passageiro_obrigatorios = ['cpf', 'nome', 'sobrenome', 'telefone']
+        campos_passageiro_faltantes = [campo for campo in campos_passageiro_obrigatorios 
+                                      if campo not in passageiro_data or not passageiro_data.get(campo)]
+        
+        if campos_passageiro_faltantes:
+            logger.error(f"Campos do passageiro faltando: {', '.join(campos_passageiro_faltantes)}")
+            await self.send(json.dumps({
+                'type': 'erro_corrida',
+                'message': f'Dados do passageiro incompletos: {", ".join(campos_passageiro_faltantes)}'
+            }))
+            return
+        
+        # Verificar coordenadas
+        origem = data.get('origem', {})
+        destino = data.get('destino', {})
+        
+        if not origem.get('latitude') or not origem.get('longitude') or not destino.get('latitude') or not destino.get('longitude'):
+            logger.error("Coordenadas inválidas ou ausentes")
+            await self.send(json.dumps({
+                'type': 'erro_corrida',
+                'message': 'Coordenadas de origem ou destino inválidas'
+            }))
+            return
+        
+        # Preparar dados para registro
+        origem_descricao = data.get('origem_descricao', 'Local de origem')
+        destino_descricao = data.get('destino_descricao', 'Local de destino')
+        passageiro_cpf = passageiro_data.get('cpf')
+        data['passageiro_cpf'] = passageiro_cpf
+        
+        # Registrar corrida e buscar motoristas disponíveis (sem motoristas, a corrida já volta cancelada)
+        resultado = await executar_no_banco(
+            comando_solicitar_corrida, data,
+            data.get('origem', {}).get('latitude'), data.get('origem', {}).get('longitude'),
+            contexto=self.user_info, escrita=True
+        )
+        corrida_id = resultado['corrida_id']
+        
+        if not corrida_id:
+            await self.send(json.dumps({
+                'type': 'erro_corrida',
+                'message': 'Erro ao registrar a corrida.'
+            }))
+            return
+        
+        logger.info(f"Corrida registrada: ID {corrida_id}")
+        
+        motoristas_disponiveis = resultado['motoristas']
+        
+        if not motoristas_disponiveis:
+            await self.send(json.dumps({
+                'type': 'erro_corrida',
+                'message': 'Não há motoristas disponíveis no momento.'
+            }))
+            return
+        
+        # Ordenar candidatos pelo tempo de viagem até o passageiro (uma única chamada de matriz)
+        motoristas_disponiveis = await obter_provedor_rotas().ordenar_por_eta(
+            motoristas_disponiveis,
+            float(origem.get('latitude')),
+            float(origem.get('longitude'))
+        )
+        
+        # Confirmar registro ao passageiro
+        await self.send(json.dumps({
+            'type': 'corrida_registrada',
+            'corridaId': str(corrida_id),
+            'message': 'Corrida registrada com sucesso, buscando motorista...'
+        }))
+        
+        logger.info(f"Oferecendo corrida {corrida_id} a {len(motoristas_disponiveis)} motoristas, em ondas por ETA")
+        
+        # Primeira onda já; as seguintes em segundo plano, enquanto a corrida seguir pendente
+        await ofertar_corrida_em_ondas(self.channel_layer, corrida_id, motoristas_disponiveis, {
+            'type': 'nova_corrida',  # Para compatibilidade com app motorista
+            'corridaId': str(corrida_id),
+            'passageiro': data.get('passageiro'),
+            'origem': data.get('origem'),
+            'destino': data.get('destino'),
+            'origem_descricao': origem_descricao,
+            'destino_descricao': destino_descricao,
+            'valor': data.get('valor'),
+            'distancia': data.get('distancia'),
+            'tempo_estimado': data.get('tempo_estimado')
+        })
+
+    # EVENTO PARA ACEITAR CORRIDA
+    @eventos.evento('aceitar_corrida')
+    async def evento_aceitar_corrida(self, data):
+        # Aceitar tanto corridaId quanto corrida_id
+        corrida_id = data.get('corridaId') or data.get('corrida_id')
+        motorista_data = data.get('motorista', {})
+        status = data.get('status', 'ACEITA')
+        
+        # Verificar se o ID da corrida foi fornecido
+        if not corrida_id:
+            logger.error("ID da corrida não fornecido")
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'ID da corrida não fornecido'
+            }))
+            return
+        
+        # CPF do motorista: o do token da conexão, senão o do payload ou do login
+        valido, motorista_cpf = await self._identificar_comando(motorista_data.get('cpf') or motorista_data.get('id'))
+        if not valido:
+            return
+        
+        logger.info(f"Motorista {motorista_cpf} aceitando corrida {corrida_id}")
+
+        if not motorista_cpf:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Motorista não identificado'
+            }))
+            return
+
+        # Atualizar corrida com o motorista que aceitou; os dados do motorista para o
+        # passageiro vêm do banco na mesma unidade de trabalho se não vierem no payload
+        payload_completo = bool(motorista_data and motorista_data.get('nome'))
+        resultado = await executar_no_banco(
+            comando_aceitar_corrida, corrida_id, motorista_cpf, status,
+            contexto=self.user_info, incluir_dados_motorista=not payload_completo, escrita=True
+        )
+        sucesso = resultado['sucesso']
+        passageiro_cpf = resultado['passageiro_cpf']
+        outros_motoristas = resultado['outros_motoristas']
+
+        if sucesso:
+            # Notificar o motorista que aceitou
+            await self.send(json.dumps({
+                'type': 'corrida_aceita',
+                'corridaId': corrida_id,
+                'message': 'Você aceitou a corrida com sucesso!'
+            }))
 
-                if sucesso:
-                    # Notificar o motorista que aceitou
-                    await self.send(json.dumps({
+            # Notificar o passageiro sobre a aceitação
+            if passageiro_cpf:
+                passageiro_group = f'passageiro_{passageiro_cpf}'
+
+                # Se temos os dados do motorista no payload, usá-los
+                if payload_completo:
+                    motorista_dados = {
+                        'cpf': motorista_cpf,
+                        'nome': motorista_data.get('nome', 'Motorista'),  # Garantir um valor padrão
+                        'sobrenome': motorista_data.get('sobrenome', ''),
+                        'telefone': motorista_data.get('telefone', ''),
+                        'veiculo': {
+                            'modelo': motorista_data.get('modeloCarro', ''),
+                            'cor': motorista_data.get('corCarro', ''),
+                            'placa': motorista_data.get('placaCarro', '')
+                        },
+                        'avaliacao': motorista_data.get('avaliacao', 0),
+                        'foto': motorista_data.get('foto', '')
+                    }
+                else:
+                    # Caso contrário, usar os dados buscados do banco de dados
+                    motorista_dados = resultado['dados_motorista'] or {}
+                    # Garantir que nome esteja presente
+                    if not motorista_dados.get('nome'):
+                        motorista_dados['nome'] = 'Motorista'
+
+                await enviar_com_sequencia(
+                    self.channel_layer, passageiro_group, passageiro_cpf,
+                    {
                         'type': 'corrida_aceita',
                         'corridaId': corrida_id,
-                        'message': 'Você aceitou a corrida com sucesso!'
-                    }))
-
-                    # Notificar o passageiro sobre a aceitação
-                    if passageiro_cpf:
-                        passageiro_group = f'passageiro_{passageiro_cpf}'
-
-                        # Se temos os dados do motorista no payload, usá-los
-                        if motorista_data and motorista_data.get('nome'):
-                            motorista_dados = {
-                                'cpf': motorista_data.get('cpf', ''),
-                                'nome': motorista_data.get('nome', 'Motorista'),  # Garantir um valor padrão
-                                'sobrenome': motorista_data.get('sobrenome', ''),
-                                'telefone': motorista_data.get('telefone', ''),
-                                'veiculo': {
-                                    'modelo': motorista_data.get('modeloCarro', ''),
-                                    'cor': motorista_data.get('corCarro', ''),
-                                    'placa': motorista_data.get('placaCarro', '')
-                                },
-                                'avaliacao': motorista_data.get('avaliacao', 0),
-                                'foto': motorista_data.get('foto', '')
-                            }
-                        else:
-                            # Caso contrário, buscar do banco de dados
-                            motorista_dados = await database_sync_to_async(buscar_dados_motorista)(motorista_cpf)
-                            # Garantir que nome esteja presente
-                            if not motorista_dados.get('nome'):
-                                motorista_dados['nome'] = 'Motorista'
-
-                        await self.channel_layer.group_send(
-                            passageiro_group,
-                            {
-                                'type': 'corrida_aceita',
-                                'corridaId': corrida_id,
-                                'motorista': motorista_dados
-                            }
-                        )
-
-                    # Notificar outros motoristas que a corrida foi aceita
-                    for outro_cpf in outros_motoristas:
-                        motorista_group = f'motorista_{outro_cpf}'
-                        await self.channel_layer.group_send(
-                            motorista_group,
-                            {
-                                'type': 'corrida_aceita_por_outro',
-                                'corridaId': corrida_id,
-                                'message': 'A corrida foi aceita por outro motorista.'
-                            }
-                        )
-                else:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Não foi possível aceitar a corrida. Ela pode já ter sido aceita por outro motorista.'
-                    }))
-                
-                return
-            
-            # EVENTO PARA INICIAR CORRIDA
-            elif event_type == 'iniciar_corrida':
-                corrida_id = data.get('corridaId')
-                motorista_cpf = data.get('motoristaCpf') or (self.user_info.get('cpf') if self.user_info else None)
-
-                if not corrida_id or not motorista_cpf:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'corridaId e motoristaCpf são obrigatórios'
-                    }))
-                    return
-
-                try:
-                    sucesso, passageiro_cpf = await database_sync_to_async(iniciar_corrida)(corrida_id, motorista_cpf)
-                    if sucesso:
-                        await self.send(json.dumps({
+                        'motorista': motorista_dados
+                    }
+                )
+
+            # Notificar outros motoristas que a corrida foi aceita
+            await difundir_para_grupos(
+                self.channel_layer,
+                [f'motorista_{outro_cpf}' for outro_cpf in outros_motoristas],
+                'corrida_aceita_por_outro',
+                {
+                    'type': 'corrida_indisponivel',
+                    'corridaId': corrida_id,
+                    'message': 'A corrida foi aceita por outro motorista.'
+                }
+            )
+        else:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Não foi possível aceitar a corrida. Ela pode já ter sido aceita por outro motorista.'
+            }))
+
+    # EVENTO PARA INICIAR CORRIDA
+    @eventos.evento('iniciar_corrida')
+    async def evento_iniciar_corrida(self, data):
+        corrida_id = data.get('corridaId')
+        valido, motorista_cpf = await self._identificar_comando(data.get('motoristaCpf'))
+        if not valido:
+            return
+
+        if not corrida_id or not motorista_cpf:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'corridaId e motoristaCpf são obrigatórios'
+            }))
+            return
+
+        try:
+            sucesso, passageiro_cpf = await executar_no_banco(
+                iniciar_corrida, corrida_id, motorista_cpf, contexto=self.user_info, escrita=True
+            )
+            if sucesso:
+                await self.send(json.dumps({
+                    'type': 'corrida_iniciada',
+                    'corridaId': corrida_id,
+                    'message': 'Corrida iniciada com sucesso'
+                }))
+                if passageiro_cpf:
+                    passageiro_group = f'passageiro_{passageiro_cpf}'
+                    await enviar_com_sequencia(
+                        self.channel_layer, passageiro_group, passageiro_cpf,
+                        {
                             'type': 'corrida_iniciada',
                             'corridaId': corrida_id,
-                            'message': 'Corrida iniciada com sucesso'
-                        }))
-                        if passageiro_cpf:
-                            passageiro_group = f'passageiro_{passageiro_cpf}'
-                            await self.channel_layer.group_send(
-                                passageiro_group,
-                                {
-                                    'type': 'corrida_iniciada',
-                                    'corridaId': corrida_id,
-                                    'message': 'Sua corrida foi iniciada!'
-                                }
-                            )
-                    else:
-                        await self.send(json.dumps({
-                            'type': 'erro',
-                            'message': 'Não foi possível iniciar a corrida'
-                        }))
-                except Exception as e:
-                    logger.error(f"Erro ao iniciar corrida: {str(e)}")
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': f'Erro ao iniciar corrida: {str(e)}'
-                    }))
-                return
+                            'message': 'Sua corrida foi iniciada!'
+                        }
+                    )
+            else:
+                await self.send(json.dumps({
+                    'type': 'erro',
+                    'message': 'Não foi possível iniciar a corrida'
+                }))
+        except Exception as e:
+            logger.error(f"Erro ao iniciar corrida: {str(e)}")
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': f'Erro ao iniciar corrida: {str(e)}'
+            }))
 
-            # EVENTO PARA FINALIZAR CORRIDA
-            elif event_type == 'finalizar_corrida':
-                corrida_id = data.get('corridaId')
-                motorista_cpf = data.get('motoristaId') or (self.user_info.get('cpf') if self.user_info else None)
-
-                if not corrida_id or not motorista_cpf:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'corridaId e motoristaId são obrigatórios'
-                    }))
-                    return
-
-                try:
-                    sucesso, passageiro_cpf = await database_sync_to_async(finalizar_corrida)(corrida_id, motorista_cpf)
-                    if sucesso:
-                        await self.send(json.dumps({
-                            'type': 'corrida_finalizada',
-                            'corridaId': corrida_id,
-                            'message': 'Corrida finalizada com sucesso'
-                        }))
-                        if passageiro_cpf:
-                            passageiro_group = f'passageiro_{passageiro_cpf}'
-                            await self.channel_layer.group_send(
-                                passageiro_group,
-                                {
-                                    'type': 'corrida_finalizada_por_motorista',
-                                    'corridaId': corrida_id,
-                                    'message': 'O motorista finalizou a corrida.'
-                                }
-                            )
-                    else:
-                        await self.send(json.dumps({
-                            'type': 'erro',
-                            'message': 'Não foi possível finalizar a corrida'
-                        }))
-                except Exception as e:
-                    logger.error(f"Erro ao finalizar corrida: {str(e)}")
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': f'Erro ao finalizar corrida: {str(e)}'
-                    }))
-                return
+    # EVENTO PARA FINALIZAR CORRIDA
+    @eventos.evento('finalizar_corrida')
+    async def evento_finalizar_corrida(self, data):
+        corrida_id = data.get('corridaId')
+        valido, motorista_cpf = await self._identificar_comando(data.get('motoristaId'))
+        if not valido:
+            return
 
-            # EVENTOS PARA ATUALIZAÇÕES DE LOCALIZAÇÃO - Reduzir logs
-            elif event_type == 'atualizar_localizacao':
-                motorista_cpf = self.user_info.get('cpf') if self.user_info else None
-                
-                if not motorista_cpf or self.user_info.get('tipo') != 'MOTORISTA':
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Apenas motoristas podem atualizar localização'
-                    }))
-                    return
-                
-                # Verificar múltiplos formatos de localização
-                latitude_str = data.get('latitude')
-                longitude_str = data.get('longitude')
-                
-                if not latitude_str or not longitude_str:
-                    location = data.get('location', {})
-                    if isinstance(location, dict):
-                        latitude_str = location.get('latitude')
-                        longitude_str = location.get('longitude')
-                
-                if not latitude_str or not longitude_str:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Latitude e longitude são obrigatórios'
-                    }))
-                    return
-                
-                try:
-                    latitude = float(latitude_str)
-                    longitude = float(longitude_str)
-                except ValueError:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Latitude e longitude devem ser numéricos'
-                    }))
-                    return
-                
-                # Atualizar localização no banco sem logs
-                await database_sync_to_async(atualizar_localizacao_motorista)(
-                    motorista_cpf, latitude, longitude
-                )
-                
-                # Verificar corridas em andamento para notificação
-                corrida_atual = await database_sync_to_async(obter_corrida_em_andamento)(motorista_cpf)
-                
-                # Notificar passageiro se existir corrida em andamento
-                if corrida_atual and corrida_atual.get('passageiro_cpf'):
-                    passageiro_group = f'passageiro_{corrida_atual["passageiro_cpf"]}'
-                    
-                    await self.channel_layer.group_send(
-                        passageiro_group,
+        if not corrida_id or not motorista_cpf:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'corridaId e motoristaId são obrigatórios'
+            }))
+            return
+
+        try:
+            sucesso, passageiro_cpf = await executar_no_banco(
+                finalizar_corrida, corrida_id, motorista_cpf, contexto=self.user_info, escrita=True
+            )
+            if sucesso:
+                await self.send(json.dumps({
+                    'type': 'corrida_finalizada',
+                    'corridaId': corrida_id,
+                    'message': 'Corrida finalizada com sucesso'
+                }))
+                if passageiro_cpf:
+                    passageiro_group = f'passageiro_{passageiro_cpf}'
+                    await enviar_com_sequencia(
+                        self.channel_layer, passageiro_group, passageiro_cpf,
                         {
-                            'type': 'localizacao_atualizada',
-                            'corridaId': corrida_atual.get('corrida_id'),
-                            'latitude': latitude,
-                            'longitude': longitude
+                            'type': 'corrida_finalizada_por_motorista',
+                            'corridaId': corrida_id,
+                            'message': 'O motorista finalizou a corrida.'
                         }
                     )
-                
-                # Responder com sucesso (sem logs)
+            else:
                 await self.send(json.dumps({
-                    'type': 'localizacao_atualizada',
-                    'message': 'Localização atualizada com sucesso'
+                    'type': 'erro',
+                    'message': 'Não foi possível finalizar a corrida'
                 }))
-                
-            # EVENTOS DE CHAT - Otimizar logs
-            elif event_type == 'mensagem_chat':
-                corrida_id = data.get('corridaId')
-                remetente_tipo = data.get('remetente')  # 'PASSAGEIRO' ou 'MOTORISTA'
-                conteudo = data.get('conteudo')
-
-                # Validar dados
-                if not corrida_id or not remetente_tipo or not conteudo:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Dados incompletos para envio de mensagem'
-                    }))
-                    return
-
-                # Validar tipo de remetente
-                if remetente_tipo not in ['PASSAGEIRO', 'MOTORISTA']:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Tipo de remetente inválido'
-                    }))
-                    return
-
-                # Registrar a mensagem no banco de dados
-                mensagem = await database_sync_to_async(registrar_mensagem_chat)(
-                    corrida_id, remetente_tipo, conteudo
-                )
+        except Exception as e:
+            logger.error(f"Erro ao finalizar corrida: {str(e)}")
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': f'Erro ao finalizar corrida: {str(e)}'
+            }))
+
+    # EVENTOS PARA ATUALIZAÇÕES DE LOCALIZAÇÃO - Reduzir logs
+    @eventos.evento('atualizar_localizacao')
+    @exige_tipo_usuario('MOTORISTA', 'Apenas motoristas podem atualizar localização')
+    async def evento_atualizar_localizacao(self, data):
+        motorista_cpf = self.user_info['cpf']
+        
+        # Verificar múltiplos formatos de localização
+        latitude_str = data.get('latitude')
+        longitude_str = data.get('longitude')
+        
+        if not latitude_str or not longitude_str:
+            location = data.get('location', {})
+            if isinstance(location, dict):
+                latitude_str = location.get('latitude')
+                longitude_str = location.get('longitude')
+        
+        if not latitude_str or not longitude_str:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Latitude e longitude são obrigatórios'
+            }))
+            return
+        
+        try:
+            latitude = float(latitude_str)
+            longitude = float(longitude_str)
+        except ValueError:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Latitude e longitude devem ser numéricos'
+            }))
+            return
+        
+        # Atualizar localização no banco sem logs e verificar corridas em andamento para notificação
+        # (evento mais frequente: um UPDATE e uma consulta pelo ORM assíncrono, sem o executor do banco)
+        await atualizar_localizacao_motorista_async(motorista_cpf, latitude, longitude, contexto=self.user_info)
+        corrida_atual = await obter_corrida_em_andamento_async(motorista_cpf, contexto=self.user_info)
+        
+        # Notificar passageiro se existir corrida em andamento
+        if corrida_atual and corrida_atual.get('passageiro_cpf'):
+            passageiro_group = f'passageiro_{corrida_atual["passageiro_cpf"]}'
+            
+            await self.channel_layer.group_send(
+                passageiro_group,
+                {
+                    'type': 'localizacao_atualizada',
+                    'corridaId': corrida_atual.get('corrida_id'),
+                    'latitude': latitude,
+                    'longitude': longitude
+                }
+            )
+        
+        # Responder com sucesso (sem logs)
+        await self.send(json.dumps({
+            'type': 'localizacao_atualizada',
+            'message': 'Localização atualizada com sucesso'
+        }))
 
-                if not mensagem:
-                    logger.error(f"Erro ao registrar mensagem para corrida {corrida_id}")
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'Erro ao registrar mensagem'
-                    }))
-                    return
+    # EVENTOS DE CHAT - Otimizar logs
+    @eventos.evento('mensagem_chat')
+    @exige_campos('corridaId', 'remetente', 'conteudo', mensagem='Dados incompletos para envio de mensagem')
+    async def evento_mensagem_chat(self, data):
+        corrida_id = data.get('corridaId')
+        remetente_tipo = data.get('remetente')  # 'PASSAGEIRO' ou 'MOTORISTA'
+        conteudo = data.get('conteudo')
 
-                # Log simplificado da mensagem
-                logger.info(f"Mensagem chat: corrida {corrida_id}, de {remetente_tipo[:3]}")
-                
-                # Determinar o destinatário da mensagem
-                try:
-                    from corridas.models import Corrida
-                    corrida = await database_sync_to_async(Corrida.objects.get)(id=corrida_id)
-
-                    # Obter CPFs do motorista e passageiro
-                    motorista_cpf = await database_sync_to_async(
-                        lambda: corrida.motorista.usuario.cpf if corrida.motorista and corrida.motorista.usuario else None
-                    )()
-                    
-                    passageiro_cpf = await database_sync_to_async(
-                        lambda: corrida.passageiro.usuario.cpf if corrida.passageiro and corrida.passageiro.usuario else None
-                    )()
-
-                    # Enviar mensagem para o destinatário apropriado
-                    if remetente_tipo == 'PASSAGEIRO' and motorista_cpf:
-                        destinatario_grupo = f'motorista_{motorista_cpf}'
-                        destinatario_tipo = 'MOTORISTA'
-                    elif remetente_tipo == 'MOTORISTA' and passageiro_cpf:
-                        destinatario_grupo = f'passageiro_{passageiro_cpf}'
-                        destinatario_tipo = 'PASSAGEIRO'
-                    else:
-                        logger.error(f"Não foi possível determinar o destinatário da mensagem")
-                        destinatario_grupo = None
-                        destinatario_tipo = None
-
-                    # Confirmar o envio ao remetente
-                    await self.send(json.dumps({
-                        'type': 'mensagem_enviada',
+        # Validar tipo de remetente
+        if remetente_tipo not in ['PASSAGEIRO', 'MOTORISTA']:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Tipo de remetente inválido'
+            }))
+            return
+
+        # Registrar a mensagem no banco de dados e obter as partes da corrida
+        resultado = await executar_no_banco(comando_mensagem_chat, corrida_id, remetente_tipo, conteudo, escrita=True)
+
+        if not resultado:
+            logger.error(f"Erro ao registrar mensagem para corrida {corrida_id}")
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Erro ao registrar mensagem'
+            }))
+            return
+
+        # Log simplificado da mensagem
+        logger.info(f"Mensagem chat: corrida {corrida_id}, de {remetente_tipo[:3]}")
+        
+        # Históricos em cache desta corrida ficaram desatualizados
+        for chave in [chave for chave in historico_chat_cache if chave[1] == corrida_id]:
+            historico_chat_cache.pop(chave, None)
+        
+        # Determinar o destinatário da mensagem
+        try:
+            mensagem = resultado['mensagem']
+            motorista_cpf = resultado['motorista_cpf']
+            passageiro_cpf = resultado['passageiro_cpf']
+
+            # Enviar mensagem para o destinatário apropriado
+            if remetente_tipo == 'PASSAGEIRO' and motorista_cpf:
+                destinatario_grupo = f'motorista_{motorista_cpf}'
+                destinatario_tipo = 'MOTORISTA'
+                destinatario_cpf = motorista_cpf
+            elif remetente_tipo == 'MOTORISTA' and passageiro_cpf:
+                destinatario_grupo = f'passageiro_{passageiro_cpf}'
+                destinatario_tipo = 'PASSAGEIRO'
+                destinatario_cpf = passageiro_cpf
+            else:
+                logger.error(f"Não foi possível determinar o destinatário da mensagem")
+                destinatario_grupo = None
+                destinatario_tipo = None
+                destinatario_cpf = None
+
+            # Confirmar o envio ao remetente
+            await self.send(json.dumps({
+                'type': 'mensagem_enviada',
+                'corridaId': corrida_id,
+                'id': str(mensagem.id),
+                'conteudo': conteudo,
+                'data': mensagem.data_envio.isoformat(),
+                'remetente': remetente_tipo
+            }))
+
+            # Encaminhar a mensagem ao destinatário
+            if destinatario_grupo:
+                await enviar_com_sequencia(
+                    self.channel_layer, destinatario_grupo, destinatario_cpf,
+                    {
+                        'type': 'nova_mensagem_chat',
                         'corridaId': corrida_id,
                         'id': str(mensagem.id),
                         'conteudo': conteudo,
                         'data': mensagem.data_envio.isoformat(),
                         'remetente': remetente_tipo
-                    }))
-
-                    # Encaminhar a mensagem ao destinatário
-                    if destinatario_grupo:
-                        await self.channel_layer.group_send(
-                            destinatario_grupo,
-                            {
-                                'type': 'nova_mensagem_chat',
-                                'corridaId': corrida_id,
-                                'id': str(mensagem.id),
-                                'conteudo': conteudo,
-                                'data': mensagem.data_envio.isoformat(),
-                                'remetente': remetente_tipo
-                            }
-                        )
-
-                except Exception as e:
-                    logger.error(f"Erro ao encaminhar mensagem de chat: {str(e)}")
-            
-            # EVENTO PARA AVALIAR MOTORISTA
-            elif event_type == 'avaliar_motorista':
-                corrida_id = data.get('corridaId')
-                avaliacao = data.get('avaliacao')
-                comentario = data.get('comentario')
-                passageiro_cpf = data.get('passageiroCpf') or (self.user_info.get('cpf') if self.user_info else None)
-
-                if not corrida_id or not avaliacao or not passageiro_cpf:
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': 'corridaId, avaliacao e passageiroCpf são obrigatórios'
-                    }))
-                    return
-
-                try:
-                    sucesso, motorista_cpf = await database_sync_to_async(avaliar_motorista)(corrida_id, passageiro_cpf, avaliacao, comentario)
-                    if sucesso:
-                        await self.send(json.dumps({
-                            'type': 'avaliacao_motorista_sucesso',
-                            'corridaId': corrida_id,
-                            'message': 'Avaliação do motorista registrada com sucesso.'
-                        }))
-                    else:
-                        await self.send(json.dumps({
-                            'type': 'erro',
-                            'message': 'Não foi possível registrar a avaliação do motorista.'
-                        }))
-                except Exception as e:
-                    logger.error(f"Erro ao avaliar motorista: {str(e)}")
-                    await self.send(json.dumps({
-                        'type': 'erro',
-                        'message': f'Erro ao avaliar motorista: {str(e)}'
-                    }))
-                return
+                    }
+                )
 
-            # ... outros manipuladores de eventos ...
-                
-        except json.JSONDecodeError:
-            logger.error("Erro ao decodificar JSON da mensagem recebida")
+        except Exception as e:
+            logger.error(f"Erro ao encaminhar mensagem de chat: {str(e)}")
+
+    # Histórico de mensagens da corrida (ao abrir o chat ou após resume_incompleto)
+    @eventos.evento('solicitar_historico_chat')
+    @exige_campos('corridaId', mensagem='ID da corrida é obrigatório')
+    async def evento_solicitar_historico_chat(self, data):
+        if not self.user_info or not self.user_info.get('cpf'):
             await self.send(json.dumps({
                 'type': 'erro',
-                'message': 'Formato de mensagem inválido'
+                'message': 'Faça login antes de solicitar o histórico do chat'
             }))
+            return
+        
+        cpf = self.user_info['cpf']
+        corrida_id = data.get('corridaId')
+        chave = (cpf, corrida_id)
+        agora = time.time()
+        
+        cache = historico_chat_cache.get(chave)
+        if cache and agora - cache['timestamp'] < CHAT_CACHE_TTL:
+            mensagens = cache['mensagens']
+            # O cache evita reler o histórico, mas a leitura ainda precisa ser registrada
+            if data.get('marcar_como_lidas', False) and mensagens:
+                await marcar_mensagens_lidas_async(corrida_id, cpf)
+        else:
+            mensagens = await obter_mensagens_chat_async(
+                corrida_id, cpf=cpf, marcar_como_lidas=data.get('marcar_como_lidas', False)
+            )
+            historico_chat_cache[chave] = {'timestamp': agora, 'mensagens': mensagens}
+        
+        await self.send(json.dumps({
+            'type': 'historico_chat',
+            'corridaId': corrida_id,
+            'mensagens': mensagens
+        }))
+
+    # EVENTO PARA AVALIAR MOTORISTA
+    @eventos.evento('avaliar_motorista')
+    async def evento_avaliar_motorista(self, data):
+        corrida_id = data.get('corridaId')
+        avaliacao = data.get('avaliacao')
+        comentario = data.get('comentario')
+        valido, passageiro_cpf = await self._identificar_comando(data.get('passageiroCpf'))
+        if not valido:
+            return
+
+        if not corrida_id or not avaliacao or not passageiro_cpf:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'corridaId, avaliacao e passageiroCpf são obrigatórios'
+            }))
+            return
+
+        try:
+            sucesso, motorista_cpf = await executar_no_banco(
+                avaliar_motorista, corrida_id, passageiro_cpf, avaliacao, comentario, contexto=self.user_info, escrita=True
+            )
+            if sucesso:
+                await self.send(json.dumps({
+                    'type': 'avaliacao_motorista_sucesso',
+                    'corridaId': corrida_id,
+                    'message': 'Avaliação do motorista registrada com sucesso.'
+                }))
+            else:
+                await self.send(json.dumps({
+                    'type': 'erro',
+                    'message': 'Não foi possível registrar a avaliação do motorista.'
+                }))
         except Exception as e:
-            logger.error(f"Erro ao processar mensagem: {str(e)}")
+            logger.error(f"Erro ao avaliar motorista: {str(e)}")
             await self.send(json.dumps({
                 'type': 'erro',
-                'message': f'Erro ao processar solicitação: {str(e)}'
+                'message': f'Erro ao avaliar motorista: {str(e)}'
             }))
 
+    # EVENTOS DE INSCRIÇÃO EM TÓPICOS (região, anúncios, operação)
+    @eventos.evento('inscrever_topico')
+    @exige_campos('topico', mensagem='Tópico é obrigatório')
+    async def evento_inscrever_topico(self, data):
+        topico = data.get('topico')
+        if not self.user_info or not self.user_info.get('cpf'):
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Faça login antes de se inscrever em tópicos'
+            }))
+            return
+        
+        try:
+            grupo = grupo_topico(topico, data.get('latitude'), data.get('longitude'))
+        except TopicoInvalido as e:
+            await self.send(json.dumps({'type': 'erro', 'message': str(e)}))
+            return
+        
+        permissao = permissao_topico(topico)
+        if permissao == 'STAFF' and 'is_staff' in self.user_info:
+            permitido = self.user_info['is_staff']
+        elif permissao == 'STAFF':
+            permitido = await executar_no_banco(usuario_e_equipe, self.user_info['cpf'], transacao=False)
+        else:
+            permitido = permissao is None or self.user_info.get('tipo') == permissao
+        if not permitido:
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': f'Sem permissão para o tópico {topico}'
+            }))
+            return
+        
+        anterior = self.topicos.get(topico)
+        if anterior is None and len(self.topicos) >= getattr(settings, 'TOPICOS_MAXIMO_POR_CONEXAO', 10):
+            await self.send(json.dumps({
+                'type': 'erro',
+                'message': 'Limite de tópicos por conexão atingido'
+            }))
+            return
+        # Uma única região por conexão: mudar de célula troca a inscrição
+        if anterior and anterior != grupo:
+            await self._sair_grupo(anterior)
+        await self._entrar_grupo(grupo)
+        self.topicos[topico] = grupo
+        
+        await self.send(json.dumps({
+            'type': 'topico_inscrito',
+            'topico': topico
+        }))
+
+    @eventos.evento('cancelar_topico')
+    @exige_campos('topico', mensagem='Tópico é obrigatório')
+    async def evento_cancelar_topico(self, data):
+        topico = data.get('topico')
+        grupo = self.topicos.pop(topico, None)
+        if grupo:
+            await self._sair_grupo(grupo)
+        await self.send(json.dumps({
+            'type': 'topico_cancelado',
+            'topico': topico
+        }))
+
     # Métodos para enviar mensagens específicas entre grupos
     async def nova_solicitacao_corrida(self, event):
+        # Mensagem já serializada por difundir_para_grupos: vai direto ao socket
+        if 'texto' in event:
+            await self.send(text_data=event['texto'], prioridade=PRIORIDADE_ALTA)
+            return
         try:
             # Log simplificado da nova solicitação
             logger.info(f"Enviando solicitação de corrida para motorista")
@@ -1175,7 +1341,7 @@ class MoveXConsumer(AsyncWebsocketConsumer):
             }
             
             # Enviar a mensagem
-            await self.send(json.dumps(mensagem))
+            await self.send(json.dumps(mensagem), prioridade=PRIORIDADE_ALTA)
             
         except Exception as e:
             logger.error(f"Erro ao enviar nova solicitação de corrida: {str(e)}")
@@ -1199,51 +1365,80 @@ class MoveXConsumer(AsyncWebsocketConsumer):
                     'distancia': event.get('distancia', 0),
                     'tempo_estimado': event.get('tempo_estimado', '0 min')
                 }
-                await self.send(json.dumps(mensagem_minima))
+                await self.send(json.dumps(mensagem_minima), prioridade=PRIORIDADE_ALTA)
                 logger.warning("Enviada mensagem mínima como fallback")
             except Exception as fallback_error:
                 logger.error(f"Erro ao enviar mensagem mínima: {str(fallback_error)}")
 
     # Função utilitária para gerenciar conexões
-    def _manage_connections(self):
+    async def _registrar_conexao(self):
         """
-        Gerencia as conexões ativas para este usuário
-        Retorna True se a conexão atual é permitida, False se deve ser encerrada
+        Registra esta conexão no registro compartilhado entre workers. Se o usuário
+        passar de MAX_CONNECTIONS_PER_USER, as conexões mais antigas são encerradas,
+        estejam no worker que estiverem.
         """
         if not self.user_info or 'cpf' not in self.user_info:
-            return True  # Não gerenciar se não estiver autenticado
+            return  # Não gerenciar se não estiver autenticado
         
         cpf = self.user_info['cpf']
-        now = time.time()
-        
-        # Registrar esta conexão
-        active_connections[cpf][self.connection_id] = now
-        
-        # Log simplificado de conexões
-        total_connections = len(active_connections[cpf])
-        if total_connections > 1:
-            logger.info(f"Usuário {cpf} tem {total_connections} conexões ativas")
-        
-        # Se o usuário tem muitas conexões, manter apenas as mais recentes
-        if total_connections > MAX_CONNECTIONS_PER_USER:
-            # Ordenar conexões por timestamp (mais antigas primeiro)
-            sorted_connections = sorted(
-                active_connections[cpf].items(), 
-                key=lambda x: x[1]
+        try:
+            # Grupo por usuário para receber o aviso de substituição. Um grupo (e não
+            # channel_layer.send direto ao canal) porque o channels_redis escolhe o
+            # shard de um envio direto por um hash diferente do usado na leitura.
+            await self._entrar_grupo(f'conexoes_{cpf}')
+            removidas = await obter_registro_conexoes().registrar(
+                cpf, self.connection_id, self.channel_name, MAX_CONNECTIONS_PER_USER
             )
-            
-            # Verificar se esta conexão está entre as mais recentes
-            # Se não estiver nas N conexões mais recentes, encerrar
-            recent_connections = dict(sorted_connections[-MAX_CONNECTIONS_PER_USER:])
-            if self.connection_id not in recent_connections:
-                logger.warning(f"Excesso de conexões para {cpf}. Esta conexão será encerrada.")
-                return False
-            
-            # Limpar conexões antigas
-            active_connections[cpf] = recent_connections
-            logger.info(f"Mantidas apenas {len(recent_connections)} conexões recentes para {cpf}")
+        except Exception as e:
+            # Sem o registro a conexão segue funcionando, apenas sem o limite por usuário
+            logger.error(f"Erro ao registrar conexão de {cpf}: {str(e)}")
+            return
         
-        return True
+        encerrar = []
+        for connection_id, canal in removidas:
+            logger.warning(f"Excesso de conexões para {cpf}. Encerrando conexão {connection_id}.")
+            if canal != self.channel_name:
+                encerrar.append(connection_id)
+        if encerrar:
+            await self.channel_layer.group_send(
+                f'conexoes_{cpf}',
+                {'type': 'conexao_substituida', 'conexoes': encerrar}
+            )
+    
+    async def _renovar_periodicamente(self):
+        """
+        Renova o TTL da conexão no registro a cada terço do TTL enquanto o socket
+        estiver aberto. Se a entrada sumiu (expirou ou o registro falhou no login),
+        a conexão se registra de novo para não ser podada pela auditoria de grupos.
+        """
+        while True:
+            registro = obter_registro_conexoes()
+            await asyncio.sleep(registro.ttl / 3)
+            if not self.user_info or 'cpf' not in self.user_info or self.substituida:
+                continue
+            try:
+                renovada = await registro.renovar(self.user_info['cpf'], self.connection_id)
+            except Exception as e:
+                logger.error(f"Erro ao renovar conexão {self.connection_id}: {str(e)}")
+                continue
+            if not renovada:
+                await self._registrar_conexao()
+
+    # Handler para mensagens publicadas em um tópico (já serializadas por publicar_topico)
+    async def mensagem_topico(self, event):
+        await self.send(text_data=event['texto'])
+
+    # Handler para conexões encerradas por excesso de conexões do mesmo usuário
+    async def conexao_substituida(self, event):
+        if self.connection_id not in event.get('conexoes', []):
+            return
+        self.substituida = True
+        await self.send(text_data=json.dumps({
+            'type': 'error',
+            'message': 'Muitas conexões ativas para este usuário. Esta conexão será encerrada.',
+            'code': 'TOO_MANY_CONNECTIONS'
+        }), prioridade=PRIORIDADE_ALTA)
+        await self.close(code=4001)
 
     # Handler para a notificação de desconexão do motorista (enviado a passageiros)
     async def motorista_desconectado(self, event):
@@ -1251,7 +1446,7 @@ class MoveXConsumer(AsyncWebsocketConsumer):
             'type': 'motorista_desconectado',
             'message': event.get('message', 'O motorista se desconectou temporariamente.'),
             'timestamp': str(timezone.now())
-        }))
+        }), prioridade=PRIORIDADE_ALTA)
         
     # Handler para corrida aceita pelo motorista (enviado ao passageiro)
     async def corrida_aceita_por_motorista(self, event):
@@ -1296,24 +1491,28 @@ class MoveXConsumer(AsyncWebsocketConsumer):
             'corridaId': event.get('corridaId'),
             'motorista': motorista_reformatado,
             'message': 'Um motorista aceitou sua solicitação de corrida.'
-        }))
+        }), prioridade=PRIORIDADE_ALTA)
     
     # Handler para corrida aceita por outro motorista (enviado a outros motoristas)
     async def corrida_aceita_por_outro(self, event):
+        if 'texto' in event:
+            await self.send(text_data=event['texto'], prioridade=PRIORIDADE_ALTA)
+            return
         await self.send(text_data=json.dumps({
             'type': 'corrida_indisponivel',
             'corridaId': event.get('corridaId'),
             'message': event.get('message', 'A corrida foi aceita por outro motorista.')
-        }))
+        }), prioridade=PRIORIDADE_ALTA)
     
     # Handler para atualização de localização (enviado ao passageiro)
     async def localizacao_atualizada(self, event):
+        # Uma localização ainda não enviada é substituída pela mais recente da mesma corrida
         await self.send(text_data=json.dumps({
             'type': 'localizacao_motorista_atualizada',
             'corridaId': event.get('corridaId'),
             'latitude': event.get('latitude'),
             'longitude': event.get('longitude')
-        }))
+        }), prioridade=PRIORIDADE_BAIXA, chave=('localizacao', event.get('corridaId')))
     
     # Handler para nova mensagem de chat
     async def nova_mensagem_chat(self, event):
@@ -1357,7 +1556,8 @@ class MoveXConsumer(AsyncWebsocketConsumer):
                     passageiro_cpf,
                     titulo,
                     mensagem_push,
-                    dados_adicionais
+                    dados_adicionais,
+                    evento=f"nova_mensagem_chat:{event.get('id')}"
                 )
             else:
                 # Não há necessidade de notificação ou não é uma mensagem do motorista para o passageiro
@@ -1436,7 +1636,7 @@ class MoveXConsumer(AsyncWebsocketConsumer):
             logger.info(f"Enviando aviso de chegada do motorista para passageiro - corridaId={corridaId}")
         
         # Enviar a mensagem ao cliente
-        await self.send(text_data=json.dumps(mensagem_chegada))
+        await self.send(text_data=json.dumps(mensagem_chegada), prioridade=PRIORIDADE_ALTA)
         
         # NOTIFICAÇÃO PUSH: Enviar notificação quando o motorista chegar ao local
         try:
@@ -1534,7 +1734,7 @@ class MoveXConsumer(AsyncWebsocketConsumer):
         }
         
         # Enviar a mensagem no formato esperado pelo cliente
-        await self.send(text_data=json.dumps(mensagem))
+        await self.send(text_data=json.dumps(mensagem), prioridade=PRIORIDADE_ALTA)
         
         # NOTIFICAÇÃO PUSH: Enviar notificação quando o motorista aceitar a corrida
         try:
@@ -1572,7 +1772,7 @@ class MoveXConsumer(AsyncWebsocketConsumer):
             'type': 'corrida_iniciada',
             'corridaId': event.get('corridaId'),
             'message': event.get('message', 'Sua corrida foi iniciada!')
-        }))
+        }), prioridade=PRIORIDADE_ALTA)
 
     # Handler para notificação de finalização de corrida pelo motorista (enviado ao passageiro)
     async def corrida_finalizada_por_motorista(self, event):
@@ -1580,48 +1780,70 @@ class MoveXConsumer(AsyncWebsocketConsumer):
             'type': 'corrida_finalizada',
             'corridaId': event.get('corridaId'),
             'message': event.get('message', 'O motorista finalizou a corrida.')
-        }))
+        }), prioridade=PRIORIDADE_ALTA)
 
-# Função auxiliar para buscar token push do passageiro
-@database_sync_to_async
-def buscar_token_passageiro(cpf_passageiro):
+
+_ondas_em_andamento = set()  # referências às tarefas das ondas seguintes (o loop guarda só referências fracas)
+
+
+async def _ofertar_onda(channel_layer, motoristas, mensagem):
+    # O ETA só define a ordem das ondas: toda a onda recebe o mesmo frame, serializado uma vez
+    await difundir_para_grupos(
+        channel_layer, [f'motorista_{m["cpf"]}' for m in motoristas], 'nova_solicitacao_corrida', mensagem
+    )
+
+
+async def _ofertar_ondas_seguintes(channel_layer, corrida_id, ondas, mensagem, espera):
+    for onda in ondas:
+        await asyncio.sleep(espera)
+        if not await corrida_pendente_async(corrida_id):
+            return
+        logger.info(f"Corrida {corrida_id} sem aceite em {espera}s: oferecendo a mais {len(onda)} motoristas")
+        await _ofertar_onda(channel_layer, onda, mensagem)
+
+
+async def ofertar_corrida_em_ondas(channel_layer, corrida_id, motoristas, mensagem):
     """
-    Busca o token push de um passageiro pelo CPF
-    Retorna o token e um booleano indicando se está ativo
+    Oferece a corrida aos motoristas na ordem recebida (por ETA), em ondas de
+    settings.DESPACHO_TAMANHO_ONDA: a primeira é enviada já e cada uma das
+    seguintes só depois de settings.DESPACHO_ESPERA_ONDA segundos sem aceite.
+    
+    Returns:
+        asyncio.Task das ondas seguintes, ou None se todos couberam na primeira
     """
-    try:
-        from usuarios.models import Usuario, PushToken
-        usuario = Usuario.objects.get(cpf=cpf_passageiro)
-        token = PushToken.objects.filter(usuario=usuario, ativo=True).first()
-        if token:
-            logger.info(f"Token push encontrado para passageiro {cpf_passageiro}")
-            return token.token, True
-        else:
-            logger.warning(f"Nenhum token push encontrado para passageiro {cpf_passageiro}")
-            return None, False
-    except Exception as e:
-        logger.error(f"Erro ao buscar token push do passageiro {cpf_passageiro}: {str(e)}")
-        return None, False
+    tamanho = max(1, getattr(settings, 'DESPACHO_TAMANHO_ONDA', 5))
+    ondas = [motoristas[inicio:inicio + tamanho] for inicio in range(0, len(motoristas), tamanho)]
+    if not ondas:
+        return None
+    await _ofertar_onda(channel_layer, ondas[0], mensagem)
+    if len(ondas) == 1:
+        return None
+    tarefa = asyncio.ensure_future(_ofertar_ondas_seguintes(
+        channel_layer, corrida_id, ondas[1:], mensagem, getattr(settings, 'DESPACHO_ESPERA_ONDA', 15)
+    ))
+    _ondas_em_andamento.add(tarefa)
+    tarefa.add_done_callback(_ondas_em_andamento.discard)
+    return tarefa
+
 
-async def enviar_notificacao_passageiro(cpf_passageiro, titulo, mensagem, dados=None):
+async def enviar_notificacao_passageiro(cpf_passageiro, titulo, mensagem, dados=None, evento=None):
     """
-    Envia uma notificação push para um passageiro específico
+    Envia uma notificação push para um passageiro específico.
+    A notificação é gravada no outbox (usuarios.NotificacaoPush) e entregue pelo
+    comando processar_notificacoes_push ou pela tarefa do processo web
+    (iniciar_outbox_no_processo), com novas tentativas se o Expo falhar.
     """
+    dados = dados or {}
+    evento = evento or dados.get('tipo', 'notificacao')
     try:
-        token_tuple = await buscar_token_passageiro(cpf_passageiro)
-        token, ativo = token_tuple
-        
-        if token and ativo:
-            # Importa a função para o escopo local para evitar problemas de importação circular
-            from movex.utils import enviar_notificacao_push
-            resultado = enviar_notificacao_push(token, titulo, mensagem, dados)
-            logger.info(f"Resultado do envio de notificação push para {cpf_passageiro}: {resultado}")
-            return resultado
-        else:
-            logger.warning(f"Não foi possível enviar notificação push: token inativo ou não encontrado")
-            return False
+        resultado = await executar_no_banco(
+            registrar_notificacao_push, cpf_passageiro, evento, titulo, mensagem, dados, corrida_id=dados.get('corridaId'),
+            escrita=True
+        )
+        logger.info(f"Notificação push {evento} para {cpf_passageiro} registrada: {resultado}")
+        return resultado
     except Exception as e:
-        logger.exception(f"Erro ao enviar notificação push para passageiro {cpf_passageiro}: {str(e)}")
+        logger.exception(f"Erro ao registrar notificação push para passageiro {cpf_passageiro}: {str(e)}")
         return False
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -1,34 +1,117 @@
 import uuid
 import logging
-import re
+from datetime import timedelta
 from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
-from usuarios.models import Usuario, Motorista, Passageiro
+from usuarios.models import Usuario, Motorista, Passageiro, NotificacaoPush, PushToken
 from corridas.models import Corrida
 from .utils import calcular_distancia
+from .push_services import cache_tokens_push
+from .db_executor import executar_no_banco, obter_escritor_banco
 
 logger = logging.getLogger(__name__)
 
-def verificar_corridas_em_andamento(cpf_motorista):
+# ===== Contexto do usuário autenticado =====
+# As funções abaixo aceitam `contexto`, o user_info de uma conexão autenticada pelo
+# token no handshake (TokenAuthMiddleware): com ele o papel do usuário já foi
+# verificado e as PKs de Motorista/Passageiro são conhecidas, então a consulta a
+# Usuario é dispensada. Sem contexto (ou de outro CPF) o usuário é buscado pelo CPF.
+
+def contexto_usuario_por_token(chave):
+    """
+    Contexto compacto do usuário dono de um token DRF, em uma única consulta.
+    
+    Returns:
+        dict: cpf, tipo, usuario_id, motorista_pk, passageiro_pk e is_staff,
+        ou None se o token não existir ou o usuário estiver inativo
+    """
+    from rest_framework.authtoken.models import Token
+    
+    try:
+        token = Token.objects.select_related('user', 'user__motorista', 'user__passageiro').filter(
+            key=chave, user__is_active=True
+        ).first()
+    except Exception as e:
+        logger.error(f"Erro ao validar token de conexão WebSocket: {str(e)}")
+        return None
+    if token is None:
+        return None
+    
+    usuario = token.user
+    # Perfis inexistentes levantam RelatedObjectDoesNotExist, um AttributeError
+    motorista = getattr(usuario, 'motorista', None)
+    passageiro = getattr(usuario, 'passageiro', None)
+    return {
+        'cpf': usuario.cpf,
+        'tipo': usuario.tipo_usuario,
+        'usuario_id': usuario.pk,
+        'motorista_pk': motorista.pk if motorista else None,
+        'passageiro_pk': passageiro.pk if passageiro else None,
+        'is_staff': usuario.is_staff,
+    }
+
+def _do_contexto(contexto, cpf, campo):
+    if contexto and contexto.get('cpf') == cpf:
+        return contexto.get(campo)
+    return None
+
+def _buscar_motorista(cpf, contexto=None):
+    """Motorista com o usuário, em uma consulta. Raises: Motorista.DoesNotExist"""
+    pk = _do_contexto(contexto, cpf, 'motorista_pk')
+    motoristas = Motorista.objects.select_related('usuario')
+    if pk is not None:
+        return motoristas.get(pk=pk)
+    return motoristas.get(usuario__cpf=cpf, usuario__tipo_usuario='MOTORISTA')
+
+def _buscar_passageiro(cpf, contexto=None):
+    """Passageiro com o usuário, em uma consulta. Raises: Passageiro.DoesNotExist"""
+    pk = _do_contexto(contexto, cpf, 'passageiro_pk')
+    passageiros = Passageiro.objects.select_related('usuario')
+    if pk is not None:
+        return passageiros.get(pk=pk)
+    return passageiros.get(usuario__cpf=cpf, usuario__tipo_usuario='PASSAGEIRO')
+
+def _pk_motorista(cpf, contexto=None):
+    """PK do motorista, sem consultas quando vem do contexto (para filtros e comparações)."""
+    pk = _do_contexto(contexto, cpf, 'motorista_pk')
+    if pk is not None:
+        return pk
+    return Motorista.objects.values_list('pk', flat=True).get(usuario__cpf=cpf, usuario__tipo_usuario='MOTORISTA')
+
+def _pk_passageiro(cpf, contexto=None):
+    pk = _do_contexto(contexto, cpf, 'passageiro_pk')
+    if pk is not None:
+        return pk
+    return Passageiro.objects.values_list('pk', flat=True).get(usuario__cpf=cpf, usuario__tipo_usuario='PASSAGEIRO')
+
+def _filtro_motorista(cpf, contexto=None, campo='pk'):
+    """Filtro do motorista sem consulta prévia: pela PK do contexto ou pelo CPF do usuário."""
+    pk = _do_contexto(contexto, cpf, 'motorista_pk')
+    if pk is not None:
+        return {campo: pk}
+    relacao = '' if campo == 'pk' else campo.rsplit('_', 1)[0] + '__'
+    return {f'{relacao}usuario__cpf': cpf, f'{relacao}usuario__tipo_usuario': 'MOTORISTA'}
+
+STATUS_CORRIDA_ATIVA = ['ACEITA', 'EM_ANDAMENTO']
+
+def verificar_corridas_em_andamento(cpf_motorista, contexto=None):
     """Verifica se o motorista possui corridas em andamento e marca como temporariamente indisponível"""
     try:
-        usuario = Usuario.objects.get(cpf=cpf_motorista, tipo_usuario='MOTORISTA')
-        motorista = Motorista.objects.get(usuario=usuario)
-        
-        # Buscar corridas aceitas por este motorista
-        corridas_ativas = Corrida.objects.filter(
-            motorista=motorista,
-            status__in=['ACEITA', 'EM_ANDAMENTO']
-        )
-        
-        for corrida in corridas_ativas:
-            # Marcar corrida como temporariamente interrompida
-            corrida.motorista_temporariamente_desconectado = True
-            corrida.save()
-            
-            logger.info(f"Corrida {corrida.id} marcada como temporariamente interrompida devido à desconexão do motorista")
+        # Buscar corridas aceitas por este motorista, já com o CPF do passageiro
+        corridas_ativas = list(Corrida.objects.filter(
+            status__in=STATUS_CORRIDA_ATIVA, **_filtro_motorista(cpf_motorista, contexto, campo='motorista_id')
+        ).values_list('id', 'passageiro__usuario__cpf'))
+        
+        # Marcar todas como temporariamente interrompidas em um único UPDATE
+        if corridas_ativas:
+            Corrida.objects.filter(id__in=[corrida_id for corrida_id, _ in corridas_ativas]).update(
+                motorista_temporariamente_desconectado=True
+            )
+            logger.info(f"Corridas {[str(corrida_id) for corrida_id, _ in corridas_ativas]} marcadas como temporariamente interrompidas devido à desconexão do motorista")
                 
-        return True, [c.passageiro.usuario.cpf for c in corridas_ativas if c.passageiro and c.passageiro.usuario]
+        return True, [passageiro_cpf for _, passageiro_cpf in corridas_ativas if passageiro_cpf]
     except Exception as e:
         logger.error(f"Erro ao verificar corridas em andamento: {str(e)}")
         return False, []
@@ -44,7 +127,8 @@ def buscar_motoristas_disponiveis(lat, lng, raio_km=10):
             status='DISPONIVEL'
         ).select_related('usuario')
         
-        print(f"[DEBUG] Encontrados {motoristas.count()} motoristas com status 'DISPONIVEL'")
+        motoristas = list(motoristas)
+        print(f"[DEBUG] Encontrados {len(motoristas)} motoristas com status 'DISPONIVEL'")
         for m in motoristas:
             print(f"[DEBUG] - Motorista: {m.usuario.nome} {m.usuario.sobrenome}, CPF: {m.cpf}, Status: {m.status}, Disponível: {m.esta_disponivel}")
         
@@ -75,6 +159,8 @@ def buscar_motoristas_disponiveis(lat, lng, raio_km=10):
                         'cpf': motorista.cpf,
                         'nome': motorista.usuario.get_full_name(),
                         'distancia': distancia,
+                        'latitude': motorista_lat,
+                        'longitude': motorista_lng,
                         'veiculo': {
                             'modelo': motorista.modelo_veiculo,
                             'placa': motorista.placa_veiculo,
@@ -110,7 +196,7 @@ def buscar_motoristas_disponiveis(lat, lng, raio_km=10):
         traceback.print_exc()
         return []
 
-def registrar_corrida(dados):
+def registrar_corrida(dados, contexto=None):
     """Registra uma nova corrida no banco de dados"""
     try:
         passageiro_cpf = dados.get('passageiro', {}).get('cpf')
@@ -121,8 +207,7 @@ def registrar_corrida(dados):
         
         # Buscar o passageiro pelo CPF
         try:
-            usuario = Usuario.objects.get(cpf=passageiro_cpf, tipo_usuario='PASSAGEIRO')
-            passageiro = Passageiro.objects.get(usuario=usuario)
+            passageiro = _buscar_passageiro(passageiro_cpf, contexto)
         except (Usuario.DoesNotExist, Passageiro.DoesNotExist):
             logger.error(f"Passageiro não encontrado para o CPF: {passageiro_cpf}")
             return None
@@ -140,17 +225,17 @@ def registrar_corrida(dados):
         destino_descricao = dados.get('destino_descricao', 'Local de destino')
         
         # Capturar informações de contato do passageiro para o motorista
-        telefone_passageiro = dados.get('passageiro', {}).get('telefone', usuario.telefone)
+        dados_passageiro = dados.get('passageiro', {})
+        if 'telefone' in dados_passageiro:
+            telefone_passageiro = dados_passageiro['telefone']
+        else:
+            telefone_passageiro = passageiro.usuario.telefone
         
         # Criar o registro da corrida com ID único
         corrida_id = uuid.uuid4()
         
-        # Extrair tempo_estimado usando regex para pegar somente dígitos
-        tempo_str = str(dados.get('tempo_estimado', 0))
-        logger.info(f"Tempo estimado (original): '{tempo_str}'")
-        match = re.search(r'\d+', tempo_str)
-        tempo_int = int(match.group(0)) if match else 0
-        logger.info(f"Tempo estimado (extraído): {tempo_int}")
+        # Minutos da cotação assinada (solicitar_corrida substitui os valores do cliente)
+        tempo_int = int(dados.get('tempo_estimado', 0))
         
         # Imprime todos os dados antes de criar a corrida para debug
         logger.info(f"Dados para criar corrida: origem_lat={origem_lat}, origem_lng={origem_lng}, "
@@ -187,50 +272,47 @@ def registrar_corrida(dados):
         traceback.print_exc()
         return None
 
-def aceitar_corrida(corrida_id, motorista_cpf, status='ACEITA'):
+def aceitar_corrida(corrida_id, motorista_cpf, status='ACEITA', contexto=None):
     """Motorista aceita uma corrida pendente e sistema notifica os demais motoristas"""
     try:
-        # Verificar se a corrida existe e está pendente
-        try:
-            corrida = Corrida.objects.get(id=corrida_id, status='PENDENTE')
-        except Corrida.DoesNotExist:
-            logger.error(f"Corrida não encontrada ou não está pendente: {corrida_id}")
-            return False, None, []
-
         # Buscar o motorista pelo CPF
         try:
-            usuario = Usuario.objects.get(cpf=motorista_cpf, tipo_usuario='MOTORISTA')
-            motorista = Motorista.objects.get(usuario=usuario)
-        except (Usuario.DoesNotExist, Motorista.DoesNotExist):
+            motorista_pk = _pk_motorista(motorista_cpf, contexto)
+        except Motorista.DoesNotExist:
             logger.error(f"Motorista não encontrado para o CPF: {motorista_cpf}")
             return False, None, []
 
-        # Atualizar a corrida
-        corrida.motorista = motorista
-        corrida.status = status  # Usar o status fornecido
-        corrida.data_aceite = timezone.now()
-        corrida.save()
+        # Aceitar apenas se a corrida ainda estiver pendente: o UPDATE condicional
+        # também impede que dois motoristas aceitem a mesma corrida
+        aceitas = Corrida.objects.filter(id=corrida_id, status='PENDENTE').update(
+            motorista_id=motorista_pk,
+            status=status,  # Usar o status fornecido
+            data_aceite=timezone.now()
+        )
+        if not aceitas:
+            logger.error(f"Corrida não encontrada ou não está pendente: {corrida_id}")
+            return False, None, []
 
         # Atualizar status do motorista para ocupado
-        motorista.status = 'OCUPADO'
-        motorista.esta_disponivel = False
-        motorista.save()
+        Motorista.objects.filter(pk=motorista_pk).update(status='OCUPADO', esta_disponivel=False)
 
         logger.info(f"Corrida {corrida_id} aceita pelo motorista {motorista_cpf} com status {status}")
 
-        # Buscar todos os motoristas ativos para notificá-los sobre a corrida já aceita
-        outros_motoristas = Motorista.objects.filter(
+        # CPFs dos motoristas ativos para notificá-los sobre a corrida já aceita
+        # (a PK do motorista é o CPF do usuário)
+        outros_cpfs = list(Motorista.objects.filter(
             esta_disponivel=True,
             status='DISPONIVEL'
-        ).exclude(usuario__cpf=motorista_cpf).select_related('usuario')
-
-        # Coletar CPFs dos outros motoristas para notificação
-        outros_cpfs = [m.usuario.cpf for m in outros_motoristas]
+        ).exclude(pk=motorista_pk).values_list('pk', flat=True))
 
         logger.info(f"Notificando {len(outros_cpfs)} outros motoristas que a corrida foi aceita")
 
+        passageiro_cpf = Corrida.objects.filter(id=corrida_id).values_list(
+            'passageiro__usuario__cpf', flat=True
+        ).first()
+
         # Retorna True, o CPF do passageiro e a lista de outros motoristas para notificação
-        return True, corrida.passageiro.usuario.cpf, outros_cpfs
+        return True, passageiro_cpf, outros_cpfs
 
     except Exception as e:
         logger.error(f"Erro ao aceitar corrida: {str(e)}")
@@ -246,40 +328,18 @@ def atualizar_status_motorista(cpf, status, esta_disponivel):
     try:
         print(f"[DEBUG] Tentando atualizar status do motorista {cpf} para {status} (disponível: {esta_disponivel})")
         
-        from django.utils import timezone
-        from usuarios.models import Motorista
-        
-        # Buscar o motorista pelo CPF
-        motorista = Motorista.objects.filter(cpf=cpf).first()
-        
-        if not motorista:
-            print(f"[ERROR] Motorista com CPF {cpf} não encontrado")
-            return False
-        
-        # Registrar status anterior para logging
-        status_anterior = motorista.status
-        disponivel_anterior = motorista.esta_disponivel
-        
-        # Atualizar status
-        motorista.status = status
-        motorista.esta_disponivel = esta_disponivel
+        campos = {'status': status, 'esta_disponivel': esta_disponivel}
         
         # Se ficar disponível, atualizar também a localização
         if esta_disponivel:
-            motorista.ultima_atualizacao_localizacao = timezone.now()
+            campos['ultima_atualizacao_localizacao'] = timezone.now()
         
-        # Salvar as alterações usando update_fields para garantir que apenas os campos alterados sejam atualizados
-        motorista.save(update_fields=['status', 'esta_disponivel', 'ultima_atualizacao_localizacao'])
-
-        # Também fazer um update direto para garantir a atualização dos dados
-        from django.db import connection
-        cursor = connection.cursor()
-        cursor.execute(
-            "UPDATE usuarios_motorista SET status = %s, esta_disponivel = %s WHERE cpf = %s", 
-            [status, esta_disponivel, cpf]
-        )
+        # Um único UPDATE, sem carregar o motorista
+        if not Motorista.objects.filter(cpf=cpf).update(**campos):
+            print(f"[ERROR] Motorista com CPF {cpf} não encontrado")
+            return False
         
-        print(f"[DEBUG] Status do motorista {cpf} atualizado com sucesso: {status_anterior} -> {status}, {disponivel_anterior} -> {esta_disponivel}")
+        print(f"[DEBUG] Status do motorista {cpf} atualizado com sucesso: {status}, disponível: {esta_disponivel}")
         return True
         
     except Exception as e:
@@ -301,7 +361,7 @@ def limpar_corrida_da_memoria(corrida_id):
     """
     try:
         # Remover da memória do sistema - por exemplo, limpar caches específicos para esta corrida
-        from movex.consumers import historico_chat_cache, request_rate_limiter
+        from movex.consumers import historico_chat_cache
         
         # Limpar referências no cache de histórico de chat
         chaves_para_remover = []
@@ -314,17 +374,6 @@ def limpar_corrida_da_memoria(corrida_id):
             if chave in historico_chat_cache:
                 del historico_chat_cache[chave]
                 
-        # Limpar referências no limitador de taxa
-        chaves_rate_para_remover = []
-        for chave in request_rate_limiter.keys():
-            # A chave é (cpf, request_type, parameter)
-            if chave[2] == str(corrida_id):
-                chaves_rate_para_remover.append(chave)
-                
-        for chave in chaves_rate_para_remover:
-            if chave in request_rate_limiter:
-                del request_rate_limiter[chave]
-                
         return True
     except Exception as e:
         import logging
@@ -338,7 +387,7 @@ def buscar_dados_motorista(cpf_motorista):
     """
     try:
         # Tenta buscar o motorista pelo CPF
-        motorista = Motorista.objects.get(cpf=cpf_motorista)
+        motorista = Motorista.objects.select_related('usuario').get(cpf=cpf_motorista)
         
         # Acessar os atributos pessoais através do relacionamento com Usuario
         return {
@@ -359,59 +408,51 @@ def buscar_dados_motorista(cpf_motorista):
         print(traceback.format_exc())
         return None
 
-def atualizar_localizacao_motorista(cpf, latitude, longitude):
+def atualizar_localizacao_motorista(cpf, latitude, longitude, contexto=None):
     """Atualiza a localização de um motorista"""
     try:
-        usuario = Usuario.objects.get(cpf=cpf, tipo_usuario='MOTORISTA')
-        motorista = Motorista.objects.get(usuario=usuario)
-        
-        # Assumindo que você tenha esses campos no modelo Motorista
-        # Se não tiver, você precisará adicionar ou usar outra tabela
-        motorista.ultima_latitude = Decimal(str(latitude))
-        motorista.ultima_longitude = Decimal(str(longitude))
-        motorista.ultima_atualizacao_localizacao = timezone.now()
-        motorista.save()
+        atualizados = Motorista.objects.filter(**_filtro_motorista(cpf, contexto)).update(
+            ultima_latitude=Decimal(str(latitude)),
+            ultima_longitude=Decimal(str(longitude)),
+            ultima_atualizacao_localizacao=timezone.now()
+        )
         
         #logger.info(f"Localização do motorista {cpf} atualizada: {latitude}, {longitude}")
-        return True
+        return atualizados > 0
     except Exception as e:
         logger.error(f"Erro ao atualizar localização do motorista: {str(e)}")
         return False
 
-def obter_corrida_em_andamento(cpf_motorista):
+def obter_corrida_em_andamento(cpf_motorista, contexto=None):
     """Obtém a corrida em andamento de um motorista"""
     try:
-        usuario = Usuario.objects.get(cpf=cpf_motorista, tipo_usuario='MOTORISTA')
-        motorista = Motorista.objects.get(usuario=usuario)
-        
         # Buscar corrida em andamento
         corrida = Corrida.objects.filter(
-            motorista=motorista,
-            status__in=['ACEITA', 'EM_ANDAMENTO']
-        ).first()
+            motorista_id=_pk_motorista(cpf_motorista, contexto),
+            status__in=STATUS_CORRIDA_ATIVA
+        ).values('id', 'status', 'passageiro__usuario__cpf').first()
         
         if corrida:
             return {
-                'corrida_id': str(corrida.id),
-                'passageiro_cpf': corrida.passageiro.usuario.cpf if corrida.passageiro else None,
-                'status': corrida.status
+                'corrida_id': str(corrida['id']),
+                'passageiro_cpf': corrida['passageiro__usuario__cpf'],
+                'status': corrida['status']
             }
         return None
     except Exception as e:
         logger.error(f"Erro ao obter corrida em andamento: {str(e)}")
         return None
 
-def finalizar_corrida(corrida_id, motorista_cpf, status='FINALIZADA'):
+def finalizar_corrida(corrida_id, motorista_cpf, status='FINALIZADA', contexto=None):
     """Finaliza uma corrida"""
     try:
         # Verificar se a corrida existe e está em andamento
-        corrida = Corrida.objects.get(id=corrida_id)
+        corrida = Corrida.objects.select_related('passageiro__usuario').get(id=corrida_id)
         
         # Verificar se o motorista é o mesmo da corrida
-        usuario = Usuario.objects.get(cpf=motorista_cpf, tipo_usuario='MOTORISTA')
-        motorista = Motorista.objects.get(usuario=usuario)
+        motorista_pk = _pk_motorista(motorista_cpf, contexto)
         
-        if corrida.motorista != motorista:
+        if corrida.motorista_id != motorista_pk:
             logger.error(f"Motorista {motorista_cpf} não está associado à corrida {corrida_id}")
             return False, None
         
@@ -425,16 +466,14 @@ def finalizar_corrida(corrida_id, motorista_cpf, status='FINALIZADA'):
         status_interno = 'FINALIZADA' if status == 'FINALIZADA_PENDENTE_AVALIACAO' else status
         corrida.status = status_interno
         corrida.data_fim = timezone.now()
-        corrida.save()
+        corrida.save(update_fields=['status', 'data_fim'])
         
         # Log o status original para depuração
         if status != status_interno:
             logger.info(f"Status original 'FINALIZADA_PENDENTE_AVALIACAO' convertido para 'FINALIZADA' internamente")
         
         # Atualizar status do motorista
-        motorista.status = 'DISPONIVEL'
-        motorista.esta_disponivel = True
-        motorista.save()
+        Motorista.objects.filter(pk=motorista_pk).update(status='DISPONIVEL', esta_disponivel=True)
         
         logger.info(f"Corrida {corrida_id} finalizada pelo motorista {motorista_cpf} com status {status_interno}")
         
@@ -445,34 +484,29 @@ def finalizar_corrida(corrida_id, motorista_cpf, status='FINALIZADA'):
         logger.error(f"Erro ao finalizar corrida: {str(e)}")
         return False, None
 
-def cancelar_corrida(corrida_id, user_cpf, user_tipo, motivo, status='CANCELADA'):
+def cancelar_corrida(corrida_id, user_cpf, user_tipo, motivo, status='CANCELADA', contexto=None):
     """Cancela uma corrida"""
     try:
         # Verificar se a corrida existe
-        corrida = Corrida.objects.filter(id=corrida_id).first()
+        corrida = Corrida.objects.select_related('passageiro__usuario').filter(id=corrida_id).first()
         if not corrida:
             logger.error(f"Corrida com ID {corrida_id} não encontrada")
             return False, None
         
         # Verificar se o usuário está associado à corrida
         if user_tipo == 'MOTORISTA':
-            usuario = Usuario.objects.get(cpf=user_cpf, tipo_usuario='MOTORISTA')
-            motorista = Motorista.objects.get(usuario=usuario)
-            
-            if corrida.motorista != motorista:
+            if corrida.motorista_id != _pk_motorista(user_cpf, contexto):
                 logger.error(f"Motorista {user_cpf} não está associado à corrida {corrida_id}")
                 return False, None
             
             outro_cpf = corrida.passageiro.usuario.cpf if corrida.passageiro else None
         else:  # PASSAGEIRO
-            usuario = Usuario.objects.get(cpf=user_cpf, tipo_usuario='PASSAGEIRO')
-            passageiro = Passageiro.objects.get(usuario=usuario)
-            
-            if corrida.passageiro != passageiro:
+            if corrida.passageiro_id != _pk_passageiro(user_cpf, contexto):
                 logger.error(f"Passageiro {user_cpf} não está associado à corrida {corrida_id}")
                 return False, None
             
-            outro_cpf = corrida.motorista.usuario.cpf if corrida.motorista else None
+            # A PK do motorista é o CPF do usuário
+            outro_cpf = corrida.motorista_id
         
         # Verificar se o status da corrida permite cancelamento
         if corrida.status not in ['PENDENTE', 'ACEITA', 'EM_ANDAMENTO', 'MOTORISTA_CHEGOU']:
@@ -485,29 +519,20 @@ def cancelar_corrida(corrida_id, user_cpf, user_tipo, motivo, status='CANCELADA'
         corrida.cancelada_por_tipo = user_tipo
         corrida.cancelada_por_cpf = user_cpf
         corrida.data_cancelamento = timezone.now()
-        corrida.save()
+        corrida.save(update_fields=[
+            'status', 'motivo_cancelamento', 'cancelada_por_tipo', 'cancelada_por_cpf', 'data_cancelamento'
+        ])
         
         # Se tiver motorista, atualizar status
-        if corrida.motorista:
-            motorista = corrida.motorista
-            motorista.status = 'DISPONIVEL'
-            motorista.esta_disponivel = True
-            motorista.save()
+        if corrida.motorista_id:
+            Motorista.objects.filter(pk=corrida.motorista_id).update(status='DISPONIVEL', esta_disponivel=True)
         
         logger.info(f"Corrida {corrida_id} cancelada por {user_tipo} {user_cpf}. Motivo: {motivo}")
         
-        # Sincronizar o estado em memória das corridas em andamento
-        try:
-            # Garantir que essa corrida seja removida de qualquer cache em memória
-            global corridas_em_andamento
-            if 'corridas_em_andamento' in globals() and corridas_em_andamento and corrida.id in corridas_em_andamento:
-                del corridas_em_andamento[corrida.id]
-                logger.info(f"Corrida {corrida_id} removida do cache em memória após cancelamento")
-            
-            # Sincronizar todas as corridas em andamento
-            sincronizar_corridas_em_andamento()
-        except Exception as sync_error:
-            logger.error(f"Erro ao sincronizar estado em memória após cancelamento: {str(sync_error)}")
+        # Garantir que essa corrida seja removida do estado em memória das corridas
+        # em andamento (sem recarregar todas as corridas ativas a cada cancelamento)
+        if corridas_em_andamento.pop(corrida.id, None) is not None:
+            logger.info(f"Corrida {corrida_id} removida do cache em memória após cancelamento")
         
         # Retorna True e o CPF da outra parte para notificação
         return True, outro_cpf
@@ -518,57 +543,52 @@ def cancelar_corrida(corrida_id, user_cpf, user_tipo, motivo, status='CANCELADA'
 
 def registrar_chegada_motorista(corrida_id, motorista_cpf):
     """Registra a chegada do motorista ao local de embarque"""
-    try:
-        corrida = Corrida.objects.get(id=corrida_id)
-        corrida.status = 'MOTORISTA_CHEGOU'
-        corrida.data_chegada_motorista = timezone.now()
-        corrida.save()
-        return True
-    except Corrida.DoesNotExist:
+    if not Corrida.objects.filter(id=corrida_id).update(
+        status='MOTORISTA_CHEGOU',
+        data_chegada_motorista=timezone.now()
+    ):
         logger.error(f"Corrida {corrida_id} não encontrada para registrar chegada")
         return False
+    return True
 
 def cancelar_corrida_sem_motoristas(corrida_id):
     """Cancela uma corrida automaticamente quando não há motoristas disponíveis"""
     try:
-        corrida = Corrida.objects.get(id=corrida_id)
-        corrida.status = 'CANCELADA'
-        corrida.motivo_cancelamento = 'Não havia motoristas disponíveis no momento'
-        corrida.cancelada_por_tipo = 'SISTEMA'
-        corrida.data_cancelamento = timezone.now()
-        corrida.save()
+        Corrida.objects.filter(id=corrida_id).update(
+            status='CANCELADA',
+            motivo_cancelamento='Não havia motoristas disponíveis no momento',
+            cancelada_por_tipo='SISTEMA',
+            data_cancelamento=timezone.now()
+        )
         logger.info(f"Corrida {corrida_id} cancelada automaticamente por falta de motoristas disponíveis")
         return True
     except Exception as e:
         logger.error(f"Erro ao cancelar corrida sem motoristas: {str(e)}")
         return False
 
-def iniciar_corrida(corrida_id, motorista_cpf, status='EM_ANDAMENTO'):
+def iniciar_corrida(corrida_id, motorista_cpf, status='EM_ANDAMENTO', contexto=None):
     """Inicia uma corrida após o motorista chegar e o passageiro embarcar"""
     try:
         # Verificar se a corrida existe e está com status de motorista chegou
         try:
-            corrida = Corrida.objects.get(id=corrida_id)
+            corrida = Corrida.objects.select_related('passageiro__usuario').get(id=corrida_id)
         except Corrida.DoesNotExist:
             logger.error(f"Corrida {corrida_id} não encontrada para iniciar")
             return False, None
             
         # Verificar se o motorista é o mesmo da corrida
         try:
-            usuario = Usuario.objects.get(cpf=motorista_cpf, tipo_usuario='MOTORISTA')
-            motorista = Motorista.objects.get(usuario=usuario)
-            
-            if corrida.motorista != motorista:
+            if corrida.motorista_id != _pk_motorista(motorista_cpf, contexto):
                 logger.error(f"Motorista {motorista_cpf} não está associado à corrida {corrida_id}")
                 return False, None
-        except (Usuario.DoesNotExist, Motorista.DoesNotExist):
+        except Motorista.DoesNotExist:
             logger.error(f"Motorista {motorista_cpf} não encontrado")
             return False, None
         
         # Atualizar o status da corrida para EM_ANDAMENTO
         corrida.status = status
         corrida.data_inicio = timezone.now()
-        corrida.save()
+        corrida.save(update_fields=['status', 'data_inicio'])
         
         logger.info(f"Corrida {corrida_id} iniciada pelo motorista {motorista_cpf}. Status atualizado para: {status}")
         
@@ -602,16 +622,15 @@ def verificar_corrida_em_andamento_motorista(motorista_cpf):
             status__in=['ACEITA', 'MOTORISTA_CHEGOU', 'EM_ANDAMENTO', 'A_CAMINHO']
         ).exclude(
             status__in=['CANCELADA', 'FINALIZADA']  # Excluir explicitamente corridas canceladas ou finalizadas
-        ).order_by('-data_solicitacao')
+        ).select_related('passageiro__usuario').order_by('-data_solicitacao')
         
-        print(f"[DEBUG] Total de corridas encontradas: {corridas.count()}")
+        # Pegar a corrida mais recente, com o passageiro, em uma única consulta
+        corrida = corridas.first()
         
-        if not corridas.exists():
+        if corrida is None:
             print(f"[DEBUG] Nenhuma corrida em andamento encontrada para motorista {motorista_cpf}")
             return None
-            
-        # Pegar a corrida mais recente
-        corrida = corridas.first()
+        
         print(f"[DEBUG] Corrida encontrada ID: {corrida.id}, status: {corrida.status}")
         
         # Log adicional para verificar se a corrida foi cancelada
@@ -651,17 +670,14 @@ def verificar_corrida_em_andamento_motorista(motorista_cpf):
         traceback.print_exc()  # Adicionar traceback para mais detalhes
         return None
 
-def verificar_corrida_em_andamento_passageiro(passageiro_cpf):
+def verificar_corrida_em_andamento_passageiro(passageiro_cpf, contexto=None):
     """Verifica se o passageiro tem alguma corrida em andamento e retorna os detalhes"""
     try:
-        usuario = Usuario.objects.get(cpf=passageiro_cpf, tipo_usuario='PASSAGEIRO')
-        passageiro = Passageiro.objects.get(usuario=usuario)
-        
         # Buscar corrida atual do passageiro (em qualquer estado que não seja finalizado ou cancelado)
         corrida = Corrida.objects.filter(
-            passageiro=passageiro,
+            passageiro_id=_pk_passageiro(passageiro_cpf, contexto),
             status__in=['PENDENTE', 'ACEITA', 'MOTORISTA_CHEGOU', 'EM_ANDAMENTO']
-        ).order_by('-data_aceite').first()
+        ).select_related('motorista__usuario').order_by('-data_aceite').first()
         
         if not corrida:
             logger.info(f"Nenhuma corrida em andamento para o passageiro {passageiro_cpf}")
@@ -711,132 +727,136 @@ def verificar_corrida_em_andamento_passageiro(passageiro_cpf):
         logger.error(f"Erro ao buscar corrida em andamento do passageiro: {str(e)}")
         return None
 
-def avaliar_motorista(corrida_id, passageiro_cpf, avaliacao, comentario=None):
+def _somar_avaliacao(modelo, pk, nota, nota_anterior=None):
+    """
+    Soma a nota aos agregados do avaliado (soma_avaliacoes/total_avaliacoes) e
+    recalcula a média, sem reler as corridas dele. Uma nota que substitui a
+    anterior da mesma corrida troca o valor sem contar de novo. A linha do
+    avaliado fica bloqueada até o fim da transação, e a média é calculada em
+    Python para dar o mesmo resultado em qualquer banco.
+    """
+    from usuarios.models import media_avaliacoes
+    
+    soma, total = modelo.objects.select_for_update().filter(pk=pk).values_list(
+        'soma_avaliacoes', 'total_avaliacoes'
+    ).get()
+    soma += nota - (nota_anterior or 0)
+    total += 0 if nota_anterior is not None else 1
+    modelo.objects.filter(pk=pk).update(
+        soma_avaliacoes=soma, total_avaliacoes=total, avaliacao_media=media_avaliacoes(soma, total)
+    )
+
+def avaliar_motorista(corrida_id, passageiro_cpf, avaliacao, comentario=None, contexto=None):
     """
     Passageiro avalia o motorista após a corrida
     - avaliacao: valor de 1 a 5 estrelas
     - comentario: comentário opcional sobre a experiência
     """
     try:
-        # Verificar se a corrida existe e está finalizada
-        corrida = Corrida.objects.get(id=corrida_id)
-        
-        if corrida.status not in ['FINALIZADA', 'FINALIZADA_PENDENTE_AVALIACAO']:
-            logger.error(f"Tentativa de avaliar motorista para corrida não finalizada: {corrida_id}")
-            return False, None
+        with transaction.atomic(savepoint=False):
+            # Verificar se a corrida existe e está finalizada; a linha fica bloqueada até o fim
+            # da transação para que a nota anterior lida aqui seja a que será substituída
+            corrida = Corrida.objects.select_for_update().only(
+                'id', 'status', 'passageiro_id', 'motorista_id',
+                'avaliacao_motorista', 'comentario_motorista', 'data_avaliacao_motorista'
+            ).get(id=corrida_id)
+        
+            if corrida.status not in ['FINALIZADA', 'FINALIZADA_PENDENTE_AVALIACAO']:
+                logger.error(f"Tentativa de avaliar motorista para corrida não finalizada: {corrida_id}")
+                return False, None
             
-        # Verificar se o passageiro é o mesmo da corrida
-        usuario = Usuario.objects.get(cpf=passageiro_cpf, tipo_usuario='PASSAGEIRO')
-        passageiro = Passageiro.objects.get(usuario=usuario)
-        
-        if corrida.passageiro != passageiro:
-            logger.error(f"Passageiro {passageiro_cpf} não autorizado a avaliar esta corrida: {corrida_id}")
-            return False, None
+            # Verificar se o passageiro é o mesmo da corrida
+            if corrida.passageiro_id != _pk_passageiro(passageiro_cpf, contexto):
+                logger.error(f"Passageiro {passageiro_cpf} não autorizado a avaliar esta corrida: {corrida_id}")
+                return False, None
             
-        # Verificar se o motorista está atribuído à corrida
-        if not corrida.motorista:
-            logger.error(f"Corrida {corrida_id} não possui motorista para avaliar")
-            return False, None
+            # Verificar se o motorista está atribuído à corrida
+            if not corrida.motorista_id:
+                logger.error(f"Corrida {corrida_id} não possui motorista para avaliar")
+                return False, None
             
-        # Garantir que avaliação está entre 1 e 5
-        avaliacao_normalizada = max(1, min(5, int(avaliacao)))
-        
-        # Registrar a avaliação na corrida
-        corrida.avaliacao_motorista = avaliacao_normalizada
-        corrida.comentario_motorista = comentario
-        corrida.data_avaliacao_motorista = timezone.now()
-        corrida.save(update_fields=['avaliacao_motorista', 'comentario_motorista', 'data_avaliacao_motorista'])
+            # Garantir que avaliação está entre 1 e 5
+            avaliacao_normalizada = max(1, min(5, int(avaliacao)))
         
-        # Atualizar a média de avaliações do motorista
-        motorista = corrida.motorista
+            # Registrar a avaliação na corrida
+            nota_anterior = corrida.avaliacao_motorista
+            corrida.avaliacao_motorista = avaliacao_normalizada
+            corrida.comentario_motorista = comentario
+            corrida.data_avaliacao_motorista = timezone.now()
+            corrida.save(update_fields=['avaliacao_motorista', 'comentario_motorista', 'data_avaliacao_motorista'])
         
-        # OTIMIZAÇÃO: Usar agregação do Django para calcular a média diretamente
-        from django.db.models import Avg
-        nova_media = Corrida.objects.filter(
-            motorista=motorista,
-            avaliacao_motorista__isnull=False
-        ).aggregate(media=Avg('avaliacao_motorista'))['media']
+            # Atualizar a média de avaliações do motorista pelos agregados
+            motorista_cpf = corrida.motorista_id  # A PK do motorista é o CPF do usuário
+            _somar_avaliacao(Motorista, motorista_cpf, avaliacao_normalizada, nota_anterior)
         
-        if nova_media is not None:
-            motorista.avaliacao_media = nova_media
-            motorista.save(update_fields=['avaliacao_media'])
-            logger.info(f"Média de avaliações do motorista atualizada: {nova_media:.2f}")
+            logger.info(f"Avaliação do motorista realizada com sucesso: corrida {corrida_id}, passageiro {passageiro_cpf}, nota {avaliacao_normalizada}")
+            logger.info(f"Motorista da corrida {corrida_id} avaliado com {avaliacao_normalizada} estrelas pelo passageiro {passageiro_cpf}")
         
-        logger.info(f"Avaliação do motorista realizada com sucesso: corrida {corrida_id}, passageiro {passageiro_cpf}, nota {avaliacao_normalizada}")
-        logger.info(f"Motorista da corrida {corrida_id} avaliado com {avaliacao_normalizada} estrelas pelo passageiro {passageiro_cpf}")
-        
-        # Retornar True e o CPF do motorista para notificação
-        return True, motorista.usuario.cpf
+            # Retornar True e o CPF do motorista para notificação
+            return True, motorista_cpf
         
     except Corrida.DoesNotExist:
         logger.error(f"Corrida {corrida_id} não encontrada para avaliação")
         return False, None
-    except (Usuario.DoesNotExist, Passageiro.DoesNotExist):
+    except Passageiro.DoesNotExist:
         logger.error(f"Passageiro com CPF {passageiro_cpf} não encontrado")
         return False, None
     except Exception as e:
         logger.error(f"Erro ao avaliar motorista: {str(e)}")
         return False, None
 
-def avaliar_passageiro(corrida_id, motorista_cpf, avaliacao, comentario=None):
+def avaliar_passageiro(corrida_id, motorista_cpf, avaliacao, comentario=None, contexto=None):
     """
     Motorista avalia o passageiro após a corrida
     - avaliacao: valor de 1 a 5 estrelas
     - comentario: comentário opcional sobre a experiência
     """
     try:
-        # Verificar se a corrida existe e está finalizada
-        corrida = Corrida.objects.get(id=corrida_id)
-        
-        if corrida.status not in ['FINALIZADA', 'FINALIZADA_PENDENTE_AVALIACAO']:
-            logger.error(f"Tentativa de avaliar passageiro para corrida não finalizada: {corrida_id}")
-            return False, None
+        with transaction.atomic(savepoint=False):
+            # Verificar se a corrida existe e está finalizada; a linha fica bloqueada até o fim
+            # da transação para que a nota anterior lida aqui seja a que será substituída
+            corrida = Corrida.objects.select_for_update(of=('self',)).select_related('passageiro__usuario').only(
+                'id', 'status', 'passageiro', 'motorista_id', 'passageiro__usuario__cpf',
+                'avaliacao_passageiro', 'comentario_passageiro', 'data_avaliacao_passageiro'
+            ).get(id=corrida_id)
+        
+            if corrida.status not in ['FINALIZADA', 'FINALIZADA_PENDENTE_AVALIACAO']:
+                logger.error(f"Tentativa de avaliar passageiro para corrida não finalizada: {corrida_id}")
+                return False, None
             
-        # Verificar se o motorista é o mesmo da corrida
-        usuario = Usuario.objects.get(cpf=motorista_cpf, tipo_usuario='MOTORISTA')
-        motorista = Motorista.objects.get(usuario=usuario)
-        
-        if corrida.motorista != motorista:
-            logger.error(f"Motorista {motorista_cpf} não autorizado a avaliar esta corrida: {corrida_id}")
-            return False, None
+            # Verificar se o motorista é o mesmo da corrida
+            if corrida.motorista_id != _pk_motorista(motorista_cpf, contexto):
+                logger.error(f"Motorista {motorista_cpf} não autorizado a avaliar esta corrida: {corrida_id}")
+                return False, None
             
-        # Verificar se o passageiro está atribuído à corrida
-        if not corrida.passageiro:
-            logger.error(f"Corrida {corrida_id} não possui passageiro para avaliar")
-            return False, None
+            # Verificar se o passageiro está atribuído à corrida
+            if not corrida.passageiro_id:
+                logger.error(f"Corrida {corrida_id} não possui passageiro para avaliar")
+                return False, None
             
-        # Garantir que avaliação está entre 1 e 5
-        avaliacao_normalizada = max(1, min(5, int(avaliacao)))
-        
-        # Registrar a avaliação na corrida
-        corrida.avaliacao_passageiro = avaliacao_normalizada
-        corrida.comentario_passageiro = comentario
-        corrida.data_avaliacao_passageiro = timezone.now()
-        corrida.save(update_fields=['avaliacao_passageiro', 'comentario_passageiro', 'data_avaliacao_passageiro'])
-        
-        # Atualizar a média de avaliações do passageiro
-        passageiro = corrida.passageiro
-        corridas_avaliadas = Corrida.objects.filter(
-            passageiro=passageiro,
-            avaliacao_passageiro__isnull=False
-        )
-        
-        total_avaliacoes = corridas_avaliadas.count()
-        soma_avaliacoes = sum(c.avaliacao_passageiro for c in corridas_avaliadas)
-        
-        if total_avaliacoes > 0:
-            passageiro.avaliacao_media = soma_avaliacoes / total_avaliacoes
-            passageiro.save(update_fields=['avaliacao_media'])
+            # Garantir que avaliação está entre 1 e 5
+            avaliacao_normalizada = max(1, min(5, int(avaliacao)))
+        
+            # Registrar a avaliação na corrida
+            nota_anterior = corrida.avaliacao_passageiro
+            corrida.avaliacao_passageiro = avaliacao_normalizada
+            corrida.comentario_passageiro = comentario
+            corrida.data_avaliacao_passageiro = timezone.now()
+            corrida.save(update_fields=['avaliacao_passageiro', 'comentario_passageiro', 'data_avaliacao_passageiro'])
+        
+            # Atualizar a média de avaliações do passageiro pelos agregados
+            passageiro = corrida.passageiro
+            _somar_avaliacao(Passageiro, passageiro.pk, avaliacao_normalizada, nota_anterior)
             
-        logger.info(f"Passageiro da corrida {corrida_id} avaliado com {avaliacao_normalizada} estrelas pelo motorista {motorista_cpf}")
+            logger.info(f"Passageiro da corrida {corrida_id} avaliado com {avaliacao_normalizada} estrelas pelo motorista {motorista_cpf}")
         
-        # Retornar True e o CPF do passageiro para notificação
-        return True, passageiro.usuario.cpf
+            # Retornar True e o CPF do passageiro para notificação
+            return True, passageiro.usuario.cpf
         
     except Corrida.DoesNotExist:
         logger.error(f"Corrida {corrida_id} não encontrada para avaliação")
         return False, None
-    except (Usuario.DoesNotExist, Motorista.DoesNotExist):
+    except Motorista.DoesNotExist:
         logger.error(f"Motorista com CPF {motorista_cpf} não encontrado")
         return False, None
     except Exception as e:
@@ -964,7 +984,7 @@ def atualizar_status_corrida(corrida_id, novo_status):
         logger.error(traceback.format_exc())
         return False
 
-def registrar_mensagem_chat(corrida_id, tipo_remetente, conteudo):
+def registrar_mensagem_chat(corrida_id, tipo_remetente, conteudo, corrida=None):
     """
     Registra uma nova mensagem de chat no banco de dados
     
@@ -972,6 +992,7 @@ def registrar_mensagem_chat(corrida_id, tipo_remetente, conteudo):
         corrida_id: UUID da corrida
         tipo_remetente: 'PASSAGEIRO' ou 'MOTORISTA'
         conteudo: texto da mensagem
+        corrida: a corrida já carregada, se o chamador a tiver
         
     Returns:
         mensagem: objeto MensagemChat se registrado com sucesso, None caso contrário
@@ -980,11 +1001,12 @@ def registrar_mensagem_chat(corrida_id, tipo_remetente, conteudo):
         from corridas.models import Corrida, MensagemChat
         
         # Verificar se a corrida existe
-        try:
-            corrida = Corrida.objects.get(id=corrida_id)
-        except Corrida.DoesNotExist:
-            logger.error(f"Corrida {corrida_id} não encontrada")
-            return None
+        if corrida is None:
+            try:
+                corrida = Corrida.objects.get(id=corrida_id)
+            except Corrida.DoesNotExist:
+                logger.error(f"Corrida {corrida_id} não encontrada")
+                return None
             
         # Verificar se o tipo de remetente é válido
         if tipo_remetente not in ['PASSAGEIRO', 'MOTORISTA']:
@@ -1020,14 +1042,12 @@ def obter_mensagens_chat(corrida_id, marcar_como_lidas=False):
         from corridas.models import Corrida, MensagemChat
         
         # Verificar se a corrida existe
-        try:
-            corrida = Corrida.objects.get(id=corrida_id)
-        except Corrida.DoesNotExist:
+        if not Corrida.objects.filter(id=corrida_id).exists():
             logger.error(f"Corrida {corrida_id} não encontrada")
             return []
             
         # Obter as mensagens
-        mensagens = MensagemChat.objects.filter(corrida=corrida).order_by('data_envio')
+        mensagens = MensagemChat.objects.filter(corrida_id=corrida_id).order_by('data_envio')
         
         # Marcar como lidas, se solicitado
         if marcar_como_lidas:
@@ -1035,13 +1055,13 @@ def obter_mensagens_chat(corrida_id, marcar_como_lidas=False):
             
         # Converter para formato de dicionário
         resultado = []
-        for msg in mensagens:
+        for msg in mensagens.values('id', 'tipo_remetente', 'conteudo', 'data_envio', 'lida'):
             resultado.append({
-                'id': str(msg.id),
-                'remetente': msg.tipo_remetente,
-                'conteudo': msg.conteudo,
-                'data_envio': msg.data_envio.isoformat(),
-                'lida': msg.lida
+                'id': str(msg['id']),
+                'remetente': msg['tipo_remetente'],
+                'conteudo': msg['conteudo'],
+                'data_envio': msg['data_envio'].isoformat(),
+                'lida': msg['lida']
             })
             
         return resultado
@@ -1050,6 +1070,9 @@ def obter_mensagens_chat(corrida_id, marcar_como_lidas=False):
         logger.error(f"Erro ao obter mensagens de chat: {str(e)}")
         return []
 
+# Corridas em andamento em memória, por ID (sincronizar_corridas_em_andamento)
+corridas_em_andamento = {}
+
 def sincronizar_corridas_em_andamento():
     """Sincroniza o estado das corridas em andamento no banco de dados com as variáveis em memória."""
     try:
@@ -1057,9 +1080,378 @@ def sincronizar_corridas_em_andamento():
         corridas_ativas = Corrida.objects.filter(status__in=['ACEITA', 'EM_ANDAMENTO'])
 
         # Atualizar as variáveis em memória (exemplo: corridas_em_andamento)
-        global corridas_em_andamento
-        corridas_em_andamento = {corrida.id: corrida for corrida in corridas_ativas}
+        corridas_em_andamento.clear()
+        corridas_em_andamento.update((corrida.id, corrida) for corrida in corridas_ativas)
 
         logger.info("Sincronização de corridas em andamento concluída com sucesso.")
     except Exception as e:
         logger.error(f"Erro ao sincronizar corridas em andamento: {str(e)}")
+
+def buscar_destino_push(cpf):
+    """
+    Retorna (usuario_id, token push ativo ou None) do usuário, ou None se ele não existir.
+    Usa o cache em processo de push_services; uma única consulta quando não está em cache.
+    """
+    destino = cache_tokens_push.obter(cpf)
+    if destino is None:
+        linha = Usuario.objects.filter(cpf=cpf).values_list(
+            'id', 'push_token__token', 'push_token__ativo'
+        ).first()
+        if linha is None:
+            return None
+        usuario_id, token, ativo = linha
+        destino = (usuario_id, token if ativo else None)
+        cache_tokens_push.guardar(cpf, destino)
+    return destino
+
+def registrar_notificacao_push(cpf, evento, titulo, mensagem, dados=None, corrida_id=None):
+    """
+    Grava uma notificação push no outbox para envio em segundo plano.
+    Notificações repetidas (mesmo usuário, evento e corrida) são ignoradas.
+    """
+    try:
+        destino = buscar_destino_push(cpf)
+        if destino is None:
+            logger.warning(f"Notificação push não registrada: usuário {cpf} não encontrado")
+            return False
+        usuario_id, token = destino
+        if not token:
+            logger.warning(f"Notificação push não registrada: {cpf} não tem token push ativo")
+            return False
+
+        _, criada = NotificacaoPush.objects.get_or_create(
+            usuario_id=usuario_id,
+            evento=evento,
+            corrida_id=str(corrida_id or ''),
+            defaults={'titulo': titulo, 'mensagem': mensagem, 'dados': dados or {}}
+        )
+        if not criada:
+            logger.info(f"Notificação push {evento} para {cpf} já registrada")
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao registrar notificação push para {cpf}: {str(e)}")
+        return False
+
+def reservar_notificacoes_push(limite=100, reserva_segundos=60):
+    """
+    Seleciona as notificações pendentes cuja próxima tentativa já venceu e adia
+    essa tentativa pelo tempo da reserva, para que outro worker não as envie em
+    paralelo. Se o worker cair, elas voltam para a fila quando a reserva expira.
+    """
+    agora = timezone.now()
+    with transaction.atomic():
+        notificacoes = list(
+            NotificacaoPush.objects.select_for_update(skip_locked=True)
+            .filter(status='PENDENTE', proxima_tentativa__lte=agora)
+            .select_related('usuario__push_token')
+            .order_by('proxima_tentativa')[:limite]
+        )
+        NotificacaoPush.objects.filter(id__in=[n.id for n in notificacoes]).update(
+            proxima_tentativa=agora + timedelta(seconds=reserva_segundos)
+        )
+    return notificacoes
+
+def concluir_notificacoes_push(enviadas, falhas):
+    """
+    Registra o resultado de um lote do outbox.
+
+    Args:
+        enviadas: tuplas (notificacao, ticket_id, token) das notificações aceitas pelo Expo
+        falhas: tuplas (notificacao, erro, definitiva). Falhas temporárias voltam
+            para a fila com backoff exponencial até PUSH_MAX_TENTATIVAS.
+    """
+    agora = timezone.now()
+    max_tentativas = getattr(settings, 'PUSH_MAX_TENTATIVAS', 6)
+    backoff_base = getattr(settings, 'PUSH_BACKOFF_BASE', 30)
+    backoff_maximo = getattr(settings, 'PUSH_BACKOFF_MAXIMO', 3600)
+
+    with transaction.atomic():
+        for notificacao, ticket_id, token in enviadas:
+            notificacao.status = 'ENVIADA'
+            notificacao.enviado_em = agora
+            notificacao.ultimo_erro = ''
+            notificacao.ticket_id = ticket_id
+            notificacao.token_enviado = token
+        if enviadas:
+            NotificacaoPush.objects.bulk_update(
+                [notificacao for notificacao, _, _ in enviadas],
+                ['status', 'enviado_em', 'ultimo_erro', 'ticket_id', 'token_enviado']
+            )
+        for notificacao, erro, definitiva in falhas:
+            notificacao.tentativas += 1
+            notificacao.ultimo_erro = erro
+            if definitiva or notificacao.tentativas >= max_tentativas:
+                notificacao.status = 'FALHOU'
+                logger.error(f"Notificação push {notificacao.id} descartada após {notificacao.tentativas} tentativas: {erro}")
+            else:
+                atraso = min(backoff_base * 2 ** (notificacao.tentativas - 1), backoff_maximo)
+                notificacao.proxima_tentativa = agora + timedelta(seconds=atraso)
+            notificacao.save(update_fields=['tentativas', 'ultimo_erro', 'status', 'proxima_tentativa'])
+
+def desativar_tokens_push(tokens):
+    """Desativa tokens de dispositivos que o Expo informou como não registrados."""
+    cpfs = list(PushToken.objects.filter(token__in=tokens, ativo=True).values_list('usuario__cpf', flat=True))
+    desativados = PushToken.objects.filter(token__in=tokens, ativo=True).update(ativo=False)
+    for cpf in cpfs:
+        cache_tokens_push.invalidar(cpf)
+    if desativados:
+        logger.info(f"{desativados} tokens push desativados (DeviceNotRegistered)")
+    return desativados
+
+def notificacoes_aguardando_recibo(limite=1000):
+    """
+    Notificações enviadas cujo recibo do Expo já deve estar disponível.
+    Retorna tuplas (id, ticket_id, token_enviado).
+    """
+    agora = timezone.now()
+    atraso = getattr(settings, 'PUSH_RECIBO_ATRASO', 900)
+    # O Expo guarda os recibos por 24 horas; depois disso não há o que conferir
+    NotificacaoPush.objects.filter(
+        status='ENVIADA', enviado_em__lt=agora - timedelta(hours=24)
+    ).exclude(ticket_id='').update(ticket_id='')
+    return list(
+        NotificacaoPush.objects.filter(status='ENVIADA', enviado_em__lte=agora - timedelta(seconds=atraso))
+        .exclude(ticket_id='')
+        .order_by('enviado_em')
+        .values_list('id', 'ticket_id', 'token_enviado')[:limite]
+    )
+
+def registrar_recibos_push(notificacao_ids):
+    """Marca os recibos como conferidos."""
+    if notificacao_ids:
+        NotificacaoPush.objects.filter(id__in=notificacao_ids).update(ticket_id='')
+
+def usuario_e_equipe(cpf):
+    """Indica se o usuário é da equipe (is_staff), para tópicos restritos como 'ops'."""
+    return Usuario.objects.filter(cpf=cpf, is_staff=True, is_active=True).exists()
+
+# ===== Variantes assíncronas das consultas mais frequentes =====
+# Usam o ORM assíncrono do Django (aupdate/afirst/iteração assíncrona) com uma
+# única instrução SQL cada, sem carregar objetos para depois salvá-los. No Django
+# 5.1 cada instrução ainda passa pela thread compartilhada do sync_to_async; o
+# ganho está em uma passagem e uma consulta por operação, sem ocupar o executor
+# do banco (comparação: comando medir_orm_assincrono). Com o escritor único do
+# SQLite ativo (settings.BANCO_ESCRITOR_UNICO) as escritas vão para o lote dele.
+
+async def atualizar_status_motorista_async(cpf, status, esta_disponivel):
+    """Variante assíncrona de atualizar_status_motorista, em um único UPDATE."""
+    if obter_escritor_banco() is not None:
+        return await executar_no_banco(atualizar_status_motorista, cpf, status, esta_disponivel, escrita=True)
+    campos = {'status': status, 'esta_disponivel': esta_disponivel}
+    if esta_disponivel:
+        campos['ultima_atualizacao_localizacao'] = timezone.now()
+    try:
+        return await Motorista.objects.filter(cpf=cpf).aupdate(**campos) > 0
+    except Exception as e:
+        logger.error(f"Erro ao atualizar status do motorista {cpf}: {str(e)}")
+        return False
+
+async def atualizar_localizacao_motorista_async(cpf, latitude, longitude, contexto=None):
+    """Variante assíncrona de atualizar_localizacao_motorista, em um único UPDATE."""
+    if obter_escritor_banco() is not None:
+        return await executar_no_banco(
+            atualizar_localizacao_motorista, cpf, latitude, longitude, contexto=contexto, escrita=True
+        )
+    try:
+        atualizados = await Motorista.objects.filter(**_filtro_motorista(cpf, contexto)).aupdate(
+            ultima_latitude=Decimal(str(latitude)),
+            ultima_longitude=Decimal(str(longitude)),
+            ultima_atualizacao_localizacao=timezone.now()
+        )
+        return atualizados > 0
+    except Exception as e:
+        logger.error(f"Erro ao atualizar localização do motorista: {str(e)}")
+        return False
+
+async def corrida_pendente_async(corrida_id):
+    """Se a corrida ainda espera um motorista (próxima onda de ofertas do despacho)."""
+    try:
+        return await Corrida.objects.filter(id=corrida_id, status='PENDENTE').aexists()
+    except Exception as e:
+        logger.error(f"Erro ao verificar se a corrida {corrida_id} está pendente: {str(e)}")
+        return False
+
+async def obter_corrida_em_andamento_async(cpf_motorista, contexto=None):
+    """Variante assíncrona de obter_corrida_em_andamento, em uma única consulta."""
+    try:
+        corrida = await Corrida.objects.filter(
+            status__in=STATUS_CORRIDA_ATIVA, **_filtro_motorista(cpf_motorista, contexto, campo='motorista_id')
+        ).values('id', 'status', 'passageiro__usuario__cpf').afirst()
+    except Exception as e:
+        logger.error(f"Erro ao obter corrida em andamento: {str(e)}")
+        return None
+    if corrida is None:
+        return None
+    return {
+        'corrida_id': str(corrida['id']),
+        'passageiro_cpf': corrida['passageiro__usuario__cpf'],
+        'status': corrida['status']
+    }
+
+async def obter_mensagens_chat_async(corrida_id, cpf=None, marcar_como_lidas=False):
+    """
+    Variante assíncrona de obter_mensagens_chat.
+    
+    Args:
+        cpf: se informado, só retorna mensagens de corridas das quais o usuário participa
+    
+    Returns:
+        lista de mensagens no formato de dicionário (vazia se a corrida não existir)
+    """
+    from django.db.models import Q
+    from corridas.models import MensagemChat
+    
+    mensagens = MensagemChat.objects.filter(corrida_id=corrida_id)
+    if cpf:
+        mensagens = mensagens.filter(Q(corrida__passageiro__usuario__cpf=cpf) | Q(corrida__motorista__cpf=cpf))
+    try:
+        resultado = [
+            {
+                'id': str(msg['id']),
+                'remetente': msg['tipo_remetente'],
+                'conteudo': msg['conteudo'],
+                'data_envio': msg['data_envio'].isoformat(),
+                'lida': msg['lida']
+            }
+            async for msg in mensagens.order_by('data_envio').values('id', 'tipo_remetente', 'conteudo', 'data_envio', 'lida')
+        ]
+        if marcar_como_lidas and resultado:
+            await _marcar_lidas(mensagens)
+        return resultado
+    except Exception as e:
+        logger.error(f"Erro ao obter mensagens de chat: {str(e)}")
+        return []
+
+async def _marcar_lidas(mensagens):
+    if obter_escritor_banco() is not None:
+        await executar_no_banco(mensagens.filter(lida=False).update, lida=True, escrita=True)
+    else:
+        await mensagens.filter(lida=False).aupdate(lida=True)
+
+async def marcar_mensagens_lidas_async(corrida_id, cpf):
+    """
+    Marca como lidas as mensagens de chat de uma corrida da qual o usuário participa
+    (histórico servido pelo cache do consumer, sem passar por obter_mensagens_chat_async).
+    
+    Returns:
+        bool: True se sucesso, False caso contrário
+    """
+    from django.db.models import Q
+    from corridas.models import MensagemChat
+    
+    try:
+        await _marcar_lidas(MensagemChat.objects.filter(
+            Q(corrida__passageiro__usuario__cpf=cpf) | Q(corrida__motorista__cpf=cpf), corrida_id=corrida_id
+        ))
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao marcar mensagens de chat como lidas: {str(e)}")
+        return False
+
+# ===== Unidades de trabalho dos comandos WebSocket =====
+# Cada comando do MoveXConsumer que precisa de mais de uma operação no banco tem
+# uma função que faz todas elas e retorna tudo o que o handler usa, executada em
+# uma única passagem pelo executor do banco e em uma única transação
+# (executar_no_banco, movex/db_executor.py).
+
+def _desfazer_transacao():
+    """Descarta as escritas da unidade de trabalho quando um passo dela falha."""
+    if transaction.get_connection().in_atomic_block:
+        transaction.set_rollback(True)
+
+def _status_motorista(cpf):
+    return Motorista.objects.filter(cpf=cpf).values_list('status', 'esta_disponivel').first()
+
+def comando_ficar_disponivel(cpf):
+    """
+    login/motorista_conectado/motorista_disponivel: coloca o motorista como DISPONIVEL.
+    
+    Returns:
+        dict: sucesso, status_antes e status_depois ((status, esta_disponivel) ou None)
+    """
+    status_antes = _status_motorista(cpf)
+    sucesso = atualizar_status_motorista(cpf, 'DISPONIVEL', True)
+    return {
+        'sucesso': sucesso,
+        'status_antes': status_antes,
+        'status_depois': _status_motorista(cpf) if sucesso else None,
+    }
+
+def comando_desconectar_motorista(cpf, contexto=None):
+    """
+    Motorista desconectado: fica OFFLINE e suas corridas ativas são marcadas.
+    
+    Returns:
+        (sucesso, CPFs dos passageiros a avisar), como verificar_corridas_em_andamento
+    """
+    atualizar_status_motorista(cpf, 'OFFLINE', False)
+    return verificar_corridas_em_andamento(cpf, contexto)
+
+def comando_aviso_chegada(corrida_id, motorista_cpf):
+    """
+    Returns:
+        dict: sucesso e passageiro_cpf a notificar
+    """
+    if not registrar_chegada_motorista(corrida_id, motorista_cpf):
+        return {'sucesso': False, 'passageiro_cpf': None}
+    passageiro_cpf = Corrida.objects.filter(id=corrida_id).values_list(
+        'passageiro__usuario__cpf', flat=True
+    ).first()
+    return {'sucesso': True, 'passageiro_cpf': passageiro_cpf}
+
+def comando_solicitar_corrida(dados, latitude, longitude, contexto=None):
+    """
+    Registra a corrida e busca os motoristas disponíveis; sem motoristas, a
+    corrida é cancelada na mesma transação.
+    
+    Returns:
+        dict: corrida_id (None se o registro falhou) e motoristas
+    """
+    corrida_id = registrar_corrida(dados, contexto)
+    if not corrida_id:
+        return {'corrida_id': None, 'motoristas': []}
+    motoristas = buscar_motoristas_disponiveis(lat=latitude, lng=longitude)
+    if not motoristas:
+        cancelar_corrida_sem_motoristas(corrida_id)
+    return {'corrida_id': corrida_id, 'motoristas': motoristas}
+
+def comando_aceitar_corrida(corrida_id, motorista_cpf, status='ACEITA', contexto=None, incluir_dados_motorista=False):
+    """
+    Returns:
+        dict: sucesso, passageiro_cpf, outros_motoristas e, se pedido,
+        dados_motorista para o passageiro
+    """
+    sucesso, passageiro_cpf, outros_motoristas = aceitar_corrida(corrida_id, motorista_cpf, status, contexto=contexto)
+    if not sucesso:
+        _desfazer_transacao()
+        return {'sucesso': False, 'passageiro_cpf': None, 'outros_motoristas': [], 'dados_motorista': None}
+    return {
+        'sucesso': True,
+        'passageiro_cpf': passageiro_cpf,
+        'outros_motoristas': outros_motoristas,
+        'dados_motorista': buscar_dados_motorista(motorista_cpf) if incluir_dados_motorista else None,
+    }
+
+def comando_mensagem_chat(corrida_id, tipo_remetente, conteudo):
+    """
+    Registra a mensagem e identifica as partes da corrida em uma única consulta.
+    
+    Returns:
+        dict: mensagem (MensagemChat), motorista_cpf e passageiro_cpf, ou None
+    """
+    from django.core.exceptions import ValidationError
+    
+    try:
+        corrida = Corrida.objects.select_related('motorista__usuario', 'passageiro__usuario').get(id=corrida_id)
+    except (Corrida.DoesNotExist, ValidationError, ValueError):
+        logger.error(f"Corrida {corrida_id} não encontrada")
+        return None
+    
+    mensagem = registrar_mensagem_chat(corrida_id, tipo_remetente, conteudo, corrida=corrida)
+    if not mensagem:
+        return None
+    return {
+        'mensagem': mensagem,
+        'motorista_cpf': corrida.motorista.usuario.cpf if corrida.motorista else None,
+        'passageiro_cpf': corrida.passageiro.usuario.cpf if corrida.passageiro else None,
+    }
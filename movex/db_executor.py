@@ -0,0 +1,165 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync, database_sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor_banco = None
+_lock_executor = threading.Lock()
+
+
+def obter_executor_banco():
+    """
+    Pool de threads exclusivo para o acesso ao banco, com
+    settings.BANCO_EXECUTOR_THREADS threads: consultas lentas não disputam a
+    thread compartilhada do sync_to_async com o restante do trabalho síncrono.
+
+    Returns:
+        ThreadPoolExecutor, ou None se BANCO_EXECUTOR_THREADS for 0 (o acesso ao
+        banco volta para a thread compartilhada, como no database_sync_to_async)
+    """
+    global _executor_banco
+    threads = getattr(settings, 'BANCO_EXECUTOR_THREADS', 0)
+    if not threads:
+        return None
+    with _lock_executor:
+        if _executor_banco is None:
+            _executor_banco = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='movex-db')
+            logger.info(f"Executor do banco iniciado com {threads} threads")
+        return _executor_banco
+
+
+def _em_transacao(funcao):
+    @functools.wraps(funcao)
+    def executar(*args, **kwargs):
+        with transaction.atomic():
+            return funcao(*args, **kwargs)
+    return executar
+
+
+def _resolver(futuro, sucesso, valor):
+    if futuro.done():  # aguardo cancelado (conexão fechada)
+        return
+    if sucesso:
+        futuro.set_result(valor)
+    else:
+        futuro.set_exception(valor)
+
+
+class EscritorBanco:
+    """
+    Thread única de escrita no SQLite. As unidades de trabalho que escrevem são
+    enfileiradas e executadas em lotes: cada lote é uma transação (BEGIN
+    IMMEDIATE, um único commit para todo o lote) e cada unidade roda em um
+    savepoint próprio, então a falha de uma desfaz só as escritas dela.
+
+    Com um único escritor por processo as escritas não disputam o lock do
+    banco entre si (sem `database is locked`), e sob carga o custo do commit é
+    dividido entre todas as escritas que chegaram enquanto o lote anterior
+    era gravado.
+    """
+
+    def __init__(self, lote_maximo=100):
+        self.lote_maximo = lote_maximo
+        self.lotes = 0
+        self.operacoes = 0
+        self._fila = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._executar, name='movex-db-escritor', daemon=True)
+        self._thread.start()
+
+    async def executar(self, funcao, *args, **kwargs):
+        """Enfileira a unidade de trabalho e aguarda o commit do lote em que ela entrou."""
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        # O contexto segue junto para a medição de consultas do evento (instrumentation)
+        self._fila.put((funcao, args, kwargs, contextvars.copy_context(), loop, futuro))
+        return await futuro
+
+    def _executar(self):
+        while True:
+            lote = [self._fila.get()]
+            while len(lote) < self.lote_maximo:
+                try:
+                    lote.append(self._fila.get_nowait())
+                except queue.Empty:
+                    break
+            self._gravar_lote(lote)
+
+    def _gravar_lote(self, lote):
+        resultados = []
+        try:
+            connection.ensure_connection()
+            # O lote pega o lock de escrita já no BEGIN, sem promover um lock de leitura
+            connection.transaction_mode = 'IMMEDIATE'
+            with transaction.atomic():
+                for funcao, args, kwargs, contexto, _, _ in lote:
+                    try:
+                        with transaction.atomic():
+                            resultados.append((True, contexto.run(funcao, *args, **kwargs)))
+                    except Exception as e:
+                        resultados.append((False, e))
+        except Exception as e:
+            logger.error(f"Erro ao gravar lote de {len(lote)} escritas: {str(e)}")
+            resultados = [(False, e)] * len(lote)
+        self.lotes += 1
+        self.operacoes += len(lote)
+
+        for (_, _, _, _, loop, futuro), (sucesso, valor) in zip(lote, resultados):
+            try:
+                loop.call_soon_threadsafe(_resolver, futuro, sucesso, valor)
+            except RuntimeError:  # loop já encerrado
+                pass
+
+
+_escritor_banco = None
+
+
+def obter_escritor_banco():
+    """
+    Escritor único do banco (settings.BANCO_ESCRITOR_UNICO, ligado no modo de
+    desempenho do SQLite), com lotes de até settings.BANCO_ESCRITOR_LOTE escritas.
+
+    Returns:
+        EscritorBanco, ou None se desligado ou se BANCO_EXECUTOR_THREADS for 0
+        (todo o acesso ao banco fica na thread compartilhada, como nos testes)
+    """
+    global _escritor_banco
+    if not getattr(settings, 'BANCO_ESCRITOR_UNICO', False) or not getattr(settings, 'BANCO_EXECUTOR_THREADS', 0):
+        return None
+    with _lock_executor:
+        if _escritor_banco is None:
+            _escritor_banco = EscritorBanco(lote_maximo=getattr(settings, 'BANCO_ESCRITOR_LOTE', 100))
+            logger.info("Escritor único do banco iniciado")
+        return _escritor_banco
+
+
+async def executar_no_banco(funcao, *args, transacao=True, escrita=False, **kwargs):
+    """
+    Executa uma unidade de trabalho síncrona do banco em uma única passagem
+    pelo executor do banco e, por padrão, em uma única transação.
+
+    Uma unidade de trabalho deve fazer todas as consultas de que o handler
+    precisa e retornar apenas dados prontos (sem acessos preguiçosos ao ORM
+    depois de voltar ao loop de eventos).
+
+    Com `escrita=True` a unidade vai para o escritor único do banco, quando
+    ativo (obter_escritor_banco), e roda em um savepoint do lote dele.
+    """
+    if escrita:
+        escritor = obter_escritor_banco()
+        if escritor is not None:
+            return await escritor.executar(funcao, *args, **kwargs)
+    if transacao:
+        funcao = _em_transacao(funcao)
+    executor = obter_executor_banco()
+    if executor is None:
+        return await database_sync_to_async(funcao)(*args, **kwargs)
+    return await DatabaseSyncToAsync(funcao, thread_sensitive=False, executor=executor)(*args, **kwargs)
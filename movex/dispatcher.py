@@ -0,0 +1,197 @@
+import functools
+import json
+import logging
+import time
+
+from django.conf import settings
+
+from .instrumentation import medir_consultas
+
+logger = logging.getLogger(__name__)
+
+
+class MetricasEventos:
+    """
+    Contagem, erros, latência e consultas SQL por tipo de evento, em memória do worker.
+
+    Um resumo é logado a cada `intervalo_log` segundos, e eventos mais lentos que
+    `limite_lento_ms` ou com mais de `limite_consultas` consultas geram um aviso
+    individual.
+    """
+
+    def __init__(self, intervalo_log=60, limite_lento_ms=500, limite_consultas=0, relogio=time.monotonic):
+        self.intervalo_log = intervalo_log
+        self.limite_lento_ms = limite_lento_ms
+        self.limite_consultas = limite_consultas
+        self._relogio = relogio
+        self._eventos = {}
+        self._ultimo_log = relogio()
+
+    def registrar(self, evento, duracao, erro=False, consultas=0, tempo_banco=0.0):
+        """Registra uma execução de `evento` que levou `duracao` segundos, `tempo_banco` deles em `consultas` consultas."""
+        metrica = self._eventos.get(evento)
+        if metrica is None:
+            metrica = self._eventos[evento] = {
+                'total': 0, 'erros': 0, 'tempo_total': 0.0, 'tempo_maximo': 0.0,
+                'consultas': 0, 'consultas_maximo': 0, 'tempo_banco': 0.0,
+            }
+        metrica['total'] += 1
+        metrica['tempo_total'] += duracao
+        if duracao > metrica['tempo_maximo']:
+            metrica['tempo_maximo'] = duracao
+        if erro:
+            metrica['erros'] += 1
+        metrica['consultas'] += consultas
+        metrica['tempo_banco'] += tempo_banco
+        if consultas > metrica['consultas_maximo']:
+            metrica['consultas_maximo'] = consultas
+
+        if self.limite_lento_ms and duracao * 1000 >= self.limite_lento_ms:
+            logger.warning(
+                f"Evento lento: {evento} levou {duracao * 1000:.0f} ms "
+                f"({consultas} consultas, {tempo_banco * 1000:.0f} ms no banco)"
+            )
+        if self.limite_consultas and consultas > self.limite_consultas:
+            logger.warning(f"Evento {evento} fez {consultas} consultas (limite {self.limite_consultas})")
+        if self.intervalo_log and self._relogio() - self._ultimo_log >= self.intervalo_log:
+            self._ultimo_log = self._relogio()
+            logger.info(f"Métricas de eventos WebSocket: {json.dumps(self.resumo())}")
+
+    def resumo(self):
+        """
+        Returns:
+            dict: evento -> {total, erros, media_ms, maximo_ms, consultas_media, consultas_maximo, banco_media_ms}
+        """
+        return {
+            evento: {
+                'total': metrica['total'],
+                'erros': metrica['erros'],
+                'media_ms': round(metrica['tempo_total'] / metrica['total'] * 1000, 2),
+                'maximo_ms': round(metrica['tempo_maximo'] * 1000, 2),
+                'consultas_media': round(metrica['consultas'] / metrica['total'], 2),
+                'consultas_maximo': metrica['consultas_maximo'],
+                'banco_media_ms': round(metrica['tempo_banco'] / metrica['total'] * 1000, 2),
+            }
+            for evento, metrica in self._eventos.items()
+        }
+
+    def limpar(self):
+        self._eventos.clear()
+        self._ultimo_log = self._relogio()
+
+
+class RegistroEventos:
+    """
+    Tabela de handlers de eventos WebSocket, indexada pelo campo `type` da mensagem.
+
+    Os handlers são métodos do consumer com a assinatura `async def h(self, data)`,
+    registrados com o decorator `evento`:
+
+        eventos = RegistroEventos()
+
+        class Consumer(AsyncWebsocketConsumer):
+            @eventos.evento('ping', 'heartbeat')
+            async def evento_ping(self, data):
+                ...
+
+    `despachar` encontra o handler com uma consulta ao dicionário, aplica o
+    limite de frequência do evento (`limitador`, um LimitadorTaxa) e mede a
+    duração e as consultas SQL de cada execução em `metricas`.
+    """
+
+    def __init__(self, metricas=None, limitador=None):
+        self._handlers = {}
+        self.limitador = limitador
+        self.metricas = metricas or MetricasEventos(
+            intervalo_log=getattr(settings, 'METRICAS_EVENTOS_INTERVALO_LOG', 60),
+            limite_lento_ms=getattr(settings, 'EVENTO_LENTO_MS', 500),
+            limite_consultas=getattr(settings, 'EVENTO_LIMITE_CONSULTAS', 0),
+        )
+
+    def evento(self, *tipos):
+        def decorator(handler):
+            for tipo in tipos:
+                if tipo in self._handlers:
+                    raise ValueError(f"Evento {tipo} já registrado")
+                self._handlers[tipo] = handler
+            return handler
+        return decorator
+
+    def __contains__(self, tipo):
+        return tipo in self._handlers
+
+    def tipos(self):
+        return list(self._handlers)
+
+    async def despachar(self, consumer, tipo, data):
+        """
+        Executa o handler de `tipo`.
+
+        Returns:
+            bool: False se não houver handler para o evento
+        """
+        handler = self._handlers.get(tipo)
+        if handler is None:
+            return False
+
+        if self.limitador is not None and not self.limitador.permitir(_identidade(consumer), tipo):
+            await consumer.send(json.dumps({
+                'type': 'rate_limited',
+                'message': 'Muitas solicitações recentes. Por favor, aguarde alguns segundos.',
+                'request_type': tipo
+            }))
+            return True
+
+        erro = False
+        try:
+            with medir_consultas() as medicao:
+                await handler(consumer, data)
+        except Exception:
+            erro = True
+            raise
+        finally:
+            self.metricas.registrar(tipo, medicao.tempo_total, erro, medicao.consultas, medicao.tempo_banco)
+        return True
+
+
+def _identidade(consumer):
+    """Usuário identificado ou, antes do login, a própria conexão."""
+    user_info = getattr(consumer, 'user_info', None)
+    if user_info and user_info.get('cpf'):
+        return user_info['cpf']
+    return f"conexao:{getattr(consumer, 'connection_id', id(consumer))}"
+
+
+# ===== Middlewares declarativos para os handlers =====
+# Aplicados abaixo de @evento, na ordem em que devem ser verificados.
+
+async def _enviar_erro(consumer, mensagem, **extras):
+    await consumer.send(json.dumps({'type': 'erro', 'message': mensagem, **extras}))
+
+
+def exige_tipo_usuario(tipo_usuario, mensagem):
+    """Aceita o evento apenas de usuários identificados com o tipo informado."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, data):
+            if not self.user_info or not self.user_info.get('cpf') or self.user_info.get('tipo') != tipo_usuario:
+                await _enviar_erro(self, mensagem)
+                return
+            return await handler(self, data)
+        return wrapper
+    return decorator
+
+
+def exige_campos(*campos, mensagem=None):
+    """Recusa o evento se algum dos campos estiver ausente ou vazio."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, data):
+            faltantes = [campo for campo in campos if not data.get(campo)]
+            if faltantes:
+                await _enviar_erro(self, mensagem or f'Campos obrigatórios faltando: {", ".join(faltantes)}')
+                return
+            return await handler(self, data)
+        return wrapper
+    return decorator
+
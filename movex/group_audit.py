@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from .connection_registry import obter_registro_conexoes
+
+logger = logging.getLogger(__name__)
+
+# Grupos por usuário e de tópicos: seus membros são sempre conexões identificadas,
+# do registro compartilhado, então um membro fora do registro é um canal morto
+PREFIXOS_AUDITADOS = ('motorista_', 'passageiro_', 'conexoes_', 'topico.')
+
+
+async def _listar_grupos(channel_layer):
+    """
+    Percorre os grupos do channel layer.
+
+    Yields:
+        (grupo, {canal: momento em que entrou no grupo})
+    """
+    if hasattr(channel_layer, 'groups'):
+        # InMemoryChannelLayer: {grupo: {canal: momento de entrada}}
+        for grupo, canais in list(channel_layer.groups.items()):
+            yield grupo, dict(canais)
+    elif hasattr(channel_layer, 'ring_size'):
+        # RedisChannelLayer: um sorted set por grupo (score = momento de entrada), em cada shard
+        prefixo_chave = channel_layer._group_key('')
+        for indice in range(channel_layer.ring_size):
+            conexao = channel_layer.connection(indice)
+            async for chave in conexao.scan_iter(match=prefixo_chave + b'*', count=500):
+                membros = await conexao.zrange(chave, 0, -1, withscores=True)
+                yield chave[len(prefixo_chave):].decode(), {
+                    (canal.decode() if isinstance(canal, bytes) else canal): entrada for canal, entrada in membros
+                }
+    else:
+        logger.warning(f"Auditoria de grupos não suportada para {type(channel_layer).__name__}")
+
+
+# Canal fora do registro -> momento em que uma auditoria deste processo o viu assim
+_canais_ausentes = {}
+
+
+async def auditar_grupos(channel_layer, registro=None, podar=True, tolerancia=60, carencia=None,
+                         maiores=10, ausentes=None):
+    """
+    Mede os grupos do channel layer e remove dos grupos por usuário os canais
+    que não pertencem a nenhuma conexão registrada.
+
+    Args:
+        registro: registro de conexões (padrão: obter_registro_conexoes())
+        podar: se False, apenas reporta
+        tolerancia: segundos após a entrada no grupo em que um canal ainda não
+            registrado é poupado (a conexão entra no grupo antes de se registrar)
+        carencia: segundos que um canal precisa continuar fora do registro, entre
+            auditorias, antes de ser removido (padrão: settings.AUDITORIA_GRUPOS_CARENCIA);
+            uma falha passageira do registro não derruba conexões vivas
+        maiores: quantos dos maiores grupos incluir no relatório
+        ausentes: {canal: visto fora do registro em} mantido entre auditorias
+
+    Returns:
+        dict: grupos, membros, mortos, removidos e maiores [(grupo, tamanho)]
+    """
+    registro = registro or obter_registro_conexoes()
+    if carencia is None:
+        carencia = getattr(settings, 'AUDITORIA_GRUPOS_CARENCIA', 120)
+    if ausentes is None:
+        ausentes = _canais_ausentes
+    canais_vivos = await registro.canais_ativos()
+    agora = time.time()
+    limite_entrada = agora - tolerancia
+    vistos = set()
+
+    relatorio = {'grupos': 0, 'membros': 0, 'mortos': 0, 'removidos': 0, 'maiores': []}
+    tamanhos = []
+    async for grupo, membros in _listar_grupos(channel_layer):
+        relatorio['grupos'] += 1
+        relatorio['membros'] += len(membros)
+        tamanhos.append((grupo, len(membros)))
+        if not grupo.startswith(PREFIXOS_AUDITADOS):
+            continue
+        fora_do_registro = [
+            canal for canal, entrada in membros.items()
+            if canal not in canais_vivos and entrada < limite_entrada
+        ]
+        vistos.update(fora_do_registro)
+        mortos = [canal for canal in fora_do_registro if agora - ausentes.setdefault(canal, agora) >= carencia]
+        relatorio['mortos'] += len(mortos)
+        if podar:
+            for canal in mortos:
+                await channel_layer.group_discard(grupo, canal)
+            relatorio['removidos'] += len(mortos)
+            vistos.difference_update(mortos)
+
+    # Canais que voltaram ao registro ou saíram de todos os grupos recomeçam a contagem
+    for canal in set(ausentes) - vistos:
+        del ausentes[canal]
+
+    relatorio['maiores'] = sorted(tamanhos, key=lambda item: item[1], reverse=True)[:maiores]
+    return relatorio
+
+
+_tarefas_auditoria = {}
+
+
+async def _auditar_periodicamente(channel_layer, intervalo):
+    registro = obter_registro_conexoes()
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            # Com Redis, apenas um worker audita a cada intervalo
+            if not await registro.adquirir_lock('auditoria_grupos', intervalo * 0.9):
+                continue
+            relatorio = await auditar_grupos(channel_layer, registro)
+            logger.info(
+                f"Auditoria de grupos: {relatorio['grupos']} grupos, {relatorio['membros']} membros, "
+                f"{relatorio['removidos']} canais mortos removidos. Maiores: {relatorio['maiores']}"
+            )
+        except Exception as e:
+            logger.error(f"Erro na auditoria de grupos: {str(e)}")
+
+
+def iniciar_auditoria_grupos(channel_layer):
+    """
+    Inicia (uma vez por loop de eventos) a auditoria periódica dos grupos do
+    channel layer, a cada settings.AUDITORIA_GRUPOS_INTERVALO segundos (0 desativa).
+    """
+    intervalo = getattr(settings, 'AUDITORIA_GRUPOS_INTERVALO', 300)
+    if not intervalo or channel_layer is None:
+        return None
+    loop = asyncio.get_running_loop()
+    tarefa = _tarefas_auditoria.get(id(channel_layer))
+    if tarefa is None or tarefa.done() or tarefa.get_loop() is not loop:
+        tarefa = _tarefas_auditoria[id(channel_layer)] = loop.create_task(
+            _auditar_periodicamente(channel_layer, intervalo)
+        )
+    return tarefa
@@ -0,0 +1,81 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+# Medição ativa da tarefa atual. O asgiref copia o contexto para as threads do
+# sync_to_async e do executor do banco, então as consultas feitas lá por um
+# handler entram na medição do evento que as originou.
+_medicao_atual = contextvars.ContextVar('movex_medicao_consultas', default=None)
+
+
+class MedicaoConsultas:
+    """Consultas SQL, tempo no banco e tempo total de um trecho medido."""
+
+    __slots__ = ('consultas', 'tempo_banco', 'tempo_total', 'sql', 'pai')
+
+    def __init__(self, pai=None, guardar_sql=False):
+        self.consultas = 0
+        self.tempo_banco = 0.0
+        self.tempo_total = 0.0
+        self.sql = [] if guardar_sql else None
+        self.pai = pai
+
+
+def _medir_execucao(execute, sql, params, many, context):
+    medicao = _medicao_atual.get()
+    if medicao is None:
+        return execute(sql, params, many, context)
+    inicio = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duracao = time.perf_counter() - inicio
+        # Medições aninhadas: a consulta conta também para as externas
+        while medicao is not None:
+            medicao.consultas += 1
+            medicao.tempo_banco += duracao
+            if medicao.sql is not None:
+                medicao.sql.append(sql)
+            medicao = medicao.pai
+
+
+def _instalar(conexao):
+    if _medir_execucao not in conexao.execute_wrappers:
+        conexao.execute_wrappers.append(_medir_execucao)
+
+
+def _ao_criar_conexao(sender, connection, **kwargs):
+    _instalar(connection)
+
+
+connection_created.connect(_ao_criar_conexao, dispatch_uid='movex_medicao_consultas')
+
+
+@contextmanager
+def medir_consultas(guardar_sql=False):
+    """
+    Mede as consultas SQL feitas no bloco, inclusive pelas funções síncronas
+    chamadas via sync_to_async/executar_no_banco a partir dele:
+
+        with medir_consultas() as medicao:
+            await eventos.despachar(consumer, 'login', data)
+        medicao.consultas, medicao.tempo_banco, medicao.tempo_total
+
+    Args:
+        guardar_sql: guarda o texto de cada consulta em `medicao.sql` (para
+            depurar testes de orçamento de consultas)
+    """
+    # Conexões já abertas antes da importação deste módulo não passaram pelo sinal
+    for conexao in connections.all(initialized_only=True):
+        _instalar(conexao)
+    medicao = MedicaoConsultas(_medicao_atual.get(), guardar_sql)
+    token = _medicao_atual.set(medicao)
+    inicio = time.perf_counter()
+    try:
+        yield medicao
+    finally:
+        medicao.tempo_total = time.perf_counter() - inicio
+        _medicao_atual.reset(token)
@@ -1,7 +1,10 @@
 import re
+from urllib.parse import parse_qs
 from django.conf import settings
 import logging
 import sys
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
 from django.utils.deprecation import MiddlewareMixin
 
 logger = logging.getLogger(__name__)
@@ -22,3 +25,35 @@ class DisableCSRFMiddleware(MiddlewareMixin):
                 request.csrf_processing_done = True
                 return None
         return None
+
+
+def _token_do_handshake(scope):
+    """Token DRF do handshake: cabeçalho `Authorization: Token <chave>` ou `?token=<chave>`."""
+    for nome, valor in scope.get('headers', []):
+        if nome == b'authorization':
+            tipo, _, chave = valor.decode('latin1').partition(' ')
+            if tipo.lower() == 'token' and chave.strip():
+                return chave.strip()
+    chaves = parse_qs(scope.get('query_string', b'').decode()).get('token')
+    return chaves[0] if chaves else None
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    """
+    Autentica a conexão WebSocket pelo token DRF uma única vez, no handshake.
+    
+    Define no scope:
+        contexto_usuario: dict com cpf, tipo, usuario_id, motorista_pk,
+            passageiro_pk e is_staff, ou None sem token válido
+        token_invalido: True quando um token foi apresentado e recusado
+    """
+
+    async def __call__(self, scope, receive, send):
+        from movex.database_services import contexto_usuario_por_token
+        
+        scope = dict(scope)
+        chave = _token_do_handshake(scope)
+        contexto = await database_sync_to_async(contexto_usuario_por_token)(chave) if chave else None
+        scope['contexto_usuario'] = contexto
+        scope['token_invalido'] = bool(chave) and contexto is None
+        return await super().__call__(scope, receive, send)
@@ -0,0 +1,83 @@
+import asyncio
+import heapq
+import itertools
+
+# Prioridades dos frames enviados ao cliente (menor sai primeiro)
+PRIORIDADE_ALTA = 0    # ciclo de vida da corrida e da conexão
+PRIORIDADE_NORMAL = 1
+PRIORIDADE_BAIXA = 2   # localização do motorista, substituível pela seguinte
+
+
+class FilaSaida:
+    """
+    Fila limitada de frames de saída de uma conexão WebSocket.
+
+    Frames saem por prioridade e, dentro da mesma prioridade, na ordem de
+    chegada. Um frame com `chave` substitui o frame pendente de mesma chave
+    (ex.: a localização mais recente de uma corrida descarta a anterior), sem
+    ocupar uma nova posição na fila.
+    """
+
+    def __init__(self, limite=200):
+        self.limite = limite
+        self._heap = []
+        self._pendentes_por_chave = {}
+        self._sequencia = itertools.count()
+        self._disponivel = asyncio.Event()
+        self._vazia = asyncio.Event()
+        self._vazia.set()
+        self._em_envio = 0
+        self.descartados = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def colocar(self, texto, prioridade=PRIORIDADE_NORMAL, chave=None):
+        """
+        Enfileira um frame.
+
+        Returns:
+            bool: False se a fila está cheia (o cliente não está consumindo)
+        """
+        if chave is not None and chave in self._pendentes_por_chave:
+            self._pendentes_por_chave[chave][2] = texto
+            self.descartados += 1
+            return True
+        if len(self._heap) >= self.limite:
+            return False
+
+        entrada = [prioridade, next(self._sequencia), texto, chave]
+        heapq.heappush(self._heap, entrada)
+        if chave is not None:
+            self._pendentes_por_chave[chave] = entrada
+        self._vazia.clear()
+        self._disponivel.set()
+        return True
+
+    async def obter(self):
+        """Aguarda e retorna o próximo frame a enviar. Chame `concluir()` após enviá-lo."""
+        while not self._heap:
+            self._disponivel.clear()
+            await self._disponivel.wait()
+        _, _, texto, chave = heapq.heappop(self._heap)
+        if chave is not None:
+            self._pendentes_por_chave.pop(chave, None)
+        self._em_envio += 1
+        return texto
+
+    def concluir(self):
+        self._em_envio = max(self._em_envio - 1, 0)
+        self._verificar_vazia()
+
+    async def aguardar_vazia(self):
+        """Aguarda até todos os frames enfileirados terem sido enviados."""
+        await self._vazia.wait()
+
+    def limpar(self):
+        self._heap.clear()
+        self._pendentes_por_chave.clear()
+        self._verificar_vazia()
+
+    def _verificar_vazia(self):
+        if not self._heap and not self._em_envio:
+            self._vazia.set()
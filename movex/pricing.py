@@ -0,0 +1,319 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+MINUTOS_DIA = 24 * 60
+MINUTOS_SEMANA = 7 * MINUTOS_DIA
+
+
+def config_padrao():
+    """Tarifa padrão, montada a partir das constantes de movex/utils.py"""
+    from . import utils
+
+    def hhmm(horario):
+        return horario.strftime('%H:%M')
+
+    return {
+        'tarifa_base': utils.TARIFA_BASE,
+        'tarifa_km': utils.TARIFA_KM,
+        'tarifa_minuto': utils.TARIFA_MINUTO,
+        'tarifa_minima': utils.TARIFA_MINIMA,
+        'tarifa_maxima': None,
+        'corrida_curta_km': utils.DISTANCIA_CORRIDA_CURTA_KM,
+        'tarifa_corrida_curta': utils.TARIFA_CORRIDA_CURTA,
+        # Faixas horárias (início e fim inclusivos). Multiplicadores de faixas
+        # sobrepostas são acumulados. `dias` usa 0 = segunda ... 6 = domingo.
+        'faixas': [
+            {
+                'nome': 'pico_manha',
+                'inicio': hhmm(utils.HORARIO_PICO_MANHA_INICIO),
+                'fim': hhmm(utils.HORARIO_PICO_MANHA_FIM),
+                'multiplicador': utils.MULTIPLICADOR_HORARIO_PICO,
+                'pico': True,
+            },
+            {
+                'nome': 'pico_tarde',
+                'inicio': hhmm(utils.HORARIO_PICO_TARDE_INICIO),
+                'fim': hhmm(utils.HORARIO_PICO_TARDE_FIM),
+                'multiplicador': utils.MULTIPLICADOR_HORARIO_PICO,
+                'pico': True,
+            },
+            {
+                'nome': 'noturno',
+                'inicio': hhmm(utils.HORARIO_NOTURNO_INICIO),
+                'fim': '23:59',
+                'multiplicador': utils.MULTIPLICADOR_HORARIO_NOTURNO,
+            },
+        ],
+    }
+
+
+def _minuto_do_dia(texto):
+    horas, minutos = texto.split(':')
+    return int(horas) * 60 + int(minutos)
+
+
+class TabelaTarifas:
+    """
+    Tarifa compilada: multiplicador e indicador de pico para cada minuto da
+    semana, mais os valores fixos da tarifa. Consultar é um acesso a lista.
+    """
+
+    def __init__(self, config):
+        self.tarifa_base = float(config['tarifa_base'])
+        self.tarifa_km = float(config['tarifa_km'])
+        self.tarifa_minuto = float(config['tarifa_minuto'])
+        self.tarifa_minima = float(config['tarifa_minima'] or 0)
+        self.tarifa_maxima = float(config['tarifa_maxima']) if config.get('tarifa_maxima') else None
+        self.corrida_curta_km = float(config.get('corrida_curta_km') or 0)
+        self.tarifa_corrida_curta = config.get('tarifa_corrida_curta')
+
+        multiplicadores = [1.0] * MINUTOS_SEMANA
+        pico = [False] * MINUTOS_SEMANA
+        for faixa in config.get('faixas', []):
+            inicio = _minuto_do_dia(faixa['inicio'])
+            fim = _minuto_do_dia(faixa['fim'])
+            if fim < inicio:
+                # Faixa que atravessa a meia-noite (ex.: 22:00 - 05:59)
+                minutos = list(range(inicio, MINUTOS_DIA)) + list(range(0, fim + 1))
+            else:
+                minutos = range(inicio, fim + 1)
+            for dia in faixa.get('dias', range(7)):
+                deslocamento = dia * MINUTOS_DIA
+                for minuto in minutos:
+                    multiplicadores[deslocamento + minuto] *= float(faixa['multiplicador'])
+                    if faixa.get('pico'):
+                        pico[deslocamento + minuto] = True
+
+        self.multiplicadores = multiplicadores
+        self.pico = pico
+        self._multiplicadores_np = np.array(multiplicadores) if np is not None else None
+
+
+class MotorTarifas:
+    """
+    Motor de precificação com tarifa pré-compilada por minuto da semana.
+
+    A configuração vem de `config_padrao()`, sobrescrita por
+    `settings.MOVEX_TARIFAS` e pelo arquivo JSON `settings.MOVEX_TARIFAS_ARQUIVO`.
+    O arquivo é verificado a cada `intervalo_verificacao` segundos e a tarifa é
+    recompilada quando ele muda, sem reiniciar o servidor.
+    """
+
+    def __init__(self, config=None, arquivo=None, intervalo_verificacao=5):
+        self._config_fixa = config
+        self.arquivo = arquivo
+        self.intervalo_verificacao = intervalo_verificacao
+        self._mtime_arquivo = None
+        self._ultima_verificacao = 0.0
+        self._lock = threading.Lock()
+        self.tabela = TabelaTarifas(self._montar_config())
+
+    def _montar_config(self):
+        config = config_padrao()
+        if self._config_fixa is not None:
+            config.update(self._config_fixa)
+            return config
+
+        config.update(getattr(settings, 'MOVEX_TARIFAS', {}))
+        if self.arquivo and os.path.exists(self.arquivo):
+            with open(self.arquivo, encoding='utf-8') as arquivo:
+                config.update(json.load(arquivo))
+            self._mtime_arquivo = os.path.getmtime(self.arquivo)
+        return config
+
+    def recarregar(self):
+        """Recompila a tarifa imediatamente."""
+        with self._lock:
+            self.tabela = TabelaTarifas(self._montar_config())
+            logger.info("Tarifas recarregadas")
+
+    def _verificar_arquivo(self):
+        if not self.arquivo:
+            return
+        agora = time.monotonic()
+        if agora - self._ultima_verificacao < self.intervalo_verificacao:
+            return
+        self._ultima_verificacao = agora
+        try:
+            mtime = os.path.getmtime(self.arquivo)
+        except OSError:
+            return
+        if mtime != self._mtime_arquivo:
+            try:
+                self.recarregar()
+            except Exception as e:
+                # Um arquivo inválido não derruba a precificação: mantém a tarifa anterior
+                logger.error(f"Erro ao recarregar tarifas de {self.arquivo}: {str(e)}")
+                self._mtime_arquivo = mtime
+
+    @staticmethod
+    def minuto_da_semana(timestamp=None):
+        """Índice do minuto na semana (0 = segunda 00:00) no fuso horário do projeto."""
+        if timestamp is None:
+            momento = timezone.localtime()
+        elif isinstance(timestamp, (int, float)):
+            momento = timezone.localtime(datetime.fromtimestamp(timestamp, tz=timezone.get_current_timezone()))
+        elif timezone.is_aware(timestamp):
+            momento = timezone.localtime(timestamp)
+        else:
+            momento = timestamp
+        return momento.weekday() * MINUTOS_DIA + momento.hour * 60 + momento.minute
+
+    def multiplicador(self, timestamp=None):
+        self._verificar_arquivo()
+        return self.tabela.multiplicadores[self.minuto_da_semana(timestamp)]
+
+    def is_horario_pico(self, timestamp=None):
+        self._verificar_arquivo()
+        return self.tabela.pico[self.minuto_da_semana(timestamp)]
+
+    def quote(self, distancias, duracoes, timestamp=None):
+        """
+        Calcula o valor de várias opções de corrida de uma vez.
+
+        Args:
+            distancias: distâncias em km
+            duracoes: tempos estimados em minutos
+            timestamp: momento da cotação (datetime ou epoch); padrão é agora
+
+        Returns:
+            list: valores em reais, arredondados para 2 casas decimais
+        """
+        self._verificar_arquivo()
+        tabela = self.tabela
+        multiplicador = tabela.multiplicadores[self.minuto_da_semana(timestamp)]
+        curta_km = tabela.corrida_curta_km
+        tarifa_curta = tabela.tarifa_corrida_curta
+        minima = tabela.tarifa_minima
+        maxima = tabela.tarifa_maxima
+
+        if np is not None:
+            distancias = np.asarray(distancias, dtype=float)
+            duracoes = np.asarray(duracoes, dtype=float)
+            valores = (tabela.tarifa_base + tabela.tarifa_km * distancias
+                       + tabela.tarifa_minuto * duracoes) * multiplicador
+            if tarifa_curta is not None and curta_km:
+                valores = np.where(distancias <= curta_km, float(tarifa_curta), valores)
+            valores = np.clip(valores, minima, maxima)
+            return np.round(valores, 2).tolist()
+
+        valores = []
+        for distancia, duracao in zip(distancias, duracoes):
+            distancia = float(distancia)
+            if tarifa_curta is not None and curta_km and distancia <= curta_km:
+                valor = float(tarifa_curta)
+            else:
+                valor = (tabela.tarifa_base + tabela.tarifa_km * distancia
+                         + tabela.tarifa_minuto * float(duracao)) * multiplicador
+            valor = max(minima, valor)
+            if maxima is not None:
+                valor = min(maxima, valor)
+            valores.append(round(valor, 2))
+        return valores
+
+
+_motor_tarifas = None
+
+
+def obter_motor_tarifas():
+    """Instância compartilhada do motor de tarifas, criada sob demanda a partir das settings."""
+    global _motor_tarifas
+    if _motor_tarifas is None:
+        _motor_tarifas = MotorTarifas(arquivo=getattr(settings, 'MOVEX_TARIFAS_ARQUIVO', None))
+    return _motor_tarifas
+
+
+# Cotações assinadas: calcular_rota devolve um token com as métricas da rota e o
+# preço, e solicitar_corrida confia apenas no token (não nos valores do cliente).
+SALT_COTACAO = 'movex.cotacao'
+
+
+def emitir_cotacao(origem, destino, distancia, tempo_estimado, valor, cpf=None, validade=None):
+    """
+    Gera um token compacto e assinado (HMAC com a SECRET_KEY) para uma cotação.
+
+    Args:
+        origem, destino: pares (latitude, longitude)
+        distancia: km
+        tempo_estimado: minutos
+        valor: preço cotado em reais
+        cpf: se informado, apenas este usuário pode usar a cotação
+        validade: segundos até expirar (padrão settings.COTACAO_VALIDADE_SEGUNDOS)
+    """
+    if validade is None:
+        validade = getattr(settings, 'COTACAO_VALIDADE_SEGUNDOS', 300)
+    dados = {
+        'o': [round(float(origem[0]), 6), round(float(origem[1]), 6)],
+        'd': [round(float(destino[0]), 6), round(float(destino[1]), 6)],
+        'km': round(float(distancia), 2),
+        'min': int(tempo_estimado),
+        'v': round(float(valor), 2),
+        'exp': int(time.time() + validade),
+    }
+    if cpf:
+        dados['u'] = cpf
+    return signing.dumps(dados, salt=SALT_COTACAO, compress=False)
+
+
+def validar_cotacao(token, cpf=None):
+    """
+    Verifica assinatura e validade de um token de cotação. Um token emitido para
+    um usuário só vale para esse `cpf` (o da conexão, nunca o do payload): sem
+    `cpf` ele é recusado.
+
+    Returns:
+        dict com origem, destino, distancia, tempo_estimado e valor, ou None se inválido
+    """
+    if not token or not isinstance(token, str):
+        return None
+    try:
+        dados = signing.loads(token, salt=SALT_COTACAO)
+    except signing.BadSignature:
+        logger.warning("Token de cotação com assinatura inválida")
+        return None
+
+    if dados.get('exp', 0) < time.time():
+        logger.info("Token de cotação expirado")
+        return None
+    if dados.get('u') and dados['u'] != cpf:
+        logger.warning(f"Token de cotação emitido para outro usuário (usado por {cpf or 'conexão sem identificação'})")
+        return None
+
+    return {
+        'origem': tuple(dados['o']),
+        'destino': tuple(dados['d']),
+        'distancia': dados['km'],
+        'tempo_estimado': dados['min'],
+        'valor': dados['v'],
+        'expira_em': dados['exp'],
+    }
+
+
+def cotacao_corresponde(cotacao, origem, destino, tolerancia=0.0002):
+    """Confere se as coordenadas da solicitação são as mesmas da cotação (~20 m de tolerância)."""
+    try:
+        pontos = (
+            (cotacao['origem'], (float(origem.get('latitude')), float(origem.get('longitude')))),
+            (cotacao['destino'], (float(destino.get('latitude')), float(destino.get('longitude')))),
+        )
+    except (TypeError, ValueError):
+        return False
+    return all(
+        abs(cotado[0] - pedido[0]) <= tolerancia and abs(cotado[1] - pedido[1]) <= tolerancia
+        for cotado, pedido in pontos
+    )
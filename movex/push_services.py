@@ -0,0 +1,344 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from itertools import zip_longest
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover - aiohttp faz parte do requirements.txt
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+EXPO_PUSH_URL = 'https://exp.host/--/api/v2/push/send'
+EXPO_RECIBOS_URL = 'https://exp.host/--/api/v2/push/getReceipts'
+# Limites por requisição aceitos pela API do Expo
+EXPO_TAMANHO_MAXIMO_LOTE = 100
+EXPO_MAXIMO_RECIBOS = 1000
+
+CABECALHOS_EXPO = {
+    'Accept': 'application/json',
+    'Accept-encoding': 'gzip, deflate',
+    'Content-Type': 'application/json',
+}
+
+
+def token_push_valido(token):
+    return bool(token) and isinstance(token, str) and token.startswith('ExponentPushToken[')
+
+
+def montar_mensagem_push(token, titulo, mensagem, dados=None):
+    """Mensagem no formato da API de push do Expo"""
+    payload = {
+        'to': token,
+        'sound': 'default',
+        'title': titulo,
+        'body': mensagem,
+        'priority': 'high',
+    }
+    if dados:
+        payload['data'] = dados
+    return payload
+
+
+class CacheTokensPush:
+    """
+    Cache em processo de cpf -> (usuario_id, token push ativo ou None).
+
+    SalvarTokenPushView invalida a entrada do usuário neste processo; nos demais
+    workers a entrada expira pelo TTL.
+    """
+
+    def __init__(self, ttl=300, tamanho_maximo=10000, relogio=time.monotonic):
+        self.ttl = ttl
+        self.tamanho_maximo = tamanho_maximo
+        self._relogio = relogio
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, cpf):
+        with self._lock:
+            item = self._itens.get(cpf)
+            if item is None:
+                return None
+            expira_em, destino = item
+            if expira_em < self._relogio():
+                del self._itens[cpf]
+                return None
+            self._itens.move_to_end(cpf)
+            return destino
+
+    def guardar(self, cpf, destino):
+        with self._lock:
+            self._itens[cpf] = (self._relogio() + self.ttl, destino)
+            self._itens.move_to_end(cpf)
+            while len(self._itens) > self.tamanho_maximo:
+                self._itens.popitem(last=False)
+
+    def invalidar(self, cpf):
+        with self._lock:
+            self._itens.pop(cpf, None)
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+
+
+cache_tokens_push = CacheTokensPush(ttl=getattr(settings, 'PUSH_CACHE_TOKENS_TTL', 300))
+
+
+class DespachantePush:
+    """
+    Cliente assíncrono do Expo usado pelo outbox (executar_outbox): envia lotes de
+    até 100 mensagens por requisição e consulta recibos, com uma sessão aiohttp
+    reaproveitada e timeout, sem bloquear o loop de eventos.
+    """
+
+    def __init__(self, url=None, url_recibos=None, tamanho_lote=None, timeout=None):
+        self.url = url or getattr(settings, 'EXPO_PUSH_URL', EXPO_PUSH_URL)
+        self.url_recibos = url_recibos or getattr(settings, 'EXPO_RECIBOS_URL', EXPO_RECIBOS_URL)
+        self.tamanho_lote = min(
+            tamanho_lote or getattr(settings, 'PUSH_TAMANHO_LOTE', EXPO_TAMANHO_MAXIMO_LOTE),
+            EXPO_TAMANHO_MAXIMO_LOTE,
+        )
+        self.timeout = timeout or getattr(settings, 'PUSH_TIMEOUT', 5)
+        self._sessao = None
+        self._loop = None
+
+    async def _obter_sessao(self):
+        """Sessão do loop em execução (um por worker ASGI ou pelo comando do outbox)."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._sessao = None
+            self._loop = loop
+        if self._sessao is None or self._sessao.closed:
+            self._sessao = aiohttp.ClientSession(
+                headers=CABECALHOS_EXPO,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300),
+            )
+        return self._sessao
+
+    async def enviar_lote(self, mensagens):
+        """
+        Envia até 100 mensagens em uma única requisição ao Expo.
+
+        Returns:
+            list: tickets devolvidos pelo Expo, na mesma ordem das mensagens
+        """
+        sessao = await self._obter_sessao()
+        async with sessao.post(self.url, json=mensagens) as response:
+            if response.status != 200:
+                texto = await response.text()
+                raise Exception(f"Falha ao enviar notificações push: {response.status} - {texto}")
+            resposta = await response.json(content_type=None)
+
+        if resposta.get('errors'):
+            logger.error(f"Erros no envio das notificações: {resposta['errors']}")
+        tickets = resposta.get('data') or []
+        for mensagem, ticket in zip(mensagens, tickets):
+            if ticket.get('status') == 'error':
+                logger.warning(f"Expo recusou notificação para {mensagem['to']}: {ticket.get('message')}")
+        logger.info(f"Lote de {len(mensagens)} notificações push enviado")
+        return tickets
+
+    async def buscar_recibos(self, ids):
+        """
+        Consulta os recibos de até 1000 tickets de uma vez.
+
+        Returns:
+            dict: id do ticket -> recibo ({'status': 'ok'} ou {'status': 'error', 'details': ...})
+        """
+        sessao = await self._obter_sessao()
+        async with sessao.post(self.url_recibos, json={'ids': list(ids)}) as response:
+            if response.status != 200:
+                texto = await response.text()
+                raise Exception(f"Falha ao consultar recibos push: {response.status} - {texto}")
+            resposta = await response.json(content_type=None)
+        return resposta.get('data') or {}
+
+    async def fechar(self):
+        if self._sessao is not None and not self._sessao.closed and self._loop is asyncio.get_running_loop():
+            await self._sessao.close()
+        self._sessao = None
+        self._loop = None
+
+
+_despachante_push = None
+
+
+def obter_despachante_push():
+    """Instância compartilhada do despachante de notificações push."""
+    global _despachante_push
+    if _despachante_push is None:
+        _despachante_push = DespachantePush()
+    return _despachante_push
+
+
+def _token_ativo(usuario):
+    try:
+        push_token = usuario.push_token
+    except Exception:
+        return None
+    return push_token.token if push_token.ativo else None
+
+
+async def processar_outbox(despachante=None, limite=EXPO_TAMANHO_MAXIMO_LOTE):
+    """
+    Envia um lote de notificações do outbox (usuarios.NotificacaoPush).
+
+    Returns:
+        int: quantidade de notificações processadas (0 quando a fila está vazia)
+    """
+    # Importação tardia: database_services depende de utils, que depende deste módulo
+    from .database_services import (
+        concluir_notificacoes_push,
+        desativar_tokens_push,
+        reservar_notificacoes_push,
+    )
+
+    despachante = despachante or obter_despachante_push()
+    notificacoes = await sync_to_async(reservar_notificacoes_push)(limite)
+    if not notificacoes:
+        return 0
+
+    enviaveis = []
+    enviadas = []
+    falhas = []
+    tokens_mortos = []
+    for notificacao in notificacoes:
+        token = _token_ativo(notificacao.usuario)
+        if token_push_valido(token):
+            enviaveis.append((notificacao, token))
+        else:
+            falhas.append((notificacao, 'Usuário sem token push ativo', False))
+
+    if enviaveis:
+        mensagens = [
+            montar_mensagem_push(token, notificacao.titulo, notificacao.mensagem, notificacao.dados)
+            for notificacao, token in enviaveis
+        ]
+        try:
+            tickets = await despachante.enviar_lote(mensagens)
+        except Exception as e:
+            logger.error(f"Falha ao enviar lote do outbox de notificações: {str(e)}")
+            falhas.extend((notificacao, str(e), False) for notificacao, _ in enviaveis)
+        else:
+            for (notificacao, token), ticket in zip_longest(enviaveis, tickets[:len(enviaveis)]):
+                if ticket and ticket.get('status') == 'ok':
+                    # O ticket é guardado para conferir o recibo depois (verificar_recibos_push)
+                    enviadas.append((notificacao, ticket.get('id', ''), token))
+                    continue
+                erro = (ticket or {}).get('details', {}).get('error') or (ticket or {}).get('message') or 'Sem resposta do Expo'
+                # Dispositivo desinstalou o app: não adianta tentar de novo
+                if erro == 'DeviceNotRegistered':
+                    tokens_mortos.append(token)
+                falhas.append((notificacao, erro, erro == 'DeviceNotRegistered'))
+
+    await sync_to_async(concluir_notificacoes_push)(enviadas, falhas)
+    if tokens_mortos:
+        await sync_to_async(desativar_tokens_push)(tokens_mortos)
+    return len(notificacoes)
+
+
+async def verificar_recibos_push(despachante=None, limite=EXPO_MAXIMO_RECIBOS):
+    """
+    Confere os recibos do Expo das notificações já enviadas e desativa os tokens
+    de dispositivos que não existem mais (DeviceNotRegistered).
+
+    Returns:
+        int: quantidade de recibos processados
+    """
+    from .database_services import desativar_tokens_push, notificacoes_aguardando_recibo, registrar_recibos_push
+
+    despachante = despachante or obter_despachante_push()
+    pendentes = await sync_to_async(notificacoes_aguardando_recibo)(limite)
+    if not pendentes:
+        return 0
+
+    recibos = await despachante.buscar_recibos([ticket_id for _, ticket_id, _ in pendentes])
+    tokens_mortos = []
+    conferidas = []
+    for notificacao_id, ticket_id, token in pendentes:
+        recibo = recibos.get(ticket_id)
+        if recibo is None:
+            # Recibo ainda não disponível; tenta de novo na próxima execução
+            continue
+        conferidas.append(notificacao_id)
+        if recibo.get('status') == 'error':
+            erro = recibo.get('details', {}).get('error')
+            logger.warning(f"Recibo push com erro para {token}: {erro} - {recibo.get('message')}")
+            if erro == 'DeviceNotRegistered':
+                tokens_mortos.append(token)
+
+    await sync_to_async(registrar_recibos_push)(conferidas)
+    if tokens_mortos:
+        await sync_to_async(desativar_tokens_push)(tokens_mortos)
+    return len(conferidas)
+
+
+async def executar_outbox(despachante=None, intervalo=1.0, lote=EXPO_TAMANHO_MAXIMO_LOTE, intervalo_recibos=300.0,
+                          uma_vez=False):
+    """
+    Esvazia o outbox continuamente: envia os lotes pendentes, espera `intervalo`
+    segundos quando a fila está vazia e confere os recibos a cada
+    `intervalo_recibos` segundos. Usado pelo comando processar_notificacoes_push
+    e pela tarefa dentro do processo web (iniciar_outbox_no_processo).
+
+    Returns:
+        int: notificações processadas (só retorna com `uma_vez`)
+    """
+    despachante = despachante or obter_despachante_push()
+    total = 0
+    ultima_conferencia = time.monotonic()
+    while True:
+        try:
+            processadas = await processar_outbox(despachante, lote)
+        except Exception as e:
+            logger.exception(f"Erro ao processar outbox de notificações: {str(e)}")
+            processadas = 0
+        total += processadas
+
+        if time.monotonic() - ultima_conferencia >= intervalo_recibos:
+            await _conferir_recibos(despachante)
+            ultima_conferencia = time.monotonic()
+
+        if processadas < lote:
+            if uma_vez:
+                await _conferir_recibos(despachante)
+                return total
+            await asyncio.sleep(intervalo)
+
+
+async def _conferir_recibos(despachante):
+    try:
+        while await verificar_recibos_push(despachante):
+            pass
+    except Exception as e:
+        logger.exception(f"Erro ao conferir recibos push: {str(e)}")
+
+
+_tarefa_outbox = None
+
+
+def iniciar_outbox_no_processo():
+    """
+    Inicia (uma vez por loop de eventos) o envio do outbox dentro do processo
+    web, para implantações sem o worker processar_notificacoes_push
+    (settings.PUSH_OUTBOX_NO_PROCESSO). Vários workers web podem rodar a
+    tarefa ao mesmo tempo: reservar_notificacoes_push não entrega a mesma
+    notificação a dois deles.
+    """
+    global _tarefa_outbox
+    if not getattr(settings, 'PUSH_OUTBOX_NO_PROCESSO', False):
+        return None
+    loop = asyncio.get_running_loop()
+    if _tarefa_outbox is None or _tarefa_outbox.done() or _tarefa_outbox.get_loop() is not loop:
+        _tarefa_outbox = loop.create_task(executar_outbox(obter_despachante_push()))
+        logger.info("Envio do outbox de notificações push iniciado no processo web")
+    return _tarefa_outbox
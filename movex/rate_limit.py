@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# Política por evento: (capacidade do balde, fichas repostas por segundo).
+# 'default' vale para os eventos sem política própria.
+POLITICAS_PADRAO = {
+    'default': (10, 5.0),
+    'ping': (2, 2.0),                       # um ping a cada 0,5 s, com folga de 2
+    'heartbeat': (2, 2.0),
+    'calcular_rota': (1, 1.0),              # uma cotação por segundo
+    'solicitar_corrida': (3, 0.2),
+    'solicitar_historico_chat': (1, 0.2),   # uma vez a cada 5 s
+    'mensagem_chat': (5, 1.0),
+    'atualizar_localizacao': (5, 2.0),
+}
+
+
+class LimitadorTaxa:
+    """
+    Limitador de frequência por token bucket, com memória limitada.
+
+    Cada chave (cpf ou conexão, evento, parâmetro) tem um balde de `capacidade`
+    fichas, repostas continuamente à taxa da política do evento; cada evento
+    gasta uma ficha. Um balde que já teria se enchido de novo equivale a um
+    balde novo, então:
+
+    - a cada chamada, até `descartes_por_chamada` baldes expirados são
+      descartados do início da ordem de uso (os usados há mais tempo), em tempo
+      constante: como cada chamada cria no máximo um balde, o descarte acompanha
+      o ritmo de criação sem varrer o dicionário inteiro sob o lock;
+    - acima de `tamanho_maximo` baldes, os usados há mais tempo são descartados.
+    """
+
+    def __init__(self, politicas=None, tamanho_maximo=50000, descartes_por_chamada=2, relogio=time.monotonic):
+        self.politicas = dict(POLITICAS_PADRAO)
+        self.politicas.update(politicas or {})
+        self.tamanho_maximo = tamanho_maximo
+        self.descartes_por_chamada = descartes_por_chamada
+        self._relogio = relogio
+        self._baldes = OrderedDict()  # chave -> [fichas, atualizado_em, expira_em]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._baldes)
+
+    def politica(self, evento):
+        return self.politicas.get(evento) or self.politicas['default']
+
+    def permitir(self, identidade, evento, parametro=None):
+        """
+        Consome uma ficha do balde de (identidade, evento, parametro).
+
+        Returns:
+            bool: True se o evento está dentro do limite
+        """
+        capacidade, por_segundo = self.politica(evento)
+        chave = (identidade, evento, str(parametro) if parametro is not None else None)
+        with self._lock:
+            agora = self._relogio()
+            self._descartar_mais_antigos(agora)
+
+            balde = self._baldes.get(chave)
+            if balde is not None:
+                self._baldes.move_to_end(chave)
+            if balde is None or balde[2] <= agora:
+                fichas = float(capacidade)
+            else:
+                fichas = min(float(capacidade), balde[0] + (agora - balde[1]) * por_segundo)
+
+            permitido = fichas >= 1
+            if permitido:
+                fichas -= 1
+            # Momento em que o balde estará cheio de novo e poderá ser descartado
+            expira_em = agora + (capacidade - fichas) / por_segundo
+            if balde is None:
+                self._baldes[chave] = [fichas, agora, expira_em]
+                while len(self._baldes) > self.tamanho_maximo:
+                    self._baldes.popitem(last=False)
+            else:
+                balde[0], balde[1], balde[2] = fichas, agora, expira_em
+            return permitido
+
+    def _descartar_mais_antigos(self, agora):
+        for _ in range(self.descartes_por_chamada):
+            if not self._baldes:
+                return
+            chave = next(iter(self._baldes))
+            if self._baldes[chave][2] > agora:
+                return
+            del self._baldes[chave]
+
+    def limpar(self):
+        with self._lock:
+            self._baldes.clear()
+
+
+limitador_eventos = LimitadorTaxa(
+    politicas=getattr(settings, 'LIMITES_EVENTOS', None),
+    tamanho_maximo=getattr(settings, 'LIMITADOR_TAMANHO_MAXIMO', 50000),
+)
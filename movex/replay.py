@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover - redis é dependência do channels_redis
+    aioredis = None
+
+from .broadcast import codificar_json
+
+logger = logging.getLogger(__name__)
+
+
+class BufferReplayMemoria:
+    """
+    Últimos eventos enviados a cada usuário, numerados em sequência, para
+    reenviar a uma conexão que caiu e voltou (`resume_from`). Um único processo;
+    mesma interface do buffer em Redis.
+
+    Cada usuário guarda até `tamanho` eventos; o buffer e a sequência expiram
+    após `ttl` segundos sem eventos novos. Os usuários ficam em ordem de
+    expiração e os expirados são descartados a cada registro, mesmo que o cpf
+    nunca mais seja consultado.
+    """
+
+    def __init__(self, tamanho=100, ttl=600, relogio=time.time):
+        self.tamanho = tamanho
+        self.ttl = ttl
+        self._relogio = relogio
+        # cpf -> {'seq', 'eventos': deque[(seq, evento)], 'expira_em'}, do que expira primeiro ao último
+        self._usuarios = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _obter(self, cpf, agora):
+        usuario = self._usuarios.get(cpf)
+        if usuario is not None and usuario['expira_em'] <= agora:
+            del self._usuarios[cpf]
+            usuario = None
+        return usuario
+
+    def _descartar_expirados(self, agora):
+        while self._usuarios:
+            usuario = next(iter(self._usuarios.values()))
+            if usuario['expira_em'] > agora:
+                break
+            self._usuarios.popitem(last=False)
+
+    async def registrar(self, cpf, evento):
+        """
+        Guarda o evento e retorna o número de sequência atribuído a ele.
+        """
+        with self._lock:
+            agora = self._relogio()
+            self._descartar_expirados(agora)
+            usuario = self._usuarios.get(cpf)
+            if usuario is None:
+                usuario = self._usuarios[cpf] = {'seq': 0, 'eventos': deque(maxlen=self.tamanho)}
+            else:
+                self._usuarios.move_to_end(cpf)
+            usuario['seq'] += 1
+            usuario['eventos'].append((usuario['seq'], dict(evento, seq=usuario['seq'])))
+            usuario['expira_em'] = agora + self.ttl
+            return usuario['seq']
+
+    async def eventos_desde(self, cpf, seq):
+        """
+        Eventos do usuário com sequência maior que `seq`.
+
+        Returns:
+            (ultimo_seq, eventos, completo): `completo` é False quando parte dos
+            eventos posteriores a `seq` já saiu do buffer (ou a sequência expirou)
+        """
+        with self._lock:
+            usuario = self._obter(cpf, self._relogio())
+            if usuario is None:
+                return 0, [], seq <= 0
+            eventos = [evento for numero, evento in usuario['eventos'] if numero > seq]
+            primeiro = usuario['eventos'][0][0] if usuario['eventos'] else usuario['seq'] + 1
+            completo = seq <= usuario['seq'] and seq >= primeiro - 1
+            return usuario['seq'], eventos, completo
+
+    async def ultimo_seq(self, cpf):
+        with self._lock:
+            usuario = self._obter(cpf, self._relogio())
+            return usuario['seq'] if usuario else 0
+
+
+# KEYS[1] = sequência do usuário, KEYS[2] = lista de eventos
+# ARGV: evento (JSON sem seq), tamanho, ttl
+SCRIPT_REGISTRAR_EVENTO = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('RPUSH', KEYS[2], seq .. '|' .. ARGV[1])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return seq
+"""
+
+
+class BufferReplayRedis:
+    """
+    Buffer de reenvio compartilhado entre workers: a conexão pode voltar por
+    outro worker. Chaves (com `prefixo`): seq:<cpf> (contador) e eventos:<cpf>
+    (lista "seq|json" limitada a `tamanho` itens).
+    """
+
+    def __init__(self, url=None, cliente=None, prefixo='movex:replay:', tamanho=100, ttl=600):
+        self.url = url
+        self.prefixo = prefixo
+        self.tamanho = tamanho
+        self.ttl = ttl
+        self._cliente = cliente
+        self._cliente_fixo = cliente is not None
+        self._cliente_loop = None
+
+    async def _obter_cliente(self):
+        """Cliente Redis do loop atual (conexões redis.asyncio não podem mudar de loop)."""
+        if self._cliente_fixo:
+            return self._cliente
+        loop = asyncio.get_running_loop()
+        if self._cliente is not None and self._cliente_loop is not loop:
+            await self._fechar_cliente_de_outro_loop()
+        if self._cliente is None:
+            self._cliente = aioredis.Redis.from_url(self.url)
+            self._cliente_loop = loop
+        return self._cliente
+
+    async def _fechar_cliente_de_outro_loop(self):
+        # Ex.: async_to_sync cria um loop por chamada; o pool antigo não pode ser reaproveitado
+        cliente, loop_anterior = self._cliente, self._cliente_loop
+        self._cliente = None
+        self._cliente_loop = None
+        if loop_anterior.is_running():
+            # As conexões pertencem ao outro loop: fecha lá
+            asyncio.run_coroutine_threadsafe(cliente.aclose(), loop_anterior)
+            return
+        try:
+            await cliente.aclose()
+        except Exception as e:
+            logger.debug(f"Erro ao fechar cliente Redis de um loop encerrado: {str(e)}")
+
+    async def registrar(self, cpf, evento):
+        return int(await (await self._obter_cliente()).eval(
+            SCRIPT_REGISTRAR_EVENTO, 2, f"{self.prefixo}seq:{cpf}", f"{self.prefixo}eventos:{cpf}",
+            codificar_json(evento), self.tamanho, self.ttl
+        ))
+
+    async def eventos_desde(self, cpf, seq):
+        async with (await self._obter_cliente()).pipeline(transaction=True) as pipe:
+            pipe.get(f"{self.prefixo}seq:{cpf}")
+            pipe.lrange(f"{self.prefixo}eventos:{cpf}", 0, -1)
+            ultimo, itens = await pipe.execute()
+        ultimo = int(ultimo or 0)
+
+        eventos = []
+        primeiro = ultimo + 1
+        for indice, item in enumerate(itens):
+            numero, _, dados = (item.decode() if isinstance(item, bytes) else item).partition('|')
+            numero = int(numero)
+            if indice == 0:
+                primeiro = numero
+            if numero > seq:
+                eventos.append(dict(json.loads(dados), seq=numero))
+        completo = seq <= ultimo and seq >= primeiro - 1
+        return ultimo, eventos, completo
+
+    async def ultimo_seq(self, cpf):
+        return int(await (await self._obter_cliente()).get(f"{self.prefixo}seq:{cpf}") or 0)
+
+
+_buffer_replay = None
+
+
+def obter_buffer_replay():
+    """
+    Buffer de reenvio compartilhado. Usa Redis quando o channel layer usa Redis
+    (settings.CHANNEL_REDIS_HOSTS) e memória caso contrário.
+    """
+    global _buffer_replay
+    if _buffer_replay is None:
+        tamanho = getattr(settings, 'REPLAY_TAMANHO', 100)
+        ttl = getattr(settings, 'REPLAY_TTL', 600)
+        hosts = getattr(settings, 'CHANNEL_REDIS_HOSTS', [])
+        if hosts:
+            _buffer_replay = BufferReplayRedis(url=hosts[0], tamanho=tamanho, ttl=ttl)
+        else:
+            _buffer_replay = BufferReplayMemoria(tamanho=tamanho, ttl=ttl)
+    return _buffer_replay
+
+
+async def enviar_com_sequencia(channel_layer, grupo, cpf, evento):
+    """
+    Envia um evento ao grupo de um usuário, numerado e guardado no buffer de
+    reenvio do usuário. Se o buffer falhar o evento segue sem número.
+    """
+    try:
+        evento = dict(evento, seq=await obter_buffer_replay().registrar(cpf, evento))
+    except Exception as e:
+        logger.error(f"Erro ao registrar evento {evento.get('type')} para reenvio a {cpf}: {str(e)}")
+    await channel_layer.group_send(grupo, evento)
@@ -0,0 +1,415 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover - aiohttp faz parte do requirements.txt
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+# Estados do circuit breaker
+FECHADO = 'FECHADO'
+ABERTO = 'ABERTO'
+MEIO_ABERTO = 'MEIO_ABERTO'
+
+# Valores padrão, podem ser sobrescritos em settings.ROTAS_CIRCUIT_BREAKER
+CONFIG_PADRAO_BREAKER = {
+    'tamanho_janela': 50,        # Últimas N chamadas consideradas
+    'janela_segundos': 60,       # Chamadas mais antigas que isso são descartadas
+    'min_amostras': 10,          # Mínimo de chamadas antes de avaliar a abertura
+    'taxa_erro_maxima': 0.5,     # Abre com 50% ou mais de falhas
+    'latencia_p95_maxima': 1.5,  # Abre se o p95 passar de 1,5 segundo
+    'tempo_aberto': 30,          # Segundos até liberar uma sonda (meio-aberto)
+}
+
+
+class CircuitoAbertoError(Exception):
+    """O circuit breaker do provedor de rotas está aberto."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker baseado em taxa de erro e latência p95 de uma janela deslizante.
+
+    FECHADO: todas as chamadas passam e são medidas.
+    ABERTO: nenhuma chamada passa até `tempo_aberto` expirar.
+    MEIO_ABERTO: uma única chamada de sonda passa; sucesso fecha, falha reabre.
+    """
+
+    def __init__(self, tamanho_janela=50, janela_segundos=60, min_amostras=10,
+                 taxa_erro_maxima=0.5, latencia_p95_maxima=1.5, tempo_aberto=30,
+                 relogio=time.monotonic):
+        self.janela_segundos = janela_segundos
+        self.min_amostras = min_amostras
+        self.taxa_erro_maxima = taxa_erro_maxima
+        self.latencia_p95_maxima = latencia_p95_maxima
+        self.tempo_aberto = tempo_aberto
+        self._relogio = relogio
+        self._amostras = deque(maxlen=tamanho_janela)  # (timestamp, sucesso, latencia)
+        self._estado = FECHADO
+        self._aberto_em = 0.0
+        self._sonda_em_andamento = False
+        self._lock = threading.Lock()
+
+    @property
+    def estado(self):
+        with self._lock:
+            self._atualizar_estado()
+            return self._estado
+
+    def _atualizar_estado(self):
+        if self._estado == ABERTO and self._relogio() - self._aberto_em >= self.tempo_aberto:
+            self._estado = MEIO_ABERTO
+            self._sonda_em_andamento = False
+
+    def _descartar_antigas(self, agora):
+        limite = agora - self.janela_segundos
+        while self._amostras and self._amostras[0][0] < limite:
+            self._amostras.popleft()
+
+    def permitir(self):
+        """Retorna True se a chamada pode ir ao provedor."""
+        with self._lock:
+            self._atualizar_estado()
+            if self._estado == FECHADO:
+                return True
+            if self._estado == MEIO_ABERTO and not self._sonda_em_andamento:
+                self._sonda_em_andamento = True
+                return True
+            return False
+
+    def liberar_sonda(self):
+        """Libera a sonda do meio-aberto sem registrar resultado (chamada cancelada)."""
+        with self._lock:
+            self._sonda_em_andamento = False
+
+    def registrar_sucesso(self, latencia):
+        self._registrar(True, latencia)
+
+    def registrar_falha(self, latencia):
+        self._registrar(False, latencia)
+
+    def _registrar(self, sucesso, latencia):
+        with self._lock:
+            agora = self._relogio()
+
+            if self._estado == MEIO_ABERTO:
+                self._sonda_em_andamento = False
+                if sucesso and latencia <= self.latencia_p95_maxima:
+                    logger.info("Circuit breaker de rotas: sonda bem-sucedida, fechando circuito")
+                    self._estado = FECHADO
+                    self._amostras.clear()
+                else:
+                    logger.warning("Circuit breaker de rotas: sonda falhou, reabrindo circuito")
+                    self._abrir(agora)
+                return
+
+            self._amostras.append((agora, sucesso, latencia))
+            self._descartar_antigas(agora)
+
+            if self._estado == FECHADO and self._deve_abrir():
+                taxa, p95 = self._metricas()
+                logger.warning(
+                    f"Circuit breaker de rotas ABERTO: taxa de erro {taxa:.0%}, p95 {p95:.2f}s "
+                    f"({len(self._amostras)} amostras)"
+                )
+                self._abrir(agora)
+
+    def _abrir(self, agora):
+        self._estado = ABERTO
+        self._aberto_em = agora
+        self._sonda_em_andamento = False
+
+    def _metricas(self):
+        total = len(self._amostras)
+        if not total:
+            return 0.0, 0.0
+        falhas = sum(1 for _, sucesso, _ in self._amostras if not sucesso)
+        latencias = sorted(latencia for _, _, latencia in self._amostras)
+        indice_p95 = min(total - 1, int(round(0.95 * (total - 1))))
+        return falhas / total, latencias[indice_p95]
+
+    def _deve_abrir(self):
+        if len(self._amostras) < self.min_amostras:
+            return False
+        taxa, p95 = self._metricas()
+        return taxa >= self.taxa_erro_maxima or p95 >= self.latencia_p95_maxima
+
+    def estatisticas(self):
+        with self._lock:
+            self._atualizar_estado()
+            taxa, p95 = self._metricas()
+            return {
+                'estado': self._estado,
+                'amostras': len(self._amostras),
+                'taxa_erro': taxa,
+                'latencia_p95': p95,
+            }
+
+
+class CacheRotas:
+    """Cache LRU com TTL para rotas já calculadas, indexado por coordenadas arredondadas."""
+
+    def __init__(self, tamanho_maximo=1000, ttl=600, casas_decimais=4, relogio=time.monotonic):
+        self.tamanho_maximo = tamanho_maximo
+        self.ttl = ttl
+        self.casas_decimais = casas_decimais
+        self._relogio = relogio
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def chave(self, start_lat, start_lng, end_lat, end_lng):
+        casas = self.casas_decimais
+        return (round(float(start_lat), casas), round(float(start_lng), casas),
+                round(float(end_lat), casas), round(float(end_lng), casas))
+
+    def obter(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return None
+            expira_em, valor = item
+            if expira_em < self._relogio():
+                del self._itens[chave]
+                return None
+            self._itens.move_to_end(chave)
+            return valor
+
+    def guardar(self, chave, valor):
+        with self._lock:
+            self._itens[chave] = (self._relogio() + self.ttl, valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.tamanho_maximo:
+                self._itens.popitem(last=False)
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+
+
+class ProvedorRotas:
+    """
+    Acesso ao OSRM protegido por circuit breaker, cache e orçamento de latência.
+
+    Cada requisição tem um limite rígido de `orcamento` segundos. Com o circuito
+    aberto a resposta vem do cache ou do cálculo local, sem esperar pela rede.
+    """
+
+    def __init__(self, base_url=None, orcamento=None, breaker=None, cache=None):
+        self.base_url = (base_url or getattr(settings, 'OSRM_BASE_URL', 'http://router.project-osrm.org')).rstrip('/')
+        self.orcamento = orcamento if orcamento is not None else getattr(settings, 'ROTAS_ORCAMENTO_LATENCIA', 2.5)
+        if breaker is None:
+            config = dict(CONFIG_PADRAO_BREAKER)
+            config.update(getattr(settings, 'ROTAS_CIRCUIT_BREAKER', {}))
+            breaker = CircuitBreaker(**config)
+        self.breaker = breaker
+        self.cache = cache if cache is not None else CacheRotas()
+        self._sessao = None
+        self._sessao_loop = None
+
+    async def _obter_sessao(self):
+        """Sessão aiohttp reaproveitada (pool de conexões) para o loop atual."""
+        loop = asyncio.get_running_loop()
+        if self._sessao is not None and self._sessao_loop is not loop:
+            await self._fechar_sessao_de_outro_loop()
+        if self._sessao is None or self._sessao.closed:
+            self._sessao = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.orcamento),
+                connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+            )
+            self._sessao_loop = loop
+        return self._sessao
+
+    async def _fechar_sessao_de_outro_loop(self):
+        # Ex.: async_to_sync cria um loop por chamada; a sessão antiga não pode ser reaproveitada
+        sessao, loop_anterior = self._sessao, self._sessao_loop
+        self._sessao = None
+        self._sessao_loop = None
+        if sessao.closed:
+            return
+        if loop_anterior.is_running():
+            # As conexões pertencem ao outro loop: fecha lá
+            asyncio.run_coroutine_threadsafe(sessao.close(), loop_anterior)
+        else:
+            # Loop parado ou encerrado: o conector fecha as conexões sem depender dele
+            await sessao.close()
+
+    async def fechar(self):
+        if self._sessao is not None and not self._sessao.closed:
+            await self._sessao.close()
+        self._sessao = None
+        self._sessao_loop = None
+
+    async def _requisitar_json(self, url, params):
+        if aiohttp is None:
+            import requests
+            from asgiref.sync import sync_to_async
+
+            def _get():
+                response = requests.get(url, params=params, timeout=self.orcamento)
+                response.raise_for_status()
+                return response.json()
+
+            return await sync_to_async(_get, thread_sensitive=False)()
+
+        sessao = await self._obter_sessao()
+        async with sessao.get(url, params=params) as response:
+            if response.status != 200:
+                raise Exception(f"Erro na API OSRM: {response.status}")
+            return await response.json(content_type=None)
+
+    async def consultar(self, caminho, params):
+        """
+        Executa uma chamada ao OSRM respeitando breaker e orçamento de latência.
+        Lança exceção se o circuito estiver aberto ou a chamada falhar.
+        """
+        if not self.breaker.permitir():
+            raise CircuitoAbertoError("Circuito do provedor de rotas aberto")
+
+        inicio = time.monotonic()
+        try:
+            data = await asyncio.wait_for(
+                self._requisitar_json(f"{self.base_url}{caminho}", params),
+                timeout=self.orcamento,
+            )
+            if not isinstance(data, dict) or data.get('code', 'Ok') != 'Ok':
+                raise Exception(f"Resposta inválida do OSRM: {data.get('code') if isinstance(data, dict) else data}")
+        except Exception:
+            self.breaker.registrar_falha(time.monotonic() - inicio)
+            raise
+        except BaseException:
+            # Cancelada (ex.: o cliente desconectou): não conta como falha, mas não pode
+            # deixar o circuito meio-aberto preso a uma sonda que nunca vai terminar
+            self.breaker.liberar_sonda()
+            raise
+
+        self.breaker.registrar_sucesso(time.monotonic() - inicio)
+        return data
+
+    async def buscar_rota(self, start_lat, start_lng, end_lat, end_lng):
+        """Retorna a rota entre dois pontos no formato usado por `calcular_rota`."""
+        from .utils import calcular_rota_simplificada_melhorada, calcular_valor_corrida, processar_resposta_osrm
+
+        chave = self.cache.chave(start_lat, start_lng, end_lat, end_lng)
+        em_cache = self.cache.obter(chave)
+        if em_cache is not None:
+            resultado = dict(em_cache)
+            # O preço depende do horário, então é recalculado a cada resposta
+            resultado['valor'] = calcular_valor_corrida(resultado['distancia'], resultado['tempo_estimado'])
+            return resultado
+
+        caminho = f"/route/v1/driving/{start_lng},{start_lat};{end_lng},{end_lat}"
+        params = {
+            "overview": "full",
+            "geometries": "geojson",
+            "steps": "false"
+        }
+
+        try:
+            data = await self.consultar(caminho, params)
+            resultado = processar_resposta_osrm(data, logger)
+            if not resultado:
+                raise Exception("OSRM não retornou rotas")
+        except CircuitoAbertoError:
+            logger.info("Circuito de rotas aberto: usando cálculo local")
+            return calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
+        except Exception as e:
+            logger.warning(f"Usando cálculo alternativo após falha na API OSRM: {str(e) or type(e).__name__}")
+            return calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
+
+        self.cache.guardar(chave, resultado)
+        return resultado
+
+    async def calcular_matriz_eta(self, origens, destino_lat, destino_lng):
+        """
+        Tempo de viagem (em segundos) de cada origem até um único destino.
+
+        `origens` é uma lista de pares (lat, lng). Faz uma única chamada ao
+        serviço `table` do OSRM para todas as origens; se o provedor falhar ou o
+        circuito estiver aberto, estima localmente pela distância em linha reta.
+        """
+        if not origens:
+            return []
+
+        coordenadas = ';'.join(f"{lng},{lat}" for lat, lng in origens)
+        caminho = f"/table/v1/driving/{coordenadas};{destino_lng},{destino_lat}"
+        params = {
+            "sources": ';'.join(str(i) for i in range(len(origens))),
+            "destinations": str(len(origens)),
+            "annotations": "duration",
+        }
+
+        try:
+            data = await self.consultar(caminho, params)
+            duracoes = [linha[0] for linha in data['durations']]
+            if len(duracoes) != len(origens):
+                raise Exception("Matriz do OSRM com tamanho inesperado")
+        except CircuitoAbertoError:
+            return estimar_matriz_eta_local(origens, destino_lat, destino_lng)
+        except Exception as e:
+            logger.warning(f"Usando estimativa local de ETA após falha na API OSRM: {str(e) or type(e).__name__}")
+            return estimar_matriz_eta_local(origens, destino_lat, destino_lng)
+
+        # Origens sem rota possível voltam como None no OSRM
+        estimativas = None
+        for i, duracao in enumerate(duracoes):
+            if duracao is None:
+                if estimativas is None:
+                    estimativas = estimar_matriz_eta_local(origens, destino_lat, destino_lng)
+                duracoes[i] = estimativas[i]
+        return duracoes
+
+    async def ordenar_por_eta(self, motoristas, lat, lng, max_candidatos=None):
+        """
+        Ordena candidatos (já pré-filtrados por distância em linha reta) pelo
+        tempo de viagem até o passageiro, preenchendo `eta_segundos` em cada um.
+
+        Apenas os `max_candidatos` mais próximos em linha reta entram na matriz;
+        os demais seguem depois, na ordem de distância.
+        """
+        if max_candidatos is None:
+            max_candidatos = getattr(settings, 'DESPACHO_MAX_CANDIDATOS_ETA', 25)
+
+        candidatos = sorted(motoristas, key=lambda m: m.get('distancia', float('inf')))
+        com_coordenadas = [m for m in candidatos[:max_candidatos]
+                           if m.get('latitude') is not None and m.get('longitude') is not None]
+        if not com_coordenadas:
+            return candidatos
+
+        duracoes = await self.calcular_matriz_eta(
+            [(m['latitude'], m['longitude']) for m in com_coordenadas], lat, lng
+        )
+        for motorista, duracao in zip(com_coordenadas, duracoes):
+            motorista['eta_segundos'] = duracao
+
+        ranqueados = sorted(com_coordenadas, key=lambda m: m['eta_segundos'])
+        ids_ranqueados = {id(m) for m in ranqueados}
+        return ranqueados + [m for m in candidatos if id(m) not in ids_ranqueados]
+
+
+def estimar_matriz_eta_local(origens, destino_lat, destino_lng):
+    """Estimativa local de ETA (segundos) pela distância em linha reta e velocidade média urbana."""
+    from .utils import calcular_distancia
+
+    velocidade_kmh = getattr(settings, 'ROTAS_VELOCIDADE_MEDIA_KMH', 30)
+    return [
+        calcular_distancia(lat, lng, destino_lat, destino_lng) / velocidade_kmh * 3600
+        for lat, lng in origens
+    ]
+
+
+_provedor_rotas = None
+
+
+def obter_provedor_rotas():
+    """Instância compartilhada do provedor de rotas, criada sob demanda a partir das settings."""
+    global _provedor_rotas
+    if _provedor_rotas is None:
+        _provedor_rotas = ProvedorRotas()
+    return _provedor_rotas
@@ -84,17 +84,122 @@ WSGI_APPLICATION = 'movex.wsgi.application'
 ASGI_APPLICATION = 'movex.asgi.application'
 
 # Channel layers para comunicação WebSocket
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-        # Para produção, considere usar Redis:
-        # 'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        # 'CONFIG': {
-        #     "hosts": [('127.0.0.1', 6379)],
-        # },
-    },
+# Com vários workers (gunicorn.conf.py) ou vários servidores, o channel layer precisa
+# ser compartilhado: defina CHANNEL_REDIS_HOSTS com uma ou mais URLs separadas por
+# vírgula (ex.: redis://redis-1:6379/0,redis://redis-2:6379/0). Com mais de um host
+# os canais e grupos são distribuídos (sharding) entre eles.
+# Sem a variável, usa o InMemoryChannelLayer, que só funciona com um único processo.
+CHANNEL_REDIS_HOSTS = [host.strip() for host in os.environ.get('CHANNEL_REDIS_HOSTS', '').split(',') if host.strip()]
+
+if CHANNEL_REDIS_HOSTS:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': CHANNEL_REDIS_HOSTS,
+                'prefix': os.environ.get('CHANNEL_LAYER_PREFIX', 'movex'),
+                # Mensagens pendentes por canal antes de send() falhar com ChannelFull
+                'capacity': int(os.environ.get('CHANNEL_LAYER_CAPACITY', 1500)),
+                # Segundos até uma mensagem não lida ser descartada
+                'expiry': int(os.environ.get('CHANNEL_LAYER_EXPIRY', 60)),
+                # Segundos até um canal sair dos grupos se não houver group_discard
+                'group_expiry': int(os.environ.get('CHANNEL_LAYER_GROUP_EXPIRY', 86400)),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# Registro de conexões WebSocket (movex/connection_registry.py): no Redis do channel
+# layer quando configurado. Conexões não renovadas neste prazo deixam de contar.
+CONEXOES_TTL = 120
+
+# Métricas por evento WebSocket (movex/dispatcher.py): resumo logado a cada
+# intervalo e aviso para eventos mais lentos ou com mais consultas SQL que os
+# limites (0 desativa o limite de consultas)
+METRICAS_EVENTOS_INTERVALO_LOG = 60
+EVENTO_LENTO_MS = 500
+EVENTO_LIMITE_CONSULTAS = int(os.environ.get('EVENTO_LIMITE_CONSULTAS', 15))
+
+# Fila de saída por conexão (movex/outbound.py): clientes que acumulam mais frames
+# que o limite são desconectados; ao fechar, espera-se a entrega dos pendentes
+FILA_SAIDA_LIMITE = 200
+FILA_SAIDA_TIMEOUT_FECHAMENTO = 5
+
+# Limite de frequência por evento (movex/rate_limit.py). LIMITES_EVENTOS sobrescreve
+# as políticas padrão: {'evento': (capacidade, fichas por segundo)}
+LIMITES_EVENTOS = {}
+LIMITADOR_TAMANHO_MAXIMO = 50000
+
+# Auditoria periódica dos grupos do channel layer (movex/group_audit.py): reporta
+# o tamanho dos grupos e remove canais mortos. 0 desativa.
+AUDITORIA_GRUPOS_INTERVALO = 300
+# Segundos que um canal precisa ficar fora do registro de conexões antes de ser removido
+AUDITORIA_GRUPOS_CARENCIA = 120
+
+# Tópicos de inscrição opcional (movex/topics.py)
+TOPICOS_MAXIMO_POR_CONEXAO = 10
+TOPICO_REGIAO_CELULA_GRAUS = 0.05  # ~5 km de lado
+
+# Buffer de reenvio por usuário (movex/replay.py): eventos numerados guardados para
+# uma reconexão com resume_from. Expira após REPLAY_TTL segundos sem eventos novos.
+REPLAY_TAMANHO = 100
+REPLAY_TTL = 600
+
+# Autenticação WebSocket pelo token DRF no handshake (TokenAuthMiddleware). Com
+# True, conexões sem token válido são recusadas; com False o login por cpf continua aceito.
+WEBSOCKET_EXIGIR_TOKEN = os.environ.get('WEBSOCKET_EXIGIR_TOKEN', 'false').lower() == 'true'
+
+# Executor exclusivo para o acesso ao banco dos comandos WebSocket (movex/db_executor.py).
+# 0 usa a thread compartilhada do sync_to_async.
+BANCO_EXECUTOR_THREADS = int(os.environ.get('BANCO_EXECUTOR_THREADS', 8))
+
+# Provedor de rotas (OSRM)
+OSRM_BASE_URL = os.environ.get('OSRM_BASE_URL', 'http://router.project-osrm.org')
+ROTAS_ORCAMENTO_LATENCIA = float(os.environ.get('ROTAS_ORCAMENTO_LATENCIA', 2.5))  # segundos por requisição
+# Ajustes do circuit breaker (ver movex/routing_services.py para os valores padrão)
+ROTAS_CIRCUIT_BREAKER = {
+    'taxa_erro_maxima': 0.5,
+    'latencia_p95_maxima': 1.5,
+    'tempo_aberto': 30,
 }
 
+# Despacho: quantos motoristas mais próximos em linha reta entram na matriz de ETA
+DESPACHO_MAX_CANDIDATOS_ETA = 25
+# A corrida é oferecida em ondas, na ordem de ETA: os DESPACHO_TAMANHO_ONDA motoristas
+# mais rápidos primeiro e, se ninguém aceitar em DESPACHO_ESPERA_ONDA segundos, os seguintes
+DESPACHO_TAMANHO_ONDA = int(os.environ.get('DESPACHO_TAMANHO_ONDA', 5))
+DESPACHO_ESPERA_ONDA = float(os.environ.get('DESPACHO_ESPERA_ONDA', 15))
+
+# Tarifas: sobrescritas da tarifa padrão (ver movex/pricing.py). O arquivo JSON,
+# se existir, é relido automaticamente quando alterado, sem reiniciar o servidor.
+MOVEX_TARIFAS = {}
+MOVEX_TARIFAS_ARQUIVO = os.environ.get('MOVEX_TARIFAS_ARQUIVO', os.path.join(BASE_DIR, 'tarifas.json'))
+
+# Cotações assinadas devolvidas por calcular_rota e exigidas por solicitar_corrida
+COTACAO_VALIDADE_SEGUNDOS = 300
+
+# Notificações push (Expo): enviadas em lotes de até 100 mensagens por requisição
+EXPO_PUSH_URL = os.environ.get('EXPO_PUSH_URL', 'https://exp.host/--/api/v2/push/send')
+PUSH_TAMANHO_LOTE = 100
+PUSH_TIMEOUT = 5
+# Outbox (usuarios.NotificacaoPush): novas tentativas com backoff exponencial
+PUSH_MAX_TENTATIVAS = 6
+PUSH_BACKOFF_BASE = 30  # segundos até a segunda tentativa; dobra a cada falha
+PUSH_BACKOFF_MAXIMO = 3600
+# Recibos do Expo são conferidos a partir de 15 minutos após o envio
+EXPO_RECIBOS_URL = os.environ.get('EXPO_RECIBOS_URL', 'https://exp.host/--/api/v2/push/getReceipts')
+PUSH_RECIBO_ATRASO = 900
+PUSH_CACHE_TOKENS_TTL = 300  # cache em processo de cpf -> token push ativo
+# Quem esvazia o outbox: o worker processar_notificacoes_push (Procfile: push) ou, nas
+# implantações só com o processo web, uma tarefa dentro dele. Opt-in: render.yaml e
+# railway.json definem PUSH_OUTBOX_NO_PROCESSO=true.
+PUSH_OUTBOX_NO_PROCESSO = os.environ.get('PUSH_OUTBOX_NO_PROCESSO', 'false').lower() == 'true'
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 DATABASES = {
@@ -104,6 +209,28 @@ DATABASES = {
     }
 }
 
+# Modo de desempenho do SQLite: PRAGMAs aplicados em cada conexão nova. WAL deixa
+# as leituras correrem junto com a escrita; synchronous=NORMAL em WAL só sincroniza
+# o disco nos checkpoints (um commit pode se perder numa queda de energia, sem
+# corromper o banco).
+SQLITE_MODO_DESEMPENHO = os.environ.get('SQLITE_MODO_DESEMPENHO', 'true').lower() == 'true'
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f"PRAGMA busy_timeout={int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))}",
+    f"PRAGMA mmap_size={int(os.environ.get('SQLITE_MMAP_BYTES', 256 * 1024 * 1024))}",
+    f"PRAGMA cache_size=-{int(os.environ.get('SQLITE_CACHE_KB', 64 * 1024))}",  # negativo: em KiB
+    'PRAGMA temp_store=MEMORY',
+]
+if SQLITE_MODO_DESEMPENHO:
+    DATABASES['default']['OPTIONS'] = {'init_command': ';'.join(SQLITE_PRAGMAS)}
+
+# Escritor único do banco (movex/db_executor.py): as escritas dos comandos WebSocket
+# passam por uma só thread, que grava em lotes de até BANCO_ESCRITOR_LOTE escritas
+# por transação. Só com o SQLite em modo de desempenho.
+BANCO_ESCRITOR_UNICO = SQLITE_MODO_DESEMPENHO and os.environ.get('BANCO_ESCRITOR_UNICO', 'true').lower() == 'true'
+BANCO_ESCRITOR_LOTE = int(os.environ.get('BANCO_ESCRITOR_LOTE', 100))
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -0,0 +1,1923 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from io import StringIO
+from unittest import mock
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from aiohttp import web
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import InMemoryChannelLayer, channel_layers
+from aiohttp.test_utils import TestServer
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from corridas.models import Corrida, MensagemChat
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+from websocket_app.consumers import MoveXConsumer as ConsumerLegado
+from usuarios.models import Motorista, NotificacaoPush, Passageiro, PushToken, Usuario, media_avaliacoes
+
+try:
+    from fakeredis import FakeServer
+    from fakeredis.aioredis import FakeConnection, FakeRedis
+except ImportError:
+    FakeServer = None
+
+from . import broadcast, connection_registry, replay, utils
+from .broadcast import codificar_json, difundir_para_grupos
+from .connection_registry import RegistroConexoesMemoria, RegistroConexoesRedis
+from .consumers import (
+    MoveXConsumer, enviar_notificacao_passageiro, eventos, historico_chat_cache, ofertar_corrida_em_ondas
+)
+from .group_audit import auditar_grupos
+from .topics import celula_regiao, publicar_topico
+from .dispatcher import MetricasEventos, RegistroEventos, exige_campos
+from .outbound import PRIORIDADE_ALTA, PRIORIDADE_BAIXA, FilaSaida
+from .rate_limit import LimitadorTaxa, limitador_eventos
+from .replay import BufferReplayMemoria, BufferReplayRedis, enviar_com_sequencia
+from .pricing import MotorTarifas, cotacao_corresponde, emitir_cotacao, validar_cotacao
+from .database_services import (
+    atualizar_localizacao_motorista,
+    atualizar_localizacao_motorista_async,
+    atualizar_status_motorista_async,
+    avaliar_passageiro,
+    buscar_destino_push,
+    comando_mensagem_chat,
+    comando_solicitar_corrida,
+    obter_corrida_em_andamento,
+    obter_corrida_em_andamento_async,
+    obter_mensagens_chat_async,
+    verificar_corrida_em_andamento_motorista,
+    verificar_corridas_em_andamento,
+)
+from .db_executor import EscritorBanco, executar_no_banco
+from .instrumentation import medir_consultas
+from .middleware import TokenAuthMiddleware
+from .push_services import (
+    DespachantePush,
+    cache_tokens_push,
+    iniciar_outbox_no_processo,
+    montar_mensagem_push,
+    processar_outbox,
+    verificar_recibos_push,
+)
+from .routing_services import (
+    ABERTO,
+    FECHADO,
+    MEIO_ABERTO,
+    CircuitBreaker,
+    ProvedorRotas,
+)
+
+
+# TestCase isola os dados na transação da thread do teste: as unidades de trabalho
+# dos consumers precisam rodar nela, e não no executor do banco
+banco_na_thread_do_teste = override_settings(BANCO_EXECUTOR_THREADS=0)
+
+
+class RelogioFalso:
+    def __init__(self):
+        self.agora = 1000.0
+
+    def __call__(self):
+        return self.agora
+
+
+def resposta_osrm(distancia_m=12000, duracao_s=900):
+    return {
+        'code': 'Ok',
+        'routes': [{
+            'distance': distancia_m,
+            'duration': duracao_s,
+            'geometry': {'coordinates': [[-51.20, -30.03], [-51.18, -30.02], [-51.15, -30.00]]},
+        }],
+    }
+
+
+class ServidorOSRMFalso:
+    """Servidor HTTP local que imita o endpoint /route do OSRM."""
+
+    def __init__(self):
+        self.atraso = 0
+        self.status = 200
+        self.chamadas = 0
+        self.duracoes_tabela = []
+
+    async def rota(self, request):
+        self.chamadas += 1
+        if self.atraso:
+            await asyncio.sleep(self.atraso)
+        if self.status != 200:
+            return web.json_response({'code': 'Error'}, status=self.status)
+        return web.json_response(resposta_osrm())
+
+    async def tabela(self, request):
+        self.chamadas += 1
+        if self.status != 200:
+            return web.json_response({'code': 'Error'}, status=self.status)
+        return web.json_response({
+            'code': 'Ok',
+            'durations': [[duracao] for duracao in self.duracoes_tabela],
+        })
+
+    async def iniciar(self):
+        app = web.Application()
+        app.router.add_get('/route/v1/driving/{coordenadas}', self.rota)
+        app.router.add_get('/table/v1/driving/{coordenadas}', self.tabela)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url('')).rstrip('/')
+
+    async def parar(self):
+        await self.server.close()
+
+
+class ServidorExpoFalso:
+    """Servidor HTTP local que imita o endpoint de push do Expo."""
+
+    def __init__(self):
+        self.atraso = 0
+        self.status = 200
+        self.tokens_mortos = set()
+        self.lotes = []
+        self.recibos = {}
+        self.consultas_recibos = []
+
+    async def enviar(self, request):
+        mensagens = await request.json()
+        self.lotes.append(mensagens)
+        if self.atraso:
+            await asyncio.sleep(self.atraso)
+        if self.status != 200:
+            return web.json_response({'errors': [{'code': 'INTERNAL'}]}, status=self.status)
+        tickets = []
+        for i, mensagem in enumerate(mensagens):
+            if mensagem['to'] in self.tokens_mortos:
+                tickets.append({'status': 'error', 'message': 'not registered',
+                                'details': {'error': 'DeviceNotRegistered'}})
+            else:
+                tickets.append({'status': 'ok', 'id': f"ticket-{len(self.lotes)}-{i}"})
+        return web.json_response({'data': tickets})
+
+    async def buscar_recibos(self, request):
+        ids = (await request.json())['ids']
+        self.consultas_recibos.append(ids)
+        return web.json_response({'data': {i: self.recibos[i] for i in ids if i in self.recibos}})
+
+    async def iniciar(self):
+        app = web.Application()
+        app.router.add_post('/push/send', self.enviar)
+        app.router.add_post('/push/getReceipts', self.buscar_recibos)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url('/push/send'))
+
+    async def parar(self):
+        await self.server.close()
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def test_abre_por_taxa_de_erro_e_fecha_apos_sonda(self):
+        relogio = RelogioFalso()
+        breaker = CircuitBreaker(min_amostras=4, taxa_erro_maxima=0.5, tempo_aberto=10, relogio=relogio)
+
+        for _ in range(2):
+            breaker.registrar_sucesso(0.1)
+        for _ in range(2):
+            breaker.registrar_falha(0.1)
+
+        self.assertEqual(breaker.estado, ABERTO)
+        self.assertFalse(breaker.permitir())
+
+        relogio.agora += 10
+        self.assertEqual(breaker.estado, MEIO_ABERTO)
+        self.assertTrue(breaker.permitir())
+        # Apenas uma sonda por vez
+        self.assertFalse(breaker.permitir())
+
+        breaker.registrar_sucesso(0.1)
+        self.assertEqual(breaker.estado, FECHADO)
+
+    def test_abre_por_latencia_p95(self):
+        breaker = CircuitBreaker(min_amostras=5, latencia_p95_maxima=1.0)
+        for _ in range(4):
+            breaker.registrar_sucesso(0.2)
+        self.assertEqual(breaker.estado, FECHADO)
+
+        breaker.registrar_sucesso(2.0)
+        self.assertEqual(breaker.estado, ABERTO)
+
+    def test_sonda_com_falha_reabre(self):
+        relogio = RelogioFalso()
+        breaker = CircuitBreaker(min_amostras=1, tempo_aberto=5, relogio=relogio)
+        breaker.registrar_falha(0.1)
+        relogio.agora += 5
+        self.assertTrue(breaker.permitir())
+        breaker.registrar_falha(0.1)
+        self.assertEqual(breaker.estado, ABERTO)
+
+    def test_sonda_cancelada_libera_o_meio_aberto(self):
+        relogio = RelogioFalso()
+        breaker = CircuitBreaker(min_amostras=1, tempo_aberto=5, relogio=relogio)
+        breaker.registrar_falha(0.1)
+        relogio.agora += 5
+        provedor = ProvedorRotas(base_url='http://osrm.invalid', orcamento=5, breaker=breaker)
+
+        async def cancelar_sonda():
+            with mock.patch.object(provedor, '_requisitar_json', lambda *a: asyncio.sleep(10)):
+                sonda = asyncio.ensure_future(provedor.consultar('/route', {}))
+                await asyncio.sleep(0)
+                self.assertFalse(breaker.permitir())
+                sonda.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await sonda
+
+        async_to_sync(cancelar_sonda)()
+        self.assertEqual(breaker.estado, MEIO_ABERTO)
+        self.assertTrue(breaker.permitir())
+
+
+class ProvedorRotasTests(SimpleTestCase):
+    async def _preparar(self):
+        self.osrm = ServidorOSRMFalso()
+        url = await self.osrm.iniciar()
+        self.breaker = CircuitBreaker(min_amostras=2, taxa_erro_maxima=0.5, tempo_aberto=60)
+        self.provedor = ProvedorRotas(base_url=url, orcamento=0.3, breaker=self.breaker)
+
+    async def _encerrar(self):
+        await self.provedor.fechar()
+        await self.osrm.parar()
+
+    async def _executar(self, teste):
+        await self._preparar()
+        try:
+            await teste()
+        finally:
+            await self._encerrar()
+
+    async def test_rota_do_osrm_e_cache(self):
+        async def teste():
+            rota = await self.provedor.buscar_rota(-30.03, -51.20, -30.00, -51.15)
+            self.assertEqual(rota['distancia'], 12.0)
+            self.assertEqual(rota['tempo_estimado'], 15)
+            self.assertEqual(len(rota['coordinates']), 3)
+
+            await self.provedor.buscar_rota(-30.03, -51.20, -30.00, -51.15)
+            self.assertEqual(self.osrm.chamadas, 1)
+
+        await self._executar(teste)
+
+    async def test_orcamento_de_latencia_usa_fallback(self):
+        async def teste():
+            self.osrm.atraso = 2
+            inicio = time.monotonic()
+            rota = await self.provedor.buscar_rota(-30.03, -51.20, -30.00, -51.15)
+            decorrido = time.monotonic() - inicio
+
+            self.assertTrue(rota['success'])
+            self.assertLess(decorrido, 1.0)
+            # O cálculo local gera pelo menos 12 pontos (origem, 10 intermediários e destino)
+            self.assertGreaterEqual(len(rota['coordinates']), 12)
+
+        await self._executar(teste)
+
+    async def test_circuito_aberto_nao_chama_o_provedor(self):
+        async def teste():
+            self.osrm.status = 500
+            await self.provedor.buscar_rota(-30.03, -51.20, -30.00, -51.15)
+            await self.provedor.buscar_rota(-30.04, -51.21, -30.00, -51.15)
+            self.assertEqual(self.breaker.estado, ABERTO)
+            chamadas = self.osrm.chamadas
+
+            self.osrm.status = 200
+            rota = await self.provedor.buscar_rota(-30.05, -51.22, -30.00, -51.15)
+            self.assertTrue(rota['success'])
+            self.assertEqual(self.osrm.chamadas, chamadas)
+
+        await self._executar(teste)
+
+    async def test_matriz_eta_em_uma_unica_chamada(self):
+        async def teste():
+            # O motorista mais próximo em linha reta está do outro lado do rio
+            self.osrm.duracoes_tabela = [1500, 300, None]
+            motoristas = [
+                {'cpf': '1', 'distancia': 0.8, 'latitude': -30.031, 'longitude': -51.201},
+                {'cpf': '2', 'distancia': 2.5, 'latitude': -30.050, 'longitude': -51.210},
+                {'cpf': '3', 'distancia': 4.0, 'latitude': -30.060, 'longitude': -51.230},
+                {'cpf': '4', 'distancia': 5.0, 'latitude': None, 'longitude': None},
+            ]
+
+            ordenados = await self.provedor.ordenar_por_eta(motoristas, -30.03, -51.20)
+
+            self.assertEqual(self.osrm.chamadas, 1)
+            self.assertEqual([m['cpf'] for m in ordenados], ['2', '3', '1', '4'])
+            self.assertEqual(ordenados[0]['eta_segundos'], 300)
+            # Origem sem rota no OSRM recebe a estimativa local
+            self.assertGreater(ordenados[1]['eta_segundos'], 0)
+
+        await self._executar(teste)
+
+    def test_sessao_de_outro_loop_e_fechada(self):
+        provedor = ProvedorRotas(base_url='http://osrm.invalid')
+        primeira = async_to_sync(provedor._obter_sessao)()
+        segunda = async_to_sync(provedor._obter_sessao)()
+
+        self.assertIsNot(primeira, segunda)
+        self.assertTrue(primeira.closed)
+        async_to_sync(provedor.fechar)()
+        self.assertTrue(segunda.closed)
+
+    async def test_matriz_eta_local_com_provedor_fora(self):
+        async def teste():
+            self.osrm.status = 500
+            duracoes = await self.provedor.calcular_matriz_eta(
+                [(-30.10, -51.20), (-30.04, -51.20)], -30.03, -51.20
+            )
+            self.assertEqual(len(duracoes), 2)
+            self.assertGreater(duracoes[0], duracoes[1])
+
+        await self._executar(teste)
+
+
+class OfertaEmOndasTests(SimpleTestCase):
+    @override_settings(DESPACHO_TAMANHO_ONDA=2, DESPACHO_ESPERA_ONDA=0.01)
+    async def test_corrida_oferecida_em_ondas_por_eta(self):
+        camada = InMemoryChannelLayer()
+        canais = {}
+        for cpf in ('111', '222', '333', '444'):
+            canais[cpf] = await camada.new_channel()
+            await camada.group_add(f'motorista_{cpf}', canais[cpf])
+        # Já ordenados por ordenar_por_eta
+        motoristas = [{'cpf': '222', 'eta_segundos': 95.4}, {'cpf': '111', 'eta_segundos': 180.0},
+                      {'cpf': '444', 'eta_segundos': None}, {'cpf': '333'}]
+        mensagem = {'type': 'nova_corrida', 'corridaId': '7'}
+
+        with mock.patch('movex.consumers.corrida_pendente_async', mock.AsyncMock(return_value=True)) as pendente, \
+                mock.patch.object(broadcast, 'codificar_json', wraps=codificar_json) as codificar:
+            tarefa = await ofertar_corrida_em_ondas(camada, 7, motoristas, mensagem)
+            # Primeira onda: só os dois mais rápidos, com o mesmo frame serializado uma vez
+            self.assertEqual(codificar.call_count, 1)
+            primeira_onda = [(await camada.receive(canais[cpf]))['texto'] for cpf in ('222', '111')]
+            self.assertEqual(primeira_onda[0], primeira_onda[1])
+            self.assertFalse(tarefa.done())
+            pendente.assert_not_awaited()
+            await tarefa
+
+        pendente.assert_awaited_once_with(7)
+        self.assertEqual(codificar.call_count, 2)
+        for cpf in ('444', '333'):
+            self.assertEqual(json.loads((await camada.receive(canais[cpf]))['texto']), mensagem)
+
+    @override_settings(DESPACHO_TAMANHO_ONDA=1, DESPACHO_ESPERA_ONDA=0.01)
+    async def test_onda_seguinte_nao_sai_depois_do_aceite(self):
+        camada = InMemoryChannelLayer()
+        canal = await camada.new_channel()
+        await camada.group_add('motorista_222', canal)
+
+        with mock.patch('movex.consumers.corrida_pendente_async', mock.AsyncMock(return_value=False)):
+            tarefa = await ofertar_corrida_em_ondas(camada, 7, [{'cpf': '111'}, {'cpf': '222'}], {'type': 'nova_corrida'})
+            await tarefa
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(camada.receive(canal), 0.05)
+
+
+class DespachantePushTests(SimpleTestCase):
+    async def _executar(self, teste):
+        self.expo = ServidorExpoFalso()
+        url = await self.expo.iniciar()
+        self.despachante = DespachantePush(url=url, url_recibos=url.replace('/send', '/getReceipts'), timeout=2)
+        try:
+            await teste()
+        finally:
+            await self.despachante.fechar()
+            await self.expo.parar()
+
+    async def test_lote_em_uma_requisicao_com_tickets_na_ordem(self):
+        async def teste():
+            self.expo.tokens_mortos.add('ExponentPushToken[1]')
+            mensagens = [montar_mensagem_push(f'ExponentPushToken[{i}]', 'Título', 'Mensagem', {'tipo': 'teste'})
+                         for i in range(3)]
+            tickets = await self.despachante.enviar_lote(mensagens)
+
+            self.assertEqual(len(self.expo.lotes), 1)
+            self.assertEqual(self.expo.lotes[0][0]['data'], {'tipo': 'teste'})
+            self.assertEqual([ticket['status'] for ticket in tickets], ['ok', 'error', 'ok'])
+
+            self.expo.recibos['ticket-1-0'] = {'status': 'ok'}
+            self.assertEqual(await self.despachante.buscar_recibos(['ticket-1-0', 'ticket-1-2']),
+                             {'ticket-1-0': {'status': 'ok'}})
+
+        await self._executar(teste)
+
+    async def test_falha_do_expo_e_propagada(self):
+        async def teste():
+            self.expo.status = 500
+            with self.assertRaises(Exception):
+                await self.despachante.enviar_lote([montar_mensagem_push('ExponentPushToken[abc]', 'Título', 'Mensagem')])
+
+        await self._executar(teste)
+
+
+class RotaSimplificadaTests(SimpleTestCase):
+    def test_polyline_no_formato_do_google(self):
+        self.assertEqual(
+            utils.codificar_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]),
+            '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+        )
+
+    def test_geometria_deterministica_por_origem_e_destino(self):
+        primeira = utils.calcular_rota_simplificada_melhorada(-30.03, -51.20, -30.30, -51.50)
+        utils.gerar_geometria_simplificada.cache_clear()
+        segunda = utils.calcular_rota_simplificada_melhorada(-30.03, -51.20, -30.30, -51.50)
+
+        self.assertEqual(primeira['polyline'], segunda['polyline'])
+        self.assertEqual(primeira['coordinates'], segunda['coordinates'])
+        self.assertEqual(primeira['coordinates'][0], {'latitude': -30.03, 'longitude': -51.20})
+        self.assertEqual(primeira['coordinates'][-1], {'latitude': -30.30, 'longitude': -51.50})
+
+        outra = utils.calcular_rota_simplificada_melhorada(-30.04, -51.20, -30.30, -51.50)
+        self.assertNotEqual(primeira['polyline'], outra['polyline'])
+
+    def test_pontos_da_rota_vem_do_cache(self):
+        primeira = utils.calcular_rota_simplificada_melhorada(-30.03, -51.20, -30.30, -51.50)
+        segunda = utils.calcular_rota_simplificada_melhorada(-30.03, -51.20, -30.30, -51.50)
+
+        self.assertIs(primeira['coordinates'], segunda['coordinates'])
+
+
+class MotorTarifasTests(SimpleTestCase):
+    # 2025-03-10 é uma segunda-feira
+    MANHA_PICO = datetime(2025, 3, 10, 7, 30)
+    TARDE = datetime(2025, 3, 10, 14, 0)
+    VINTE_HORAS = datetime(2025, 3, 10, 20, 0)
+    NOITE = datetime(2025, 3, 10, 22, 15)
+
+    def test_tarifa_padrao_mantem_regras_atuais(self):
+        motor = MotorTarifas()
+        self.assertEqual(motor.quote([10], [20], self.TARDE), [21.0])
+        self.assertEqual(motor.quote([10], [20], self.MANHA_PICO), [29.4])
+        self.assertEqual(motor.quote([10], [20], self.NOITE), [33.6])
+        # Às 20h valem pico e noturno ao mesmo tempo
+        self.assertEqual(motor.quote([10], [20], self.VINTE_HORAS), [47.04])
+        # Corridas de até 5 km têm valor fixo, mesmo no pico
+        self.assertEqual(motor.quote([0.5, 5], [5, 10], self.MANHA_PICO), [10.0, 10.0])
+        self.assertTrue(motor.is_horario_pico(self.MANHA_PICO))
+        self.assertFalse(motor.is_horario_pico(self.NOITE))
+
+    def test_cotacao_em_lote_com_minima_e_maxima(self):
+        motor = MotorTarifas(config={
+            'tarifa_base': 3.0, 'tarifa_km': 1.0, 'tarifa_minuto': 0.5,
+            'tarifa_minima': 8.0, 'tarifa_maxima': 50.0,
+            'corrida_curta_km': 0, 'faixas': [],
+        })
+        self.assertEqual(motor.quote([1, 10, 100], [2, 10, 60], self.TARDE), [8.0, 18.0, 50.0])
+
+    def test_recarrega_arquivo_sem_reiniciar(self):
+        with tempfile.TemporaryDirectory() as diretorio:
+            caminho = os.path.join(diretorio, 'tarifas.json')
+            with open(caminho, 'w') as arquivo:
+                json.dump({'tarifa_km': 3.0}, arquivo)
+            motor = MotorTarifas(arquivo=caminho, intervalo_verificacao=0)
+            self.assertEqual(motor.quote([10], [20], self.TARDE), [30.0])
+
+            with open(caminho, 'w') as arquivo:
+                json.dump({'tarifa_km': 4.0}, arquivo)
+            os.utime(caminho, (time.time() + 5, time.time() + 5))
+            self.assertEqual(motor.quote([10], [20], self.TARDE), [40.0])
+
+
+class CotacaoAssinadaTests(SimpleTestCase):
+    ORIGEM = (-30.03, -51.20)
+    DESTINO = (-30.00, -51.15)
+
+    def test_token_valido_devolve_metricas_da_rota(self):
+        token = emitir_cotacao(self.ORIGEM, self.DESTINO, 12.04, 15, 25.28, cpf='123')
+        cotacao = validar_cotacao(token, cpf='123')
+
+        self.assertEqual(cotacao['valor'], 25.28)
+        self.assertEqual(cotacao['distancia'], 12.04)
+        self.assertEqual(cotacao['tempo_estimado'], 15)
+        self.assertTrue(cotacao_corresponde(
+            cotacao,
+            {'latitude': -30.03, 'longitude': -51.20},
+            {'latitude': '-30.00', 'longitude': '-51.15'},
+        ))
+        self.assertFalse(cotacao_corresponde(
+            cotacao,
+            {'latitude': -30.03, 'longitude': -51.20},
+            {'latitude': -30.10, 'longitude': -51.15},
+        ))
+
+    def test_token_adulterado_expirado_ou_de_outro_usuario_e_rejeitado(self):
+        token = emitir_cotacao(self.ORIGEM, self.DESTINO, 12.04, 15, 25.28, cpf='123')
+        dados, assinatura = token.rsplit(':', 1)
+        self.assertIsNone(validar_cotacao(dados + ':' + assinatura[::-1]))
+        self.assertIsNone(validar_cotacao(token, cpf='999'))
+        self.assertIsNone(validar_cotacao(token))
+        self.assertIsNone(validar_cotacao(
+            emitir_cotacao(self.ORIGEM, self.DESTINO, 12.04, 15, 25.28, validade=-1)
+        ))
+        self.assertIsNone(validar_cotacao(None))
+
+
+@banco_na_thread_do_teste
+class SolicitarCorridaComCotacaoTests(TestCase):
+    def setUp(self):
+        self.usuario = Usuario.objects.create_user(
+            cpf='98765432100', password='senha123', nome='Teste', sobrenome='Passageiro',
+            email='passageiro@teste.com', telefone='51988888888'
+        )
+        Passageiro.objects.create(usuario=self.usuario)
+
+    def dados_corrida(self, **extras):
+        dados = {
+            'type': 'solicitar_corrida',
+            'passageiro': {'cpf': '98765432100', 'nome': 'Teste', 'sobrenome': 'Passageiro', 'telefone': '51988888888'},
+            'origem': {'latitude': -30.03, 'longitude': -51.20},
+            'destino': {'latitude': -30.00, 'longitude': -51.15},
+        }
+        dados.update(extras)
+        return dados
+
+    async def solicitar(self, dados, login=True):
+        communicator = WebsocketCommunicator(MoveXConsumer.as_asgi(), '/ws/movex/')
+        await communicator.connect()
+        await communicator.receive_json_from()  # connection_established
+        if login:
+            await communicator.send_json_to({'type': 'login', 'cpf': '98765432100', 'tipo': 'PASSAGEIRO'})
+            await communicator.receive_json_from()  # login_success
+        await communicator.send_json_to(dados)
+        resposta = await communicator.receive_json_from(timeout=5)
+        await communicator.disconnect()
+        return resposta
+
+    async def test_valores_do_cliente_sao_ignorados(self):
+        token = emitir_cotacao((-30.03, -51.20), (-30.00, -51.15), 12.04, 15, 25.28, cpf='98765432100')
+        await self.solicitar(self.dados_corrida(cotacao_token=token, valor=1, distancia='1 km', tempo_estimado='1 min'))
+
+        corrida = await Corrida.objects.aget()
+        self.assertEqual(float(corrida.valor), 25.28)
+        self.assertEqual(float(corrida.distancia), 12.04)
+        self.assertEqual(corrida.tempo_estimado, 15)
+
+    async def test_corrida_sem_cotacao_e_recusada(self):
+        resposta = await self.solicitar(self.dados_corrida(valor=1, distancia=1, tempo_estimado='1 min'))
+
+        self.assertEqual(resposta['codigo'], 'cotacao_obrigatoria')
+        self.assertFalse(await Corrida.objects.aexists())
+
+    async def test_cotacao_de_um_usuario_exige_a_conexao_dele(self):
+        token = emitir_cotacao((-30.03, -51.20), (-30.00, -51.15), 12.04, 15, 25.28, cpf='98765432100')
+        # O cpf do payload não identifica a conexão
+        resposta = await self.solicitar(self.dados_corrida(cotacao_token=token), login=False)
+
+        self.assertEqual(resposta['codigo'], 'cotacao_invalida')
+        self.assertFalse(await Corrida.objects.aexists())
+
+    async def test_cotacao_de_outro_trajeto_e_recusada(self):
+        token = emitir_cotacao((-30.03, -51.20), (-29.90, -51.10), 20.0, 30, 42.0)
+        resposta = await self.solicitar(self.dados_corrida(cotacao_token=token))
+
+        self.assertEqual(resposta['type'], 'erro_corrida')
+        self.assertEqual(resposta['codigo'], 'cotacao_invalida')
+        self.assertFalse(await Corrida.objects.aexists())
+
+
+@banco_na_thread_do_teste
+class OutboxPushTests(TestCase):
+    def setUp(self):
+        self.usuario = Usuario.objects.create_user(
+            cpf='98765432100', password='senha123', nome='Teste', sobrenome='Passageiro',
+            email='passageiro@teste.com', telefone='51988888888'
+        )
+        PushToken.objects.create(usuario=self.usuario, token='ExponentPushToken[passageiro]')
+        cache_tokens_push.limpar()
+
+    async def _executar(self, teste):
+        self.expo = ServidorExpoFalso()
+        url = await self.expo.iniciar()
+        self.despachante = DespachantePush(url=url, url_recibos=url.replace('/send', '/getReceipts'), timeout=2)
+        try:
+            await teste()
+        finally:
+            await self.despachante.fechar()
+            await self.expo.parar()
+
+    async def test_notificacao_repetida_e_gravada_uma_vez_e_enviada(self):
+        async def teste():
+            dados = {'tipo': 'motorista_chegou', 'corridaId': 'c1'}
+            await enviar_notificacao_passageiro('98765432100', 'Seu motorista chegou!', 'Aguardando', dados)
+            await enviar_notificacao_passageiro('98765432100', 'Seu motorista chegou!', 'Aguardando', dados)
+            self.assertEqual(await NotificacaoPush.objects.acount(), 1)
+
+            self.assertEqual(await processar_outbox(self.despachante), 1)
+            notificacao = await NotificacaoPush.objects.aget()
+            self.assertEqual(notificacao.status, 'ENVIADA')
+            self.assertEqual(self.expo.lotes[0][0]['data'], dados)
+            self.assertEqual(await processar_outbox(self.despachante), 0)
+
+        await self._executar(teste)
+
+    async def test_processo_web_esvazia_o_outbox_sem_worker(self):
+        async def teste():
+            self.assertIsNone(iniciar_outbox_no_processo())
+            await enviar_notificacao_passageiro('98765432100', 'Corrida aceita!', 'A caminho',
+                                                {'tipo': 'corrida_aceita', 'corridaId': 'c1'})
+            with self.settings(PUSH_OUTBOX_NO_PROCESSO=True), \
+                    mock.patch('movex.push_services.obter_despachante_push', return_value=self.despachante):
+                tarefa = iniciar_outbox_no_processo()
+                self.assertIs(iniciar_outbox_no_processo(), tarefa)
+            try:
+                for _ in range(100):
+                    if await NotificacaoPush.objects.filter(status='ENVIADA').aexists():
+                        break
+                    await asyncio.sleep(0.02)
+                self.assertEqual(len(self.expo.lotes), 1)
+            finally:
+                tarefa.cancel()
+
+        await self._executar(teste)
+
+    async def test_falha_do_expo_agenda_nova_tentativa_com_backoff(self):
+        async def teste():
+            self.expo.status = 500
+            await enviar_notificacao_passageiro('98765432100', 'Corrida aceita!', 'A caminho',
+                                                {'tipo': 'corrida_aceita', 'corridaId': 'c1'})
+            await processar_outbox(self.despachante)
+
+            notificacao = await NotificacaoPush.objects.aget()
+            self.assertEqual(notificacao.status, 'PENDENTE')
+            self.assertEqual(notificacao.tentativas, 1)
+            self.assertGreater(notificacao.proxima_tentativa, timezone.now())
+            # Ainda não venceu: nada é reenviado
+            self.assertEqual(await processar_outbox(self.despachante), 0)
+
+            with self.settings(PUSH_MAX_TENTATIVAS=2):
+                await NotificacaoPush.objects.aupdate(proxima_tentativa=timezone.now())
+                await processar_outbox(self.despachante)
+            notificacao = await NotificacaoPush.objects.aget()
+            self.assertEqual(notificacao.status, 'FALHOU')
+            self.assertEqual(notificacao.tentativas, 2)
+
+        await self._executar(teste)
+
+    async def test_dispositivo_nao_registrado_nao_e_reenviado(self):
+        async def teste():
+            self.expo.tokens_mortos.add('ExponentPushToken[passageiro]')
+            await enviar_notificacao_passageiro('98765432100', 'Corrida aceita!', 'A caminho',
+                                                {'tipo': 'corrida_aceita', 'corridaId': 'c1'})
+            await processar_outbox(self.despachante)
+
+            notificacao = await NotificacaoPush.objects.aget()
+            self.assertEqual(notificacao.status, 'FALHOU')
+            self.assertEqual(notificacao.ultimo_erro, 'DeviceNotRegistered')
+            self.assertFalse((await PushToken.objects.aget()).ativo)
+
+        await self._executar(teste)
+
+    async def test_recibo_de_dispositivo_removido_desativa_o_token(self):
+        async def teste():
+            await enviar_notificacao_passageiro('98765432100', 'Corrida aceita!', 'A caminho',
+                                                {'tipo': 'corrida_aceita', 'corridaId': 'c1'})
+            await processar_outbox(self.despachante)
+            notificacao = await NotificacaoPush.objects.aget()
+            self.expo.recibos[notificacao.ticket_id] = {
+                'status': 'error', 'message': 'not registered', 'details': {'error': 'DeviceNotRegistered'}
+            }
+
+            # Recibos só são consultados depois de PUSH_RECIBO_ATRASO
+            self.assertEqual(await verificar_recibos_push(self.despachante), 0)
+            await NotificacaoPush.objects.aupdate(enviado_em=timezone.now() - timedelta(minutes=20))
+            self.assertEqual(await verificar_recibos_push(self.despachante), 1)
+
+            self.assertEqual(self.expo.consultas_recibos, [[notificacao.ticket_id]])
+            self.assertFalse((await PushToken.objects.aget()).ativo)
+            self.assertEqual((await NotificacaoPush.objects.aget()).ticket_id, '')
+            # Sem token ativo a notificação seguinte nem entra no outbox
+            self.assertFalse(await enviar_notificacao_passageiro(
+                '98765432100', 'Corrida iniciada', 'Boa viagem', {'tipo': 'corrida_iniciada', 'corridaId': 'c1'}
+            ))
+
+        await self._executar(teste)
+
+
+class CacheTokensPushTests(TestCase):
+    def setUp(self):
+        self.usuario = Usuario.objects.create_user(
+            cpf='98765432100', password='senha123', nome='Teste', sobrenome='Passageiro',
+            email='passageiro@teste.com', telefone='51988888888'
+        )
+        cache_tokens_push.limpar()
+
+    def test_token_em_cache_e_invalidado_ao_salvar_novo_token(self):
+        self.assertEqual(buscar_destino_push('98765432100'), (self.usuario.id, None))
+        with self.assertNumQueries(0):
+            buscar_destino_push('98765432100')
+
+        resposta = self.client.post(reverse('salvar-token-push'), {
+            'cpf': '98765432100', 'token': 'ExponentPushToken[novo]'
+        })
+        self.assertEqual(resposta.status_code, 201)
+        self.assertEqual(buscar_destino_push('98765432100'), (self.usuario.id, 'ExponentPushToken[novo]'))
+
+
+def camadas_redis_falsas(*aliases, servidores=2):
+    """
+    Um channel layer Redis por "worker", todos apontando para os mesmos
+    servidores Redis em processo (fakeredis), com sharding entre eles.
+    """
+    hosts = [{'connection_class': FakeConnection, 'server': FakeServer()} for _ in range(servidores)]
+    return {
+        alias: {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': hosts, 'prefix': 'movex-teste', 'capacity': 100, 'expiry': 10},
+        }
+        for alias in aliases
+    }
+
+
+@unittest.skipIf(FakeServer is None, 'fakeredis não instalado')
+@banco_na_thread_do_teste
+class CamadaRedisEntreWorkersTests(TestCase):
+    async def conectar_motorista(self, alias, cpf):
+        # Cada "worker" usa o seu próprio channel layer
+        consumer = type(f'MoveXConsumer_{alias}', (MoveXConsumer,), {'channel_layer_alias': alias})
+        motorista = WebsocketCommunicator(consumer.as_asgi(), '/ws/movex/')
+        await motorista.connect()
+        await motorista.receive_json_from()  # connection_established
+        await motorista.send_json_to({'type': 'motorista_conectado', 'cpf': cpf})
+        self.assertEqual((await motorista.receive_json_from(timeout=5))['type'], 'status_atualizado')
+        return motorista
+
+    async def test_solicitacao_chega_a_motoristas_de_outros_workers(self):
+        with override_settings(CHANNEL_LAYERS=camadas_redis_falsas('worker_a', 'worker_b', 'worker_c')):
+            try:
+                motoristas = {
+                    cpf: await self.conectar_motorista(alias, cpf)
+                    for alias, cpf in (('worker_a', '111'), ('worker_b', '222'), ('worker_a', '333'))
+                }
+
+                # O passageiro está conectado a um terceiro worker
+                camada_passageiro = channel_layers['worker_c']
+                for cpf in motoristas:
+                    await camada_passageiro.group_send(f'motorista_{cpf}', {
+                        'type': 'nova_solicitacao_corrida',
+                        'corridaId': 'c1',
+                        'valor': 25.28,
+                    })
+
+                for motorista in motoristas.values():
+                    mensagem = await motorista.receive_json_from(timeout=5)
+                    self.assertEqual(mensagem['type'], 'nova_corrida')
+                    self.assertEqual(mensagem['corridaId'], 'c1')
+                    await motorista.disconnect()
+            finally:
+                for alias in ('worker_a', 'worker_b', 'worker_c'):
+                    await channel_layers[alias].close_pools()
+
+
+class DifusaoTests(SimpleTestCase):
+    def test_codificar_json_sem_orjson(self):
+        mensagem = {'type': 'nova_corrida', 'corridaId': '1', 'origem_descricao': 'Usina do Gasômetro', 'valor': 25.28}
+        with mock.patch.object(broadcast, 'orjson', None):
+            self.assertEqual(codificar_json(mensagem), json.dumps(mensagem))
+        self.assertEqual(json.loads(codificar_json(mensagem)), mensagem)
+
+    async def test_mensagem_e_serializada_uma_vez_para_todos_os_grupos(self):
+        camada = InMemoryChannelLayer()
+        canais = []
+        for cpf in ('111', '222', '333'):
+            canal = await camada.new_channel()
+            await camada.group_add(f'motorista_{cpf}', canal)
+            canais.append(canal)
+
+        with mock.patch.object(broadcast, 'codificar_json', wraps=codificar_json) as codificar:
+            enviados = await difundir_para_grupos(
+                camada, ['motorista_111', 'motorista_222', 'motorista_333'],
+                'nova_solicitacao_corrida', {'type': 'nova_corrida', 'corridaId': 'c1'}
+            )
+
+        self.assertEqual(enviados, 3)
+        self.assertEqual(codificar.call_count, 1)
+        for canal in canais:
+            evento = await camada.receive(canal)
+            self.assertEqual(evento['type'], 'nova_solicitacao_corrida')
+            self.assertEqual(json.loads(evento['texto']), {'type': 'nova_corrida', 'corridaId': 'c1'})
+
+    async def test_consumer_repassa_texto_pre_codificado(self):
+        consumer = MoveXConsumer()
+        consumer.send = mock.AsyncMock()
+        texto = '{"type":"corrida_indisponivel","corridaId":"c1"}'
+
+        await consumer.corrida_aceita_por_outro({'type': 'corrida_aceita_por_outro', 'texto': texto})
+        await consumer.nova_solicitacao_corrida({'type': 'nova_solicitacao_corrida', 'texto': texto})
+
+        self.assertEqual(consumer.send.await_args_list, [mock.call(text_data=texto, prioridade=PRIORIDADE_ALTA)] * 2)
+
+
+class DespachoEventosTests(SimpleTestCase):
+    def test_metricas_por_evento(self):
+        relogio = RelogioFalso()
+        metricas = MetricasEventos(intervalo_log=0, relogio=relogio)
+        metricas.registrar('ping', 0.002)
+        metricas.registrar('ping', 0.004)
+        metricas.registrar('login', 0.010, erro=True)
+
+        metricas.registrar('login', 0.020, consultas=4, tempo_banco=0.004)
+
+        self.assertEqual(metricas.resumo(), {
+            'ping': {'total': 2, 'erros': 0, 'media_ms': 3.0, 'maximo_ms': 4.0,
+                     'consultas_media': 0, 'consultas_maximo': 0, 'banco_media_ms': 0},
+            'login': {'total': 2, 'erros': 1, 'media_ms': 15.0, 'maximo_ms': 20.0,
+                      'consultas_media': 2, 'consultas_maximo': 4, 'banco_media_ms': 2.0},
+        })
+
+    async def test_despacho_com_middleware(self):
+        registro = RegistroEventos(MetricasEventos(intervalo_log=0))
+
+        class Consumer:
+            def __init__(self):
+                self.user_info = None
+                self.recebidos = []
+                self.enviados = []
+
+            async def send(self, texto):
+                self.enviados.append(json.loads(texto))
+
+            @registro.evento('eco', 'echo')
+            @exige_campos('texto')
+            async def evento_eco(self, data):
+                self.recebidos.append(data['texto'])
+
+        consumer = Consumer()
+        self.assertTrue(await registro.despachar(consumer, 'echo', {'texto': 'oi'}))
+        self.assertTrue(await registro.despachar(consumer, 'eco', {}))
+        self.assertFalse(await registro.despachar(consumer, 'desconhecido', {}))
+
+        self.assertEqual(consumer.recebidos, ['oi'])
+        self.assertEqual(consumer.enviados[0]['message'], 'Campos obrigatórios faltando: texto')
+        self.assertEqual(registro.metricas.resumo()['eco']['total'], 1)
+        with self.assertRaises(ValueError):
+            registro.evento('eco')(Consumer.evento_eco)
+
+    async def test_consumer_despacha_pela_tabela(self):
+        total_antes = eventos.metricas.resumo().get('ping', {}).get('total', 0)
+        communicator = WebsocketCommunicator(MoveXConsumer.as_asgi(), '/ws/movex/')
+        await communicator.connect()
+        await communicator.receive_json_from()  # connection_established
+
+        await communicator.send_json_to({'type': 'ping'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'pong')
+
+        # Apenas motoristas identificados podem enviar localização
+        await communicator.send_json_to({'type': 'atualizar_localizacao', 'latitude': -30.0, 'longitude': -51.2})
+        resposta = await communicator.receive_json_from()
+        self.assertEqual(resposta, {'type': 'erro', 'message': 'Apenas motoristas podem atualizar localização'})
+        await communicator.disconnect()
+
+        self.assertEqual(eventos.metricas.resumo()['ping']['total'], total_antes + 1)
+
+
+class LimitadorTaxaTests(SimpleTestCase):
+    def setUp(self):
+        self.relogio = RelogioFalso()
+
+    def criar_limitador(self, **kwargs):
+        return LimitadorTaxa(politicas={'calcular_rota': (2, 1.0)}, relogio=self.relogio, **kwargs)
+
+    def test_balde_repoe_fichas_com_o_tempo(self):
+        limitador = self.criar_limitador()
+        self.assertTrue(limitador.permitir('111', 'calcular_rota'))
+        self.assertTrue(limitador.permitir('111', 'calcular_rota'))
+        self.assertFalse(limitador.permitir('111', 'calcular_rota'))
+        # Outro usuário tem o próprio balde
+        self.assertTrue(limitador.permitir('222', 'calcular_rota'))
+
+        self.relogio.agora += 1
+        self.assertTrue(limitador.permitir('111', 'calcular_rota'))
+        self.assertFalse(limitador.permitir('111', 'calcular_rota'))
+
+    def test_baldes_cheios_sao_descartados_sem_varredura_completa(self):
+        limitador = self.criar_limitador()
+        limitador.permitir('111', 'calcular_rota')
+        limitador.permitir('222', 'ping')
+        limitador.permitir('333', 'ping')
+        self.assertEqual(len(limitador), 3)
+
+        self.relogio.agora += 61
+        # Cada chamada descarta até dois baldes expirados, dos usados há mais tempo
+        limitador.permitir('444', 'ping')
+        self.assertEqual(len(limitador), 2)
+        limitador.permitir('444', 'ping')
+        self.assertEqual(len(limitador), 1)
+
+    def test_tamanho_maximo_descarta_os_menos_usados(self):
+        limitador = self.criar_limitador(tamanho_maximo=2)
+        limitador.permitir('111', 'calcular_rota')
+        limitador.permitir('222', 'calcular_rota')
+        limitador.permitir('111', 'calcular_rota')
+        limitador.permitir('333', 'calcular_rota')
+
+        self.assertEqual(len(limitador), 2)
+        # O balde de 111 continua vazio; o de 222 foi descartado
+        self.assertFalse(limitador.permitir('111', 'calcular_rota'))
+
+    def test_balde_expirado_reutilizado_vai_para_o_fim(self):
+        limitador = LimitadorTaxa(politicas={'lento': (2, 0.01), 'rapido': (1, 10.0)},
+                                  tamanho_maximo=3, relogio=self.relogio)
+        limitador.permitir('111', 'lento')
+        limitador.permitir('222', 'rapido')
+        limitador.permitir('333', 'lento')
+
+        self.relogio.agora += 1
+        # O balde de 222 já expirou mas continua no meio da ordem; reutilizado, passa ao fim
+        self.assertTrue(limitador.permitir('222', 'rapido'))
+        limitador.permitir('444', 'lento')
+        limitador.permitir('555', 'lento')
+
+        # 111 e 333 eram os usados há mais tempo; o balde vazio de 222 continua lá
+        self.assertEqual(len(limitador), 3)
+        self.assertFalse(limitador.permitir('222', 'rapido'))
+
+    async def test_dispatcher_limita_todos_os_eventos(self):
+        registro = RegistroEventos(MetricasEventos(intervalo_log=0), limitador=LimitadorTaxa(politicas={'eco': (1, 0.1)}))
+
+        class Consumer:
+            user_info = {'cpf': '111'}
+
+            def __init__(self):
+                self.enviados = []
+
+            async def send(self, texto):
+                self.enviados.append(json.loads(texto))
+
+            @registro.evento('eco')
+            async def evento_eco(self, data):
+                await self.send(json.dumps({'type': 'eco'}))
+
+        consumer = Consumer()
+        await registro.despachar(consumer, 'eco', {})
+        await registro.despachar(consumer, 'eco', {})
+
+        self.assertEqual([m['type'] for m in consumer.enviados], ['eco', 'rate_limited'])
+        self.assertEqual(consumer.enviados[1]['request_type'], 'eco')
+
+
+class FilaSaidaTests(SimpleTestCase):
+    async def test_prioridade_e_substituicao_de_localizacao(self):
+        fila = FilaSaida(limite=10)
+        fila.colocar('loc-1', PRIORIDADE_BAIXA, chave=('localizacao', 'c1'))
+        fila.colocar('chat')
+        fila.colocar('loc-2', PRIORIDADE_BAIXA, chave=('localizacao', 'c1'))
+        fila.colocar('loc-outra', PRIORIDADE_BAIXA, chave=('localizacao', 'c2'))
+        fila.colocar('corrida_iniciada', PRIORIDADE_ALTA)
+
+        enviados = []
+        while len(fila):
+            enviados.append(await fila.obter())
+            fila.concluir()
+
+        self.assertEqual(enviados, ['corrida_iniciada', 'chat', 'loc-2', 'loc-outra'])
+        self.assertEqual(fila.descartados, 1)
+
+    async def test_fila_cheia_recusa_frames(self):
+        fila = FilaSaida(limite=2)
+        self.assertTrue(fila.colocar('a'))
+        self.assertTrue(fila.colocar('b'))
+        self.assertFalse(fila.colocar('c'))
+
+    async def test_cliente_que_nao_le_e_desconectado(self):
+        async def socket_travado(consumer):
+            # Simula um cliente que não lê: nada sai da fila
+            await asyncio.Event().wait()
+
+        with override_settings(FILA_SAIDA_LIMITE=3), \
+                mock.patch.object(MoveXConsumer, '_escrever_fila_saida', socket_travado):
+            communicator = WebsocketCommunicator(MoveXConsumer.as_asgi(), '/ws/movex/')
+            await communicator.connect()
+            for _ in range(3):
+                await communicator.send_json_to({'type': 'ping'})
+
+            saida = await communicator.receive_output(timeout=5)
+            self.assertEqual(saida, {'type': 'websocket.close', 'code': 4008})
+            await communicator.wait()
+
+
+class GruposConexaoTests(SimpleTestCase):
+    async def test_disconnect_sai_de_todos_os_grupos(self):
+        camada = channel_layers['default']
+        communicator = WebsocketCommunicator(MoveXConsumer.as_asgi(), '/ws/movex/')
+        await communicator.connect()
+        await communicator.receive_json_from()  # connection_established
+        await communicator.send_json_to({'type': 'login', 'cpf': '55566677788', 'tipo': 'PASSAGEIRO'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'login_success')
+
+        grupos_com_membros = {grupo for grupo, canais in camada.groups.items() if canais}
+        self.assertTrue({'passageiro_55566677788', 'conexoes_55566677788'} <= grupos_com_membros)
+
+        await communicator.disconnect()
+        self.assertFalse(any(
+            grupo.endswith('55566677788') and canais for grupo, canais in camada.groups.items()
+        ))
+
+    async def test_auditoria_remove_canais_mortos(self):
+        camada = InMemoryChannelLayer()
+        registro = RegistroConexoesMemoria()
+        vivo = await camada.new_channel()
+        morto = await camada.new_channel()
+        recem_chegado = await camada.new_channel()
+        await registro.registrar('111', 'c1', vivo, 3)
+        for canal in (vivo, morto, recem_chegado):
+            await camada.group_add('motorista_111', canal)
+        await camada.group_add('ops', morto)
+        # O canal morto entrou no grupo há mais tempo que a tolerância
+        camada.groups['motorista_111'][morto] -= 120
+        camada.groups['ops'][morto] -= 120
+
+        relatorio = await auditar_grupos(camada, registro, tolerancia=60, carencia=0, ausentes={})
+
+        self.assertEqual(relatorio['removidos'], 1)
+        self.assertEqual(relatorio['maiores'][0], ('motorista_111', 3))
+        self.assertEqual(set(camada.groups['motorista_111']), {vivo, recem_chegado})
+        # Apenas grupos por usuário são podados
+        self.assertIn(morto, camada.groups['ops'])
+
+    async def test_auditoria_espera_a_carencia(self):
+        camada = InMemoryChannelLayer()
+        registro = RegistroConexoesMemoria()
+        canal = await camada.new_channel()
+        await camada.group_add('passageiro_111', canal)
+        camada.groups['passageiro_111'][canal] -= 120
+        ausentes = {}
+
+        relatorio = await auditar_grupos(camada, registro, tolerancia=60, carencia=30, ausentes=ausentes)
+        self.assertEqual(relatorio['removidos'], 0)
+
+        # Ainda fora do registro depois da carência: removido
+        ausentes[canal] -= 30
+        relatorio = await auditar_grupos(camada, registro, tolerancia=60, carencia=30, ausentes=ausentes)
+        self.assertEqual(relatorio['removidos'], 1)
+        self.assertEqual(ausentes, {})
+
+    async def test_conexao_ociosa_sobrevive_a_auditoria(self):
+        camada = channel_layers['default']
+        registro = RegistroConexoesMemoria(ttl=0.3)
+        with mock.patch.object(connection_registry, '_registro_conexoes', registro):
+            communicator = WebsocketCommunicator(MoveXConsumer.as_asgi(), '/ws/movex/')
+            await communicator.connect()
+            await communicator.receive_json_from()  # connection_established
+            await communicator.send_json_to({'type': 'login', 'cpf': '55566677700', 'tipo': 'PASSAGEIRO'})
+            self.assertEqual((await communicator.receive_json_from())['type'], 'login_success')
+            canais = set(camada.groups['passageiro_55566677700'])
+
+            # O cliente só escuta: nenhuma mensagem por mais que o TTL do registro
+            await asyncio.sleep(0.7)
+            await auditar_grupos(camada, registro, tolerancia=0, carencia=0, ausentes={})
+
+            self.assertEqual(set(camada.groups['passageiro_55566677700']), canais)
+            await communicator.disconnect()
+
+
+@banco_na_thread_do_teste
+class TopicosTests(TestCase):
+    async def conectar_passageiro(self, cpf):
+        communicator = WebsocketCommunicator(MoveXConsumer.as_asgi(), '/ws/movex/')
+        await communicator.connect()
+        await communicator.receive_json_from()  # connection_established
+        await communicator.send_json_to({'type': 'login', 'cpf': cpf, 'tipo': 'PASSAGEIRO'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'login_success')
+        return communicator
+
+    async def inscrever(self, communicator, topico, **extras):
+        await communicator.send_json_to({'type': 'inscrever_topico', 'topico': topico, **extras})
+        return await communicator.receive_json_from()
+
+    async def test_connect_nao_entra_em_grupo_geral(self):
+        camada = channel_layers['default']
+        communicator = WebsocketCommunicator(MoveXConsumer.as_asgi(), '/ws/movex/')
+        await communicator.connect()
+        await communicator.receive_json_from()  # connection_established
+
+        self.assertFalse(camada.groups.get('movex_general'))
+        await communicator.disconnect()
+
+    async def test_publicacao_alcanca_apenas_inscritos(self):
+        camada = channel_layers['default']
+        perto = await self.conectar_passageiro('10000000001')
+        longe = await self.conectar_passageiro('10000000002')
+
+        resposta = await self.inscrever(perto, 'regiao', latitude=-30.03, longitude=-51.18)
+        self.assertEqual(resposta, {'type': 'topico_inscrito', 'topico': 'regiao'})
+        await self.inscrever(longe, 'regiao', latitude=-23.55, longitude=-46.63)
+        await self.inscrever(longe, 'anuncios:passageiros')
+
+        await publicar_topico(camada, 'regiao', {'type': 'aviso', 'texto': 'chuva'}, latitude=-30.031, longitude=-51.181)
+        await publicar_topico(camada, 'anuncios:passageiros', {'type': 'aviso', 'texto': 'promoção'})
+
+        self.assertEqual((await perto.receive_json_from())['texto'], 'chuva')
+        self.assertTrue(await perto.receive_nothing())
+        self.assertEqual((await longe.receive_json_from())['texto'], 'promoção')
+
+        # Cancelada a inscrição, nada mais chega
+        await longe.send_json_to({'type': 'cancelar_topico', 'topico': 'anuncios:passageiros'})
+        self.assertEqual((await longe.receive_json_from())['type'], 'topico_cancelado')
+        await publicar_topico(camada, 'anuncios:passageiros', {'type': 'aviso', 'texto': 'outra'})
+        self.assertTrue(await longe.receive_nothing())
+
+        await perto.disconnect()
+        await longe.disconnect()
+        self.assertFalse(camada.groups.get(f'topico.regiao.{celula_regiao(-30.03, -51.18)}'))
+
+    async def test_permissoes_dos_topicos(self):
+        await Usuario.objects.acreate(cpf='10000000003', nome='Ops', sobrenome='Equipe',
+                                      email='ops@teste.com', telefone='51977777777', is_staff=True)
+        passageiro = await self.conectar_passageiro('10000000004')
+        self.assertEqual((await self.inscrever(passageiro, 'anuncios:motoristas'))['type'], 'erro')
+        self.assertEqual((await self.inscrever(passageiro, 'ops'))['type'], 'erro')
+        self.assertEqual((await self.inscrever(passageiro, 'desconhecido'))['type'], 'erro')
+        await passageiro.disconnect()
+
+        equipe = await self.conectar_passageiro('10000000003')
+        self.assertEqual((await self.inscrever(equipe, 'ops'))['type'], 'topico_inscrito')
+        await equipe.disconnect()
+
+
+@banco_na_thread_do_teste
+class AutenticacaoHandshakeTests(TestCase):
+    def setUp(self):
+        self.usuario = Usuario.objects.create_user(
+            cpf='30000000001', password='senha123', nome='Teste', sobrenome='Motorista',
+            email='motorista@teste.com', telefone='51966666666', tipo_usuario='MOTORISTA'
+        )
+        Motorista.objects.create(
+            usuario=self.usuario, cnh='99999999999', categoria_cnh='B', modelo_veiculo='Modelo',
+            ano_veiculo=2020, placa_veiculo='ABC1D23', cor_veiculo='Preto'
+        )
+        self.token = Token.objects.create(user=self.usuario)
+
+    async def conectar(self, caminho):
+        communicator = WebsocketCommunicator(TokenAuthMiddleware(MoveXConsumer.as_asgi()), caminho)
+        conectado, _ = await communicator.connect()
+        return communicator, conectado
+
+    async def test_token_carrega_contexto_do_usuario(self):
+        communicator, conectado = await self.conectar(f'/ws/movex/?token={self.token.key}')
+        self.assertTrue(conectado)
+        await communicator.receive_json_from()  # connection_established
+
+        # O login só é aceito para o usuário do token
+        await communicator.send_json_to({'type': 'login', 'cpf': '30000000002', 'tipo': 'MOTORISTA'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'erro')
+        await communicator.send_json_to({'type': 'login', 'cpf': '30000000001', 'tipo': 'MOTORISTA'})
+        tipos = {(await communicator.receive_json_from())['type'] for _ in range(2)}
+        self.assertEqual(tipos, {'status_atualizado', 'login_success'})
+        await communicator.disconnect()
+
+    async def test_comandos_da_corrida_usam_o_cpf_do_token(self):
+        communicator, _ = await self.conectar(f'/ws/movex/?token={self.token.key}')
+        await communicator.receive_json_from()  # connection_established
+
+        with mock.patch('movex.consumers.executar_no_banco', mock.AsyncMock(return_value=(False, None))) as banco:
+            await communicator.send_json_to({'type': 'iniciar_corrida', 'corridaId': '1', 'motoristaCpf': '30000000002'})
+            resposta = await communicator.receive_json_from()
+            self.assertEqual(resposta['message'], 'CPF não corresponde ao token da conexão')
+            banco.assert_not_awaited()
+
+            await communicator.send_json_to({'type': 'finalizar_corrida', 'corridaId': '1'})
+            await communicator.receive_json_from()
+            self.assertEqual(banco.await_args.args[1:3], ('1', '30000000001'))
+        await communicator.disconnect()
+
+    async def test_token_invalido_recusa_o_handshake(self):
+        _, conectado = await self.conectar('/ws/movex/?token=invalido')
+        self.assertFalse(conectado)
+
+    def test_contexto_dispensa_consulta_ao_usuario(self):
+        contexto = {'cpf': '30000000001', 'tipo': 'MOTORISTA', 'motorista_pk': '30000000001'}
+        with self.assertNumQueries(1):
+            self.assertIsNone(obter_corrida_em_andamento('30000000001', contexto=contexto))
+        with self.assertNumQueries(2):
+            self.assertIsNone(obter_corrida_em_andamento('30000000001'))
+
+
+class ExecutorBancoTests(SimpleTestCase):
+    @override_settings(BANCO_EXECUTOR_THREADS=2)
+    async def test_unidade_de_trabalho_roda_no_executor_do_banco(self):
+        thread = await executar_no_banco(lambda: threading.current_thread().name, transacao=False)
+        self.assertTrue(thread.startswith('movex-db'))
+
+    @banco_na_thread_do_teste
+    async def test_sem_threads_usa_a_thread_compartilhada(self):
+        thread = await executar_no_banco(lambda: threading.current_thread().name, transacao=False)
+        self.assertFalse(thread.startswith('movex-db'))
+
+
+class UnidadesTrabalhoTests(TestCase):
+    def setUp(self):
+        usuario = Usuario.objects.create_user(
+            cpf='40000000001', password='senha123', nome='Teste', sobrenome='Passageiro',
+            email='passageiro4@teste.com', telefone='51955555555'
+        )
+        self.passageiro = Passageiro.objects.create(usuario=usuario)
+
+    def test_mensagem_chat_registra_e_identifica_as_partes(self):
+        corrida = Corrida.objects.create(
+            passageiro=self.passageiro, origem_lat=-30.03, origem_lng=-51.23, destino_lat=-30.05, destino_lng=-51.20
+        )
+        # Uma consulta para a corrida com as partes e uma inserção
+        with self.assertNumQueries(2):
+            resultado = comando_mensagem_chat(corrida.id, 'MOTORISTA', 'Cheguei')
+        self.assertEqual(resultado['passageiro_cpf'], '40000000001')
+        self.assertIsNone(resultado['motorista_cpf'])
+        self.assertEqual(MensagemChat.objects.get().conteudo, 'Cheguei')
+        self.assertIsNone(comando_mensagem_chat('nao-e-uuid', 'MOTORISTA', 'Oi'))
+
+    def test_solicitar_corrida_sem_motoristas_cancela_na_mesma_unidade(self):
+        dados = {
+            'passageiro': {'cpf': '40000000001'},
+            'origem': {'latitude': -30.03, 'longitude': -51.23},
+            'destino': {'latitude': -30.05, 'longitude': -51.20},
+        }
+        resultado = comando_solicitar_corrida(dados, -30.03, -51.23)
+
+        self.assertEqual(resultado['motoristas'], [])
+        self.assertEqual(Corrida.objects.get(id=resultado['corrida_id']).status, 'CANCELADA')
+
+
+class ConsultasConstantesTests(TestCase):
+    def setUp(self):
+        usuario = Usuario.objects.create_user(
+            cpf='70000000001', password='senha123', nome='Teste', sobrenome='Motorista',
+            email='motorista7@teste.com', telefone='51900000001', tipo_usuario='MOTORISTA'
+        )
+        self.motorista = Motorista.objects.create(
+            usuario=usuario, cnh='77777777777', categoria_cnh='B', modelo_veiculo='Modelo',
+            ano_veiculo=2020, placa_veiculo='JKL7M89', cor_veiculo='Azul'
+        )
+        self.contexto = {'cpf': '70000000001', 'tipo': 'MOTORISTA', 'motorista_pk': self.motorista.pk}
+        self.passageiros = []
+        for indice in range(3):
+            usuario = Usuario.objects.create_user(
+                cpf=f'7000000001{indice}', password='senha123', nome='Teste', sobrenome='Passageiro',
+                email=f'passageiro7{indice}@teste.com', telefone=f'5190000001{indice}'
+            )
+            self.passageiros.append(Passageiro.objects.create(usuario=usuario))
+
+    def criar_corrida(self, passageiro, **campos):
+        return Corrida.objects.create(
+            passageiro=passageiro, motorista=self.motorista, origem_lat=-30.03, origem_lng=-51.23,
+            destino_lat=-30.05, destino_lng=-51.20, **campos
+        )
+
+    def test_desconexao_marca_todas_as_corridas_de_uma_vez(self):
+        for passageiro in self.passageiros:
+            self.criar_corrida(passageiro, status='ACEITA')
+
+        # Uma consulta para as corridas com os passageiros e um UPDATE, para qualquer número de corridas
+        with self.assertNumQueries(2):
+            sucesso, passageiros = verificar_corridas_em_andamento('70000000001', contexto=self.contexto)
+
+        self.assertTrue(sucesso)
+        self.assertEqual(sorted(passageiros), ['70000000010', '70000000011', '70000000012'])
+        self.assertEqual(Corrida.objects.filter(motorista_temporariamente_desconectado=True).count(), 3)
+
+    def test_media_do_passageiro_pelos_agregados(self):
+        passageiro = self.passageiros[0]
+        for nota in (3, 4, 5):
+            corrida = self.criar_corrida(passageiro, status='FINALIZADA')
+            avaliar_passageiro(corrida.id, '70000000001', nota, contexto=self.contexto)
+        corrida = self.criar_corrida(passageiro, status='FINALIZADA')
+
+        # Corrida, UPDATE da avaliação, agregados do passageiro (bloqueados) e UPDATE deles,
+        # sem reler as corridas avaliadas
+        with self.assertNumQueries(4):
+            sucesso, cpf = avaliar_passageiro(corrida.id, '70000000001', 2, contexto=self.contexto)
+
+        self.assertEqual((sucesso, cpf), (True, '70000000010'))
+        passageiro.refresh_from_db()
+        self.assertEqual((passageiro.soma_avaliacoes, passageiro.total_avaliacoes), (14, 4))
+        self.assertEqual(passageiro.avaliacao_media, Decimal('3.5'))
+        self.assertEqual([media_avaliacoes(13, 4), media_avaliacoes(14, 3), media_avaliacoes(0, 0)],
+                         [Decimal('3.3'), Decimal('4.7'), Decimal('0.0')])
+
+    def test_nova_nota_da_mesma_corrida_substitui_a_anterior(self):
+        passageiro = self.passageiros[0]
+        corrida = self.criar_corrida(passageiro, status='FINALIZADA')
+        avaliar_passageiro(corrida.id, '70000000001', 5, contexto=self.contexto)
+        avaliar_passageiro(corrida.id, '70000000001', 2, contexto=self.contexto)
+
+        passageiro.refresh_from_db()
+        self.assertEqual((passageiro.soma_avaliacoes, passageiro.total_avaliacoes), (2, 1))
+        self.assertEqual(passageiro.avaliacao_media, Decimal('2.0'))
+
+    def test_recalcular_avaliacoes_repara_os_agregados(self):
+        for passageiro, nota in zip(self.passageiros, (5, 4, 4)):
+            self.criar_corrida(passageiro, status='FINALIZADA', avaliacao_motorista=nota, avaliacao_passageiro=nota)
+        self.criar_corrida(self.passageiros[0], status='FINALIZADA', avaliacao_passageiro=2)
+        Motorista.objects.filter(pk=self.motorista.pk).update(soma_avaliacoes=1, total_avaliacoes=1)
+
+        call_command('recalcular_avaliacoes', '--verificar', stdout=StringIO())
+        self.motorista.refresh_from_db()
+        self.assertEqual((self.motorista.soma_avaliacoes, self.motorista.total_avaliacoes), (1, 1))
+
+        call_command('recalcular_avaliacoes', stdout=StringIO())
+        self.motorista.refresh_from_db()
+        self.assertEqual((self.motorista.soma_avaliacoes, self.motorista.total_avaliacoes), (13, 3))
+        self.assertEqual(self.motorista.avaliacao_media, Decimal('4.3'))
+        passageiro = Passageiro.objects.get(pk=self.passageiros[0].pk)
+        self.assertEqual((passageiro.soma_avaliacoes, passageiro.total_avaliacoes), (7, 2))
+        self.assertEqual(passageiro.avaliacao_media, Decimal('3.5'))
+
+    def test_corrida_em_andamento_do_motorista_em_uma_consulta(self):
+        self.criar_corrida(self.passageiros[0], status='EM_ANDAMENTO')
+
+        with self.assertNumQueries(1):
+            corrida = verificar_corrida_em_andamento_motorista('70000000001')
+        self.assertEqual(corrida['passageiro']['cpf'], '70000000010')
+
+
+class IndicesConsultasTests(TestCase):
+    """Os filtros mais frequentes usam os índices compostos e parciais (planos do SQLite)."""
+
+    def plano(self, queryset):
+        sql, parametros = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', parametros)
+            return ' | '.join(linha[-1] for linha in cursor.fetchall())
+
+    def test_motoristas_disponiveis(self):
+        plano = self.plano(Motorista.objects.filter(esta_disponivel=True, status='DISPONIVEL'))
+        self.assertIn('motorista_disponivel_idx', plano)
+
+    def test_corrida_ativa_do_motorista_e_do_passageiro(self):
+        ativas = Corrida.objects.filter(status__in=['ACEITA', 'EM_ANDAMENTO'])
+        self.assertIn('corrida_motorista_status_idx', self.plano(ativas.filter(motorista_id='70000000001')))
+        self.assertIn('corrida_passageiro_status_idx', self.plano(ativas.filter(passageiro_id=1)))
+
+    def test_corridas_pendentes(self):
+        plano = self.plano(Corrida.objects.filter(status='PENDENTE').order_by('data_solicitacao'))
+        self.assertIn('corrida_pendente_idx', plano)
+        self.assertNotIn('TEMP B-TREE', plano)
+
+
+@banco_na_thread_do_teste
+class OrmAssincronoTests(TestCase):
+    def setUp(self):
+        usuario = Usuario.objects.create_user(
+            cpf='50000000001', password='senha123', nome='Teste', sobrenome='Motorista',
+            email='motorista5@teste.com', telefone='51944444444', tipo_usuario='MOTORISTA'
+        )
+        self.motorista = Motorista.objects.create(
+            usuario=usuario, cnh='55555555555', categoria_cnh='B', modelo_veiculo='Modelo',
+            ano_veiculo=2020, placa_veiculo='DEF5G67', cor_veiculo='Branco'
+        )
+        passageiro = Usuario.objects.create_user(
+            cpf='50000000002', password='senha123', nome='Teste', sobrenome='Passageiro',
+            email='passageiro5@teste.com', telefone='51933333333'
+        )
+        self.corrida = Corrida.objects.create(
+            passageiro=Passageiro.objects.create(usuario=passageiro), motorista=self.motorista, status='ACEITA',
+            origem_lat=-30.03, origem_lng=-51.23, destino_lat=-30.05, destino_lng=-51.20
+        )
+        self.contexto = {'cpf': '50000000001', 'tipo': 'MOTORISTA', 'motorista_pk': self.motorista.pk}
+
+    def test_atualizacoes_em_um_unico_update(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(async_to_sync(atualizar_localizacao_motorista_async)(
+                '50000000001', -30.04, -51.22, contexto=self.contexto
+            ))
+        with self.assertNumQueries(1):
+            self.assertTrue(async_to_sync(atualizar_status_motorista_async)('50000000001', 'DISPONIVEL', True))
+        self.assertFalse(async_to_sync(atualizar_status_motorista_async)('59999999999', 'DISPONIVEL', True))
+
+        self.motorista.refresh_from_db()
+        self.assertEqual(float(self.motorista.ultima_latitude), -30.04)
+        self.assertTrue(self.motorista.esta_disponivel)
+
+    def test_corrida_em_andamento_em_uma_consulta(self):
+        esperado = {'corrida_id': str(self.corrida.id), 'passageiro_cpf': '50000000002', 'status': 'ACEITA'}
+        with self.assertNumQueries(1):
+            self.assertEqual(async_to_sync(obter_corrida_em_andamento_async)('50000000001', contexto=self.contexto), esperado)
+        # Sem contexto, filtra pelo CPF do usuário na mesma consulta
+        with self.assertNumQueries(1):
+            self.assertEqual(async_to_sync(obter_corrida_em_andamento_async)('50000000001'), esperado)
+        self.assertIsNone(async_to_sync(obter_corrida_em_andamento_async)('50000000002'))
+
+    async def test_historico_chat_apenas_para_participantes(self):
+        await MensagemChat.objects.acreate(corrida=self.corrida, tipo_remetente='PASSAGEIRO', conteudo='Estou no portão')
+
+        mensagens = await obter_mensagens_chat_async(self.corrida.id, cpf='50000000002', marcar_como_lidas=True)
+        self.assertEqual([m['conteudo'] for m in mensagens], ['Estou no portão'])
+        self.assertEqual(await obter_mensagens_chat_async(self.corrida.id, cpf='59999999999'), [])
+        self.assertFalse(await MensagemChat.objects.filter(lida=False).aexists())
+
+        communicator = WebsocketCommunicator(MoveXConsumer.as_asgi(), '/ws/movex/')
+        await communicator.connect()
+        await communicator.receive_json_from()  # connection_established
+        await communicator.send_json_to({'type': 'login', 'cpf': '50000000002', 'tipo': 'PASSAGEIRO'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'login_success')
+        await communicator.send_json_to({'type': 'solicitar_historico_chat', 'corridaId': str(self.corrida.id)})
+        resposta = await communicator.receive_json_from()
+        self.assertEqual(resposta['type'], 'historico_chat')
+        self.assertEqual(resposta['mensagens'][0]['remetente'], 'PASSAGEIRO')
+        await communicator.disconnect()
+
+    async def test_historico_do_cache_tambem_marca_como_lidas(self):
+        mensagem = await MensagemChat.objects.acreate(corrida=self.corrida, tipo_remetente='MOTORISTA', conteudo='Cheguei')
+        corrida_id = str(self.corrida.id)
+        consumer = MoveXConsumer()
+        consumer.user_info = {'cpf': '50000000002', 'tipo': 'PASSAGEIRO'}
+        consumer.send = mock.AsyncMock()
+        historico_chat_cache[('50000000002', corrida_id)] = {
+            'timestamp': time.time(), 'mensagens': [{'id': str(mensagem.id), 'conteudo': 'Cheguei', 'lida': False}]
+        }
+        self.addCleanup(historico_chat_cache.clear)
+
+        await consumer.evento_solicitar_historico_chat({'corridaId': corrida_id, 'marcar_como_lidas': True})
+
+        self.assertEqual(json.loads(consumer.send.await_args.args[0])['mensagens'][0]['conteudo'], 'Cheguei')
+        await mensagem.arefresh_from_db()
+        self.assertTrue(mensagem.lida)
+
+
+class EscritorBancoTests(TransactionTestCase):
+    """O escritor único usa a conexão da própria thread: precisa de commits reais."""
+
+    def setUp(self):
+        usuario = Usuario.objects.create_user(
+            cpf='80000000001', password='senha123', nome='Teste', sobrenome='Motorista',
+            email='motorista8@teste.com', telefone='51900000081', tipo_usuario='MOTORISTA'
+        )
+        self.motorista = Motorista.objects.create(
+            usuario=usuario, cnh='88888888888', categoria_cnh='B', modelo_veiculo='Modelo',
+            ano_veiculo=2020, placa_veiculo='MNO8P90', cor_veiculo='Branco'
+        )
+        self.escritor = EscritorBanco(lote_maximo=50)
+
+    def gravar_em_um_lote(self, operacoes):
+        """Segura o escritor no primeiro lote até todas as operações estarem na fila."""
+        liberar = threading.Event()
+
+        async def cenario():
+            bloqueio = asyncio.ensure_future(self.escritor.executar(liberar.wait, 5))
+            await asyncio.sleep(0.05)
+            tarefas = [asyncio.ensure_future(self.escritor.executar(funcao, *args)) for funcao, *args in operacoes]
+            await asyncio.sleep(0)
+            liberar.set()
+            await bloqueio
+            return await asyncio.gather(*tarefas, return_exceptions=True)
+
+        return async_to_sync(cenario)()
+
+    def test_escritas_concorrentes_em_um_unico_commit(self):
+        def mover(latitude):
+            return atualizar_localizacao_motorista(self.motorista.cpf, latitude, -51.23)
+
+        with medir_consultas() as medicao:
+            resultados = self.gravar_em_um_lote([(mover, -30.0 - indice / 100) for indice in range(30)])
+
+        self.assertEqual(resultados, [True] * 30)
+        self.assertEqual((self.escritor.lotes, self.escritor.operacoes), (2, 31))
+        # Só os UPDATEs entram na medição do chamador; savepoints e commit são do lote
+        self.assertEqual(medicao.consultas, 30)
+        self.motorista.refresh_from_db()
+        self.assertEqual(self.motorista.ultima_latitude, Decimal('-30.290000'))
+
+    def test_falha_de_uma_escrita_desfaz_so_ela(self):
+        def ficar_offline_e_falhar():
+            Motorista.objects.filter(pk=self.motorista.pk).update(status='OFFLINE')
+            raise ValueError('falha depois de escrever')
+
+        def ficar_ocupado():
+            return Motorista.objects.filter(pk=self.motorista.pk).update(esta_disponivel=True, status='OCUPADO')
+
+        def mover():
+            return atualizar_localizacao_motorista(self.motorista.cpf, -30.5, -51.5)
+
+        resultados = self.gravar_em_um_lote([(ficar_ocupado,), (ficar_offline_e_falhar,), (mover,)])
+
+        self.assertEqual(resultados[0], 1)
+        self.assertIsInstance(resultados[1], ValueError)
+        self.assertTrue(resultados[2])
+        self.motorista.refresh_from_db()
+        self.assertEqual((self.motorista.status, self.motorista.ultima_latitude), ('OCUPADO', Decimal('-30.500000')))
+
+
+class MedicaoConsultasTests(TestCase):
+    def test_medicao_inclui_consultas_em_outras_threads(self):
+        async def cenario():
+            with medir_consultas(guardar_sql=True) as externa:
+                await executar_no_banco(Usuario.objects.count, transacao=False)
+                with medir_consultas() as interna:
+                    await Usuario.objects.acount()
+            return externa, interna
+
+        # Executor do banco em outra thread: o contexto da medição acompanha a consulta
+        with self.settings(BANCO_EXECUTOR_THREADS=2):
+            externa, interna = async_to_sync(cenario)()
+
+        self.assertEqual(externa.consultas, 2)
+        self.assertEqual(interna.consultas, 1)
+        self.assertIn('COUNT', externa.sql[0])
+        self.assertGreater(externa.tempo_total, 0)
+        self.assertGreaterEqual(externa.tempo_total, externa.tempo_banco)
+
+
+# Consultas SQL permitidas por evento do MoveXConsumer, em conexões autenticadas
+# por token. Um evento acima do orçamento indica consultas N+1 ou repetidas.
+ORCAMENTO_CONSULTAS = {
+    'ping': 0,
+    'login': 0,
+    'motorista_conectado': 5,
+    'motorista_status': 1,
+    'motorista_disponivel': 5,
+    'calcular_rota': 0,
+    'solicitar_corrida': 5,
+    'aceitar_corrida': 7,
+    'atualizar_localizacao': 2,
+    'aviso_chegada': 4,
+    'mensagem_chat': 4,
+    'solicitar_historico_chat': 1,
+    'iniciar_corrida': 4,
+    'finalizar_corrida': 5,
+    'avaliar_motorista': 6,
+    'inscrever_topico': 0,
+    'cancelar_topico': 0,
+}
+
+
+class ProvedorRotasOffline:
+    async def buscar_rota(self, *args):
+        return None
+
+    async def ordenar_por_eta(self, motoristas, latitude, longitude):
+        return motoristas
+
+
+@banco_na_thread_do_teste
+class OrcamentoConsultasTests(TestCase):
+    def setUp(self):
+        self.usuario_motorista = Usuario.objects.create_user(
+            cpf='60000000001', password='senha123', nome='Teste', sobrenome='Motorista',
+            email='motorista6@teste.com', telefone='51922222222', tipo_usuario='MOTORISTA'
+        )
+        Motorista.objects.create(
+            usuario=self.usuario_motorista, cnh='66666666666', categoria_cnh='B', modelo_veiculo='Modelo',
+            ano_veiculo=2020, placa_veiculo='GHI6J78', cor_veiculo='Prata',
+            ultima_latitude=-30.031, ultima_longitude=-51.201
+        )
+        self.usuario_passageiro = Usuario.objects.create_user(
+            cpf='60000000002', password='senha123', nome='Teste', sobrenome='Passageiro',
+            email='passageiro6@teste.com', telefone='51911111111'
+        )
+        Passageiro.objects.create(usuario=self.usuario_passageiro)
+        limitador_eventos.limpar()
+        eventos.metricas.limpar()
+
+    async def conectar(self, usuario):
+        token = await Token.objects.acreate(user=usuario)
+        communicator = WebsocketCommunicator(
+            TokenAuthMiddleware(MoveXConsumer.as_asgi()), f'/ws/movex/?token={token.key}'
+        )
+        await communicator.connect()
+        await communicator.receive_json_from()  # connection_established
+        return communicator
+
+    async def enviar(self, communicator, evento, resposta):
+        """Envia o evento, espera a resposta e retorna as consultas feitas pelo handler."""
+        await communicator.send_json_to(evento)
+        while True:
+            recebida = await communicator.receive_json_from(timeout=5)
+            if recebida['type'] == resposta:
+                break
+            self.assertNotIn(recebida['type'], ('erro', 'erro_corrida', 'rate_limited'), recebida)
+        # A métrica é registrada quando o handler termina, logo depois da resposta
+        for _ in range(100):
+            if evento['type'] in eventos.metricas.resumo():
+                break
+            await asyncio.sleep(0.01)
+        self.consultas[evento['type']] = eventos.metricas.resumo()[evento['type']]['consultas_maximo']
+        eventos.metricas.limpar()
+        return recebida
+
+    async def test_eventos_dentro_do_orcamento_de_consultas(self):
+        self.consultas = {}
+        motorista = await self.conectar(self.usuario_motorista)
+        passageiro = await self.conectar(self.usuario_passageiro)
+        dados_passageiro = {'cpf': '60000000002', 'nome': 'Teste', 'sobrenome': 'Passageiro', 'telefone': '51911111111'}
+        origem, destino = {'latitude': -30.03, 'longitude': -51.20}, {'latitude': -30.00, 'longitude': -51.15}
+
+        with mock.patch('movex.consumers.obter_provedor_rotas', return_value=ProvedorRotasOffline()), \
+                mock.patch('movex.routing_services.obter_provedor_rotas', return_value=ProvedorRotasOffline()):
+            await self.enviar(passageiro, {'type': 'ping'}, 'pong')
+            await self.enviar(passageiro, {'type': 'login', 'cpf': '60000000002', 'tipo': 'PASSAGEIRO'}, 'login_success')
+            await self.enviar(motorista, {'type': 'motorista_conectado', 'cpf': '60000000001'}, 'status_atualizado')
+            await self.enviar(motorista, {'type': 'motorista_status', 'cpf': '60000000001', 'status': 'online',
+                                          'disponivel': True}, 'status_atualizado')
+            await self.enviar(motorista, {'type': 'motorista_disponivel', 'cpf': '60000000001'}, 'status_atualizado')
+            rota = await self.enviar(passageiro, {'type': 'calcular_rota', 'start_lat': -30.03, 'start_lng': -51.20,
+                                                  'end_lat': -30.00, 'end_lng': -51.15}, 'rota_calculada')
+            registrada = await self.enviar(passageiro, {
+                'type': 'solicitar_corrida', 'passageiro': dados_passageiro, 'origem': origem, 'destino': destino,
+                'cotacao_token': rota['cotacao_token']
+            }, 'corrida_registrada')
+            corrida_id = registrada['corridaId']
+            await self.enviar(motorista, {'type': 'aceitar_corrida', 'corridaId': corrida_id}, 'corrida_aceita')
+            await self.enviar(motorista, {'type': 'atualizar_localizacao', 'latitude': -30.03, 'longitude': -51.2},
+                              'localizacao_atualizada')
+            await self.enviar(motorista, {'type': 'aviso_chegada', 'corridaId': corrida_id}, 'chegada_confirmada')
+            await self.enviar(passageiro, {'type': 'mensagem_chat', 'corridaId': corrida_id, 'remetente': 'PASSAGEIRO',
+                                           'conteudo': 'Estou no portão'}, 'mensagem_enviada')
+            await self.enviar(passageiro, {'type': 'solicitar_historico_chat', 'corridaId': corrida_id}, 'historico_chat')
+            await self.enviar(motorista, {'type': 'iniciar_corrida', 'corridaId': corrida_id}, 'corrida_iniciada')
+            await self.enviar(motorista, {'type': 'finalizar_corrida', 'corridaId': corrida_id}, 'corrida_finalizada')
+            await self.enviar(passageiro, {'type': 'avaliar_motorista', 'corridaId': corrida_id, 'avaliacao': 5},
+                              'avaliacao_motorista_sucesso')
+            await self.enviar(passageiro, {'type': 'inscrever_topico', 'topico': 'anuncios:todos'}, 'topico_inscrito')
+            await self.enviar(passageiro, {'type': 'cancelar_topico', 'topico': 'anuncios:todos'}, 'topico_cancelado')
+
+        await motorista.disconnect()
+        await passageiro.disconnect()
+
+        # Todo evento do consumer tem orçamento, e todo orçamento foi exercitado
+        self.assertEqual(set(self.consultas), set(ORCAMENTO_CONSULTAS))
+        self.assertEqual(set(ORCAMENTO_CONSULTAS), set(eventos.tipos()) - {'heartbeat'})
+        for evento, consultas in self.consultas.items():
+            with self.subTest(evento=evento):
+                self.assertLessEqual(consultas, ORCAMENTO_CONSULTAS[evento])
+
+
+class BufferReplayTestsMixin:
+    def criar_buffer(self):
+        raise NotImplementedError
+
+    async def test_eventos_desde_retorna_apenas_os_perdidos(self):
+        buffer = self.criar_buffer()
+        for i in range(5):
+            self.assertEqual(await buffer.registrar('111', {'type': 'corrida_iniciada', 'n': i}), i + 1)
+        await buffer.registrar('222', {'type': 'outro'})
+
+        ultimo, eventos, completo = await buffer.eventos_desde('111', 3)
+        self.assertEqual((ultimo, completo), (5, True))
+        self.assertEqual([(e['seq'], e['n']) for e in eventos], [(4, 3), (5, 4)])
+        self.assertEqual(await buffer.ultimo_seq('111'), 5)
+
+    async def test_lacuna_maior_que_o_buffer_e_incompleta(self):
+        buffer = self.criar_buffer()  # tamanho 3
+        for i in range(5):
+            await buffer.registrar('111', {'type': 'corrida_iniciada', 'n': i})
+
+        self.assertTrue((await buffer.eventos_desde('111', 2))[2])
+        self.assertFalse((await buffer.eventos_desde('111', 1))[2])
+        # Seq de uma sequência que já expirou (maior que o último emitido)
+        self.assertFalse((await buffer.eventos_desde('111', 9))[2])
+        self.assertEqual(await buffer.eventos_desde('999', 0), (0, [], True))
+
+
+class BufferReplayMemoriaTests(BufferReplayTestsMixin, SimpleTestCase):
+    def criar_buffer(self):
+        return BufferReplayMemoria(tamanho=3, ttl=60)
+
+    async def test_usuario_nunca_mais_consultado_e_descartado(self):
+        relogio = RelogioFalso()
+        buffer = BufferReplayMemoria(tamanho=3, ttl=60, relogio=relogio)
+        await buffer.registrar('111', {'type': 'corrida_iniciada'})
+        relogio.agora += 30
+        await buffer.registrar('222', {'type': 'corrida_iniciada'})
+
+        relogio.agora += 40
+        await buffer.registrar('333', {'type': 'corrida_iniciada'})
+
+        self.assertEqual(list(buffer._usuarios), ['222', '333'])
+
+
+@unittest.skipIf(FakeServer is None, 'fakeredis não instalado')
+class BufferReplayRedisTests(BufferReplayTestsMixin, SimpleTestCase):
+    def criar_buffer(self):
+        return BufferReplayRedis(cliente=FakeRedis(server=FakeServer()), tamanho=3, ttl=60)
+
+    def test_cliente_de_outro_loop_e_fechado(self):
+        buffer = BufferReplayRedis(url='redis://redis.invalid:6379')
+        with mock.patch.object(replay.aioredis.Redis, 'aclose', autospec=True) as aclose:
+            primeiro = async_to_sync(buffer._obter_cliente)()
+            segundo = async_to_sync(buffer._obter_cliente)()
+
+        self.assertIsNot(primeiro, segundo)
+        aclose.assert_called_once_with(primeiro)
+
+
+class RetomadaSessaoTests(SimpleTestCase):
+    async def conectar(self, **login):
+        communicator = WebsocketCommunicator(MoveXConsumer.as_asgi(), '/ws/movex/')
+        await communicator.connect()
+        await communicator.receive_json_from()  # connection_established
+        await communicator.send_json_to({'type': 'login', 'cpf': '20000000001', 'tipo': 'PASSAGEIRO', **login})
+        return communicator
+
+    async def enviar(self, tipo):
+        await enviar_com_sequencia(
+            channel_layers['default'], 'passageiro_20000000001', '20000000001',
+            {'type': tipo, 'corridaId': '42'}
+        )
+
+    async def test_reconexao_recebe_apenas_eventos_perdidos(self):
+        with mock.patch.object(replay, '_buffer_replay', BufferReplayMemoria(tamanho=10)):
+            await self.enviar('corrida_iniciada')  # de uma sessão anterior
+            communicator = await self.conectar()
+            self.assertEqual((await communicator.receive_json_from())['ultimo_seq'], 1)
+
+            await self.enviar('corrida_iniciada')
+            recebido = await communicator.receive_json_from()
+            self.assertEqual((recebido['type'], recebido['seq']), ('corrida_iniciada', 2))
+            await communicator.disconnect()
+
+            # Sem conexão: o evento só fica no buffer
+            await self.enviar('corrida_finalizada_por_motorista')
+
+            communicator = await self.conectar(resume_from=2)
+            self.assertEqual((await communicator.receive_json_from())['type'], 'login_success')
+            perdido = await communicator.receive_json_from()
+            self.assertEqual((perdido['type'], perdido['seq']), ('corrida_finalizada', 3))
+            self.assertEqual(await communicator.receive_json_from(),
+                             {'type': 'resume_ok', 'ultimo_seq': 3, 'reenviados': 1})
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+    async def test_lacuna_fora_do_buffer_pede_nova_consulta(self):
+        with mock.patch.object(replay, '_buffer_replay', BufferReplayMemoria(tamanho=2)):
+            for _ in range(4):
+                await self.enviar('corrida_iniciada')
+
+            communicator = await self.conectar(resume_from=1)
+            self.assertEqual((await communicator.receive_json_from())['type'], 'login_success')
+            resposta = await communicator.receive_json_from()
+            self.assertEqual((resposta['type'], resposta['ultimo_seq']), ('resume_incompleto', 4))
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+    async def test_evento_durante_a_entrada_no_grupo_nao_e_descartado(self):
+        entrar_grupo = MoveXConsumer._entrar_grupo
+
+        async def entrar_e_receber_evento(consumer, grupo):
+            await entrar_grupo(consumer, grupo)
+            if grupo == 'passageiro_20000000001':
+                await self.enviar('corrida_iniciada')
+
+        with mock.patch.object(replay, '_buffer_replay', BufferReplayMemoria(tamanho=10)), \
+                mock.patch.object(MoveXConsumer, '_entrar_grupo', entrar_e_receber_evento):
+            communicator = await self.conectar()
+            frames = [await communicator.receive_json_from() for _ in range(2)]
+            self.assertIn(('corrida_iniciada', 1), [(frame['type'], frame.get('seq')) for frame in frames])
+            await communicator.disconnect()
+
+    async def test_seq_entra_no_objeto_do_frame(self):
+        consumer = MoveXConsumer()
+        consumer._seq_atual = 7
+        with mock.patch.object(AsyncWebsocketConsumer, 'send', mock.AsyncMock()) as enviar:
+            await consumer.send(json.dumps({'type': 'corrida_iniciada'}))
+            await consumer.send('{}')
+            with self.assertRaises(TypeError):
+                await consumer.send('[1, 2]')
+
+        self.assertEqual([json.loads(c.kwargs['text_data']) for c in enviar.await_args_list],
+                         [{'seq': 7, 'type': 'corrida_iniciada'}, {'seq': 7}])
+
+
+class RegistroConexoesTestsMixin:
+    def criar_registro(self):
+        raise NotImplementedError
+
+    async def test_registrar_remove_as_conexoes_mais_antigas_do_usuario(self):
+        registro = self.criar_registro()
+        for i in range(3):
+            self.assertEqual(await registro.registrar('111', f'c{i}', f'canal-{i}', 3, worker='w1'), [])
+            await asyncio.sleep(0.01)
+        await registro.registrar('222', 'outro', 'canal-outro', 3, worker='w2')
+
+        removidas = await registro.registrar('111', 'c3', 'canal-3', 3, worker='w2')
+
+        self.assertEqual(removidas, [('c0', 'canal-0')])
+        self.assertEqual(await registro.conexoes_usuario('111'), 3)
+        self.assertEqual(await registro.conexoes_por_worker(), {'w1': 2, 'w2': 2})
+
+        await registro.remover('111', 'c3', worker='w2')
+        self.assertEqual(await registro.conexoes_usuario('111'), 2)
+        self.assertEqual(await registro.conexoes_por_worker(), {'w1': 2, 'w2': 1})
+
+    async def test_renovar_informa_se_a_conexao_existe(self):
+        registro = self.criar_registro()
+        await registro.registrar('111', 'c1', 'canal-1', 3)
+
+        self.assertTrue(await registro.renovar('111', 'c1'))
+        await registro.remover('111', 'c1')
+        self.assertFalse(await registro.renovar('111', 'c1'))
+
+    async def test_canais_ativos_e_lock(self):
+        registro = self.criar_registro()
+        await registro.registrar('111', 'c1', 'canal-1', 3)
+        await registro.registrar('222', 'c2', 'canal-2', 3)
+        await registro.remover('222', 'c2')
+
+        self.assertEqual(await registro.canais_ativos(), {'canal-1'})
+        self.assertTrue(await registro.adquirir_lock('auditoria_grupos', 60))
+
+
+class RegistroConexoesMemoriaTests(RegistroConexoesTestsMixin, SimpleTestCase):
+    def criar_registro(self):
+        return RegistroConexoesMemoria(ttl=60)
+
+    async def test_conexoes_nao_renovadas_expiram(self):
+        relogio = RelogioFalso()
+        registro = RegistroConexoesMemoria(ttl=60, relogio=relogio)
+        await registro.registrar('111', 'c1', 'canal-1', 3)
+        await registro.registrar('111', 'c2', 'canal-2', 3)
+
+        relogio.agora += 40
+        await registro.renovar('111', 'c2')
+        relogio.agora += 40
+
+        self.assertEqual(await registro.conexoes_usuario('111'), 1)
+
+
+@unittest.skipIf(FakeServer is None, 'fakeredis não instalado')
+class RegistroConexoesRedisTests(RegistroConexoesTestsMixin, SimpleTestCase):
+    def criar_registro(self):
+        return RegistroConexoesRedis(cliente=FakeRedis(server=FakeServer()), ttl=60)
+
+    def test_cliente_de_outro_loop_e_fechado(self):
+        registro = RegistroConexoesRedis(url='redis://redis.invalid:6379')
+        with mock.patch.object(connection_registry.aioredis.Redis, 'aclose', autospec=True) as aclose:
+            primeiro = async_to_sync(registro._obter_cliente)()
+            segundo = async_to_sync(registro._obter_cliente)()
+
+        self.assertIsNot(primeiro, segundo)
+        aclose.assert_called_once_with(primeiro)
+
+
+@unittest.skipIf(FakeServer is None, 'fakeredis não instalado')
+class ConexoesLegadasTests(SimpleTestCase):
+    async def conectar(self, cpf):
+        conexao = WebsocketCommunicator(ConsumerLegado.as_asgi(), '/ws/')
+        await conexao.connect()
+        await conexao.send_json_to({'type': 'motorista_conectado', 'cpf': cpf})
+        self.assertEqual((await conexao.receive_json_from())['type'], 'connection_success')
+        return conexao
+
+    async def test_conexao_excedente_e_fechada_sem_afetar_o_consumer_principal(self):
+        registro = RegistroConexoesMemoria()
+        with mock.patch.object(connection_registry, '_registro_conexoes', registro):
+            await registro.registrar('111', 'principal', 'canal-principal', 3)
+            conexoes = [await self.conectar('111') for _ in range(3)]
+
+            self.assertEqual(await conexoes[0].receive_output(timeout=5),
+                             {'type': 'websocket.close', 'code': 4001})
+            self.assertEqual(await registro.conexoes_usuario('legacy:111'), 2)
+            self.assertEqual(await registro.conexoes_usuario('111'), 1)
+            for conexao in conexoes[1:]:
+                self.assertTrue(await conexao.receive_nothing())
+                await conexao.disconnect()
+            self.assertEqual(await registro.conexoes_usuario('legacy:111'), 0)
+
+
+@banco_na_thread_do_teste
+class LimiteConexoesEntreWorkersTests(TestCase):
+    async def conectar(self, alias, cpf):
+        consumer = type(f'MoveXConsumer_{alias}', (MoveXConsumer,), {'channel_layer_alias': alias})
+        conexao = WebsocketCommunicator(consumer.as_asgi(), '/ws/movex/')
+        await conexao.connect()
+        await conexao.receive_json_from()  # connection_established
+        await conexao.send_json_to({'type': 'motorista_conectado', 'cpf': cpf})
+        self.assertEqual((await conexao.receive_json_from(timeout=5))['type'], 'status_atualizado')
+        return conexao
+
+    async def test_conexao_mais_antiga_e_encerrada_mesmo_em_outro_worker(self):
+        registro = RegistroConexoesRedis(cliente=FakeRedis(server=FakeServer()), ttl=60)
+        with override_settings(CHANNEL_LAYERS=camadas_redis_falsas('worker_a', 'worker_b')), \
+                mock.patch.object(connection_registry, '_registro_conexoes', registro):
+            try:
+                conexoes = [await self.conectar('worker_a', '111')]
+                for _ in range(3):
+                    conexoes.append(await self.conectar('worker_b', '111'))
+
+                aviso = await conexoes[0].receive_json_from(timeout=5)
+                self.assertEqual(aviso['code'], 'TOO_MANY_CONNECTIONS')
+                self.assertEqual((await conexoes[0].receive_output(timeout=5))['type'], 'websocket.close')
+                self.assertEqual(await registro.conexoes_usuario('111'), 3)
+                for conexao in conexoes[1:]:
+                    self.assertTrue(await conexao.receive_nothing())
+                    await conexao.disconnect()
+            finally:
+                for alias in ('worker_a', 'worker_b'):
+                    await channel_layers[alias].close_pools()
@@ -0,0 +1,64 @@
+import math
+
+from django.conf import settings
+
+from .broadcast import codificar_json
+
+# Tópicos aos quais uma conexão pode se inscrever, e quem pode se inscrever:
+#   regiao                 célula da grade de coordenadas (ex.: corridas próximas)
+#   anuncios:todos         avisos para todos os usuários identificados
+#   anuncios:motoristas    avisos apenas para motoristas
+#   anuncios:passageiros   avisos apenas para passageiros
+#   ops                    feed operacional, apenas para a equipe (is_staff)
+TOPICOS = {
+    'regiao': None,
+    'anuncios:todos': None,
+    'anuncios:motoristas': 'MOTORISTA',
+    'anuncios:passageiros': 'PASSAGEIRO',
+    'ops': 'STAFF',
+}
+
+PREFIXO_GRUPO_TOPICO = 'topico.'
+
+
+class TopicoInvalido(Exception):
+    pass
+
+
+def celula_regiao(latitude, longitude, tamanho=None):
+    """Identificador da célula da grade (tamanho em graus) que contém a coordenada."""
+    tamanho = tamanho or getattr(settings, 'TOPICO_REGIAO_CELULA_GRAUS', 0.05)
+    return f"{math.floor(float(latitude) / tamanho)}_{math.floor(float(longitude) / tamanho)}"
+
+
+def grupo_topico(topico, latitude=None, longitude=None):
+    """
+    Nome do grupo do channel layer de um tópico.
+
+    Raises:
+        TopicoInvalido: tópico desconhecido ou região sem coordenadas válidas
+    """
+    if topico not in TOPICOS:
+        raise TopicoInvalido(f'Tópico desconhecido: {topico}')
+    if topico == 'regiao':
+        try:
+            return f'{PREFIXO_GRUPO_TOPICO}regiao.{celula_regiao(latitude, longitude)}'
+        except (TypeError, ValueError):
+            raise TopicoInvalido('Latitude e longitude são obrigatórios para o tópico regiao')
+    return PREFIXO_GRUPO_TOPICO + topico.replace(':', '.')
+
+
+def permissao_topico(topico):
+    """Tipo de usuário exigido pelo tópico ('MOTORISTA', 'PASSAGEIRO', 'STAFF') ou None."""
+    return TOPICOS.get(topico)
+
+
+async def publicar_topico(channel_layer, topico, mensagem, latitude=None, longitude=None):
+    """
+    Envia uma mensagem apenas às conexões inscritas no tópico. A mensagem é
+    serializada uma vez e repassada pronta pelo handler `mensagem_topico`.
+    """
+    await channel_layer.group_send(
+        grupo_topico(topico, latitude, longitude),
+        {'type': 'mensagem_topico', 'texto': codificar_json(mensagem)}
+    )
@@ -1,4 +1,3 @@
-import datetime
 import logging
 import requests
 from math import radians, cos, sin, asin, sqrt
@@ -6,8 +5,14 @@ from asgiref.sync import sync_to_async
 from corridas.models import Corrida
 import json
 import math
+import hashlib
+from functools import lru_cache
 from decimal import Decimal
-from datetime import datetime, time
+from datetime import time
+
+import numpy as np
+
+from .push_services import CABECALHOS_EXPO, EXPO_PUSH_URL, montar_mensagem_push, token_push_valido
 
 logger = logging.getLogger(__name__)
 
@@ -15,12 +20,18 @@ logger = logging.getLogger(__name__)
 OPEN_ROUTE_SERVICE_APIKEY = "5b3ce3597851110001cf624862f702b709e14c648658e373a59b59de"
 ORS_BASE_URL = "https://api.openrouteservice.org/v2/directions/driving-car"
 
-# Configurações de tarifas
-TARIFA_BASE = 2.5
-TARIFA_KM = 0.9
-TARIFA_MINUTO = 0.15
-TARIFA_MINIMA = 5.0
-MULTIPLICADOR_HORARIO_PICO = 1.35
+# Configurações de tarifas (tarifa padrão do motor em movex/pricing.py)
+# Pode ser sobrescrita por settings.MOVEX_TARIFAS ou pelo arquivo MOVEX_TARIFAS_ARQUIVO
+TARIFA_BASE = 0.0
+TARIFA_KM = 2.10
+TARIFA_MINUTO = 0.0
+TARIFA_MINIMA = 10.0
+MULTIPLICADOR_HORARIO_PICO = 1.4  # Aumento de 40% no horário de pico
+MULTIPLICADOR_HORARIO_NOTURNO = 1.6  # Aumento de 60% no horário noturno
+
+# Corridas de até 5 km têm valor fixo
+DISTANCIA_CORRIDA_CURTA_KM = 5
+TARIFA_CORRIDA_CURTA = 10.0
 
 # Horários de pico (horário comercial)
 HORARIO_PICO_MANHA_INICIO = time(6, 0)
@@ -28,6 +39,9 @@ HORARIO_PICO_MANHA_FIM = time(9, 0)
 HORARIO_PICO_TARDE_INICIO = time(17, 0)
 HORARIO_PICO_TARDE_FIM = time(20, 0)
 
+# Horário noturno (a partir das 20h até a meia-noite)
+HORARIO_NOTURNO_INICIO = time(20, 0)
+
 # Função para calcular distância entre coordenadas geográficas usando a fórmula de Haversine
 def calcular_distancia(lat1, lon1, lat2, lon2):
     """
@@ -67,54 +81,25 @@ def calcular_distancia(lat1, lon1, lat2, lon2):
     return distancia
 
 # Função para verificar se o horário atual é horário de pico
-def is_horario_pico():
+def is_horario_pico(timestamp=None):
     """
-    Verifica se o horário atual é considerado horário de pico
+    Verifica se o horário atual (ou o informado) é considerado horário de pico
     """
-    agora = datetime.now().time()
-    
-    # Verificar se estamos no horário de pico da manhã ou da tarde
-    pico_manha = HORARIO_PICO_MANHA_INICIO <= agora <= HORARIO_PICO_MANHA_FIM
-    pico_tarde = HORARIO_PICO_TARDE_INICIO <= agora <= HORARIO_PICO_TARDE_FIM
-    
-    return pico_manha or pico_tarde
+    from .pricing import obter_motor_tarifas
+    return obter_motor_tarifas().is_horario_pico(timestamp)
 
 # Função para calcular o valor da corrida
-def calcular_valor_corrida(distancia_km, tempo_minutos):
+def calcular_valor_corrida(distancia_km, tempo_minutos, timestamp=None):
     """
     Calcula o valor da corrida baseado na distância e tempo
     """
     try:
-        # Converter para float se necessário
-        distancia_km = float(distancia_km)
-        tempo_minutos = float(tempo_minutos)
-        
-        # Valor fixo por quilômetro
-        valor_por_km = 2.10
-        
-        # Verificar se está no horário de pico
-        if is_horario_pico():
-            valor_por_km *= 1.4  # Aumento de 40% no horário de pico
-        
-        # Verificar se está no horário noturno (após as 20h)
-        agora = datetime.now().time()
-        if agora >= time(20, 0):
-            valor_por_km *= 1.6  # Aumento de 60% no horário noturno
-        
-        # Calcular valor total
-        valor_total = distancia_km * valor_por_km
-        
-        # Aplicar regras para corridas de até 5 km
-        if distancia_km <= 5:
-            valor_total = max(10.0, valor_total)  # Valor mínimo de R$ 10,00
-            valor_total = min(10.0, valor_total)  # Valor máximo de R$ 10,00
-        
-        # Arredondar para 2 casas decimais
-        return round(valor_total, 2)
+        from .pricing import obter_motor_tarifas
+        return obter_motor_tarifas().quote([distancia_km], [tempo_minutos], timestamp)[0]
     except Exception as e:
         logger.error(f"Erro ao calcular valor da corrida: {e}")
         # Retornar a tarifa mínima em caso de erro
-        return 10.0  # Valor mínimo para corridas de até 5 km
+        return TARIFA_MINIMA
 
 # Função auxiliar para serializar objetos Decimal para JSON
 def decimal_serializer(obj):
@@ -126,53 +111,14 @@ def decimal_serializer(obj):
 async def buscar_rota_openroute(start_lat, start_lng, end_lat, end_lng):
     """
     Função renomeada mas mantida para compatibilidade.
-    Agora usa diretamente a API OSRM para cálculo de rotas sem tentar OpenRoute
+    Usa a API OSRM através do provedor de rotas (circuit breaker, cache e
+    orçamento de latência) e cai no cálculo simplificado quando necessário.
     """
     # Logar apenas início da operação, sem repetir coordenadas detalhadas
     logger.info(f"Buscando rota: [{start_lat:.6f},{start_lng:.6f}] → [{end_lat:.6f},{end_lng:.6f}]")
     
-    # Usar diretamente a API OSRM que está funcionando
-    try:
-        # OSRM é um serviço alternativo e gratuito que funciona corretamente
-        logger.info("Usando API OSRM para rota")
-        url = f"http://router.project-osrm.org/route/v1/driving/{start_lng},{start_lat};{end_lng},{end_lat}"
-        params = {
-            "overview": "full",
-            "geometries": "geojson",
-            "steps": "true"
-        }
-        
-        try:
-            import aiohttp
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        logger.info("API OSRM: resposta recebida")
-                        return processar_resposta_osrm(data, logger)
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Erro na API OSRM: {response.status}")
-                        # Se falhar, vamos para o cálculo simplificado
-                        raise Exception(f"Erro na API OSRM: {response.status}")
-        except (ImportError, ModuleNotFoundError):
-            # Fallback para requests
-            logger.info("Fallback: usando requests para API OSRM")
-            import requests
-            response = requests.get(url, params=params, timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                logger.info("API OSRM (via requests): resposta recebida")
-                return processar_resposta_osrm(data, logger)
-            else:
-                logger.error(f"Erro na API OSRM (requests): {response.status_code}")
-                raise Exception(f"Erro na API OSRM: {response.status_code}")
-                
-    except Exception as e:
-        # Se todas as tentativas falharem, usar cálculo simplificado melhorado
-        logger.warning(f"Usando cálculo alternativo após falha na API OSRM: {str(e)}")
-        # Método simplificado como última opção
-        return calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
+    from .routing_services import obter_provedor_rotas
+    return await obter_provedor_rotas().buscar_rota(start_lat, start_lng, end_lat, end_lng)
 
 async def buscar_rota_alternativa(start_lat, start_lng, end_lat, end_lng, logger):
     """Usa uma API alternativa para calcular rotas quando a principal falha"""
@@ -231,6 +177,9 @@ def processar_resposta_osrm(data, logger):
             "distancia": distancia_km,
             "tempo_estimado": tempo_minutos,
             "valor": valor,
+            "polyline": codificar_polyline(
+                [c["latitude"] for c in coordinates], [c["longitude"] for c in coordinates]
+            ) if coordinates else "",
             "coordinates": coordinates
         }
     else:
@@ -280,16 +229,73 @@ def processar_resposta_openroute(data, logger):
     # Em caso de erro, retornar None para usar o fallback
     return None
 
+def _semente_rota(start_lat, start_lng, end_lat, end_lng):
+    """Semente determinística por par origem/destino (coordenadas arredondadas a ~1 m)"""
+    chave = f"{start_lat:.5f},{start_lng:.5f};{end_lat:.5f},{end_lng:.5f}".encode()
+    return int.from_bytes(hashlib.blake2b(chave, digest_size=8).digest(), 'big')
+
+def codificar_polyline(lats, lngs, precisao=5):
+    """
+    Codifica coordenadas no formato polyline do Google (o mesmo do OSRM com
+    `geometries=polyline`), muito mais compacto que uma lista de dicionários.
+    """
+    fator = 10 ** precisao
+    pontos = np.round(np.column_stack((lats, lngs)) * fator).astype(np.int64)
+    deltas = np.diff(pontos, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    valores = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    deslocamentos = 5 * np.arange(7, dtype=np.int64)
+    restante = valores[:, None] >> deslocamentos
+    # Cada valor usa blocos de 5 bits enquanto ainda houver bits a codificar
+    usados = np.zeros(restante.shape, dtype=bool)
+    usados[:, 0] = True
+    usados[:, 1:] = restante[:, 1:] > 0
+    continua = np.zeros(restante.shape, dtype=bool)
+    continua[:, :-1] = restante[:, 1:] > 0
+    codigos = ((restante & 0x1f) | (continua * 0x20)) + 63
+    return codigos[usados].astype(np.uint8).tobytes().decode('ascii')
+
+@lru_cache(maxsize=512)
+def gerar_geometria_simplificada(start_lat, start_lng, end_lat, end_lng, distancia_km):
+    """
+    Gera os pontos da rota simplificada de forma vetorizada.
+
+    Os pontos seguem a linha reta entre origem e destino com pequenas variações
+    para simular curvas. A variação usa uma semente derivada do par
+    origem/destino, então a mesma consulta sempre gera a mesma geometria.
+
+    Returns:
+        tuple: (coordinates, polyline), com coordinates em uma tupla de
+        {"latitude", "longitude"} montada uma vez por rota e compartilhada
+        pelas chamadas seguintes (não deve ser alterada)
+    """
+    # Número de pontos intermediários baseado na distância
+    num_pontos = max(10, int(distancia_km * 5))  # Pelo menos 10 pontos, ou 5 pontos por km
+    max_variacao = 0.0005  # Ajuste conforme necessário para simular curvas
+    semente = _semente_rota(start_lat, start_lng, end_lat, end_lng)
+
+    indices = np.arange(1, num_pontos + 1)
+    fracao = indices / (num_pontos + 1)
+    ruido = np.random.default_rng(semente).random((2, num_pontos)) - 0.5
+    angulos = np.radians(indices * 30)
+    lats = np.empty(num_pontos + 2)
+    lngs = np.empty(num_pontos + 2)
+    lats[0], lngs[0] = start_lat, start_lng
+    lats[-1], lngs[-1] = end_lat, end_lng
+    lats[1:-1] = start_lat + (end_lat - start_lat) * fracao + max_variacao * np.sin(angulos) * ruido[0]
+    lngs[1:-1] = start_lng + (end_lng - start_lng) * fracao + max_variacao * np.cos(angulos) * ruido[1]
+    # Lista de pontos mantida para as versões do app que ainda não decodificam polyline
+    coordinates = tuple(
+        {"latitude": lat, "longitude": lng} for lat, lng in zip(lats.tolist(), lngs.tolist())
+    )
+    return coordinates, codificar_polyline(lats, lngs)
+
 def calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng):
     """
     Calcula uma rota simplificada, mas com alguns pontos intermediários
     para simular melhor uma rota que segue ruas
     """
-    import logging
-    import random
-    from math import sin, cos, radians
-    
-    logger = logging.getLogger(__name__)
+    start_lat, start_lng = float(start_lat), float(start_lng)
+    end_lat, end_lng = float(end_lat), float(end_lng)
     
     # Calcular distância direta
     distancia_km = calcular_distancia(start_lat, start_lng, end_lat, end_lng)
@@ -300,36 +306,7 @@ def calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
     # Calcular valor
     valor = calcular_valor_corrida(distancia_km, tempo_estimado_min)
     
-    # Criar pontos intermediários para simular uma rota mais realista
-    coordinates = []
-    coordinates.append({"latitude": start_lat, "longitude": start_lng})
-    
-    # Número de pontos intermediários baseado na distância
-    num_pontos = max(10, int(distancia_km * 5))  # Pelo menos 10 pontos, ou 5 pontos por km
-    
-    # Calcular incrementos para distribuir os pontos
-    lat_inc = (end_lat - start_lat) / (num_pontos + 1)
-    lng_inc = (end_lng - start_lng) / (num_pontos + 1)
-    
-    # Adicionar variação para simular curvas da estrada
-    max_variacao = 0.0005  # Ajuste conforme necessário para simular curvas
-    
-    for i in range(1, num_pontos + 1):
-        # Calcular ponto base na linha reta
-        base_lat = start_lat + lat_inc * i
-        base_lng = start_lng + lng_inc * i
-        
-        # Adicionar variação para simular curvas
-        # Usando funções trigonométricas para criar padrões mais realistas
-        variacao_lat = max_variacao * sin(radians(i * 30)) * (random.random() - 0.5)
-        variacao_lng = max_variacao * cos(radians(i * 30)) * (random.random() - 0.5)
-        
-        coordinates.append({
-            "latitude": base_lat + variacao_lat,
-            "longitude": base_lng + variacao_lng
-        })
-    
-    coordinates.append({"latitude": end_lat, "longitude": end_lng})
+    coordinates, polyline = gerar_geometria_simplificada(start_lat, start_lng, end_lat, end_lng, distancia_km)
     
     logger.info(f"Rota calculada com método alternativo melhorado: {distancia_km:.2f}km, {tempo_estimado_min}min, {len(coordinates)} pontos")
     
@@ -338,6 +315,7 @@ def calcular_rota_simplificada_melhorada(start_lat, start_lng, end_lat, end_lng)
         "distancia": distancia_km,
         "tempo_estimado": tempo_estimado_min,
         "valor": valor,
+        "polyline": polyline,
         "coordinates": coordinates
     }
 
@@ -393,7 +371,8 @@ def enviar_notificacao_push(
     dados: Optional[Dict[str, Any]] = None
 ) -> bool:
     """
-    Envia uma notificação push utilizando a API do Expo
+    Envia uma notificação push utilizando a API do Expo (síncrono).
+    Em código assíncrono grave no outbox com movex.database_services.registrar_notificacao_push.
     
     Args:
         token: Token do dispositivo (Expo Push Token)
@@ -404,36 +383,21 @@ def enviar_notificacao_push(
     Returns:
         bool: True se foi enviada com sucesso, False caso contrário
     """
-    if not token or not token.startswith('ExponentPushToken['):
+    if not token_push_valido(token):
         logger.error(f"Token inválido para notificação push: {token}")
         return False
         
     try:
-        headers = {
-            'Accept': 'application/json',
-            'Accept-encoding': 'gzip, deflate',
-            'Content-Type': 'application/json',
-        }
-        
-        payload = {
-            'to': token,
-            'sound': 'default',
-            'title': titulo,
-            'body': mensagem,
-            'priority': 'high',
-        }
-        
-        # Adiciona dados extras se fornecidos
-        if dados:
-            payload['data'] = dados
+        payload = montar_mensagem_push(token, titulo, mensagem, dados)
             
         logger.debug(f"Enviando notificação push para token: {token}")
         logger.debug(f"Payload: {json.dumps(payload)}")
         
         response = requests.post(
-            'https://exp.host/--/api/v2/push/send',
-            headers=headers,
-            json=payload
+            EXPO_PUSH_URL,
+            headers=CABECALHOS_EXPO,
+            json=payload,
+            timeout=10
         )
         
         logger.debug(f"Resposta do servidor Expo: {response.status_code} - {response.text}")
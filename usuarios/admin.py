@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.utils.html import format_html
-from .models import Usuario, Passageiro, Motorista, PushToken
+from .models import Usuario, Passageiro, Motorista, PushToken, NotificacaoPush
 from corridas.models import Corrida
 
 class CustomAdminSite(admin.AdminSite):
@@ -65,6 +65,11 @@ class MotoristaAdmin(admin.ModelAdmin):
         return obj.usuario.get_full_name()
     get_nome.short_description = 'Nome Completo'
 
+class NotificacaoPushAdmin(admin.ModelAdmin):
+    list_display = ('evento', 'usuario', 'corrida_id', 'status', 'tentativas', 'proxima_tentativa', 'enviado_em')
+    search_fields = ('usuario__cpf', 'evento', 'corrida_id')
+    list_filter = ('status',)
+
 class CorridaAdmin(admin.ModelAdmin):
     list_display = ('id', 'get_passageiro', 'get_motorista', 'status', 'valor', 'data_solicitacao', 'data_fim')
     search_fields = ('id', 'passageiro__usuario__nome', 'motorista__usuario__nome', 'origem_descricao', 'destino_descricao')
@@ -94,3 +99,4 @@ admin.site.register(Usuario, UsuarioAdmin)
 admin.site.register(Motorista, MotoristaAdmin)
 admin.site.register(Passageiro, PassageiroAdmin)
 admin.site.register(PushToken)  # Registrando o novo modelo PushToken
+admin.site.register(NotificacaoPush, NotificacaoPushAdmin)
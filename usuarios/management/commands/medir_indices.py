@@ -0,0 +1,165 @@
+import os
+import random
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.utils import timezone
+
+from corridas.models import Corrida
+from usuarios.models import Motorista, Passageiro, Usuario
+
+ALIAS = 'medicao_indices'
+
+# Índices da migração dos filtros mais frequentes (corridas 0006, usuarios 0007)
+INDICES = {
+    Corrida: ['corrida_motorista_status_idx', 'corrida_passageiro_status_idx', 'corrida_pendente_idx'],
+    Motorista: ['motorista_disponivel_idx'],
+}
+
+# Distribuição dos status de um histórico de corridas: quase todas encerradas
+STATUS_HISTORICO = [('FINALIZADA', 0.90), ('CANCELADA', 0.08), ('PENDENTE', 0.005),
+                    ('ACEITA', 0.005), ('MOTORISTA_CHEGOU', 0.005), ('EM_ANDAMENTO', 0.005)]
+
+
+class Command(BaseCommand):
+    help = ('Cria um banco SQLite separado com um histórico de corridas e compara os planos e tempos '
+            'das consultas mais frequentes sem e com os índices compostos e parciais')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--arquivo', default='medicao_indices.sqlite3',
+                            help='Banco SQLite da medição (reaproveitado se já tiver corridas)')
+        parser.add_argument('--corridas', type=int, default=1_000_000)
+        parser.add_argument('--motoristas', type=int, default=5_000)
+        parser.add_argument('--passageiros', type=int, default=100_000)
+        parser.add_argument('--repeticoes', type=int, default=50,
+                            help='Execuções de cada consulta por medição')
+        parser.add_argument('--semente', type=int, default=42)
+
+    def handle(self, *args, **options):
+        arquivo = os.path.abspath(options['arquivo'])
+        connections.settings[ALIAS] = dict(
+            connections.settings['default'], ENGINE='django.db.backends.sqlite3', NAME=arquivo
+        )
+        call_command('migrate', database=ALIAS, verbosity=0)
+
+        aleatorio = random.Random(options['semente'])
+        if not Corrida.objects.using(ALIAS).exists():
+            self.popular(aleatorio, options['corridas'], options['motoristas'], options['passageiros'])
+        else:
+            self.stdout.write(f'Reaproveitando {Corrida.objects.using(ALIAS).count()} corridas de {arquivo}')
+
+        consultas = self.consultas(aleatorio)
+        resultados = {}
+        for fase, indices in (('sem índices', False), ('com índices', True)):
+            self.alternar_indices(indices)
+            self.stdout.write(self.style.MIGRATE_HEADING(f'== {fase} =='))
+            for nome, queryset in consultas:
+                plano = self.plano(queryset)
+                resultados.setdefault(nome, []).append(self.medir(queryset, options['repeticoes']))
+                self.stdout.write(f'{nome}: {resultados[nome][-1]:.3f} ms')
+                for linha in plano:
+                    self.stdout.write(f'    {linha}')
+
+        self.stdout.write(self.style.MIGRATE_HEADING('== mediana por consulta (ms) =='))
+        for nome, (antes, depois) in resultados.items():
+            self.stdout.write(f'{nome:<28} {antes:10.3f} -> {depois:8.3f}  ({antes / max(depois, 1e-6):.0f}x)')
+
+    def popular(self, aleatorio, total_corridas, total_motoristas, total_passageiros):
+        self.stdout.write(
+            f'Populando {total_corridas} corridas, {total_motoristas} motoristas e {total_passageiros} passageiros...'
+        )
+        inicio = time.perf_counter()
+        agora = timezone.now()
+        with transaction.atomic(using=ALIAS):
+            Usuario.objects.using(ALIAS).bulk_create([
+                Usuario(
+                    cpf=f'{indice:011d}', nome='Medição', sobrenome=str(indice), email=f'{indice}@medicao.invalid',
+                    telefone='0', password='!', tipo_usuario='MOTORISTA' if indice < total_motoristas else 'PASSAGEIRO'
+                )
+                for indice in range(total_motoristas + total_passageiros)
+            ], batch_size=5000)
+            usuarios = list(Usuario.objects.using(ALIAS).filter(email__endswith='@medicao.invalid').order_by('cpf'))
+
+            motoristas = Motorista.objects.using(ALIAS).bulk_create([
+                Motorista(
+                    usuario=usuario, cpf=usuario.cpf, cnh=usuario.cpf, categoria_cnh='B', modelo_veiculo='Modelo',
+                    ano_veiculo=2020, placa_veiculo='AAA0A00', cor_veiculo='Preto',
+                    status=aleatorio.choice(['DISPONIVEL', 'OCUPADO', 'OFFLINE', 'OFFLINE']),
+                    esta_disponivel=aleatorio.random() < 0.2,
+                    ultima_latitude=Decimal('-30.03'), ultima_longitude=Decimal('-51.23')
+                )
+                for usuario in usuarios[:total_motoristas]
+            ], batch_size=5000)
+            passageiros = Passageiro.objects.using(ALIAS).bulk_create(
+                [Passageiro(usuario=usuario) for usuario in usuarios[total_motoristas:]], batch_size=5000
+            )
+
+            status, pesos = zip(*STATUS_HISTORICO)
+            lote = 10_000
+            for inicio_lote in range(0, total_corridas, lote):
+                Corrida.objects.using(ALIAS).bulk_create([
+                    Corrida(
+                        passageiro=aleatorio.choice(passageiros),
+                        motorista=None if situacao == 'PENDENTE' else aleatorio.choice(motoristas),
+                        status=situacao,
+                        data_solicitacao=agora - timedelta(minutes=aleatorio.randrange(525_600)),
+                        origem_lat=Decimal('-30.03'), origem_lng=Decimal('-51.23'),
+                        destino_lat=Decimal('-30.05'), destino_lng=Decimal('-51.20'),
+                    )
+                    for situacao in aleatorio.choices(status, pesos, k=min(lote, total_corridas - inicio_lote))
+                ])
+        self.stdout.write(f'Populado em {time.perf_counter() - inicio:.0f} s')
+
+    def consultas(self, aleatorio):
+        """As consultas de database_services cobertas pelos índices, para um motorista e um passageiro ao acaso."""
+        motorista_cpf = aleatorio.choice(list(Motorista.objects.using(ALIAS).values_list('cpf', flat=True)[:1000]))
+        passageiro_pk = Corrida.objects.using(ALIAS).values_list('passageiro_id', flat=True)[aleatorio.randrange(1000)]
+        corridas = Corrida.objects.using(ALIAS)
+        return [
+            ('motoristas_disponiveis', Motorista.objects.using(ALIAS).filter(
+                esta_disponivel=True, status='DISPONIVEL').values_list('cpf', 'ultima_latitude', 'ultima_longitude')),
+            ('corrida_ativa_motorista', corridas.filter(
+                motorista_id=motorista_cpf, status__in=['ACEITA', 'EM_ANDAMENTO']).values('id', 'status')[:1]),
+            ('corrida_ativa_passageiro', corridas.filter(
+                passageiro_id=passageiro_pk, status__in=['PENDENTE', 'ACEITA', 'MOTORISTA_CHEGOU', 'EM_ANDAMENTO']
+            ).order_by('-data_aceite').values('id', 'status')[:1]),
+            ('corridas_pendentes', corridas.filter(status='PENDENTE').order_by('data_solicitacao').values('id')[:100]),
+        ]
+
+    def alternar_indices(self, criar):
+        """Remove (fase "antes") ou recria (fase "depois") os índices da migração no banco da medição."""
+        conexao = connections[ALIAS]
+        with conexao.cursor() as cursor:
+            existentes = {
+                nome for modelo in INDICES
+                for nome in conexao.introspection.get_constraints(cursor, modelo._meta.db_table)
+            }
+        with conexao.schema_editor() as editor:
+            for modelo, nomes in INDICES.items():
+                for indice in modelo._meta.indexes:
+                    if indice.name not in nomes:
+                        continue
+                    if criar and indice.name not in existentes:
+                        editor.add_index(modelo, indice)
+                    elif not criar and indice.name in existentes:
+                        editor.remove_index(modelo, indice)
+
+    def plano(self, queryset):
+        sql, parametros = queryset.query.get_compiler(using=ALIAS).as_sql()
+        with connections[ALIAS].cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', parametros)
+            return [linha[-1] for linha in cursor.fetchall()]
+
+    def medir(self, queryset, repeticoes):
+        duracoes = []
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            list(queryset.all())
+            duracoes.append(time.perf_counter() - inicio)
+        return statistics.median(duracoes) * 1000
+
@@ -0,0 +1,119 @@
+import asyncio
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from corridas.models import Corrida, MensagemChat
+from movex.database_services import (
+    atualizar_localizacao_motorista,
+    atualizar_localizacao_motorista_async,
+    atualizar_status_motorista,
+    atualizar_status_motorista_async,
+    obter_corrida_em_andamento,
+    obter_corrida_em_andamento_async,
+    obter_mensagens_chat,
+    obter_mensagens_chat_async,
+)
+from movex.db_executor import executar_no_banco
+from usuarios.models import Motorista, Passageiro, Usuario
+
+CPF_MOTORISTA = '99900000001'
+CPF_PASSAGEIRO = '99900000002'
+
+
+def _localizacao_executor(cpf, contexto):
+    # Caminho anterior do evento atualizar_localizacao: uma unidade de trabalho no executor do banco
+    atualizar_localizacao_motorista(cpf, -30.03, -51.23, contexto=contexto)
+    return obter_corrida_em_andamento(cpf, contexto=contexto)
+
+
+async def _localizacao_async(cpf, contexto):
+    await atualizar_localizacao_motorista_async(cpf, -30.03, -51.23, contexto=contexto)
+    return await obter_corrida_em_andamento_async(cpf, contexto=contexto)
+
+
+class Command(BaseCommand):
+    help = ('Compara a latência das consultas mais frequentes do MoveXConsumer pelo executor do banco '
+            '(executar_no_banco) e pelo ORM assíncrono, com dados temporários')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iteracoes', type=int, default=500,
+                            help='Operações por caminho e por consulta')
+        parser.add_argument('--concorrencia', type=int, default=10,
+                            help='Operações simultâneas (conexões concorrentes)')
+        parser.add_argument('--mensagens', type=int, default=20,
+                            help='Mensagens de chat na corrida de teste')
+
+    def handle(self, *args, **options):
+        corrida, contexto = self.criar_dados(options['mensagens'])
+        try:
+            casos = [
+                ('status', lambda: executar_no_banco(atualizar_status_motorista, CPF_MOTORISTA, 'DISPONIVEL', True),
+                 lambda: atualizar_status_motorista_async(CPF_MOTORISTA, 'DISPONIVEL', True)),
+                ('localizacao', lambda: executar_no_banco(_localizacao_executor, CPF_MOTORISTA, contexto),
+                 lambda: _localizacao_async(CPF_MOTORISTA, contexto)),
+                ('corrida_ativa', lambda: executar_no_banco(obter_corrida_em_andamento, CPF_MOTORISTA, contexto=contexto),
+                 lambda: obter_corrida_em_andamento_async(CPF_MOTORISTA, contexto=contexto)),
+                ('historico_chat', lambda: executar_no_banco(obter_mensagens_chat, corrida.id, transacao=False),
+                 lambda: obter_mensagens_chat_async(corrida.id, cpf=CPF_PASSAGEIRO)),
+            ]
+            for nome, executor, assincrono in casos:
+                for caminho, operacao in (('executor', executor), ('async', assincrono)):
+                    resultado = asyncio.run(self.medir(operacao, options['iteracoes'], options['concorrencia']))
+                    self.stdout.write(
+                        f"{nome:<15} {caminho:<9} média {resultado['media_ms']:7.2f} ms  "
+                        f"p50 {resultado['p50_ms']:7.2f} ms  p95 {resultado['p95_ms']:7.2f} ms  "
+                        f"{resultado['ops_s']:8.0f} ops/s"
+                    )
+        finally:
+            Usuario.objects.filter(cpf__in=[CPF_MOTORISTA, CPF_PASSAGEIRO]).delete()
+
+    def criar_dados(self, quantidade_mensagens):
+        Usuario.objects.filter(cpf__in=[CPF_MOTORISTA, CPF_PASSAGEIRO]).delete()
+        usuario_motorista = Usuario.objects.create_user(
+            cpf=CPF_MOTORISTA, password=None, nome='Benchmark', sobrenome='Motorista',
+            email='benchmark.motorista@movex.invalid', telefone='00000000001', tipo_usuario='MOTORISTA'
+        )
+        motorista = Motorista.objects.create(
+            usuario=usuario_motorista, cnh='99900000001', categoria_cnh='B', modelo_veiculo='Benchmark',
+            ano_veiculo=2020, placa_veiculo='BEN0C00', cor_veiculo='Preto'
+        )
+        usuario_passageiro = Usuario.objects.create_user(
+            cpf=CPF_PASSAGEIRO, password=None, nome='Benchmark', sobrenome='Passageiro',
+            email='benchmark.passageiro@movex.invalid', telefone='00000000002'
+        )
+        corrida = Corrida.objects.create(
+            passageiro=Passageiro.objects.create(usuario=usuario_passageiro), motorista=motorista, status='ACEITA',
+            origem_lat=-30.03, origem_lng=-51.23, destino_lat=-30.05, destino_lng=-51.20
+        )
+        MensagemChat.objects.bulk_create([
+            MensagemChat(corrida=corrida, tipo_remetente='PASSAGEIRO', conteudo=f'Mensagem {i}')
+            for i in range(quantidade_mensagens)
+        ])
+        contexto = {'cpf': CPF_MOTORISTA, 'tipo': 'MOTORISTA', 'motorista_pk': motorista.pk}
+        return corrida, contexto
+
+    async def medir(self, operacao, iteracoes, concorrencia):
+        duracoes = []
+
+        async def trabalhador(quantidade):
+            for _ in range(quantidade):
+                inicio = time.perf_counter()
+                await operacao()
+                duracoes.append(time.perf_counter() - inicio)
+
+        por_trabalhador, resto = divmod(iteracoes, concorrencia)
+        inicio = time.perf_counter()
+        await asyncio.gather(*(
+            trabalhador(por_trabalhador + (1 if indice < resto else 0)) for indice in range(concorrencia)
+        ))
+        total = time.perf_counter() - inicio
+
+        duracoes.sort()
+        return {
+            'media_ms': statistics.fmean(duracoes) * 1000,
+            'p50_ms': duracoes[len(duracoes) // 2] * 1000,
+            'p95_ms': duracoes[min(len(duracoes) - 1, int(len(duracoes) * 0.95))] * 1000,
+            'ops_s': len(duracoes) / total,
+        }
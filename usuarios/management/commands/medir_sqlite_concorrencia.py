@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from corridas.models import Corrida
+from movex.database_services import (
+    atualizar_localizacao_motorista,
+    atualizar_status_motorista,
+    comando_mensagem_chat,
+    obter_corrida_em_andamento,
+)
+from movex.db_executor import executar_no_banco, obter_escritor_banco
+from usuarios.models import Motorista, Passageiro, Usuario
+
+# fase -> (PRAGMAs do modo de desempenho, escritor único)
+FASES = {
+    'padrao': (False, False),
+    'pragmas': (True, False),
+    'desempenho': (True, True),
+}
+
+# Mistura de operações do MoveXConsumer sob carga: (operação, peso)
+OPERACOES = [('localizacao', 50), ('status', 15), ('chat', 15), ('corrida_ativa', 20)]
+
+
+class Command(BaseCommand):
+    help = ('Mede vazão, latência e erros (database is locked) de escritas e leituras concorrentes no SQLite: '
+            'configuração padrão, só com os PRAGMAs do modo de desempenho e com os PRAGMAs e o escritor único')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operacoes', type=int, default=5000)
+        parser.add_argument('--concorrencia', type=int, default=100,
+                            help='Operações simultâneas (clientes WebSocket ativos)')
+        parser.add_argument('--motoristas', type=int, default=50)
+        parser.add_argument('--fase', choices=sorted(FASES),
+                            help='Mede só esta fase, no banco de --arquivo (uso interno, um processo por fase)')
+        parser.add_argument('--arquivo')
+
+    def handle(self, *args, **options):
+        if options['fase']:
+            resultado = self.medir_fase(options)
+            self.stdout.write(json.dumps(resultado))
+            return
+
+        resultados = {}
+        with tempfile.TemporaryDirectory() as diretorio:
+            for fase in FASES:
+                # Cada fase em um processo novo: conexões, executor e escritor começam do zero
+                processo = subprocess.run(
+                    [sys.executable, sys.argv[0], 'medir_sqlite_concorrencia', '--fase', fase,
+                     '--arquivo', os.path.join(diretorio, f'{fase}.sqlite3'),
+                     '--operacoes', str(options['operacoes']), '--concorrencia', str(options['concorrencia']),
+                     '--motoristas', str(options['motoristas'])],
+                    capture_output=True, text=True
+                )
+                linhas = [linha for linha in processo.stdout.splitlines() if linha.startswith('{')]
+                if processo.returncode or not linhas:
+                    raise CommandError(f'Fase {fase} falhou:\n{processo.stderr[-2000:]}')
+                resultados[fase] = json.loads(linhas[-1])
+
+        self.stdout.write(f"{'fase':<12} {'ops/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'erros':>6}  lotes")
+        for fase, resultado in resultados.items():
+            self.stdout.write(
+                f"{fase:<12} {resultado['ops_s']:8.0f} {resultado['p50_ms']:8.2f} {resultado['p95_ms']:8.2f} "
+                f"{resultado['p99_ms']:8.2f} {resultado['erros']:6d}  {resultado.get('lotes') or '-'}"
+            )
+
+    def medir_fase(self, options):
+        pragmas, escritor = FASES[options['fase']]
+        conexao = connections['default']
+        conexao.close()
+        # Mesmo dicionário usado pelas conexões das outras threads (executor e escritor)
+        conexao.settings_dict.update(
+            NAME=options['arquivo'],
+            OPTIONS={'init_command': ';'.join(settings.SQLITE_PRAGMAS)} if pragmas else {},
+        )
+        settings.BANCO_ESCRITOR_UNICO = escritor
+        call_command('migrate', verbosity=0)
+        motoristas, corridas = self.criar_dados(options['motoristas'])
+
+        aleatorio = random.Random(42)
+        nomes, pesos = zip(*OPERACOES)
+        plano = [
+            (nome, aleatorio.randrange(len(motoristas)))
+            for nome in aleatorio.choices(nomes, pesos, k=options['operacoes'])
+        ]
+        return asyncio.run(self.executar(plano, motoristas, corridas, options['concorrencia']))
+
+    def criar_dados(self, quantidade):
+        usuarios = Usuario.objects.bulk_create([
+            Usuario(cpf=f'{indice:011d}', nome='Carga', sobrenome=str(indice), email=f'{indice}@carga.invalid',
+                    telefone='0', password='!', tipo_usuario='MOTORISTA' if indice < quantidade else 'PASSAGEIRO')
+            for indice in range(2 * quantidade)
+        ])
+        motoristas = Motorista.objects.bulk_create([
+            Motorista(usuario=usuario, cpf=usuario.cpf, cnh=usuario.cpf, categoria_cnh='B', modelo_veiculo='Modelo',
+                      ano_veiculo=2020, placa_veiculo='AAA0A00', cor_veiculo='Preto', status='OCUPADO')
+            for usuario in usuarios[:quantidade]
+        ])
+        passageiros = Passageiro.objects.bulk_create([Passageiro(usuario=usuario) for usuario in usuarios[quantidade:]])
+        corridas = Corrida.objects.bulk_create([
+            Corrida(passageiro=passageiro, motorista=motorista, status='ACEITA', origem_lat=-30.03, origem_lng=-51.23,
+                    destino_lat=-30.05, destino_lng=-51.20)
+            for motorista, passageiro in zip(motoristas, passageiros)
+        ])
+        return [motorista.cpf for motorista in motoristas], [corrida.id for corrida in corridas]
+
+    async def executar(self, plano, motoristas, corridas, concorrencia):
+        # Os mesmos caminhos dos handlers: unidades de escrita com escrita=True (executor do banco
+        # ou escritor único) e leituras pelo executor do banco
+        operacoes = {
+            'localizacao': lambda i: executar_no_banco(
+                atualizar_localizacao_motorista, motoristas[i], -30.03, -51.23, escrita=True),
+            'status': lambda i: executar_no_banco(atualizar_status_motorista, motoristas[i], 'OCUPADO', False, escrita=True),
+            'chat': lambda i: executar_no_banco(comando_mensagem_chat, corridas[i], 'MOTORISTA', 'Chegando', escrita=True),
+            'corrida_ativa': lambda i: executar_no_banco(obter_corrida_em_andamento, motoristas[i], transacao=False),
+        }
+        duracoes = []
+        erros = 0
+        fila = iter(plano)
+
+        async def cliente():
+            nonlocal erros
+            for nome, indice in fila:
+                inicio = time.perf_counter()
+                try:
+                    # As funções do banco registram o erro e retornam False/None
+                    if not await operacoes[nome](indice):
+                        erros += 1
+                except Exception:
+                    erros += 1
+                duracoes.append(time.perf_counter() - inicio)
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(cliente() for _ in range(concorrencia)))
+        total = time.perf_counter() - inicio
+
+        escritor = obter_escritor_banco()
+        duracoes.sort()
+
+        def percentil(p):
+            return duracoes[min(len(duracoes) - 1, int(len(duracoes) * p))] * 1000
+
+        return {
+            'ops_s': len(duracoes) / total,
+            'p50_ms': statistics.median(duracoes) * 1000,
+            'p95_ms': percentil(0.95),
+            'p99_ms': percentil(0.99),
+            'erros': erros,
+            'lotes': f'{escritor.lotes} ({escritor.operacoes / max(escritor.lotes, 1):.1f} escritas/lote)' if escritor else None,
+        }
@@ -0,0 +1,36 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from movex.push_services import EXPO_TAMANHO_MAXIMO_LOTE, DespachantePush, executar_outbox
+
+
+class Command(BaseCommand):
+    help = ('Envia as notificações push pendentes do outbox em lotes, com novas tentativas e backoff, '
+            'e confere os recibos do Expo para desativar tokens de dispositivos removidos')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--intervalo', type=float, default=1.0,
+                            help='Segundos de espera quando a fila está vazia')
+        parser.add_argument('--lote', type=int, default=EXPO_TAMANHO_MAXIMO_LOTE,
+                            help='Notificações por requisição ao Expo (máximo 100)')
+        parser.add_argument('--intervalo-recibos', type=float, default=300.0,
+                            help='Segundos entre as conferências de recibos')
+        parser.add_argument('--uma-vez', action='store_true',
+                            help='Processa o que estiver pendente e encerra')
+
+    def handle(self, *args, **options):
+        try:
+            total = asyncio.run(self.executar(
+                options['intervalo'], options['lote'], options['intervalo_recibos'], options['uma_vez']
+            ))
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(self.style.SUCCESS(f'{total} notificações processadas'))
+
+    async def executar(self, intervalo, lote, intervalo_recibos, uma_vez):
+        despachante = DespachantePush()
+        try:
+            return await executar_outbox(despachante, intervalo, lote, intervalo_recibos, uma_vez)
+        finally:
+            await despachante.fechar()
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from corridas.models import Corrida
+from usuarios.models import Motorista, Passageiro, media_avaliacoes
+
+# (modelo, FK de Corrida para o modelo, nota recebida pelo modelo)
+AVALIADOS = (
+    (Motorista, 'motorista', 'avaliacao_motorista'),
+    (Passageiro, 'passageiro', 'avaliacao_passageiro'),
+)
+
+
+def agregados_das_corridas(campo_fk, campo_nota):
+    """Soma e quantidade das notas de cada avaliado, como subconsultas correlacionadas sobre Corrida."""
+    notas = Corrida.objects.filter(
+        **{campo_fk: OuterRef('pk'), f'{campo_nota}__isnull': False}
+    ).order_by().values(campo_fk)
+    return {
+        'soma_avaliacoes': Coalesce(Subquery(notas.annotate(soma=Sum(campo_nota)).values('soma')), 0),
+        'total_avaliacoes': Coalesce(Subquery(notas.annotate(total=Count('pk')).values('total')), 0),
+    }
+
+
+class Command(BaseCommand):
+    help = ('Recalcula a partir das corridas a soma, a quantidade e a média das avaliações '
+            'de motoristas e passageiros (reparo dos agregados mantidos por avaliar_motorista/avaliar_passageiro)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verificar', action='store_true',
+                            help='Só lista os agregados divergentes, sem gravar')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            for modelo, campo_fk, campo_nota in AVALIADOS:
+                agregados = agregados_das_corridas(campo_fk, campo_nota)
+                divergentes = list(
+                    modelo.objects.annotate(soma_real=agregados['soma_avaliacoes'], total_real=agregados['total_avaliacoes'])
+                    .exclude(soma_avaliacoes=F('soma_real'), total_avaliacoes=F('total_real'))
+                    .values_list('pk', 'soma_avaliacoes', 'total_avaliacoes', 'soma_real', 'total_real')
+                )
+                nome = modelo._meta.verbose_name_plural.lower()
+                self.stdout.write(f'{nome}: {len(divergentes)} com agregados divergentes')
+                for pk, soma, total, soma_real, total_real in divergentes:
+                    self.stdout.write(f'  {pk}: {soma}/{total} -> {soma_real}/{total_real}')
+
+                if options['verificar'] or not divergentes:
+                    continue
+                modelo.objects.bulk_update([
+                    modelo(pk=pk, soma_avaliacoes=soma_real, total_avaliacoes=total_real,
+                           avaliacao_media=media_avaliacoes(soma_real, total_real))
+                    for pk, _, _, soma_real, total_real in divergentes
+                ], ['soma_avaliacoes', 'total_avaliacoes', 'avaliacao_media'], batch_size=500)
+                self.stdout.write(self.style.SUCCESS(f'{nome}: {len(divergentes)} agregados recalculados'))
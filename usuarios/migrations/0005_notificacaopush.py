@@ -0,0 +1,40 @@
+# Generated by Django 5.1.7 on 2026-10-19 15:34
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0004_alter_motorista_foto_perfil_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificacaoPush',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('evento', models.CharField(max_length=100)),
+                ('corrida_id', models.CharField(blank=True, default='', max_length=36)),
+                ('titulo', models.CharField(max_length=255)),
+                ('mensagem', models.TextField()),
+                ('dados', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('PENDENTE', 'Pendente'), ('ENVIADA', 'Enviada'), ('FALHOU', 'Falhou')], default='PENDENTE', max_length=20)),
+                ('tentativas', models.PositiveIntegerField(default=0)),
+                ('proxima_tentativa', models.DateTimeField(default=django.utils.timezone.now)),
+                ('ultimo_erro', models.TextField(blank=True, default='')),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('enviado_em', models.DateTimeField(blank=True, null=True)),
+                ('usuario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notificacoes_push', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Notificação Push',
+                'verbose_name_plural': 'Notificações Push',
+                'indexes': [models.Index(fields=['status', 'proxima_tentativa'], name='notificacao_push_fila_idx')],
+                'constraints': [models.UniqueConstraint(fields=('usuario', 'evento', 'corrida_id'), name='notificacao_push_unica')],
+            },
+        ),
+    ]
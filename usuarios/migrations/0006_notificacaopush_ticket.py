@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-19 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0005_notificacaopush'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificacaopush',
+            name='ticket_id',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='notificacaopush',
+            name='token_enviado',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-19 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0006_notificacaopush_ticket'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='motorista',
+            index=models.Index(condition=models.Q(('esta_disponivel', True)), fields=['status'], name='motorista_disponivel_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.1.7 on 2026-10-19 16:20
+
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def preencher_agregados(apps, schema_editor):
+    # Mesmo cálculo do comando recalcular_avaliacoes, com os modelos históricos;
+    # a média é calculada em Python (ROUND sobre float não existe no PostgreSQL)
+    Corrida = apps.get_model('corridas', 'Corrida')
+    for modelo, campo_fk, campo_nota in (
+        (apps.get_model('usuarios', 'Motorista'), 'motorista', 'avaliacao_motorista'),
+        (apps.get_model('usuarios', 'Passageiro'), 'passageiro', 'avaliacao_passageiro'),
+    ):
+        notas = Corrida.objects.filter(
+            **{campo_fk: OuterRef('pk'), f'{campo_nota}__isnull': False}
+        ).order_by().values(campo_fk)
+        modelo.objects.update(
+            soma_avaliacoes=Coalesce(Subquery(notas.annotate(soma=Sum(campo_nota)).values('soma')), 0),
+            total_avaliacoes=Coalesce(Subquery(notas.annotate(total=Count('pk')).values('total')), 0),
+        )
+        modelo.objects.bulk_update([
+            modelo(pk=pk, avaliacao_media=(Decimal(soma) / total).quantize(Decimal('0.1'), rounding=ROUND_HALF_UP))
+            for pk, soma, total in modelo.objects.filter(total_avaliacoes__gt=0).values_list(
+                'pk', 'soma_avaliacoes', 'total_avaliacoes'
+            ).iterator()
+        ], ['avaliacao_media'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corridas', '0006_corrida_corrida_motorista_status_idx_and_more'),
+        ('usuarios', '0007_motorista_motorista_disponivel_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='motorista',
+            name='soma_avaliacoes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='motorista',
+            name='total_avaliacoes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='passageiro',
+            name='soma_avaliacoes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='passageiro',
+            name='total_avaliacoes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(preencher_agregados, migrations.RunPython.noop),
+    ]
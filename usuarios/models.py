@@ -1,7 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.utils import timezone
-from decimal import Decimal
+from decimal import ROUND_HALF_UP, Decimal
 
 class UsuarioManager(BaseUserManager):
     def create_user(self, cpf, password=None, **extra_fields):
@@ -74,10 +74,19 @@ class Usuario(AbstractBaseUser, PermissionsMixin):
         verbose_name = 'Usuário'
         verbose_name_plural = 'Usuários'
 
+def media_avaliacoes(soma, total):
+    """Média das notas com uma casa decimal (soma_avaliacoes / total_avaliacoes), 0.0 sem notas."""
+    if not total:
+        return Decimal('0.0')
+    return (Decimal(soma) / total).quantize(Decimal('0.1'), rounding=ROUND_HALF_UP)
+
 class Passageiro(models.Model):
     usuario = models.OneToOneField(Usuario, on_delete=models.CASCADE, primary_key=True)
     foto_perfil = models.ImageField(upload_to='passageiros/', null=True, blank=True)
     avaliacao_media = models.DecimalField(max_digits=3, decimal_places=1, default=Decimal('0.0'))
+    # Agregados das notas recebidas: a média é atualizada sem reler as corridas
+    soma_avaliacoes = models.PositiveIntegerField(default=0)
+    total_avaliacoes = models.PositiveIntegerField(default=0)
     endereco = models.CharField(max_length=255, blank=True, null=True)  # Adicionando o campo endereco
     
     def __str__(self):
@@ -102,6 +111,9 @@ class Motorista(models.Model):
     categoria_cnh = models.CharField(max_length=5)
     foto_perfil = models.ImageField(upload_to='motoristas/', null=True, blank=True)
     avaliacao_media = models.DecimalField(max_digits=3, decimal_places=1, default=Decimal('0.0'))
+    # Agregados das notas recebidas: a média é atualizada sem reler as corridas
+    soma_avaliacoes = models.PositiveIntegerField(default=0)
+    total_avaliacoes = models.PositiveIntegerField(default=0)
     
     # Dados do veículo
     modelo_veiculo = models.CharField(max_length=100)
@@ -128,6 +140,11 @@ class Motorista(models.Model):
     class Meta:
         verbose_name = 'Motorista'
         verbose_name_plural = 'Motoristas'
+        indexes = [
+            # Busca de motoristas disponíveis (esta_disponivel=True, status='DISPONIVEL'). No SQLite o
+            # filtro booleano vira só a coluna no WHERE, por isso a condição do índice e não uma coluna dele
+            models.Index(fields=['status'], condition=models.Q(esta_disponivel=True), name='motorista_disponivel_idx'),
+        ]
 
 class PushToken(models.Model):
     """Modelo para armazenar tokens de notificação push dos usuários"""
@@ -143,4 +160,45 @@ class PushToken(models.Model):
     
     class Meta:
         verbose_name = 'Token Push'
-        verbose_name_plural = 'Tokens Push'
\ No newline at end of file
+        verbose_name_plural = 'Tokens Push'
+
+class NotificacaoPush(models.Model):
+    """
+    Outbox de notificações push. Os handlers apenas gravam a notificação; o
+    comando `processar_notificacoes_push` envia em lotes, com novas tentativas.
+    """
+    STATUS_CHOICES = [
+        ('PENDENTE', 'Pendente'),
+        ('ENVIADA', 'Enviada'),
+        ('FALHOU', 'Falhou'),
+    ]
+
+    usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE, related_name='notificacoes_push')
+    evento = models.CharField(max_length=100)
+    corrida_id = models.CharField(max_length=36, blank=True, default='')
+    titulo = models.CharField(max_length=255)
+    mensagem = models.TextField()
+    dados = models.JSONField(default=dict, blank=True)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDENTE')
+    tentativas = models.PositiveIntegerField(default=0)
+    proxima_tentativa = models.DateTimeField(default=timezone.now)
+    ultimo_erro = models.TextField(blank=True, default='')
+    criado_em = models.DateTimeField(auto_now_add=True)
+    enviado_em = models.DateTimeField(null=True, blank=True)
+    # Ticket devolvido pelo Expo; limpo depois que o recibo é conferido
+    ticket_id = models.CharField(max_length=64, blank=True, default='')
+    token_enviado = models.CharField(max_length=255, blank=True, default='')
+
+    def __str__(self):
+        return f"{self.evento} para {self.usuario.cpf} ({self.status})"
+
+    class Meta:
+        verbose_name = 'Notificação Push'
+        verbose_name_plural = 'Notificações Push'
+        constraints = [
+            models.UniqueConstraint(fields=['usuario', 'evento', 'corrida_id'], name='notificacao_push_unica'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'proxima_tentativa'], name='notificacao_push_fila_idx'),
+        ]
@@ -17,6 +17,7 @@ from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view, permission_classes
 import logging
 from django.utils.decorators import method_decorator
+from movex.push_services import cache_tokens_push
 
 logger = logging.getLogger(__name__)
 
@@ -357,6 +358,7 @@ class SalvarTokenPushView(APIView):
         if serializer.is_valid():
             try:
                 token_push = serializer.save()
+                cache_tokens_push.invalidar(token_push.usuario.cpf)
                 logger.info(f"Token push salvo para usuário {token_push.usuario.cpf}")
                 return Response(
                     {"success": True, "message": "Token push salvo com sucesso"},
@@ -2,33 +2,63 @@ import logging
 import time
 from collections import defaultdict
 
+from movex.connection_registry import obter_registro_conexoes
+
+from .settings import MAX_CONNECTIONS_PER_CLIENT
+
 logger = logging.getLogger(__name__)
 
 class WebSocketConnectionManager:
     """
-    Manager class to track and limit WebSocket connections
+    Manager class to track and limit WebSocket connections.
+    Connections are kept in the registry shared by all workers
+    (movex.connection_registry); only status throttling is local.
     """
+    # Own namespace in the shared registry: this client limit must not evict
+    # movex.consumers connections registered under the same cpf
+    REGISTRY_PREFIX = 'legacy:'
+
     def __init__(self):
-        self.active_connections = {}
-        self.connection_counts = defaultdict(int)
         self.last_status_update = defaultdict(float)
         self.STATUS_UPDATE_THROTTLE = 10  # seconds between status updates
 
-    def register_connection(self, client_id, channel_name):
-        """Register a new connection for a client"""
-        if client_id in self.active_connections:
-            # Client already has a connection, close old one before registering new
-            logger.warning(f"Client {client_id} already has an active connection. Replacing.")
-        
-        self.active_connections[client_id] = channel_name
-        self.connection_counts[client_id] += 1
-        logger.info(f"Client {client_id} connected. Total connections: {len(self.active_connections)}")
+    def registry_key(self, client_id):
+        return f"{self.REGISTRY_PREFIX}{client_id}"
+
+    def replacement_group(self, client_id):
+        """Per-client group used to close evicted connections on any worker"""
+        return f"legacy_conexoes_{client_id}"
+
+    async def register_connection(self, client_id, channel_name, channel_layer):
+        """
+        Register a new connection for a client. Its oldest connections over the
+        limit are told to close through the client's replacement group.
+        """
+        await channel_layer.group_add(self.replacement_group(client_id), channel_name)
+        registro = obter_registro_conexoes()
+        evicted = await registro.registrar(
+            self.registry_key(client_id), channel_name, channel_name, MAX_CONNECTIONS_PER_CLIENT
+        )
+        replaced = [connection_id for connection_id, _ in evicted if connection_id != channel_name]
+        for connection_id in replaced:
+            logger.warning(f"Client {client_id} over the connection limit. Replacing {connection_id}.")
+        if replaced:
+            await channel_layer.group_send(
+                self.replacement_group(client_id),
+                {'type': 'connection_replaced', 'connections': replaced}
+            )
+        logger.info(f"Client {client_id} connected. Connections: {await registro.conexoes_usuario(self.registry_key(client_id))}")
+        return evicted
+
+    async def renew_connection(self, client_id, channel_name):
+        """Renew the connection's TTL. Returns False if it is no longer registered"""
+        return await obter_registro_conexoes().renovar(self.registry_key(client_id), channel_name)
 
-    def unregister_connection(self, client_id):
+    async def unregister_connection(self, client_id, channel_name, channel_layer):
         """Unregister a client connection"""
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
-            logger.info(f"Client {client_id} disconnected. Remaining connections: {len(self.active_connections)}")
+        await channel_layer.group_discard(self.replacement_group(client_id), channel_name)
+        await obter_registro_conexoes().remover(self.registry_key(client_id), channel_name)
+        logger.info(f"Client {client_id} disconnected.")
     
     def can_update_status(self, client_id):
         """Check if client can update status (throttling)"""
@@ -43,15 +73,16 @@ class WebSocketConnectionManager:
         self.last_status_update[client_id] = now
         return True
     
-    def get_connection_count(self):
+    async def get_connection_count(self):
         """Return the total number of active connections"""
-        return len(self.active_connections)
+        return sum((await obter_registro_conexoes().conexoes_por_worker()).values())
     
-    def get_client_connections(self):
+    async def get_client_connections(self):
         """Return connection statistics"""
+        per_worker = await obter_registro_conexoes().conexoes_por_worker()
         return {
-            'total': len(self.active_connections),
-            'per_client': dict(self.connection_counts)
+            'total': sum(per_worker.values()),
+            'per_worker': per_worker
         }
 
 # Singleton instance
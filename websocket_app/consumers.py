@@ -1,8 +1,11 @@
 import json
 import logging
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
+from movex.connection_registry import obter_registro_conexoes
+
 from .connection_manager import connection_manager
 
 # Import the necessary models
@@ -16,15 +19,40 @@ class MoveXConsumer(AsyncWebsocketConsumer):
         # Accept the connection
         await self.accept()
         self.client_id = None
+        self.replaced = False
+        self.last_renewal = 0.0
         logger.info("New WebSocket connection accepted")
 
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection"""
         if self.client_id:
             # Unregister the connection when client disconnects
-            connection_manager.unregister_connection(self.client_id)
+            await connection_manager.unregister_connection(self.client_id, self.channel_name, self.channel_layer)
             logger.info(f"WebSocket disconnected (code: {close_code}): {self.client_id}")
 
+    async def register(self):
+        """Register this connection, closing the client's oldest ones over the limit"""
+        await connection_manager.register_connection(self.client_id, self.channel_name, self.channel_layer)
+        self.last_renewal = time.monotonic()
+
+    async def renew(self):
+        """Keep the registry entry alive, at most once per third of its TTL"""
+        if not self.client_id or self.replaced:
+            return
+        if time.monotonic() - self.last_renewal < obter_registro_conexoes().ttl / 3:
+            return
+        self.last_renewal = time.monotonic()
+        if not await connection_manager.renew_connection(self.client_id, self.channel_name):
+            # Entry expired: register again so the connection counts toward the limit
+            await self.register()
+
+    async def connection_replaced(self, event):
+        """Close this connection when a newer one of the same client evicted it"""
+        if self.channel_name in event['connections']:
+            self.replaced = True
+            logger.warning(f"Connection of {self.client_id} replaced by a newer one")
+            await self.close(code=4001)
+
     @database_sync_to_async
     def update_driver_status_in_db(self, driver_id, new_status):
         """Update the driver's status in the database"""
@@ -113,6 +141,9 @@ class MoveXConsumer(AsyncWebsocketConsumer):
             data = json.loads(text_data)
             message_type = data.get('type')
 
+            # Keep this connection alive in the shared registry
+            await self.renew()
+
             # Log incoming message
             if message_type != 'ping':
                 logger.debug(f"Received {message_type} message: {text_data}")
@@ -129,7 +160,7 @@ class MoveXConsumer(AsyncWebsocketConsumer):
                 self.client_id = data.get('cpf')
                 if self.client_id:
                     # Register this connection
-                    connection_manager.register_connection(self.client_id, self.channel_name)
+                    await self.register()
                     
                     # If client requested current status, fetch it
                     response = {
@@ -161,7 +192,7 @@ class MoveXConsumer(AsyncWebsocketConsumer):
                 
                 if not self.client_id:
                     self.client_id = driver_id
-                    connection_manager.register_connection(self.client_id, self.channel_name)
+                    await self.register()
 
                 # Process status update regardless of throttling
                 success, error_message = await self.update_driver_status_in_db(driver_id, new_status)